@@ -10,6 +10,10 @@ import time
 import os
 import zipfile
 import sys
+import glob
+import shutil
+import tempfile
+import subprocess
 from datetime import datetime, timedelta
 from botocore.exceptions import ClientError
 
@@ -20,6 +24,7 @@ lambda_client = boto3.client('lambda')
 bedrock_agent = boto3.client('bedrock-agent')
 bedrock_runtime = boto3.client('bedrock-agent-runtime')
 sts = boto3.client('sts')
+dynamodb = boto3.client('dynamodb')
 
 # Get account info
 account_id = sts.get_caller_identity()['Account']
@@ -27,6 +32,51 @@ region = boto3.Session().region_name or 'us-east-1'
 
 # Global configuration
 LAMBDA_DIR = "lambda_functions"
+LAMBDA_RUNTIME = "python3.9"
+LAYER_NAME = "finops-dependencies"
+STATE_TABLE = "finops-state"
+
+def write_lambda_source(filename, code):
+    """Write a bootstrap Lambda module, keeping a maintained copy that is already on disk"""
+    path = os.path.join(LAMBDA_DIR, filename)
+    if os.path.exists(path):
+        return
+    with open(path, 'w') as f:
+        f.write(code)
+
+def create_dependency_layer(bucket_name):
+    """Build the third-party packages in lambda_functions/requirements.txt into a Lambda layer"""
+    print("Creating dependency layer...")
+    
+    build_dir = tempfile.mkdtemp()
+    try:
+        # Lambda layers expose python/ on sys.path; install Linux wheels matching the function runtime
+        subprocess.run([
+            sys.executable, '-m', 'pip', 'install',
+            '-r', os.path.join(LAMBDA_DIR, 'requirements.txt'),
+            '-t', os.path.join(build_dir, 'python'),
+            '--platform', 'manylinux2014_x86_64',
+            '--python-version', LAMBDA_RUNTIME.replace('python', ''),
+            '--only-binary=:all:', '--quiet'
+        ], check=True)
+        
+        zip_filename = f'{LAYER_NAME}.zip'
+        shutil.make_archive(LAYER_NAME, 'zip', build_dir)
+    finally:
+        shutil.rmtree(build_dir, ignore_errors=True)
+    
+    s3_key = f"lambda-layers/{zip_filename}"
+    s3.upload_file(zip_filename, bucket_name, s3_key)
+    os.remove(zip_filename)
+    
+    response = lambda_client.publish_layer_version(
+        LayerName=LAYER_NAME,
+        Description='Third-party packages for the FinOps Lambda functions',
+        Content={'S3Bucket': bucket_name, 'S3Key': s3_key},
+        CompatibleRuntimes=[LAMBDA_RUNTIME]
+    )
+    print(f"Published layer: {response['LayerVersionArn']}")
+    return response['LayerVersionArn']
 
 def create_iam_roles():
     """Create necessary IAM roles for Bedrock and Lambda"""
@@ -136,10 +186,73 @@ def create_iam_roles():
         except:
             pass
     
+    # Job checkpoints and result pages live in the shared state table, with
+    # oversized values spilled to the deployment bucket; job workers re-invoke their own function
+    state_policy = {
+        "Version": "2012-10-17",
+        "Statement": [
+            {
+                "Effect": "Allow",
+                "Action": [
+                    "dynamodb:GetItem",
+                    "dynamodb:PutItem"
+                ],
+                "Resource": f"arn:aws:dynamodb:{region}:{account_id}:table/{STATE_TABLE}"
+            },
+            {
+                "Effect": "Allow",
+                "Action": [
+                    "s3:GetObject",
+                    "s3:PutObject"
+                ],
+                "Resource": f"arn:aws:s3:::finops-bedrock-{account_id}-*/finops-state/*"
+            },
+            {
+                "Effect": "Allow",
+                "Action": [
+                    "lambda:InvokeFunction"
+                ],
+                "Resource": f"arn:aws:lambda:{region}:{account_id}:function:finops-*"
+            }
+        ]
+    }
+    
+    try:
+        iam.put_role_policy(
+            RoleName='FinOpsLambdaExecutionRole',
+            PolicyName='FinOpsStatePolicy',
+            PolicyDocument=json.dumps(state_policy)
+        )
+    except:
+        pass
+    
     # Wait for roles to propagate
     time.sleep(10)
     return True
 
+def create_state_table():
+    """Create the DynamoDB table shared by every Lambda container for jobs and result pages"""
+    print(f"Creating state table: {STATE_TABLE}")
+    
+    try:
+        dynamodb.create_table(
+            TableName=STATE_TABLE,
+            AttributeDefinitions=[{'AttributeName': 'cache_key', 'AttributeType': 'S'}],
+            KeySchema=[{'AttributeName': 'cache_key', 'KeyType': 'HASH'}],
+            BillingMode='PAY_PER_REQUEST'
+        )
+        dynamodb.get_waiter('table_exists').wait(TableName=STATE_TABLE)
+        dynamodb.update_time_to_live(
+            TableName=STATE_TABLE,
+            TimeToLiveSpecification={'Enabled': True, 'AttributeName': 'expires_at'}
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ResourceInUseException':
+            print("State table already exists")
+        else:
+            raise
+    return STATE_TABLE
+
 def create_s3_bucket():
     """Create S3 bucket for deployment artifacts"""
     bucket_name = f"finops-bedrock-{account_id}-{int(time.time())}"
@@ -392,8 +505,7 @@ def identify_cost_anomalies(params):
 '''
     
     # Write Lambda function
-    with open(os.path.join(LAMBDA_DIR, 'cost_analysis_lambda.py'), 'w') as f:
-        f.write(cost_analysis_code)
+    write_lambda_source('cost_analysis_lambda.py', cost_analysis_code)
     
     # Optimization Lambda
     optimization_code = '''import json
@@ -612,8 +724,7 @@ def identify_idle_resources(params):
     }
 '''
     
-    with open(os.path.join(LAMBDA_DIR, 'optimization_lambda.py'), 'w') as f:
-        f.write(optimization_code)
+    write_lambda_source('optimization_lambda.py', optimization_code)
     
     # Forecasting Lambda
     forecasting_code = '''import json
@@ -788,11 +899,21 @@ def analyze_growth_trends(params):
         return {'error': f'Failed to analyze growth trends: {str(e)}'}
 '''
     
-    with open(os.path.join(LAMBDA_DIR, 'forecasting_lambda.py'), 'w') as f:
-        f.write(forecasting_code)
+    write_lambda_source('forecasting_lambda.py', forecasting_code)
     
     # Package and deploy Lambda functions
     deployed_functions = {}
+    layer_arn = create_dependency_layer(bucket_name)
+    state_table = create_state_table()
+    environment = {
+        'Variables': {
+            'JOB_STORE_BACKEND': 'dynamodb',
+            'JOB_TABLE': state_table,
+            'STATE_SPILL_BUCKET': bucket_name
+        }
+    }
+    # Every function ships all modules so shared helpers import the same way in each of them
+    modules = sorted(glob.glob(os.path.join(LAMBDA_DIR, '*.py')))
     
     lambda_configs = [
         {
@@ -816,7 +937,8 @@ def analyze_growth_trends(params):
         # Create zip file
         zip_filename = f'{config["name"]}.zip'
         with zipfile.ZipFile(zip_filename, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            zipf.write(os.path.join(LAMBDA_DIR, config['file']), config['file'])
+            for module in modules:
+                zipf.write(module, os.path.basename(module))
         
         # Upload to S3
         s3_key = f"lambda-functions/{zip_filename}"
@@ -826,7 +948,7 @@ def analyze_growth_trends(params):
         try:
             response = lambda_client.create_function(
                 FunctionName=config['name'],
-                Runtime='python3.9',
+                Runtime=LAMBDA_RUNTIME,
                 Role=f"arn:aws:iam::{account_id}:role/FinOpsLambdaExecutionRole",
                 Handler=config['handler'],
                 Code={
@@ -834,7 +956,9 @@ def analyze_growth_trends(params):
                     'S3Key': s3_key
                 },
                 Timeout=60,
-                MemorySize=256
+                MemorySize=256,
+                Layers=[layer_arn],
+                Environment=environment
             )
             deployed_functions[config['name']] = response['FunctionArn']
             print(f"Deployed Lambda: {config['name']}")
@@ -846,6 +970,12 @@ def analyze_growth_trends(params):
                     S3Bucket=bucket_name,
                     S3Key=s3_key
                 )
+                lambda_client.get_waiter('function_updated').wait(FunctionName=config['name'])
+                lambda_client.update_function_configuration(
+                    FunctionName=config['name'],
+                    Layers=[layer_arn],
+                    Environment=environment
+                )
                 deployed_functions[config['name']] = response['FunctionArn']
                 print(f"Updated Lambda: {config['name']}")
             else:
@@ -9,6 +9,7 @@ set -e
 CONFIG_FILE="config.json"
 TEMPLATE_DIR="cloudformation/templates"
 LAMBDA_DIR="../lambda-functions"
+LAMBDA_RUNTIME_VERSION="3.11"
 FRONTEND_DIR="../frontend"
 PACKAGE_DIR="package"
 
@@ -91,16 +92,21 @@ package_lambda_functions() {
     # Package each Lambda function
     for lambda_file in "$LAMBDA_DIR"/*.py; do
         local lambda_name=$(basename "$lambda_file" .py)
+        if [ "$lambda_name" == "__init__" ]; then
+            continue
+        fi
         print_message "${YELLOW}" "Packaging $lambda_name..."
         
-        # Create a zip file for the Lambda function
-        cp "$lambda_file" "$temp_dir/lambda_function.py"
-        cd "$temp_dir"
-        zip -q "$lambda_name.zip" lambda_function.py
-        cd - > /dev/null
+        # Every function ships all agent modules, so the orchestrator can run agents in-process;
+        # the handler is reachable both as <module>.lambda_handler and lambda_function.lambda_handler
+        local function_dir="$temp_dir/$lambda_name"
+        mkdir -p "$function_dir"
+        cp "$LAMBDA_DIR"/*.py "$function_dir/"
+        cp "$lambda_file" "$function_dir/lambda_function.py"
+        (cd "$function_dir" && zip -q "$lambda_name.zip" *.py)
         
         # Move the zip file to the package directory
-        mv "$temp_dir/$lambda_name.zip" "$PACKAGE_DIR/$lambda_name.zip"
+        mv "$function_dir/$lambda_name.zip" "$PACKAGE_DIR/$lambda_name.zip"
     done
     
     # Clean up
@@ -109,6 +115,29 @@ package_lambda_functions() {
     print_message "${GREEN}" "Lambda functions packaged successfully."
 }
 
+# Function to build the dependencies layer (NumPy and friends) for the Lambda runtime
+package_dependency_layer() {
+    print_message "${BLUE}" "Building dependencies layer..."
+    
+    local temp_dir=$(mktemp -d)
+    
+    # Wheels for Amazon Linux, whatever platform the deployment runs on
+    python3 -m pip install -q \
+        -r "$LAMBDA_DIR/requirements.txt" \
+        --target "$temp_dir/python" \
+        --platform manylinux2014_x86_64 \
+        --implementation cp \
+        --python-version "$LAMBDA_RUNTIME_VERSION" \
+        --only-binary=:all: || print_error_and_exit "Failed to build the dependencies layer."
+    
+    (cd "$temp_dir" && zip -q -r dependencies_layer.zip python)
+    mv "$temp_dir/dependencies_layer.zip" "$PACKAGE_DIR/dependencies_layer.zip"
+    
+    rm -rf "$temp_dir"
+    
+    print_message "${GREEN}" "Dependencies layer built successfully."
+}
+
 # Function to upload Lambda packages to S3
 upload_lambda_packages() {
     local bucket_name=$1
@@ -215,6 +244,7 @@ main() {
     check_command "aws"
     check_command "jq"
     check_command "zip"
+    check_command "python3"
     check_aws_cli
     check_config_file
     
@@ -226,8 +256,9 @@ main() {
     # Create package directory
     create_package_dir
     
-    # Package Lambda functions
+    # Package Lambda functions and their dependencies layer
     package_lambda_functions
+    package_dependency_layer
     
     # Upload Lambda packages to S3
     local bucket_name="finops-copilot-assets-$environment-$(aws sts get-caller-identity --query "Account" --output text)"
@@ -1,54 +1,146 @@
+import os
 import json
 import boto3
 import logging
-from datetime import datetime, timedelta
+import warnings
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
 from typing import Dict, List, Any
 
 # Configure logging
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+# Rightsizing flags instances whose CPU statistic is below the first threshold (high priority below the
+# second). 'p95' sizes on regular peaks and skips memory-bound instances; 'avg' is the older rule, which
+# also flags instances that idle on average but peak regularly.
+RIGHTSIZING_CPU_THRESHOLDS = {
+    'avg': (20, 10),
+    'p95': (40, 20)
+}
+RIGHTSIZING_CPU_STATISTIC = os.environ.get('RIGHTSIZING_CPU_STATISTIC', 'p95')
+if RIGHTSIZING_CPU_STATISTIC not in RIGHTSIZING_CPU_THRESHOLDS:
+    logger.warning(
+        f"Unsupported RIGHTSIZING_CPU_STATISTIC {RIGHTSIZING_CPU_STATISTIC!r}; "
+        f"expected one of {sorted(RIGHTSIZING_CPU_THRESHOLDS)}, using 'p95'"
+    )
+    RIGHTSIZING_CPU_STATISTIC = 'p95'
+RIGHTSIZING_MEMORY_BOUND_P95 = 60
+
+# GetMetricData accepts at most 500 queries per request
+METRIC_QUERIES_PER_REQUEST = 500
+
+# An instance-id filter takes at most 200 values; chunks are described concurrently
+DESCRIBE_CHUNK_SIZE = 200
+DESCRIBE_WORKERS = 8
+
+# (key, metric name, statistic) pulled hourly from AWS/EC2 for every instance
+EC2_UTILIZATION_METRICS = [
+    ('cpu_avg', 'CPUUtilization', 'Average'),
+    ('cpu_max', 'CPUUtilization', 'Maximum'),
+    ('net_in', 'NetworkIn', 'Sum'),
+    ('net_out', 'NetworkOut', 'Sum'),
+    ('disk_read', 'DiskReadOps', 'Sum'),
+    ('disk_write', 'DiskWriteOps', 'Sum')
+]
+
+class UtilizationMatrix:
+    """Hourly metric values held as a (metric, instance, hour) float32 array, NaN where missing"""
+    
+    def __init__(self, metric_keys: List[str], instance_ids: List[str], start_time: datetime, hours: int):
+        self.metric_index = {key: i for i, key in enumerate(metric_keys)}
+        self.instance_index = {instance_id: i for i, instance_id in enumerate(instance_ids)}
+        self.instance_ids = list(instance_ids)
+        # Naive datetimes here are UTC (utcnow, CloudWatch); timestamp() would read them as local time
+        if start_time.tzinfo is None:
+            start_time = start_time.replace(tzinfo=timezone.utc)
+        self.start_epoch = start_time.timestamp()
+        self.values = np.full((len(metric_keys), len(instance_ids), hours), np.nan, dtype=np.float32)
+    
+    def add_series(self, metric_key: str, instance_id: str, timestamps: List[datetime], values: List[float]):
+        """Place a metric series into its row, aligning timestamps to hour slots"""
+        if not timestamps:
+            return
+        hours = self.values.shape[2]
+        epochs = np.fromiter((ts.timestamp() for ts in timestamps), dtype=np.float64, count=len(timestamps))
+        slots = ((epochs - self.start_epoch) // 3600).astype(np.int64)
+        in_range = (slots >= 0) & (slots < hours)
+        row = self.values[self.metric_index[metric_key], self.instance_index[instance_id]]
+        row[slots[in_range]] = np.asarray(values, dtype=np.float32)[in_range]
+    
+    def set_row(self, metric_key: str, instance_id: str, values: List[Any]):
+        """Place an already hour-aligned series (None where missing) into its row"""
+        hours = self.values.shape[2]
+        row = np.array(values[:hours], dtype=np.float64)
+        self.values[self.metric_index[metric_key], self.instance_index[instance_id], :len(row)] = row
+    
+    def has_data(self, metric_key: str) -> bool:
+        return bool(np.isfinite(self.values[self.metric_index[metric_key]]).any())
+    
+    def summarize(self, metric_key: str) -> Dict[str, np.ndarray]:
+        """Per-instance count, mean, p50, p95 and max for one metric, computed across the whole fleet at once"""
+        data = self.values[self.metric_index[metric_key]]
+        counts = np.isfinite(data).sum(axis=1)
+        with warnings.catch_warnings():
+            # Instances without datapoints yield all-NaN rows; they are zeroed below
+            warnings.simplefilter('ignore', category=RuntimeWarning)
+            mean = np.nanmean(data, axis=1)
+            p50, p95 = np.nanpercentile(data, [50, 95], axis=1)
+            maximum = np.nanmax(data, axis=1)
+        return {
+            'count': counts,
+            'mean': np.nan_to_num(mean),
+            'p50': np.nan_to_num(p50),
+            'p95': np.nan_to_num(p95),
+            'max': np.nan_to_num(maximum)
+        }
+
+EC2_COST_SERVICE = 'Amazon Elastic Compute Cloud - Compute'
+
 class EC2CostAnalyzer:
-    def __init__(self):
+    def __init__(self, shared_data: Dict[str, Any] = None):
         self.ec2_client = boto3.client('ec2')
         self.cloudwatch_client = boto3.client('cloudwatch')
         self.cost_explorer_client = boto3.client('ce')
+        # Inputs the orchestrator prefetched once for every agent in its plan
+        self.shared_data = shared_data or {}
+        # Instance details described during this invocation, keyed by instance ID
+        self.instance_map: Dict[str, Dict[str, Any]] = dict(self.shared_data.get('ec2_instances', {}))
         
     def analyze_instance_utilization(self, instance_ids: List[str], days: int = 30) -> Dict[str, Any]:
         """Analyze EC2 instance utilization over the specified period"""
         try:
-            end_time = datetime.utcnow()
+            if not instance_ids:
+                return {}
+            
+            end_time = datetime.utcnow().replace(minute=0, second=0, microsecond=0)
             start_time = end_time - timedelta(days=days)
             
-            utilization_data = {}
+            matrix = self.collect_utilization_matrix(instance_ids, start_time, end_time)
+            cpu = matrix.summarize('cpu_avg')
+            cpu_max = matrix.summarize('cpu_max')
+            net_in = matrix.summarize('net_in')
+            net_out = matrix.summarize('net_out')
+            disk_ops = matrix.summarize('disk_read')['p95'] + matrix.summarize('disk_write')['p95']
+            memory = matrix.summarize('memory') if matrix.has_data('memory') else None
             
-            for instance_id in instance_ids:
-                # Get CPU utilization metrics
-                cpu_response = self.cloudwatch_client.get_metric_statistics(
-                    Namespace='AWS/EC2',
-                    MetricName='CPUUtilization',
-                    Dimensions=[
-                        {
-                            'Name': 'InstanceId',
-                            'Value': instance_id
-                        }
-                    ],
-                    StartTime=start_time,
-                    EndTime=end_time,
-                    Period=3600,  # 1 hour periods
-                    Statistics=['Average', 'Maximum']
-                )
-                
-                # Calculate average CPU utilization
-                cpu_values = [point['Average'] for point in cpu_response['Datapoints']]
-                avg_cpu = sum(cpu_values) / len(cpu_values) if cpu_values else 0
-                max_cpu = max([point['Maximum'] for point in cpu_response['Datapoints']]) if cpu_response['Datapoints'] else 0
-                
+            utilization_data = {}
+            for i, instance_id in enumerate(matrix.instance_ids):
                 utilization_data[instance_id] = {
-                    'avg_cpu': avg_cpu,
-                    'max_cpu': max_cpu,
-                    'data_points': len(cpu_values)
+                    'avg_cpu': round(float(cpu['mean'][i]), 2),
+                    'max_cpu': round(float(cpu_max['max'][i]), 2),
+                    'p50_cpu': round(float(cpu['p50'][i]), 2),
+                    'p95_cpu': round(float(cpu['p95'][i]), 2),
+                    'p95_network_in_bytes': float(net_in['p95'][i]),
+                    'p95_network_out_bytes': float(net_out['p95'][i]),
+                    'p95_disk_ops': float(disk_ops[i]),
+                    'data_points': int(cpu['count'][i])
                 }
+                if memory is not None and memory['count'][i] > 0:
+                    utilization_data[instance_id]['avg_memory'] = round(float(memory['mean'][i]), 2)
+                    utilization_data[instance_id]['p95_memory'] = round(float(memory['p95'][i]), 2)
             
             return utilization_data
             
@@ -56,34 +148,157 @@ class EC2CostAnalyzer:
             logger.error(f"Error analyzing instance utilization: {str(e)}")
             return {}
     
+    def collect_utilization_matrix(self, instance_ids: List[str], start_time: datetime, 
+                                   end_time: datetime) -> UtilizationMatrix:
+        """Pull hourly CPU, network, disk and CWAgent memory for all instances via batched GetMetricData"""
+        hours = int((end_time - start_time).total_seconds() // 3600)
+        metric_keys = [key for key, _, _ in EC2_UTILIZATION_METRICS] + ['memory']
+        
+        shared = self.shared_data.get('metrics')
+        if shared and shared['days'] * 24 == hours and set(instance_ids) <= set(shared['series']):
+            matrix = UtilizationMatrix(metric_keys, instance_ids, datetime.fromisoformat(shared['start']), hours)
+            sources = [(key, f'{metric_name}/{stat}') for key, metric_name, stat in EC2_UTILIZATION_METRICS]
+            sources.append(('memory', 'mem_used_percent/Average'))
+            for instance_id in instance_ids:
+                for key, source in sources:
+                    if source in shared['series'][instance_id]:
+                        matrix.set_row(key, instance_id, shared['series'][instance_id][source])
+            return matrix
+        
+        matrix = UtilizationMatrix(metric_keys, instance_ids, start_time, hours)
+        
+        queries = []
+        query_targets = {}
+        for index, instance_id in enumerate(instance_ids):
+            for key, metric_name, stat in EC2_UTILIZATION_METRICS:
+                query_id = f'{key}_{index}'
+                query_targets[query_id] = (key, instance_id)
+                queries.append({
+                    'Id': query_id,
+                    'MetricStat': {
+                        'Metric': {
+                            'Namespace': 'AWS/EC2',
+                            'MetricName': metric_name,
+                            'Dimensions': [{'Name': 'InstanceId', 'Value': instance_id}]
+                        },
+                        'Period': 3600,
+                        'Stat': stat
+                    },
+                    'ReturnData': True
+                })
+        
+        # Memory only exists where the CloudWatch agent runs, under varying dimension sets,
+        # so a single fleet-wide search labelled by InstanceId covers it
+        memory_query = {
+            'Id': 'memory_search',
+            'Expression': "SEARCH('Namespace=\"CWAgent\" MetricName=\"mem_used_percent\"', 'Average', 3600)",
+            'Label': "${PROP('Dim.InstanceId')}",
+            'ReturnData': True
+        }
+        
+        chunks = [
+            queries[i:i + METRIC_QUERIES_PER_REQUEST - 1]
+            for i in range(0, len(queries), METRIC_QUERIES_PER_REQUEST - 1)
+        ]
+        chunks[0] = chunks[0] + [memory_query]
+        
+        paginator = self.cloudwatch_client.get_paginator('get_metric_data')
+        for chunk in chunks:
+            for page in paginator.paginate(
+                MetricDataQueries=chunk,
+                StartTime=start_time,
+                EndTime=end_time
+            ):
+                for result in page['MetricDataResults']:
+                    if result['Id'].startswith('memory_search'):
+                        if result.get('Label') in matrix.instance_index:
+                            matrix.add_series('memory', result['Label'], result['Timestamps'], result['Values'])
+                    elif result['Id'] in query_targets:
+                        key, instance_id = query_targets[result['Id']]
+                        matrix.add_series(key, instance_id, result['Timestamps'], result['Values'])
+        
+        return matrix
+    
     def get_instance_details(self, instance_ids: List[str]) -> Dict[str, Any]:
         """Get detailed information about EC2 instances"""
         try:
-            response = self.ec2_client.describe_instances(InstanceIds=instance_ids)
+            missing_ids = [i for i in dict.fromkeys(instance_ids) if i not in self.instance_map]
+            chunks = [
+                missing_ids[i:i + DESCRIBE_CHUNK_SIZE]
+                for i in range(0, len(missing_ids), DESCRIBE_CHUNK_SIZE)
+            ]
             
-            instances_info = {}
-            for reservation in response['Reservations']:
-                for instance in reservation['Instances']:
-                    instance_id = instance['InstanceId']
-                    instances_info[instance_id] = {
-                        'instance_type': instance['InstanceType'],
-                        'state': instance['State']['Name'],
-                        'launch_time': instance['LaunchTime'].isoformat(),
-                        'availability_zone': instance['Placement']['AvailabilityZone'],
-                        'tags': {tag['Key']: tag['Value'] for tag in instance.get('Tags', [])},
-                        'vpc_id': instance.get('VpcId'),
-                        'subnet_id': instance.get('SubnetId')
-                    }
+            if chunks:
+                with ThreadPoolExecutor(max_workers=min(DESCRIBE_WORKERS, len(chunks))) as executor:
+                    for described in executor.map(self._describe_instance_chunk, chunks):
+                        self.instance_map.update(described)
+            
+            not_found = [i for i in missing_ids if i not in self.instance_map]
+            if not_found:
+                logger.warning(f"{len(not_found)} instance IDs were not found: {not_found[:10]}")
             
-            return instances_info
+            return {i: self.instance_map[i] for i in instance_ids if i in self.instance_map}
             
         except Exception as e:
             logger.error(f"Error getting instance details: {str(e)}")
             return {}
     
+    def get_running_instance_ids(self) -> List[str]:
+        """List running instances, recording their details in the instance map"""
+        if 'ec2_instances' in self.shared_data:
+            return list(self.shared_data['ec2_instances'])
+        
+        paginator = self.ec2_client.get_paginator('describe_instances')
+        instance_ids = []
+        for page in paginator.paginate(
+            Filters=[{'Name': 'instance-state-name', 'Values': ['running']}]
+        ):
+            for reservation in page['Reservations']:
+                for instance in reservation['Instances']:
+                    self.instance_map[instance['InstanceId']] = self._summarize_instance(instance)
+                    instance_ids.append(instance['InstanceId'])
+        return instance_ids
+    
+    def _describe_instance_chunk(self, instance_ids: List[str]) -> Dict[str, Any]:
+        """Describe one chunk of instances; a filter skips stale IDs instead of failing the call"""
+        paginator = self.ec2_client.get_paginator('describe_instances')
+        described = {}
+        for page in paginator.paginate(
+            Filters=[{'Name': 'instance-id', 'Values': instance_ids}]
+        ):
+            for reservation in page['Reservations']:
+                for instance in reservation['Instances']:
+                    described[instance['InstanceId']] = self._summarize_instance(instance)
+        return described
+    
+    @staticmethod
+    def _summarize_instance(instance: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            'instance_type': instance['InstanceType'],
+            'state': instance['State']['Name'],
+            'launch_time': instance['LaunchTime'].isoformat(),
+            'availability_zone': instance['Placement']['AvailabilityZone'],
+            'tags': {tag['Key']: tag['Value'] for tag in instance.get('Tags', [])},
+            'vpc_id': instance.get('VpcId'),
+            'subnet_id': instance.get('SubnetId')
+        }
+    
     def get_instance_costs(self, instance_ids: List[str], days: int = 30) -> Dict[str, Any]:
         """Get cost information for specific instances"""
         try:
+            cube = self.shared_data.get('cost_cube')
+            if cube and cube['days'] == days:
+                daily = defaultdict(float)
+                for date, service, _, amount in cube['rows']:
+                    if service == EC2_COST_SERVICE:
+                        daily[date] += amount
+                total_cost = sum(daily.values())
+                return {
+                    'total_cost': total_cost,
+                    'daily_costs': [{'date': date, 'cost': cost} for date, cost in sorted(daily.items())],
+                    'average_daily_cost': total_cost / days if days > 0 else 0
+                }
+            
             end_date = datetime.utcnow().date()
             start_date = end_date - timedelta(days=days)
             
@@ -104,7 +319,7 @@ class EC2CostAnalyzer:
                 Filter={
                     'Dimensions': {
                         'Key': 'SERVICE',
-                        'Values': ['Amazon Elastic Compute Cloud - Compute']
+                        'Values': [EC2_COST_SERVICE]
                     }
                 }
             )
@@ -131,25 +346,39 @@ class EC2CostAnalyzer:
             return {}
     
     def identify_optimization_opportunities(self, utilization_data: Dict[str, Any], 
-                                         instances_info: Dict[str, Any]) -> List[Dict[str, Any]]:
+                                         instances_info: Dict[str, Any] = None) -> List[Dict[str, Any]]:
         """Identify cost optimization opportunities based on utilization data"""
+        if instances_info is None:
+            instances_info = self.instance_map
         opportunities = []
         
         for instance_id, utilization in utilization_data.items():
             instance_info = instances_info.get(instance_id, {})
             instance_type = instance_info.get('instance_type', 'unknown')
             
-            # Check for underutilized instances (avg CPU < 20%)
-            if utilization['avg_cpu'] < 20:
-                opportunities.append({
+            # Check for underutilized instances on the configured CPU statistic; p95 falls back to
+            # the average when percentiles are unavailable
+            threshold, high_priority_below = RIGHTSIZING_CPU_THRESHOLDS[RIGHTSIZING_CPU_STATISTIC]
+            if RIGHTSIZING_CPU_STATISTIC == 'p95':
+                cpu = utilization.get('p95_cpu', utilization['avg_cpu'])
+                memory_bound = utilization.get('p95_memory', 0) > RIGHTSIZING_MEMORY_BOUND_P95
+            else:
+                cpu = utilization['avg_cpu']
+                memory_bound = False
+            if cpu < threshold and not memory_bound:
+                opportunity = {
                     'type': 'right_sizing',
                     'instance_id': instance_id,
                     'instance_type': instance_type,
                     'current_avg_cpu': utilization['avg_cpu'],
                     'recommendation': 'Consider downsizing to a smaller instance type',
-                    'priority': 'high' if utilization['avg_cpu'] < 10 else 'medium',
-                    'estimated_savings_percent': 30 if utilization['avg_cpu'] < 10 else 20
-                })
+                    'priority': 'high' if cpu < high_priority_below else 'medium',
+                    'estimated_savings_percent': 30 if cpu < high_priority_below else 20
+                }
+                if RIGHTSIZING_CPU_STATISTIC == 'p95':
+                    opportunity['p95_cpu'] = cpu
+                    opportunity['p95_memory'] = utilization.get('p95_memory')
+                opportunities.append(opportunity)
             
             # Check for idle instances (max CPU < 5% over the period)
             if utilization['max_cpu'] < 5:
@@ -185,7 +414,7 @@ def lambda_handler(event, context):
         logger.info(f"Received event: {json.dumps(event)}")
         
         # Initialize the analyzer
-        analyzer = EC2CostAnalyzer()
+        analyzer = EC2CostAnalyzer(event.get('shared_data'))
         
         # Extract parameters from the event
         action = event.get('action', 'analyze_all')
@@ -195,19 +424,7 @@ def lambda_handler(event, context):
         # If no specific instances provided, get all running instances
         if not instance_ids:
             try:
-                ec2_response = analyzer.ec2_client.describe_instances(
-                    Filters=[
-                        {
-                            'Name': 'instance-state-name',
-                            'Values': ['running']
-                        }
-                    ]
-                )
-                
-                instance_ids = []
-                for reservation in ec2_response['Reservations']:
-                    for instance in reservation['Instances']:
-                        instance_ids.append(instance['InstanceId'])
+                instance_ids = analyzer.get_running_instance_ids()
                         
             except Exception as e:
                 logger.error(f"Error getting running instances: {str(e)}")
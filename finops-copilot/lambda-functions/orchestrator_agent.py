@@ -1,15 +1,513 @@
 import json
+import os
+import time
+import uuid
 import boto3
+import heapq
+import queue
+import hashlib
+import importlib
+import threading
 import logging
-from datetime import datetime, timedelta
-from typing import Dict, List, Any
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Any, Optional, Callable, Iterator
 import asyncio
 import concurrent.futures
+from state_store import create_store, create_job_store, lease_job, requeue_job, expire_job
 
 # Configure logging
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+# Async job settings: agent invocations can run for minutes, so hand over early
+JOB_TTL_SECONDS = 86400
+JOB_MIN_REMAINING_MS = 120000
+
+# Synchronous fan-out: one deadline for the whole request, leaving room to synthesize afterwards
+ORCHESTRATOR_DEADLINE_SECONDS = float(os.environ.get('ORCHESTRATOR_DEADLINE_SECONDS', '25'))
+SYNTHESIS_RESERVE_SECONDS = 2
+MAX_AGENT_CONCURRENCY = int(os.environ.get('MAX_AGENT_CONCURRENCY', '16'))
+
+# Per-agent timeouts and scheduling priorities (lower is scheduled and reported first)
+DEFAULT_AGENT_TIMEOUT_SECONDS = 20
+AGENT_TIMEOUT_SECONDS = {
+    'ec2_agent': 20,
+    's3_agent': 20,
+    'rds_agent': 15,
+    'ri_sp_agent': 20,
+    'tagging_agent': 20,
+    'apptio_integration': 15
+}
+AGENT_PRIORITIES = {
+    'ec2_agent': 0,
+    'ri_sp_agent': 0,
+    'rds_agent': 1,
+    's3_agent': 1,
+    'tagging_agent': 2,
+    'apptio_integration': 3
+}
+
+# Agents with a long latency tail get a second, hedged invocation once the first runs this long
+AGENT_HEDGE_AFTER_SECONDS = {
+    's3_agent': 8,
+    'tagging_agent': 8
+}
+
+# Recommendations kept by the synthesizer, as a running top-K while agent results stream in
+SYNTHESIS_TOP_K = 10
+
+# In-process execution: the module each agent's lambda_handler lives in, for AGENT_EXECUTOR=inprocess
+AGENT_MODULES = {
+    'ec2_agent': 'ec2_agent',
+    's3_agent': 's3_agent',
+    'rds_agent': 'rds_agent',
+    'ri_sp_agent': 'ri_sp_agent',
+    'tagging_agent': 'tagging_agent',
+    'apptio_integration': 'apptio_integration'
+}
+
+# Merge index: recommendation types mapped to the action they propose on a resource, and the actions
+# that make others on the same resource moot (stopping an instance subsumes rightsizing it). Each agent
+# covers its own resources, so merges happen within one agent's results; the tagging agent's
+# recommendations are estate-wide aggregates without a resource and are kept as they are.
+RECOMMENDATION_ACTIONS = {
+    'idle_instance': 'stop',
+    'right_sizing': 'rightsize',
+    'burstable_instance': 'rightsize',
+    'multi_az_optimization': 'reduce_redundancy',
+    'backup_optimization': 'reduce_backups',
+    'storage_class_optimization': 'tier_storage',
+    'lifecycle_policy': 'tier_storage',
+    'version_management': 'expire_versions',
+    'multipart_cleanup': 'cleanup_uploads',
+    'tagging_compliance': 'tag'
+}
+ACTION_SUBSUMES = {
+    'stop': {'rightsize', 'reduce_redundancy', 'reduce_backups'}
+}
+# Fields naming the resource a recommendation targets, and the service of bare IDs per agent
+RESOURCE_ID_FIELDS = ['resource_arn', 'resource', 'instance_id', 'db_instance_identifier', 'bucket_name']
+AGENT_RESOURCE_SERVICES = {
+    'ec2_agent': 'ec2',
+    'rds_agent': 'rds',
+    's3_agent': 's3'
+}
+
+# Result cache: an agent's result is reused until its source data can have changed, i.e. for
+# roughly the latency at which that source refreshes (CloudWatch hourly, Cost Explorer a few times a day)
+AGENT_RESULT_TTL_SECONDS = {
+    'ec2_agent': 3600,
+    'rds_agent': 3600,
+    's3_agent': 21600,
+    'ri_sp_agent': 21600,
+    'tagging_agent': 3600,
+    'apptio_integration': 86400
+}
+DEFAULT_AGENT_RESULT_TTL_SECONDS = 3600
+
+# Inputs several agents would otherwise fetch on their own: what each depends on and who consumes it.
+# An input is prefetched once when two or more planned agents consume it, or a prefetched input needs it.
+SHARED_INPUT_GRAPH = {
+    'cost_cube': {'depends_on': [], 'consumers': ['ec2_agent', 'rds_agent', 's3_agent']},
+    'ec2_instances': {'depends_on': [], 'consumers': ['ec2_agent']},
+    'rds_instances': {'depends_on': [], 'consumers': ['rds_agent']},
+    'metrics': {'depends_on': ['ec2_instances', 'rds_instances'], 'consumers': ['ec2_agent', 'rds_agent']}
+}
+
+# Cost Explorer service name whose daily cost each agent reads from the shared cost cube
+AGENT_COST_SERVICES = {
+    'ec2_agent': 'Amazon Elastic Compute Cloud - Compute',
+    'rds_agent': 'Amazon Relational Database Service',
+    's3_agent': 'Amazon Simple Storage Service'
+}
+
+# Hourly metrics each agent reads, fetched for both fleets in shared GetMetricData requests
+SHARED_METRICS = {
+    'ec2_agent': {
+        'inventory': 'ec2_instances',
+        'namespace': 'AWS/EC2',
+        'dimension': 'InstanceId',
+        'metrics': [('CPUUtilization', 'Average'), ('CPUUtilization', 'Maximum'), ('NetworkIn', 'Sum'),
+                    ('NetworkOut', 'Sum'), ('DiskReadOps', 'Sum'), ('DiskWriteOps', 'Sum')]
+    },
+    'rds_agent': {
+        'inventory': 'rds_instances',
+        'namespace': 'AWS/RDS',
+        'dimension': 'DBInstanceIdentifier',
+        'metrics': [('CPUUtilization', 'Average'), ('CPUUtilization', 'Maximum'),
+                    ('DatabaseConnections', 'Average'), ('DatabaseConnections', 'Maximum'),
+                    ('ReadIOPS', 'Average'), ('WriteIOPS', 'Average'), ('FreeStorageSpace', 'Minimum')]
+    }
+}
+METRIC_QUERIES_PER_REQUEST = 500
+# Upper bound on Cost Explorer pages read for the cost cube; a repeated page token also ends the read
+COST_CUBE_MAX_PAGES = 50
+# Synchronous invocations carry at most 6 MB; above this many datapoints agents fetch their own metrics
+SHARED_METRIC_POINTS_LIMIT = 250000
+# Share of the request deadline the shared-input prefetch may use; inputs still loading after it
+# are abandoned and their consumers fetch for themselves, so agents keep most of the deadline
+PREFETCH_DEADLINE_SHARE = 0.3
+
+def create_result_cache():
+    """Create the orchestrator result cache selected by RESULT_CACHE_BACKEND"""
+    return create_store(
+        os.environ.get('RESULT_CACHE_BACKEND', 'file'),
+        os.environ.get('RESULT_CACHE_TABLE'),
+        os.environ.get('RESULT_CACHE_PATH', '/tmp/finops-copilot-results')
+    )
+
+class SharedClientPool:
+    """Stands in for the boto3 module inside in-process agents so they share one client per configuration
+    
+    Client construction is serialized, as boto3 does not make it thread-safe; the clients
+    themselves are safe to share between the agents' threads. Anything other than client()
+    is delegated to boto3.
+    """
+    
+    def __init__(self):
+        self.clients: Dict[tuple, Any] = {}
+        self.lock = threading.Lock()
+    
+    def client(self, service_name: str, region_name: str = None, config=None, **kwargs):
+        options = getattr(config, '_user_provided_options', None)
+        key = (service_name, region_name, json.dumps(options, sort_keys=True, default=str),
+               json.dumps(kwargs, sort_keys=True, default=str))
+        with self.lock:
+            if key not in self.clients:
+                self.clients[key] = boto3.client(service_name, region_name=region_name, config=config, **kwargs)
+            return self.clients[key]
+    
+    def __getattr__(self, name):
+        return getattr(boto3, name)
+
+class LambdaAgentExecutor:
+    """Runs each agent as its own Lambda function through a synchronous invoke"""
+    
+    def __init__(self, agent_functions: Dict[str, str], lambda_client=None):
+        self.agent_functions = agent_functions
+        self.lambda_client = lambda_client or boto3.client('lambda')
+    
+    def invoke(self, agent_name: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+        function_name = self.agent_functions.get(agent_name)
+        if not function_name:
+            return {'error': f'Unknown agent: {agent_name}'}
+        
+        response = self.lambda_client.invoke(
+            FunctionName=function_name,
+            InvocationType='RequestResponse',
+            Payload=json.dumps(payload)
+        )
+        
+        # Parse response
+        response_payload = json.loads(response['Payload'].read())
+        
+        # An unhandled exception in the agent still answers 200, flagged with FunctionError
+        if response['StatusCode'] == 200 and not response.get('FunctionError'):
+            return {
+                'agent': agent_name,
+                'success': True,
+                'data': response_payload
+            }
+        return {
+            'agent': agent_name,
+            'success': False,
+            'error': response_payload
+        }
+
+class InProcessAgentExecutor:
+    """Runs agents' lambda_handler functions in this process, for local runs, containers and low latency
+    
+    The agent modules must be importable next to this one. Each is imported once and its boto3
+    reference swapped for a SharedClientPool, so agents reuse clients across invocations and with
+    each other. The response goes through the same JSON round trip as a Lambda invoke, so
+    results match LambdaAgentExecutor's exactly.
+    """
+    
+    def __init__(self, agent_modules: Dict[str, str] = None, client_pool: SharedClientPool = None):
+        self.agent_modules = agent_modules or AGENT_MODULES
+        self.client_pool = client_pool or SharedClientPool()
+        self.handlers: Dict[str, Callable] = {}
+        self.lock = threading.Lock()
+    
+    def handler(self, agent_name: str) -> Callable:
+        with self.lock:
+            if agent_name not in self.handlers:
+                module = importlib.import_module(self.agent_modules[agent_name])
+                module.boto3 = self.client_pool
+                self.handlers[agent_name] = module.lambda_handler
+            return self.handlers[agent_name]
+    
+    def invoke(self, agent_name: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+        if agent_name not in self.agent_modules:
+            return {'error': f'Unknown agent: {agent_name}'}
+        
+        response_payload = json.loads(json.dumps(self.handler(agent_name)(dict(payload), None)))
+        return {
+            'agent': agent_name,
+            'success': True,
+            'data': response_payload
+        }
+
+def agent_response_error(result: Dict[str, Any]) -> Optional[str]:
+    """The error carried by an invoked agent's own response, or None for a good result
+    
+    An agent handler that catches an exception still returns normally, with a non-200 statusCode
+    and an error in its body, so a successful invoke is not a successful analysis.
+    """
+    data = result.get('data')
+    if not isinstance(data, dict):
+        return None
+    body = data.get('body', data)
+    if isinstance(body, str):
+        try:
+            body = json.loads(body)
+        except ValueError:
+            body = {}
+    error = body.get('error') if isinstance(body, dict) else None
+    status_code = data.get('statusCode', 200)
+    if status_code != 200:
+        return f'{result.get("agent")} returned status {status_code}: {error or "no error detail"}'
+    return f'{result.get("agent")} reported an error: {error}' if error else None
+
+def create_agent_executor(agent_functions: Dict[str, str], lambda_client=None):
+    """Create the agent executor selected by AGENT_EXECUTOR"""
+    if os.environ.get('AGENT_EXECUTOR', 'lambda') == 'inprocess':
+        return in_process_executor
+    return LambdaAgentExecutor(agent_functions, lambda_client)
+
+# Imported agents and their shared clients live for the whole container
+in_process_executor = InProcessAgentExecutor()
+
+def get_account_id(context) -> str:
+    """Account the agents analyze, taken from the function ARN when available"""
+    if context is not None and getattr(context, 'invoked_function_arn', None):
+        return context.invoked_function_arn.split(':')[4]
+    if os.environ.get('AWS_ACCOUNT_ID'):
+        return os.environ['AWS_ACCOUNT_ID']
+    try:
+        return str(boto3.client('sts').get_caller_identity()['Account'])
+    except Exception as e:
+        logger.warning(f"Could not resolve account id: {str(e)}")
+        return 'unknown'
+
+def data_watermark(agents: List[str], now: float = None) -> tuple:
+    """Freshness window of a set of agents: the TTL of the fastest-changing source and the window start"""
+    ttl = min(AGENT_RESULT_TTL_SECONDS.get(agent, DEFAULT_AGENT_RESULT_TTL_SECONDS) for agent in agents)
+    now = time.time() if now is None else now
+    return ttl, int(now // ttl) * ttl
+
+def result_cache_key(kind: str, **fields) -> str:
+    """Stable key for a cache entry, hashing its canonical JSON form"""
+    canonical = json.dumps(dict(fields, kind=kind), sort_keys=True, default=str)
+    return f'{kind}-' + hashlib.sha256(canonical.encode()).hexdigest()
+
+class RecommendationIndex:
+    """Recommendations merged by (resource, action) across agents, with a running top-K
+    
+    A recommendation for an action already proposed on the same resource is a duplicate and
+    only the larger saving is kept; a recommendation made moot by another action on that
+    resource (ACTION_SUBSUMES) is dropped whichever arrives first. The savings of everything
+    dropped are tallied so totals can be reconciled. Each add is O(log K); a top-K entry
+    being dropped marks the heap stale and the next read rebuilds it in O(n log K).
+    """
+    
+    PRIORITY_ORDER = {'high': 3, 'medium': 2, 'low': 1}
+    
+    def __init__(self, top_k: int = SYNTHESIS_TOP_K):
+        self.top_k = top_k
+        self.entries: List[Dict[str, Any]] = []
+        self.by_resource: Dict[tuple, Dict[str, Dict[str, Any]]] = {}
+        self.heap: List[tuple] = []
+        self.heap_stale = False
+        self.removed_savings = 0
+        self.merged_count = 0
+        self.high_priority_count = 0
+    
+    @staticmethod
+    def resource_key(rec: Dict[str, Any], agent_name: str) -> Optional[tuple]:
+        """(service, resource id) of the resource a recommendation targets, ARNs and bare IDs alike"""
+        for field in RESOURCE_ID_FIELDS:
+            value = rec.get(field)
+            if not isinstance(value, str) or not value:
+                continue
+            if value.startswith('arn:'):
+                parts = value.split(':', 5)
+                if len(parts) < 6:
+                    return None
+                return parts[2], parts[5].replace(':', '/').rsplit('/', 1)[-1]
+            service = AGENT_RESOURCE_SERVICES.get(agent_name)
+            if field == 'bucket_name':
+                service = 's3'
+            elif field == 'db_instance_identifier':
+                service = 'rds'
+            return (service, value) if service else None
+        return None
+    
+    @staticmethod
+    def savings(rec: Dict[str, Any]) -> float:
+        return rec.get('estimated_monthly_savings') or 0
+    
+    def add(self, rec: Dict[str, Any], agent_name: str, sequence: int):
+        entry = {
+            'key': (self.PRIORITY_ORDER.get(rec.get('priority', 'low'), 1), self.savings(rec), -sequence),
+            'rec': rec,
+            'active': False
+        }
+        self.entries.append(entry)
+        resource = self.resource_key(rec, agent_name)
+        action = RECOMMENDATION_ACTIONS.get(rec.get('type'))
+        if resource is None or action is None:
+            self._activate(entry)
+            return
+        
+        actions = self.by_resource.setdefault(resource, {})
+        for other_action, other in actions.items():
+            if action in ACTION_SUBSUMES.get(other_action, ()):
+                self._merge(other, entry)
+                return
+        
+        existing = actions.get(action)
+        if existing is not None:
+            if self.savings(rec) > self.savings(existing['rec']):
+                self._deactivate(existing)
+                self._merge(entry, existing)
+                actions[action] = entry
+                self._activate(entry)
+            else:
+                self._merge(existing, entry)
+            return
+        
+        for other_action in list(actions):
+            if other_action in ACTION_SUBSUMES.get(action, ()):
+                other = actions.pop(other_action)
+                self._deactivate(other)
+                self._merge(entry, other)
+        actions[action] = entry
+        self._activate(entry)
+    
+    def _merge(self, kept: Dict[str, Any], dropped: Dict[str, Any]):
+        """Fold a dropped recommendation into the one that supersedes it"""
+        self.removed_savings += self.savings(dropped['rec'])
+        self.merged_count += 1
+        sources = kept['rec'].setdefault('source_agents', [kept['rec'].get('source_agent')])
+        for agent_name in dropped['rec'].get('source_agents', [dropped['rec'].get('source_agent')]):
+            if agent_name not in sources:
+                sources.append(agent_name)
+        if dropped['rec'].get('type') != kept['rec'].get('type'):
+            merged_types = kept['rec'].setdefault('merged_types', [])
+            if dropped['rec'].get('type') not in merged_types:
+                merged_types.append(dropped['rec'].get('type'))
+    
+    def _activate(self, entry: Dict[str, Any]):
+        entry['active'] = True
+        if entry['rec'].get('priority') == 'high':
+            self.high_priority_count += 1
+        if self.heap_stale:
+            return
+        if len(self.heap) < self.top_k:
+            heapq.heappush(self.heap, (entry['key'], entry))
+        elif entry['key'] > self.heap[0][0]:
+            heapq.heapreplace(self.heap, (entry['key'], entry))
+    
+    def _deactivate(self, entry: Dict[str, Any]):
+        entry['active'] = False
+        if entry['rec'].get('priority') == 'high':
+            self.high_priority_count -= 1
+        if any(heap_entry is entry for _, heap_entry in self.heap):
+            self.heap_stale = True
+    
+    def top(self) -> List[Dict[str, Any]]:
+        """The top-K active recommendations, best first"""
+        if self.heap_stale:
+            best = heapq.nlargest(self.top_k, (e for e in self.entries if e['active']), key=lambda e: e['key'])
+            self.heap = [(e['key'], e) for e in best]
+            heapq.heapify(self.heap)
+            self.heap_stale = False
+        return [entry['rec'] for _, entry in sorted(self.heap, key=lambda item: item[0], reverse=True)]
+
+class IncrementalSynthesizer:
+    """Merges agent results one at a time into a synthesis that can be read after every step
+    
+    Cost totals accumulate per result, and recommendations go through a RecommendationIndex
+    that merges overlapping ones and keeps the top-K by (priority, savings, arrival). Savings
+    dropped as duplicates or subsumed actions are taken back out of the potential savings.
+    """
+    
+    def __init__(self, query: str, top_k: int = SYNTHESIS_TOP_K):
+        self.query = query
+        self.top_k = top_k
+        self.agents_consulted: List[str] = []
+        self.summary: Dict[str, Any] = {}
+        self.agent_status: Dict[str, str] = {}
+        self.total_current_cost = 0
+        self.total_potential_savings = 0
+        self.index = RecommendationIndex(top_k)
+        self.sequence = 0
+    
+    def add(self, result: Dict[str, Any]):
+        agent_name = result.get('agent')
+        self.agent_status[agent_name] = result.get('status', 'completed' if result.get('success') else 'failed')
+        if not result.get('success'):
+            return
+        
+        agent_data = result['data']
+        self.agents_consulted.append(agent_name)
+        
+        # Extract data from agent response
+        if 'body' in agent_data:
+            body = json.loads(agent_data['body']) if isinstance(agent_data['body'], str) else agent_data['body']
+        else:
+            body = agent_data
+        
+        # Extract summary information
+        if 'summary' in body:
+            summary = body['summary']
+            self.summary[agent_name] = summary
+            
+            # Accumulate cost information
+            if 'total_monthly_cost' in summary:
+                self.total_current_cost += summary['total_monthly_cost']
+            if 'potential_monthly_savings' in summary:
+                self.total_potential_savings += summary['potential_monthly_savings']
+        
+        # Merge recommendations; earlier arrivals win ties, as a stable sort would
+        for rec in body.get('recommendations', []):
+            rec['source_agent'] = agent_name
+            self.index.add(rec, agent_name, self.sequence)
+            self.sequence += 1
+    
+    def snapshot(self) -> Dict[str, Any]:
+        """The synthesis of everything merged so far"""
+        potential_savings = max(self.total_potential_savings - self.index.removed_savings, 0)
+        synthesis = {
+            'query': self.query,
+            'timestamp': datetime.utcnow().isoformat(),
+            'agents_consulted': list(self.agents_consulted),
+            'summary': dict(self.summary),
+            'recommendations': self.index.top(),
+            'cost_impact': {
+                'current_monthly_cost': self.total_current_cost,
+                'potential_monthly_savings': potential_savings,
+                'overlapping_savings_removed': self.index.removed_savings,
+                'savings_percentage': (potential_savings / self.total_current_cost * 100) if self.total_current_cost > 0 else 0
+            },
+            'merged_recommendations': self.index.merged_count,
+            'next_steps': [],
+            'agent_status': dict(self.agent_status),
+            'partial': any(status != 'completed' for status in self.agent_status.values())
+        }
+        
+        # Generate next steps based on recommendations
+        if self.index.high_priority_count:
+            synthesis['next_steps'].append(f"Address {self.index.high_priority_count} high-priority recommendations immediately")
+        
+        if potential_savings > 1000:
+            synthesis['next_steps'].append("Schedule a detailed cost review meeting with stakeholders")
+        
+        synthesis['next_steps'].append("Set up automated monitoring for identified optimization opportunities")
+        
+        return synthesis
+
 class FinOpsOrchestrator:
     def __init__(self):
         self.lambda_client = boto3.client('lambda')
@@ -25,6 +523,7 @@ class FinOpsOrchestrator:
             'tagging_agent': 'finops-copilot-tagging-agent',
             'apptio_integration': 'finops-copilot-apptio-integration'
         }
+        self.executor = create_agent_executor(self.agent_functions, self.lambda_client)
     
     def parse_user_query(self, query: str) -> Dict[str, Any]:
         """Parse user query to determine which agents to invoke and what actions to take"""
@@ -82,35 +581,15 @@ class FinOpsOrchestrator:
         return analysis_plan
     
     def invoke_agent(self, agent_name: str, payload: Dict[str, Any]) -> Dict[str, Any]:
-        """Invoke a specific agent Lambda function"""
+        """Invoke a specific agent through the configured executor"""
         try:
-            function_name = self.agent_functions.get(agent_name)
-            if not function_name:
-                return {'error': f'Unknown agent: {agent_name}'}
-            
-            logger.info(f"Invoking {agent_name} with payload: {payload}")
-            
-            response = self.lambda_client.invoke(
-                FunctionName=function_name,
-                InvocationType='RequestResponse',
-                Payload=json.dumps(payload)
-            )
-            
-            # Parse response
-            response_payload = json.loads(response['Payload'].read())
-            
-            if response['StatusCode'] == 200:
-                return {
-                    'agent': agent_name,
-                    'success': True,
-                    'data': response_payload
-                }
-            else:
-                return {
-                    'agent': agent_name,
-                    'success': False,
-                    'error': response_payload
-                }
+            logger.info(f"Invoking {agent_name} with payload: { {k: v for k, v in payload.items() if k != 'shared_data'} }")
+            result = self.executor.invoke(agent_name, payload)
+            error = agent_response_error(result) if result.get('success') else None
+            if error:
+                logger.warning(error)
+                return {'agent': agent_name, 'success': False, 'error': error}
+            return result
                 
         except Exception as e:
             logger.error(f"Error invoking {agent_name}: {str(e)}")
@@ -120,114 +599,420 @@ class FinOpsOrchestrator:
                 'error': str(e)
             }
     
-    def invoke_agents_parallel(self, agents_payload: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-        """Invoke multiple agents in parallel for better performance"""
-        results = []
+    def invoke_agents_parallel(self, agents_payload: List[Dict[str, Any]], timeout: float = None,
+                               on_result: Callable[[Dict[str, Any]], None] = None) -> List[Dict[str, Any]]:
+        """Invoke agents concurrently within a deadline, hedging slow agents with known tails
+        
+        Each result carries a status of completed, timed_out or failed. Agents still running at
+        their own timeout or at the deadline are abandoned so the caller can synthesize what
+        arrived; results are returned in priority order, and also passed to on_result as each
+        agent finishes.
+        """
+        started = time.monotonic()
+        deadline = started + (ORCHESTRATOR_DEADLINE_SECONDS if timeout is None else timeout)
+        ordered = sorted(agents_payload, key=lambda p: AGENT_PRIORITIES.get(p['agent'], len(AGENT_PRIORITIES)))
+        hedges = sum(1 for p in ordered if p['agent'] in AGENT_HEDGE_AFTER_SECONDS)
+        executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(1, min(MAX_AGENT_CONCURRENCY, len(ordered) + hedges))
+        )
         
-        with concurrent.futures.ThreadPoolExecutor(max_workers=5) as executor:
-            # Submit all agent invocations
-            future_to_agent = {
-                executor.submit(self.invoke_agent, payload['agent'], payload['payload']): payload['agent']
-                for payload in agents_payload
+        pending = {}
+        future_to_agent = {}
+        for payload in ordered:
+            agent_name = payload['agent']
+            hedge_after = AGENT_HEDGE_AFTER_SECONDS.get(agent_name)
+            pending[agent_name] = {
+                'payload': payload['payload'],
+                'timeout_at': min(deadline, started + AGENT_TIMEOUT_SECONDS.get(agent_name, DEFAULT_AGENT_TIMEOUT_SECONDS)),
+                'hedge_at': started + hedge_after if hedge_after is not None else None,
+                'in_flight': 1
             }
-            
-            # Collect results as they complete
-            for future in concurrent.futures.as_completed(future_to_agent):
-                agent_name = future_to_agent[future]
-                try:
-                    result = future.result()
-                    results.append(result)
-                except Exception as e:
-                    logger.error(f"Error getting result from {agent_name}: {str(e)}")
-                    results.append({
-                        'agent': agent_name,
-                        'success': False,
-                        'error': str(e)
-                    })
+            future_to_agent[executor.submit(self.invoke_agent, agent_name, payload['payload'])] = agent_name
+        
+        results = {}
+        
+        def finish(agent_name, result, status):
+            result['status'] = status
+            result['elapsed_ms'] = int((time.monotonic() - started) * 1000)
+            results[agent_name] = result
+            del pending[agent_name]
+            if on_result is not None:
+                on_result(result)
         
-        return results
-    
-    def synthesize_results(self, agent_results: List[Dict[str, Any]], 
-                          original_query: str) -> Dict[str, Any]:
-        """Synthesize results from multiple agents into a coherent response"""
         try:
-            synthesis = {
-                'query': original_query,
-                'timestamp': datetime.utcnow().isoformat(),
-                'agents_consulted': [],
-                'summary': {},
-                'recommendations': [],
-                'cost_impact': {},
-                'next_steps': []
-            }
-            
-            total_potential_savings = 0
-            total_current_cost = 0
-            all_recommendations = []
-            
-            # Process results from each agent
-            for result in agent_results:
-                if not result.get('success'):
-                    continue
-                
-                agent_name = result['agent']
-                agent_data = result['data']
-                synthesis['agents_consulted'].append(agent_name)
+            while pending:
+                now = time.monotonic()
+                for agent_name, state in list(pending.items()):
+                    if now >= state['timeout_at']:
+                        finish(agent_name, {
+                            'agent': agent_name,
+                            'success': False,
+                            'error': f'No response within {state["timeout_at"] - started:.1f}s'
+                        }, 'timed_out')
+                    elif state['hedge_at'] is not None and now >= state['hedge_at']:
+                        logger.info(f"Hedging slow invocation of {agent_name}")
+                        state['hedge_at'] = None
+                        state['in_flight'] += 1
+                        future_to_agent[executor.submit(self.invoke_agent, agent_name, state['payload'])] = agent_name
+                if not pending:
+                    break
                 
-                # Extract data from agent response
-                if 'body' in agent_data:
-                    body = json.loads(agent_data['body']) if isinstance(agent_data['body'], str) else agent_data['body']
-                else:
-                    body = agent_data
+                next_event = min(
+                    min(state['timeout_at'], state['hedge_at'] or state['timeout_at'])
+                    for state in pending.values()
+                )
+                waiting = [f for f, agent_name in future_to_agent.items() if agent_name in pending]
+                done, _ = concurrent.futures.wait(
+                    waiting, timeout=max(0, next_event - now), return_when=concurrent.futures.FIRST_COMPLETED
+                )
                 
-                # Extract summary information
-                if 'summary' in body:
-                    summary = body['summary']
-                    synthesis['summary'][agent_name] = summary
+                for future in done:
+                    agent_name = future_to_agent.pop(future)
+                    if agent_name not in pending:
+                        continue
+                    state = pending[agent_name]
+                    state['in_flight'] -= 1
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        logger.error(f"Error getting result from {agent_name}: {str(e)}")
+                        result = {'agent': agent_name, 'success': False, 'error': str(e)}
                     
-                    # Accumulate cost information
-                    if 'total_monthly_cost' in summary:
-                        total_current_cost += summary['total_monthly_cost']
-                    if 'potential_monthly_savings' in summary:
-                        total_potential_savings += summary['potential_monthly_savings']
-                
-                # Extract recommendations
-                if 'recommendations' in body:
-                    recommendations = body['recommendations']
-                    for rec in recommendations:
-                        rec['source_agent'] = agent_name
-                        all_recommendations.append(rec)
+                    # A failed copy only counts once no hedged copy is still running
+                    if result.get('success'):
+                        finish(agent_name, result, 'completed')
+                    elif state['in_flight'] == 0:
+                        finish(agent_name, result, 'failed')
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+        
+        return [results[payload['agent']] for payload in ordered]
+    
+    def build_agents_payload(self, analysis_plan: Dict[str, Any], days: int, 
+                             depth: str) -> List[Dict[str, Any]]:
+        """Build the per-agent invocation payloads for an analysis plan"""
+        agents_payload = []
+        for agent in analysis_plan['agents_to_invoke']:
+            payload = {
+                'action': 'analyze_all',
+                'days': days,
+                'depth': depth
+            }
             
-            # Sort recommendations by priority and potential savings
-            priority_order = {'high': 3, 'medium': 2, 'low': 1}
-            all_recommendations.sort(
-                key=lambda x: (
-                    priority_order.get(x.get('priority', 'low'), 1),
-                    x.get('estimated_monthly_savings', 0)
-                ),
-                reverse=True
+            agents_payload.append({
+                'agent': agent,
+                'payload': payload
+            })
+        
+        return agents_payload
+    
+    @staticmethod
+    def normalize_plan(analysis_plan: Dict[str, Any]) -> Dict[str, Any]:
+        """The parts of a plan that change what is computed; phrasing-only differences drop out"""
+        return {
+            'agents': sorted(analysis_plan['agents_to_invoke']),
+            'scope': analysis_plan.get('scope', 'general')
+        }
+    
+    def get_cached_agent_results(self, agents_payload: List[Dict[str, Any]], account_id: str) -> Dict[str, Any]:
+        """Completed agent results still inside their freshness window, keyed by agent"""
+        cached = {}
+        for entry in agents_payload:
+            key = self.agent_cache_key(entry, account_id)
+            result = result_cache.get(key)
+            if result is not None:
+                cached[entry['agent']] = dict(result, cached=True)
+        return cached
+    
+    def cache_agent_results(self, agents_payload: List[Dict[str, Any]], agent_results: List[Dict[str, Any]],
+                            account_id: str):
+        """Store completed agent results until their source data can have changed"""
+        results = {result['agent']: result for result in agent_results}
+        for entry in agents_payload:
+            result = results.get(entry['agent'])
+            if result is None or result.get('status') != 'completed':
+                continue
+            ttl, watermark = data_watermark([entry['agent']])
+            try:
+                result_cache.put(self.agent_cache_key(entry, account_id), result,
+                                 max(int(watermark + ttl - time.time()), 1))
+            except Exception as e:
+                logger.warning(f"Failed to cache {entry['agent']} result: {str(e)}")
+    
+    @staticmethod
+    def agent_cache_key(entry: Dict[str, Any], account_id: str) -> str:
+        _, watermark = data_watermark([entry['agent']])
+        payload = {k: v for k, v in entry['payload'].items() if k != 'shared_data'}
+        return result_cache_key('agent', agent=entry['agent'], payload=payload,
+                                account=account_id, watermark=watermark)
+    
+    def compile_prefetch_plan(self, agents: List[str]) -> List[List[str]]:
+        """Shared inputs worth prefetching for a set of agents, grouped into dependency levels"""
+        planned = set(agents)
+        selected = {
+            name for name, spec in SHARED_INPUT_GRAPH.items()
+            if len(planned & set(spec['consumers'])) >= 2
+        }
+        # Pull in dependencies that at least one planned agent consumes
+        frontier = list(selected)
+        while frontier:
+            for dependency in SHARED_INPUT_GRAPH[frontier.pop()]['depends_on']:
+                if dependency not in selected and planned & set(SHARED_INPUT_GRAPH[dependency]['consumers']):
+                    selected.add(dependency)
+                    frontier.append(dependency)
+        
+        levels = []
+        done = set()
+        while len(done) < len(selected):
+            level = sorted(
+                name for name in selected - done
+                if all(d in done or d not in selected for d in SHARED_INPUT_GRAPH[name]['depends_on'])
             )
-            
-            synthesis['recommendations'] = all_recommendations[:10]  # Top 10 recommendations
-            
-            # Set cost impact
-            synthesis['cost_impact'] = {
-                'current_monthly_cost': total_current_cost,
-                'potential_monthly_savings': total_potential_savings,
-                'savings_percentage': (total_potential_savings / total_current_cost * 100) if total_current_cost > 0 else 0
+            levels.append(level)
+            done.update(level)
+        return levels
+    
+    def prefetch_shared_inputs(self, agents: List[str], days: int, timeout: float = None) -> Dict[str, Any]:
+        """Fetch each shared input once, level by level, running a level's inputs concurrently
+        
+        Inputs still loading after timeout seconds are abandoned, along with the levels that
+        depend on them; consumers fall back to fetching those inputs themselves.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        shared = {}
+        calls = {}
+        abandoned = []
+        for level in self.compile_prefetch_plan(agents):
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                abandoned.extend(level)
+                continue
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(level))
+            try:
+                futures = {
+                    executor.submit(getattr(self, f'prefetch_{name}'), agents, days, dict(shared)): name
+                    for name in level
+                }
+                done, not_done = concurrent.futures.wait(futures, timeout=remaining)
+                abandoned.extend(futures[future] for future in not_done)
+                for future in done:
+                    name = futures[future]
+                    try:
+                        value, calls[name] = future.result()
+                    except Exception as e:
+                        # Consumers fall back to fetching the input themselves
+                        logger.warning(f"Failed to prefetch {name}: {str(e)}")
+                        continue
+                    if value is not None:
+                        shared[name] = value
+            finally:
+                executor.shutdown(wait=False, cancel_futures=True)
+        
+        if abandoned:
+            logger.warning(f"Prefetch ran out of time; agents fetch {sorted(abandoned)} themselves")
+        logger.info(f"Prefetched {sorted(shared)} with {sum(calls.values())} AWS calls")
+        return {'data': shared, 'aws_calls': calls, 'abandoned': sorted(abandoned)}
+    
+    def prefetch_cost_cube(self, agents: List[str], days: int, shared: Dict[str, Any]) -> tuple:
+        """Daily cost by service and usage type for every planned agent's service, in one query"""
+        end_date = datetime.utcnow().date()
+        start_date = end_date - timedelta(days=days)
+        services = sorted({AGENT_COST_SERVICES[a] for a in agents if a in AGENT_COST_SERVICES})
+        request = {
+            'TimePeriod': {'Start': start_date.strftime('%Y-%m-%d'), 'End': end_date.strftime('%Y-%m-%d')},
+            'Granularity': 'DAILY',
+            'Metrics': ['BlendedCost'],
+            'GroupBy': [{'Type': 'DIMENSION', 'Key': 'SERVICE'}, {'Type': 'DIMENSION', 'Key': 'USAGE_TYPE'}],
+            'Filter': {'Dimensions': {'Key': 'SERVICE', 'Values': services}}
+        }
+        
+        ce_client = boto3.client('ce')
+        rows = []
+        calls = 0
+        seen_tokens = set()
+        for _ in range(COST_CUBE_MAX_PAGES):
+            response = ce_client.get_cost_and_usage(**request)
+            calls += 1
+            for result in response['ResultsByTime']:
+                date = result['TimePeriod']['Start']
+                for group in result['Groups']:
+                    service, usage_type = group['Keys']
+                    rows.append([date, service, usage_type, float(group['Metrics']['BlendedCost']['Amount'])])
+            token = response.get('NextPageToken')
+            if not token:
+                break
+            if token in seen_tokens:
+                logger.warning("Cost Explorer repeated a page token; stopping the cost cube read")
+                break
+            seen_tokens.add(token)
+            request['NextPageToken'] = token
+        else:
+            logger.warning(f"Cost cube truncated at {COST_CUBE_MAX_PAGES} pages")
+        
+        return {'days': days, 'services': services, 'rows': rows}, calls
+    
+    def prefetch_ec2_instances(self, agents: List[str], days: int, shared: Dict[str, Any]) -> tuple:
+        """Running EC2 instances, in the ec2 agent's instance summary format"""
+        paginator = boto3.client('ec2').get_paginator('describe_instances')
+        instances = {}
+        calls = 0
+        for page in paginator.paginate(Filters=[{'Name': 'instance-state-name', 'Values': ['running']}]):
+            calls += 1
+            for reservation in page['Reservations']:
+                for instance in reservation['Instances']:
+                    instances[instance['InstanceId']] = {
+                        'instance_type': instance['InstanceType'],
+                        'state': instance['State']['Name'],
+                        'launch_time': instance['LaunchTime'].isoformat(),
+                        'availability_zone': instance['Placement']['AvailabilityZone'],
+                        'tags': {tag['Key']: tag['Value'] for tag in instance.get('Tags', [])},
+                        'vpc_id': instance.get('VpcId'),
+                        'subnet_id': instance.get('SubnetId')
+                    }
+        return instances, calls
+    
+    def prefetch_rds_instances(self, agents: List[str], days: int, shared: Dict[str, Any]) -> tuple:
+        """Every DB instance as returned by DescribeDBInstances, with timestamps as ISO strings"""
+        paginator = boto3.client('rds').get_paginator('describe_db_instances')
+        instances = {}
+        calls = 0
+        for page in paginator.paginate():
+            calls += 1
+            for instance in page['DBInstances']:
+                instances[instance['DBInstanceIdentifier']] = json.loads(json.dumps(
+                    instance, default=lambda value: value.isoformat() if isinstance(value, datetime) else str(value)
+                ))
+        return instances, calls
+    
+    def prefetch_metrics(self, agents: List[str], days: int, shared: Dict[str, Any]) -> tuple:
+        """Hourly series for both fleets through shared GetMetricData requests, aligned to hour slots"""
+        end_time = datetime.utcnow().replace(minute=0, second=0, microsecond=0)
+        start_time = end_time - timedelta(days=days)
+        hours = days * 24
+        
+        queries = []
+        query_targets = {}
+        for agent, spec in SHARED_METRICS.items():
+            if agent not in agents or spec['inventory'] not in shared:
+                continue
+            resource_ids = [
+                resource_id for resource_id, resource in shared[spec['inventory']].items()
+                if resource.get('DBInstanceStatus', 'available') == 'available'
+            ]
+            for index, resource_id in enumerate(resource_ids):
+                for m, (metric_name, stat) in enumerate(spec['metrics']):
+                    query_id = f'{agent.split("_")[0]}_{m}_{index}'
+                    query_targets[query_id] = (agent, resource_id, f'{metric_name}/{stat}')
+                    queries.append({
+                        'Id': query_id,
+                        'MetricStat': {
+                            'Metric': {
+                                'Namespace': spec['namespace'],
+                                'MetricName': metric_name,
+                                'Dimensions': [{'Name': spec['dimension'], 'Value': resource_id}]
+                            },
+                            'Period': 3600,
+                            'Stat': stat
+                        },
+                        'ReturnData': True
+                    })
+        
+        # The memory search returns up to one more series per EC2 instance
+        search_memory = 'ec2_agent' in agents and 'ec2_instances' in shared
+        series_count = len(queries) + (len(shared['ec2_instances']) if search_memory else 0)
+        if not queries or series_count * hours > SHARED_METRIC_POINTS_LIMIT:
+            return None, 0
+        
+        chunks = [
+            queries[i:i + METRIC_QUERIES_PER_REQUEST - 1]
+            for i in range(0, len(queries), METRIC_QUERIES_PER_REQUEST - 1)
+        ]
+        if search_memory:
+            # CloudWatch agent memory, found with one fleet-wide search as the ec2 agent does
+            chunks[0].append({
+                'Id': 'memory_search',
+                'Expression': "SEARCH('Namespace=\"CWAgent\" MetricName=\"mem_used_percent\"', 'Average', 3600)",
+                'Label': "${PROP('Dim.InstanceId')}",
+                'ReturnData': True
+            })
+        
+        series = {agent: {} for agent in SHARED_METRICS if agent in agents}
+        paginator = boto3.client('cloudwatch').get_paginator('get_metric_data')
+        calls = 0
+        start_epoch = start_time.replace(tzinfo=timezone.utc).timestamp()
+        for chunk in chunks:
+            for page in paginator.paginate(
+                MetricDataQueries=chunk,
+                StartTime=start_time,
+                EndTime=end_time
+            ):
+                calls += 1
+                for result in page['MetricDataResults']:
+                    if result['Id'].startswith('memory_search'):
+                        if result.get('Label') not in shared['ec2_instances']:
+                            continue
+                        agent, resource_id, key = 'ec2_agent', result['Label'], 'mem_used_percent/Average'
+                    elif result['Id'] in query_targets:
+                        agent, resource_id, key = query_targets[result['Id']]
+                    else:
+                        continue
+                    row = series[agent].setdefault(resource_id, {}).setdefault(key, [None] * hours)
+                    for timestamp, value in zip(result['Timestamps'], result['Values']):
+                        slot = int((timestamp.timestamp() - start_epoch) // 3600)
+                        if 0 <= slot < hours:
+                            row[slot] = value
+        
+        return {
+            'days': days,
+            'start': start_time.replace(tzinfo=timezone.utc).isoformat(),
+            'period': 3600,
+            'series': series
+        }, calls
+    
+    def attach_shared_data(self, agents_payload: List[Dict[str, Any]], shared: Dict[str, Any]):
+        """Hand each agent the prefetched inputs it consumes"""
+        for entry in agents_payload:
+            agent = entry['agent']
+            data = {
+                name: value for name, value in shared.items()
+                if agent in SHARED_INPUT_GRAPH[name]['consumers']
+            }
+            if 'metrics' in data:
+                data['metrics'] = dict(data['metrics'], series=data['metrics']['series'].get(agent, {}))
+            if data:
+                entry['payload']['shared_data'] = data
+    
+    def enrich_with_apptio(self, synthesis: Dict[str, Any], days: int) -> Dict[str, Any]:
+        """Call the Apptio integration to enrich a synthesis; returns the enrichment fields"""
+        enrichment = {}
+        try:
+            apptio_payload = {
+                'action': 'enrich_analysis',
+                'aws_cost_data': synthesis,
+                'days': days
             }
             
-            # Generate next steps based on recommendations
-            high_priority_recs = [r for r in all_recommendations if r.get('priority') == 'high']
-            if high_priority_recs:
-                synthesis['next_steps'].append(f"Address {len(high_priority_recs)} high-priority recommendations immediately")
-            
-            if total_potential_savings > 1000:
-                synthesis['next_steps'].append("Schedule a detailed cost review meeting with stakeholders")
-            
-            synthesis['next_steps'].append("Set up automated monitoring for identified optimization opportunities")
+            logger.info("Enriching analysis with Apptio data")
+            apptio_response = self.invoke_agent('apptio_integration', apptio_payload)
             
-            return synthesis
+            if apptio_response.get('success') and 'body' in apptio_response.get('data', {}):
+                enriched_data = json.loads(apptio_response['data']['body'])
+                enrichment['apptio_insights'] = enriched_data.get('apptio_insights', {})
+                enrichment['combined_analysis'] = enriched_data.get('combined_analysis', {})
+                
+        except Exception as e:
+            logger.warning(f"Failed to enrich with Apptio data: {str(e)}")
+        
+        return enrichment
+    
+    def synthesize_results(self, agent_results: List[Dict[str, Any]], 
+                          original_query: str) -> Dict[str, Any]:
+        """Synthesize results from multiple agents into a coherent response"""
+        try:
+            synthesizer = IncrementalSynthesizer(original_query)
+            for result in agent_results:
+                synthesizer.add(result)
+            return synthesizer.snapshot()
             
         except Exception as e:
             logger.error(f"Error synthesizing results: {str(e)}")
@@ -261,6 +1046,10 @@ class FinOpsOrchestrator:
             if potential_savings > 0:
                 response_parts.append(f"I've identified potential monthly savings of ${potential_savings:,.2f} ({savings_percentage:.1f}% reduction).")
             
+            missing = [agent for agent, status in synthesis.get('agent_status', {}).items() if status != 'completed']
+            if missing:
+                response_parts.append(f"Results are partial: {', '.join(missing)} did not complete.")
+            
             # Recommendations summary
             if recommendations_count > 0:
                 high_priority = len([r for r in synthesis['recommendations'] if r.get('priority') == 'high'])
@@ -283,84 +1072,409 @@ class FinOpsOrchestrator:
             logger.error(f"Error generating natural language response: {str(e)}")
             return f"I've completed the analysis but encountered an issue generating the summary. Please check the detailed results."
 
+def submit_analysis_job(event: Dict[str, Any], context) -> Dict[str, Any]:
+    """Create a background analysis job and start its worker"""
+    orchestrator = FinOpsOrchestrator()
+    user_query = event.get('query', 'Analyze my AWS costs')
+    days = event.get('days', 30)
+    analysis_depth = event.get('depth', 'standard')
+    
+    analysis_plan = orchestrator.parse_user_query(user_query)
+    agents_payload = orchestrator.build_agents_payload(analysis_plan, days, analysis_depth)
+    
+    stages = [payload['agent'] for payload in agents_payload] + ['synthesis']
+    if analysis_plan.get('scope') == 'comprehensive':
+        stages.append('apptio_enrichment')
+    
+    now = datetime.utcnow().isoformat()
+    job = {
+        'job_id': uuid.uuid4().hex,
+        'status': 'pending',
+        'query': user_query,
+        'days': days,
+        'analysis_plan': analysis_plan,
+        'agents_payload': agents_payload,
+        'stages': stages,
+        'completed_stages': [],
+        'results': {},
+        'created_at': now,
+        'updated_at': now
+    }
+    requeue_job(job)
+    job_store.put(job['job_id'], job, JOB_TTL_SECONDS)
+    start_job_worker(job['job_id'], context)
+    
+    return {
+        'job_id': job['job_id'],
+        'status': job['status'],
+        'total_stages': len(stages),
+        'analysis_plan': analysis_plan
+    }
+
+def submit_stream_job(event: Dict[str, Any], context) -> Dict[str, Any]:
+    """Create a background job that records analysis events as they happen
+    
+    The worker appends each event from iter_analysis_events to the job as it is yielded, so
+    clients poll with the job id and an event cursor to receive the events incrementally.
+    """
+    request = {key: value for key, value in event.items() if key != 'mode'}
+    analysis_plan = FinOpsOrchestrator().parse_user_query(request.get('query', 'Analyze my AWS costs'))
+    
+    now = datetime.utcnow().isoformat()
+    job = {
+        'job_id': uuid.uuid4().hex,
+        'kind': 'stream',
+        'status': 'pending',
+        'request': request,
+        'stages': analysis_plan['agents_to_invoke'] + ['synthesis'],
+        'completed_stages': [],
+        'results': {},
+        'events': [],
+        'created_at': now,
+        'updated_at': now
+    }
+    requeue_job(job)
+    job_store.put(job['job_id'], job, JOB_TTL_SECONDS)
+    start_job_worker(job['job_id'], context)
+    
+    return {
+        'job_id': job['job_id'],
+        'status': job['status'],
+        'total_stages': len(job['stages']),
+        'analysis_plan': analysis_plan
+    }
+
+def start_job_worker(job_id: str, context):
+    """Run the job worker inline (tests, local runs) or as an async self-invocation"""
+    if context is None or os.environ.get('JOB_RUNNER', 'lambda') == 'inline':
+        run_analysis_job(job_id, context)
+        return
+    boto3.client('lambda').invoke(
+        FunctionName=context.invoked_function_arn,
+        InvocationType='Event',
+        Payload=json.dumps({'job_worker': job_id})
+    )
+
+def save_job(job: Dict[str, Any]):
+    """Checkpoint a job to the job store"""
+    job['updated_at'] = datetime.utcnow().isoformat()
+    job_store.put(job['job_id'], job, JOB_TTL_SECONDS)
+
+def run_analysis_job(job_id: str, context) -> Dict[str, Any]:
+    """Advance a job stage by stage, checkpointing each agent result as it arrives"""
+    job = job_store.get(job_id)
+    if not job or job['status'] in ['completed', 'failed']:
+        return {'job_id': job_id, 'status': job['status'] if job else 'unknown'}
+    
+    if job.get('kind') == 'stream':
+        return run_stream_job(job, context)
+    
+    def out_of_time() -> bool:
+        return context is not None and context.get_remaining_time_in_millis() < JOB_MIN_REMAINING_MS
+    
+    orchestrator = FinOpsOrchestrator()
+    lease_job(job, context)
+    save_job(job)
+    
+    try:
+        pending = [p for p in job['agents_payload'] if p['agent'] not in job['completed_stages']]
+        if pending:
+            if out_of_time():
+                requeue_job(job)
+                save_job(job)
+                start_job_worker(job_id, context)
+                return {'job_id': job_id, 'status': job['status']}
+            
+            # Pollers see the running synthesis of whatever has completed so far
+            synthesizer = IncrementalSynthesizer(job['query'])
+            for agent_name in job['completed_stages']:
+                synthesizer.add(job['results'][agent_name])
+            
+            with concurrent.futures.ThreadPoolExecutor(max_workers=len(pending)) as executor:
+                future_to_agent = {
+                    executor.submit(orchestrator.invoke_agent, p['agent'], p['payload']): p['agent']
+                    for p in pending
+                }
+                for future in concurrent.futures.as_completed(future_to_agent):
+                    agent_name = future_to_agent[future]
+                    job['results'][agent_name] = future.result()
+                    job['completed_stages'].append(agent_name)
+                    synthesizer.add(job['results'][agent_name])
+                    job['partial_result'] = synthesizer.snapshot()
+                    save_job(job)
+        
+        for stage in ['synthesis', 'apptio_enrichment']:
+            if stage not in job['stages'] or stage in job['completed_stages']:
+                continue
+            if out_of_time():
+                requeue_job(job)
+                save_job(job)
+                start_job_worker(job_id, context)
+                return {'job_id': job_id, 'status': job['status']}
+            
+            if stage == 'synthesis':
+                agent_results = [job['results'][p['agent']] for p in job['agents_payload']]
+                job['results'][stage] = orchestrator.synthesize_results(agent_results, job['query'])
+            else:
+                job['results'][stage] = orchestrator.enrich_with_apptio(job['results']['synthesis'], job['days'])
+            job['completed_stages'].append(stage)
+            save_job(job)
+        
+        synthesis = dict(job['results']['synthesis'])
+        synthesis.update(job['results'].get('apptio_enrichment', {}))
+        job['result'] = {
+            'query': job['query'],
+            'natural_response': orchestrator.generate_natural_language_response(synthesis),
+            'detailed_analysis': synthesis,
+            'analysis_plan': job['analysis_plan'],
+            'agent_results': [job['results'][p['agent']] for p in job['agents_payload']],
+            'timestamp': datetime.utcnow().isoformat()
+        }
+        job['status'] = 'completed'
+        
+    except Exception as e:
+        logger.error(f"Error running analysis job {job_id}: {str(e)}")
+        job['status'] = 'failed'
+        job['error'] = str(e)
+    
+    save_job(job)
+    return {'job_id': job_id, 'status': job['status']}
+
+def run_stream_job(job: Dict[str, Any], context) -> Dict[str, Any]:
+    """Run a stream job, checkpointing every analysis event so pollers see it straight away"""
+    lease_job(job, context)
+    save_job(job)
+    
+    try:
+        for analysis_event in iter_analysis_events(job['request'], context):
+            job['events'].append(analysis_event)
+            if analysis_event['event'] == 'agent_result':
+                job['completed_stages'].append(analysis_event['agent'])
+            elif analysis_event['event'] == 'synthesis':
+                job['completed_stages'].append('synthesis')
+            elif analysis_event['event'] == 'complete':
+                job['result'] = analysis_event['result']
+                job['completed_stages'] = list(job['stages'])
+            save_job(job)
+        job['status'] = 'completed'
+        
+    except Exception as e:
+        logger.error(f"Error running stream job {job['job_id']}: {str(e)}")
+        job['status'] = 'failed'
+        job['error'] = str(e)
+        job['events'].append({'event': 'error', 'error': str(e)})
+    
+    save_job(job)
+    return {'job_id': job['job_id'], 'status': job['status']}
+
+def get_job_status(job_id: str, cursor: int = 0, event_cursor: int = 0) -> Optional[Dict[str, Any]]:
+    """Report job progress plus the stage results and events recorded since the given cursors"""
+    job = job_store.get(job_id)
+    if not job:
+        return None
+    # A worker that crashed or timed out never checkpoints a final status
+    if expire_job(job):
+        save_job(job)
+    
+    new_stages = job['completed_stages'][cursor:]
+    status = {
+        'job_id': job_id,
+        'status': job['status'],
+        'progress': {
+            'completed_stages': len(job['completed_stages']),
+            'total_stages': len(job['stages']),
+            'percentage': round(len(job['completed_stages']) / len(job['stages']) * 100, 1)
+        },
+        'results': {stage: job['results'][stage] for stage in new_stages if stage in job['results']},
+        'cursor': len(job['completed_stages']),
+        'updated_at': job['updated_at']
+    }
+    if 'events' in job:
+        status['events'] = job['events'][event_cursor:]
+        status['event_cursor'] = len(job['events'])
+    if 'result' in job:
+        status['result'] = job['result']
+    elif 'partial_result' in job:
+        status['partial_result'] = job['partial_result']
+    if 'error' in job:
+        status['error'] = job['error']
+    return status
+
+job_store = create_job_store('/tmp/finops-copilot-jobs')
+result_cache = create_result_cache()
+
+def iter_analysis_events(event: Dict[str, Any], context) -> Iterator[Dict[str, Any]]:
+    """Run a synchronous analysis, yielding progress events as they happen
+    
+    Yields a plan event, an agent_result event with the running synthesis as each agent
+    (cached or invoked) finishes, a synthesis event before Apptio enrichment, and finally a
+    complete event carrying the full response body.
+    """
+    orchestrator = FinOpsOrchestrator()
+    
+    # Extract parameters
+    user_query = event.get('query', 'Analyze my AWS costs')
+    analysis_depth = event.get('depth', 'standard')
+    days = event.get('days', 30)
+    
+    # Parse the user query to create analysis plan
+    analysis_plan = orchestrator.parse_user_query(user_query)
+    logger.info(f"Analysis plan: {analysis_plan}")
+    
+    # Paraphrases map to the same plan; serve a whole result computed in the current freshness window
+    account_id = get_account_id(context)
+    plan_ttl, watermark = data_watermark(analysis_plan['agents_to_invoke'])
+    plan_key = result_cache_key(
+        'plan', plan=orchestrator.normalize_plan(analysis_plan), days=days, depth=analysis_depth,
+        account=account_id, watermark=watermark
+    )
+    if not event.get('refresh'):
+        cached = result_cache.get(plan_key)
+        if cached is not None:
+            logger.info("Serving cached orchestrator result")
+            cached['query'] = user_query
+            cached['cache'] = {'plan_hit': True, 'cached_agents': sorted(analysis_plan['agents_to_invoke'])}
+            yield {'event': 'plan', 'analysis_plan': analysis_plan, 'cached_agents': cached['cache']['cached_agents']}
+            yield {'event': 'complete', 'result': cached}
+            return
+    
+    budget = float(event.get('deadline_seconds', ORCHESTRATOR_DEADLINE_SECONDS))
+    if context is not None:
+        budget = min(budget, context.get_remaining_time_in_millis() / 1000 - SYNTHESIS_RESERVE_SECONDS)
+    deadline = time.monotonic() + budget
+    
+    # Prepare agent invocations; agents with a fresh cached result are not invoked again
+    agents_payload = orchestrator.build_agents_payload(analysis_plan, days, analysis_depth)
+    cached_results = {} if event.get('refresh') else orchestrator.get_cached_agent_results(agents_payload, account_id)
+    to_invoke = [entry for entry in agents_payload if entry['agent'] not in cached_results]
+    yield {'event': 'plan', 'analysis_plan': analysis_plan, 'cached_agents': sorted(cached_results)}
+    
+    synthesizer = IncrementalSynthesizer(user_query)
+    
+    def progress(result):
+        synthesizer.add(result)
+        return {
+            'event': 'agent_result',
+            'agent': result['agent'],
+            'status': result.get('status'),
+            'cached': bool(result.get('cached')),
+            'elapsed_ms': result.get('elapsed_ms'),
+            'synthesis': synthesizer.snapshot()
+        }
+    
+    for entry in agents_payload:
+        if entry['agent'] in cached_results:
+            yield progress(cached_results[entry['agent']])
+    
+    # Fetch inputs shared by several of the remaining agents once up front, within part of the deadline
+    prefetch = orchestrator.prefetch_shared_inputs(
+        [entry['agent'] for entry in to_invoke], days, max(deadline - time.monotonic(), 0) * PREFETCH_DEADLINE_SHARE
+    )
+    orchestrator.attach_shared_data(to_invoke, prefetch['data'])
+    
+    # Invoke agents in parallel on a worker thread, relaying each result as it lands
+    remaining = max(deadline - time.monotonic(), 0)
+    logger.info(f"Invoking {len(to_invoke)} agents in parallel within {remaining:.1f}s "
+                f"({len(cached_results)} served from cache)")
+    arrivals = queue.Queue()
+    outcome = {}
+    
+    def run_fan_out():
+        try:
+            outcome['results'] = orchestrator.invoke_agents_parallel(to_invoke, remaining, arrivals.put)
+        except Exception as e:
+            outcome['error'] = e
+        finally:
+            arrivals.put(None)
+    
+    threading.Thread(target=run_fan_out, daemon=True).start()
+    while True:
+        result = arrivals.get()
+        if result is None:
+            break
+        yield progress(result)
+    if 'error' in outcome:
+        raise outcome['error']
+    
+    invoked_results = outcome['results']
+    orchestrator.cache_agent_results(to_invoke, invoked_results, account_id)
+    by_agent = dict(cached_results, **{result['agent']: result for result in invoked_results})
+    agent_results = [by_agent[entry['agent']] for entry in agents_payload]
+    
+    # Synthesize results
+    synthesis = orchestrator.synthesize_results(agent_results, user_query)
+    yield {'event': 'synthesis', 'synthesis': synthesis}
+    
+    # Enrich with Apptio data if available and the deadline allows
+    if analysis_plan.get('scope') == 'comprehensive' and time.monotonic() < deadline:
+        synthesis.update(orchestrator.enrich_with_apptio(synthesis, days))
+    
+    # Generate natural language response
+    natural_response = orchestrator.generate_natural_language_response(synthesis)
+    
+    # Prepare final response; only complete results are cached for the whole plan
+    body = {
+        'query': user_query,
+        'natural_response': natural_response,
+        'detailed_analysis': synthesis,
+        'analysis_plan': analysis_plan,
+        'agent_results': agent_results,
+        'prefetch_aws_calls': prefetch['aws_calls'],
+        'prefetch_abandoned': prefetch['abandoned'],
+        'timestamp': datetime.utcnow().isoformat()
+    }
+    if not synthesis.get('partial') and 'error' not in synthesis:
+        try:
+            result_cache.put(plan_key, body, max(int(watermark + plan_ttl - time.time()), 1))
+        except Exception as e:
+            logger.warning(f"Failed to cache orchestrator result: {str(e)}")
+    body['cache'] = {'plan_hit': False, 'cached_agents': sorted(cached_results)}
+    yield {'event': 'complete', 'result': body}
+
 def lambda_handler(event, context):
     """AWS Lambda handler for the FinOps Orchestrator"""
     try:
         logger.info(f"Received event: {json.dumps(event)}")
         
-        # Initialize orchestrator
-        orchestrator = FinOpsOrchestrator()
-        
-        # Extract parameters
-        user_query = event.get('query', 'Analyze my AWS costs')
-        analysis_depth = event.get('depth', 'standard')
-        days = event.get('days', 30)
-        
-        # Parse the user query to create analysis plan
-        analysis_plan = orchestrator.parse_user_query(user_query)
-        logger.info(f"Analysis plan: {analysis_plan}")
+        # Async job mode: worker self-invocation, status polling and submission
+        if 'job_worker' in event:
+            return run_analysis_job(event['job_worker'], context)
         
-        # Prepare agent invocations
-        agents_payload = []
-        for agent in analysis_plan['agents_to_invoke']:
-            payload = {
-                'action': 'analyze_all',
-                'days': days,
-                'depth': analysis_depth
+        if event.get('job_id'):
+            status = get_job_status(event['job_id'], int(event.get('cursor', 0)), int(event.get('event_cursor', 0)))
+            if status is None:
+                return {
+                    'statusCode': 404,
+                    'body': json.dumps({'error': 'Unknown job', 'job_id': event['job_id']})
+                }
+            return {
+                'statusCode': 200,
+                'body': json.dumps(status)
             }
-            
-            agents_payload.append({
-                'agent': agent,
-                'payload': payload
-            })
-        
-        # Invoke agents in parallel
-        logger.info(f"Invoking {len(agents_payload)} agents in parallel")
-        agent_results = orchestrator.invoke_agents_parallel(agents_payload)
         
-        # Synthesize results
-        synthesis = orchestrator.synthesize_results(agent_results, user_query)
+        if event.get('mode') == 'async':
+            return {
+                'statusCode': 202,
+                'body': json.dumps(submit_analysis_job(event, context))
+            }
         
-        # Enrich with Apptio data if available
-        if analysis_plan.get('scope') == 'comprehensive':
-            try:
-                # Call Apptio integration to enrich the analysis
-                apptio_payload = {
-                    'action': 'enrich_analysis',
-                    'aws_cost_data': synthesis,
-                    'days': days
-                }
-                
-                logger.info("Enriching analysis with Apptio data")
-                apptio_response = orchestrator.invoke_agent('apptio_integration', apptio_payload)
-                
-                if apptio_response.get('success') and 'body' in apptio_response.get('data', {}):
-                    enriched_data = json.loads(apptio_response['data']['body'])
-                    synthesis['apptio_insights'] = enriched_data.get('apptio_insights', {})
-                    synthesis['combined_analysis'] = enriched_data.get('combined_analysis', {})
-                    
-            except Exception as e:
-                logger.warning(f"Failed to enrich with Apptio data: {str(e)}")
+        if event.get('mode') == 'stream':
+            # Events are recorded in the job store as they happen; poll with job_id and event_cursor
+            return {
+                'statusCode': 202,
+                'body': json.dumps(submit_stream_job(event, context))
+            }
         
-        # Generate natural language response
-        natural_response = orchestrator.generate_natural_language_response(synthesis)
+        for analysis_event in iter_analysis_events(event, context):
+            if analysis_event['event'] == 'complete':
+                body = analysis_event['result']
         
-        # Prepare final response
-        response = {
+        logger.info("Orchestrator analysis completed successfully")
+        return {
             'statusCode': 200,
-            'body': json.dumps({
-                'query': user_query,
-                'natural_response': natural_response,
-                'detailed_analysis': synthesis,
-                'analysis_plan': analysis_plan,
-                'agent_results': agent_results,
-                'timestamp': datetime.utcnow().isoformat()
-            })
+            'body': json.dumps(body)
         }
         
-        logger.info("Orchestrator analysis completed successfully")
-        return response
-        
     except Exception as e:
         logger.error(f"Error in orchestrator lambda_handler: {str(e)}")
         return {
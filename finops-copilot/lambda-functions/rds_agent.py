@@ -1,6 +1,7 @@
 import json
 import boto3
 import logging
+from collections import defaultdict
 from datetime import datetime, timedelta
 from typing import Dict, List, Any
 
@@ -8,108 +9,65 @@ from typing import Dict, List, Any
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+# GetMetricData accepts at most 500 queries per request
+METRIC_QUERIES_PER_REQUEST = 500
+
+# (key, metric name, statistic) pulled hourly from AWS/RDS for every DB instance
+RDS_UTILIZATION_METRICS = [
+    ('cpu_avg', 'CPUUtilization', 'Average'),
+    ('cpu_max', 'CPUUtilization', 'Maximum'),
+    ('connections_avg', 'DatabaseConnections', 'Average'),
+    ('connections_max', 'DatabaseConnections', 'Maximum'),
+    ('read_iops', 'ReadIOPS', 'Average'),
+    ('write_iops', 'WriteIOPS', 'Average'),
+    ('free_storage_min', 'FreeStorageSpace', 'Minimum')
+]
+
+# Allocated storage is flagged when at least this share stayed free for the whole period
+RDS_STORAGE_FREE_FRACTION = 0.5
+GIB = 1024 ** 3
+
+RDS_COST_SERVICE = 'Amazon Relational Database Service'
+
 class RDSCostAnalyzer:
-    def __init__(self):
+    def __init__(self, shared_data: Dict[str, Any] = None):
         self.rds_client = boto3.client('rds')
         self.cloudwatch_client = boto3.client('cloudwatch')
         self.cost_explorer_client = boto3.client('ce')
+        # Inputs the orchestrator prefetched once for every agent in its plan
+        self.shared_data = shared_data or {}
+        # DB instances described during this invocation, keyed by identifier
+        self.instance_map: Dict[str, Dict[str, Any]] = self.shared_data.get('rds_instances')
         
     def analyze_instance_utilization(self, instance_ids: List[str], days: int = 30) -> Dict[str, Any]:
         """Analyze RDS instance utilization over the specified period"""
         try:
-            end_time = datetime.utcnow()
+            if not instance_ids:
+                return {}
+            
+            end_time = datetime.utcnow().replace(minute=0, second=0, microsecond=0)
             start_time = end_time - timedelta(days=days)
             
-            utilization_data = {}
+            series = self.collect_metric_series(instance_ids, start_time, end_time)
+            
+            def average(values):
+                return sum(values) / len(values) if values else 0
+            
+            def minimum(values):
+                return min(values) if values else None
             
+            utilization_data = {}
             for instance_id in instance_ids:
-                # Get CPU utilization metrics
-                cpu_response = self.cloudwatch_client.get_metric_statistics(
-                    Namespace='AWS/RDS',
-                    MetricName='CPUUtilization',
-                    Dimensions=[
-                        {
-                            'Name': 'DBInstanceIdentifier',
-                            'Value': instance_id
-                        }
-                    ],
-                    StartTime=start_time,
-                    EndTime=end_time,
-                    Period=3600,  # 1 hour periods
-                    Statistics=['Average', 'Maximum']
-                )
-                
-                # Get database connections
-                connections_response = self.cloudwatch_client.get_metric_statistics(
-                    Namespace='AWS/RDS',
-                    MetricName='DatabaseConnections',
-                    Dimensions=[
-                        {
-                            'Name': 'DBInstanceIdentifier',
-                            'Value': instance_id
-                        }
-                    ],
-                    StartTime=start_time,
-                    EndTime=end_time,
-                    Period=3600,  # 1 hour periods
-                    Statistics=['Average', 'Maximum']
-                )
-                
-                # Get read IOPS
-                read_iops_response = self.cloudwatch_client.get_metric_statistics(
-                    Namespace='AWS/RDS',
-                    MetricName='ReadIOPS',
-                    Dimensions=[
-                        {
-                            'Name': 'DBInstanceIdentifier',
-                            'Value': instance_id
-                        }
-                    ],
-                    StartTime=start_time,
-                    EndTime=end_time,
-                    Period=3600,
-                    Statistics=['Average', 'Maximum']
-                )
-                
-                # Get write IOPS
-                write_iops_response = self.cloudwatch_client.get_metric_statistics(
-                    Namespace='AWS/RDS',
-                    MetricName='WriteIOPS',
-                    Dimensions=[
-                        {
-                            'Name': 'DBInstanceIdentifier',
-                            'Value': instance_id
-                        }
-                    ],
-                    StartTime=start_time,
-                    EndTime=end_time,
-                    Period=3600,
-                    Statistics=['Average', 'Maximum']
-                )
-                
-                # Calculate average metrics
-                cpu_values = [point['Average'] for point in cpu_response['Datapoints']]
-                avg_cpu = sum(cpu_values) / len(cpu_values) if cpu_values else 0
-                max_cpu = max([point['Maximum'] for point in cpu_response['Datapoints']]) if cpu_response['Datapoints'] else 0
-                
-                connection_values = [point['Average'] for point in connections_response['Datapoints']]
-                avg_connections = sum(connection_values) / len(connection_values) if connection_values else 0
-                max_connections = max([point['Maximum'] for point in connections_response['Datapoints']]) if connections_response['Datapoints'] else 0
-                
-                read_iops_values = [point['Average'] for point in read_iops_response['Datapoints']]
-                avg_read_iops = sum(read_iops_values) / len(read_iops_values) if read_iops_values else 0
-                
-                write_iops_values = [point['Average'] for point in write_iops_response['Datapoints']]
-                avg_write_iops = sum(write_iops_values) / len(write_iops_values) if write_iops_values else 0
-                
+                metrics = series[instance_id]
                 utilization_data[instance_id] = {
-                    'avg_cpu': avg_cpu,
-                    'max_cpu': max_cpu,
-                    'avg_connections': avg_connections,
-                    'max_connections': max_connections,
-                    'avg_read_iops': avg_read_iops,
-                    'avg_write_iops': avg_write_iops,
-                    'data_points': len(cpu_values)
+                    'avg_cpu': average(metrics['cpu_avg']),
+                    'max_cpu': max(metrics['cpu_max']) if metrics['cpu_max'] else 0,
+                    'avg_connections': average(metrics['connections_avg']),
+                    'max_connections': max(metrics['connections_max']) if metrics['connections_max'] else 0,
+                    'avg_read_iops': average(metrics['read_iops']),
+                    'avg_write_iops': average(metrics['write_iops']),
+                    'min_free_storage_bytes': minimum(metrics['free_storage_min']),
+                    'data_points': len(metrics['cpu_avg'])
                 }
             
             return utilization_data
@@ -118,36 +76,102 @@ class RDSCostAnalyzer:
             logger.error(f"Error analyzing RDS instance utilization: {str(e)}")
             return {}
     
+    def collect_metric_series(self, instance_ids: List[str], start_time: datetime, 
+                              end_time: datetime) -> Dict[str, Dict[str, List[float]]]:
+        """Pull every RDS utilization metric for all instances via batched GetMetricData"""
+        series = {
+            instance_id: {key: [] for key, _, _ in RDS_UTILIZATION_METRICS}
+            for instance_id in instance_ids
+        }
+        
+        shared = self.shared_data.get('metrics')
+        hours = int((end_time - start_time).total_seconds() // 3600)
+        if shared and shared['days'] * 24 == hours and set(instance_ids) <= set(shared['series']):
+            for instance_id in instance_ids:
+                for key, metric_name, stat in RDS_UTILIZATION_METRICS:
+                    values = shared['series'][instance_id].get(f'{metric_name}/{stat}', [])
+                    series[instance_id][key] = [value for value in values if value is not None]
+            return series
+        
+        queries = []
+        query_targets = {}
+        for index, instance_id in enumerate(instance_ids):
+            for key, metric_name, stat in RDS_UTILIZATION_METRICS:
+                query_id = f'{key}_{index}'
+                query_targets[query_id] = (instance_id, key)
+                queries.append({
+                    'Id': query_id,
+                    'MetricStat': {
+                        'Metric': {
+                            'Namespace': 'AWS/RDS',
+                            'MetricName': metric_name,
+                            'Dimensions': [{'Name': 'DBInstanceIdentifier', 'Value': instance_id}]
+                        },
+                        'Period': 3600,
+                        'Stat': stat
+                    },
+                    'ReturnData': True
+                })
+        
+        paginator = self.cloudwatch_client.get_paginator('get_metric_data')
+        for i in range(0, len(queries), METRIC_QUERIES_PER_REQUEST):
+            for page in paginator.paginate(
+                MetricDataQueries=queries[i:i + METRIC_QUERIES_PER_REQUEST],
+                StartTime=start_time,
+                EndTime=end_time
+            ):
+                for result in page['MetricDataResults']:
+                    if result['Id'] in query_targets:
+                        instance_id, key = query_targets[result['Id']]
+                        series[instance_id][key].extend(result['Values'])
+        
+        return series
+    
+    def describe_instances(self) -> Dict[str, Dict[str, Any]]:
+        """Describe every DB instance once per invocation, indexed by identifier"""
+        if self.instance_map is None:
+            instance_map = {}
+            paginator = self.rds_client.get_paginator('describe_db_instances')
+            for page in paginator.paginate():
+                for instance in page['DBInstances']:
+                    instance_map[instance['DBInstanceIdentifier']] = instance
+            self.instance_map = instance_map
+        return self.instance_map
+    
+    def get_available_instance_ids(self) -> List[str]:
+        """List identifiers of DB instances in the available state"""
+        return [
+            instance_id for instance_id, instance in self.describe_instances().items()
+            if instance['DBInstanceStatus'] == 'available'
+        ]
+    
     def get_instance_details(self, instance_ids: List[str]) -> Dict[str, Any]:
         """Get detailed information about RDS instances"""
         try:
+            instance_map = self.describe_instances()
             instances_info = {}
             
             for instance_id in instance_ids:
-                try:
-                    response = self.rds_client.describe_db_instances(
-                        DBInstanceIdentifier=instance_id
-                    )
-                    
-                    if response['DBInstances']:
-                        instance = response['DBInstances'][0]
-                        instances_info[instance_id] = {
-                            'instance_class': instance['DBInstanceClass'],
-                            'engine': instance['Engine'],
-                            'engine_version': instance['EngineVersion'],
-                            'allocated_storage': instance['AllocatedStorage'],
-                            'storage_type': instance['StorageType'],
-                            'multi_az': instance['MultiAZ'],
-                            'status': instance['DBInstanceStatus'],
-                            'availability_zone': instance['AvailabilityZone'],
-                            'tags': {tag['Key']: tag['Value'] for tag in instance.get('TagList', [])},
-                            'backup_retention_period': instance.get('BackupRetentionPeriod', 0),
-                            'storage_encrypted': instance.get('StorageEncrypted', False),
-                            'creation_time': instance['InstanceCreateTime'].isoformat()
-                        }
-                except Exception as e:
-                    logger.error(f"Error getting details for instance {instance_id}: {str(e)}")
-                    instances_info[instance_id] = {'error': str(e)}
+                instance = instance_map.get(instance_id)
+                if instance is None:
+                    logger.error(f"Error getting details for instance {instance_id}: DB instance not found")
+                    instances_info[instance_id] = {'error': f'DB instance {instance_id} not found'}
+                    continue
+                
+                instances_info[instance_id] = {
+                    'instance_class': instance['DBInstanceClass'],
+                    'engine': instance['Engine'],
+                    'engine_version': instance['EngineVersion'],
+                    'allocated_storage': instance['AllocatedStorage'],
+                    'storage_type': instance['StorageType'],
+                    'multi_az': instance['MultiAZ'],
+                    'status': instance['DBInstanceStatus'],
+                    'availability_zone': instance.get('AvailabilityZone'),
+                    'tags': {tag['Key']: tag['Value'] for tag in instance.get('TagList', [])},
+                    'backup_retention_period': instance.get('BackupRetentionPeriod', 0),
+                    'storage_encrypted': instance.get('StorageEncrypted', False),
+                    'creation_time': self._isoformat(instance.get('InstanceCreateTime'))
+                }
             
             return instances_info
             
@@ -155,9 +179,30 @@ class RDSCostAnalyzer:
             logger.error(f"Error getting RDS instance details: {str(e)}")
             return {}
     
+    @staticmethod
+    def _isoformat(value: Any) -> str:
+        """Timestamps arrive as datetimes from boto3 and as ISO strings in prefetched shared data"""
+        if value is None or isinstance(value, str):
+            return value
+        return value.isoformat()
+    
     def get_instance_costs(self, instance_ids: List[str], days: int = 30) -> Dict[str, Any]:
         """Get cost information for specific RDS instances"""
         try:
+            cube = self.shared_data.get('cost_cube')
+            if cube and cube['days'] == days:
+                daily = defaultdict(float)
+                for date, service, _, amount in cube['rows']:
+                    if service == RDS_COST_SERVICE:
+                        daily[date] += amount
+                total_cost = sum(daily.values())
+                return {
+                    'total_cost': total_cost,
+                    'daily_costs': [{'date': date, 'cost': cost} for date, cost in sorted(daily.items())],
+                    'average_daily_cost': total_cost / days if days > 0 else 0,
+                    'estimated_per_instance_cost': total_cost / len(instance_ids) if instance_ids else 0
+                }
+            
             end_date = datetime.utcnow().date()
             start_date = end_date - timedelta(days=days)
             
@@ -178,7 +223,7 @@ class RDSCostAnalyzer:
                 Filter={
                     'Dimensions': {
                         'Key': 'SERVICE',
-                        'Values': ['Amazon Relational Database Service']
+                        'Values': [RDS_COST_SERVICE]
                     }
                 }
             )
@@ -270,6 +315,23 @@ class RDSCostAnalyzer:
                         'estimated_savings_percent': 25
                     })
             
+            # Check for allocated storage that stayed mostly free over the whole period
+            allocated_gb = instance_info.get('allocated_storage', 0)
+            min_free_bytes = utilization.get('min_free_storage_bytes')
+            if allocated_gb and min_free_bytes is not None and min_free_bytes >= allocated_gb * GIB * RDS_STORAGE_FREE_FRACTION:
+                peak_used_gb = max(allocated_gb - min_free_bytes / GIB, 0)
+                opportunities.append({
+                    'type': 'storage_right_sizing',
+                    'instance_id': instance_id,
+                    'storage_type': instance_info.get('storage_type'),
+                    'allocated_storage_gb': allocated_gb,
+                    'peak_used_storage_gb': round(peak_used_gb, 1),
+                    'unused_storage_gb': round(allocated_gb - peak_used_gb, 1),
+                    'recommendation': 'Allocated storage cannot be reduced in place; move to a smaller allocation '
+                                      '(snapshot restore or blue/green deployment) and enable storage autoscaling',
+                    'priority': 'medium' if allocated_gb >= 500 else 'low'
+                })
+            
             # Check for instances without proper tagging
             tags = instance_info.get('tags', {})
             required_tags = ['Environment', 'Owner', 'Project']
@@ -304,7 +366,7 @@ def lambda_handler(event, context):
         logger.info(f"Received event: {json.dumps(event)}")
         
         # Initialize the analyzer
-        analyzer = RDSCostAnalyzer()
+        analyzer = RDSCostAnalyzer(event.get('shared_data'))
         
         # Extract parameters from the event
         action = event.get('action', 'analyze_all')
@@ -314,11 +376,7 @@ def lambda_handler(event, context):
         # If no specific instances provided, get all running instances
         if not instance_ids:
             try:
-                rds_response = analyzer.rds_client.describe_db_instances()
-                instance_ids = []
-                for instance in rds_response['DBInstances']:
-                    if instance['DBInstanceStatus'] == 'available':
-                        instance_ids.append(instance['DBInstanceIdentifier'])
+                instance_ids = analyzer.get_available_instance_ids()
                         
             except Exception as e:
                 logger.error(f"Error getting RDS instances: {str(e)}")
@@ -1,7 +1,15 @@
+import os
 import json
+import time
 import boto3
 import logging
-from datetime import datetime, timedelta
+import threading
+import numpy as np
+from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor
+from bisect import bisect_right
+from itertools import accumulate
+from datetime import datetime, timedelta, timezone
 from typing import Dict, List, Any
 from collections import defaultdict
 
@@ -9,10 +17,438 @@ from collections import defaultdict
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+# Cost Explorer allows a handful of requests per second per account; stay under it across threads
+CE_REQUESTS_PER_SECOND = float(os.environ.get('CE_REQUESTS_PER_SECOND', '5'))
+
+# Cost Explorer responses per (operation, request), reused by warm invocations for the same window
+CE_CACHE_TTL_SECONDS = int(os.environ.get('CE_CACHE_TTL_SECONDS', '3600'))
+_ce_response_cache: Dict[str, Any] = {}
+_ce_cache_lock = threading.Lock()
+# Upper bound on pages merged per Cost Explorer call; a repeated page token also ends the read
+CE_MAX_PAGES = 50
+
+class RateLimiter:
+    """Token bucket shared by every thread issuing Cost Explorer requests"""
+    
+    def __init__(self, rate: float, burst: float = None):
+        self.rate = rate
+        self.capacity = burst or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+    
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+ce_rate_limiter = RateLimiter(CE_REQUESTS_PER_SECOND)
+
+# Effective discount versus on-demand by commitment type, term in years and payment option
+COMMITMENT_DISCOUNTS = {
+    'compute_sp': {
+        1: {'no_upfront': 0.17, 'partial_upfront': 0.20, 'all_upfront': 0.22},
+        3: {'no_upfront': 0.36, 'partial_upfront': 0.40, 'all_upfront': 0.42}
+    },
+    'ec2_instance_sp': {
+        1: {'no_upfront': 0.28, 'partial_upfront': 0.31, 'all_upfront': 0.33},
+        3: {'no_upfront': 0.47, 'partial_upfront': 0.51, 'all_upfront': 0.53}
+    },
+    'reserved_instance': {
+        1: {'no_upfront': 0.30, 'partial_upfront': 0.33, 'all_upfront': 0.35},
+        3: {'no_upfront': 0.50, 'partial_upfront': 0.54, 'all_upfront': 0.57}
+    }
+}
+# Compute Savings Plans float across every pool; the others are bound to one instance family and region
+POOLED_COMMITMENT_TYPES = {'ec2_instance_sp', 'reserved_instance'}
+PAYMENT_UPFRONT_FRACTION = {'no_upfront': 0.0, 'partial_upfront': 0.5, 'all_upfront': 1.0}
+# Commitment levels swept, as quantiles of hourly eligible on-demand spend
+COMMITMENT_LEVEL_QUANTILES = np.linspace(0.0, 1.0, 101)[1:]
+HOURS_PER_YEAR = 8760
+HOURS_PER_MONTH = 730
+
+# Cost Explorer keeps hourly granularity for the last 14 days only
+USAGE_LOOKBACK_DAYS = 14
+
+# Regions whose Reserved Instances make up the portfolio; defaults to the client's region
+COMMITMENT_REGIONS = [region for region in os.environ.get('COMMITMENT_REGIONS', '').split(',') if region]
+
+# Portfolio built from describe calls, reused by warm invocations
+PORTFOLIO_TTL_SECONDS = int(os.environ.get('PORTFOLIO_TTL_SECONDS', '3600'))
+_portfolio_cache: Dict[tuple, Any] = {}
+
+# Renewal alerts look this far ahead; commitments inside the first tier are high priority
+RENEWAL_ALERT_DAYS = 90
+RENEWAL_HIGH_PRIORITY_DAYS = 30
+
+# Savings Plans API labels mapped onto the simulator's commitment types and payment options
+SAVINGS_PLAN_TYPES = {'Compute': 'compute_sp', 'EC2Instance': 'ec2_instance_sp'}
+PAYMENT_OPTION_KEYS = {
+    'No Upfront': 'no_upfront',
+    'Partial Upfront': 'partial_upfront',
+    'All Upfront': 'all_upfront'
+}
+
+def _capped_sums(usage: np.ndarray, capacity: np.ndarray) -> np.ndarray:
+    """sum over hours of min(usage[h, c], capacity[l, c]) for every level l and column c
+    
+    Each column is sorted once and all columns are laid end to end with disjoint offsets, so a
+    single searchsorted over the flattened array answers every (level, column) pair.
+    """
+    hours, columns = usage.shape
+    ordered = np.sort(usage, axis=0)
+    prefix = np.vstack([np.zeros((1, columns)), np.cumsum(ordered, axis=0)])
+    span = max(float(ordered.max(initial=0)), float(capacity.max(initial=0))) + 1.0
+    offsets = np.arange(columns) * span
+    flat = (ordered + offsets).T.ravel()
+    below = np.searchsorted(flat, capacity + offsets, side='right') - np.arange(columns) * hours
+    return prefix[below, np.arange(columns)] + capacity * (hours - below)
+
+def _residual_usage(usage: np.ndarray, pools: List[str], commitments: List[Dict[str, Any]]) -> np.ndarray:
+    """Usage left on-demand after existing commitments apply, pool-bound ones first"""
+    residual = usage.copy()
+    for commitment in sorted(commitments, key=lambda c: c.get('pool') is None):
+        capacity = commitment['hourly_commitment'] / (1 - commitment['discount'])
+        if commitment.get('pool') is not None:
+            column = pools.index(commitment['pool'])
+            residual[:, column] = np.maximum(residual[:, column] - capacity, 0)
+        else:
+            total = residual.sum(axis=1)
+            covered = np.minimum(total, capacity)
+            residual *= np.divide(total - covered, total, out=np.zeros_like(total), where=total > 0)[:, None]
+    return residual
+
+def simulate_commitments(usage: np.ndarray, pools: List[str], existing: List[Dict[str, Any]] = None,
+                         commitment_types: List[str] = None, terms: List[int] = None,
+                         payment_options: List[str] = None,
+                         level_quantiles: np.ndarray = None) -> Dict[str, Any]:
+    """Evaluate every (commitment type, term, payment option, level) purchase against hourly usage
+    
+    usage is an (hours, pools) matrix of eligible on-demand spend per hour, taken as the profile
+    that repeats over the term. Existing commitments ({'hourly_commitment', 'discount',
+    'expires_in_hours', optional 'pool'}) absorb usage until they expire, which splits the horizon
+    into a few segments; a new commitment of capacity k covers sum(min(usage, k)) per segment.
+    Coverage only depends on scope and level, so it is computed once and broadcast over terms
+    and payment options. Result arrays are shaped (types, terms, payment options, levels).
+    """
+    usage = np.asarray(usage, dtype=np.float64)
+    existing = existing or []
+    commitment_types = commitment_types or list(COMMITMENT_DISCOUNTS)
+    terms = terms or [1, 3]
+    payment_options = payment_options or list(PAYMENT_UPFRONT_FRACTION)
+    quantiles = COMMITMENT_LEVEL_QUANTILES if level_quantiles is None else np.asarray(level_quantiles, dtype=np.float64)
+    profile_hours = usage.shape[0]
+    term_hours = np.array(terms, dtype=np.float64) * HOURS_PER_YEAR
+    
+    # Segments between existing commitment expiries: starts[k], lengths[k, term]
+    expiries = sorted({float(c['expires_in_hours']) for c in existing if 0 < c['expires_in_hours'] < term_hours.max()})
+    starts = np.array([0.0] + expiries)
+    ends = np.append(starts[1:], np.inf)
+    lengths = np.clip(np.minimum(ends[:, None], term_hours[None, :]) - starts[:, None], 0, None)
+    residuals = [
+        _residual_usage(usage, pools, [c for c in existing if c['expires_in_hours'] > start])
+        for start in starts
+    ]
+    
+    # Capacity per level in on-demand dollars: one pooled figure for Compute SP, one per pool otherwise
+    total_capacity = np.quantile(usage.sum(axis=1), quantiles)
+    pool_capacity = np.quantile(usage, quantiles, axis=0)
+    covered_by_scope = {
+        False: np.stack([_capped_sums(r.sum(axis=1, keepdims=True), total_capacity[:, None])[:, 0] for r in residuals]),
+        True: np.stack([_capped_sums(r, pool_capacity).sum(axis=1) for r in residuals])
+    }
+    capacity_by_scope = {False: total_capacity, True: pool_capacity.sum(axis=1)}
+    
+    pooled = [t in POOLED_COMMITMENT_TYPES for t in commitment_types]
+    covered = np.stack([covered_by_scope[p] for p in pooled])[:, None, None, :, :]     # (T, 1, 1, K, L)
+    capacity = np.stack([capacity_by_scope[p] for p in pooled])[:, None, None, :]       # (T, 1, 1, L)
+    discount = np.array([[[COMMITMENT_DISCOUNTS[t][term][option] for option in payment_options]
+                          for term in terms] for t in commitment_types])[..., None]      # (T, R, P, 1)
+    upfront_fraction = np.array([PAYMENT_UPFRONT_FRACTION[o] for o in payment_options])[None, None, :, None]
+    weights = (lengths.T / profile_hours)[None, :, None, :, None]                        # (1, R, 1, K, 1)
+    
+    hourly_commitment = capacity * (1 - discount)
+    commitment_cost = hourly_commitment * term_hours[None, :, None, None]
+    covered_on_demand = (covered * weights).sum(axis=3)
+    residual_on_demand = np.array([r.sum() for r in residuals])
+    baseline_on_demand = (lengths.T / profile_hours) @ residual_on_demand                 # (R,)
+    total_on_demand = usage.sum() * term_hours / profile_hours
+    net_savings = covered_on_demand - commitment_cost
+    upfront_cost = commitment_cost * upfront_fraction
+    
+    # Break-even: first hour cumulative savings repay the upfront fee, piecewise linear per segment
+    rate = covered / profile_hours - (hourly_commitment * (1 - upfront_fraction))[..., None, :]
+    accrued = np.cumsum(rate * lengths.T[None, :, None, :, None], axis=3) - upfront_cost[..., None, :]
+    before = accrued - rate * lengths.T[None, :, None, :, None]
+    crossed = (accrued >= 0) & (lengths.T[None, :, None, :, None] > 0)
+    first = np.argmax(crossed, axis=3)[..., None, :]
+    crossing_rate = np.take_along_axis(rate, first, axis=3)[..., 0, :]
+    shortfall = np.maximum(-np.take_along_axis(before, first, axis=3)[..., 0, :], 0)
+    break_even_hours = starts[first[..., 0, :]] + np.divide(
+        shortfall, crossing_rate, out=np.zeros_like(shortfall), where=crossing_rate > 0)
+    break_even_hours = np.where(crossed.any(axis=3), break_even_hours, np.nan)
+    
+    term_axis = (None, slice(None), None, None)
+    utilization = np.divide(covered_on_demand, capacity * term_hours[term_axis],
+                            out=np.zeros_like(covered_on_demand), where=capacity > 0)
+    already_covered = (total_on_demand - baseline_on_demand)[term_axis]
+    coverage = np.divide(already_covered + covered_on_demand, total_on_demand[term_axis],
+                         out=np.zeros_like(covered_on_demand), where=total_on_demand[term_axis] > 0)
+    
+    return {
+        'commitment_types': commitment_types,
+        'terms': terms,
+        'payment_options': payment_options,
+        'level_quantiles': quantiles,
+        'hourly_commitment': np.broadcast_to(hourly_commitment, net_savings.shape),
+        'upfront_cost': upfront_cost,
+        'net_savings': net_savings,
+        'utilization': np.broadcast_to(utilization, net_savings.shape),
+        'coverage': np.broadcast_to(coverage, net_savings.shape),
+        'break_even_months': break_even_hours / HOURS_PER_MONTH
+    }
+
+def validate_simulation_request(event: Dict[str, Any], pools: List[str] = None) -> List[str]:
+    """Problems with a simulate_commitments request's options, and with its existing commitments once pools are known"""
+    errors = []
+    for field, allowed in [('commitment_types', list(COMMITMENT_DISCOUNTS)), ('terms', [1, 3]),
+                           ('payment_options', list(PAYMENT_UPFRONT_FRACTION))]:
+        values = event.get(field)
+        if values is None:
+            continue
+        if not isinstance(values, list) or not values:
+            errors.append(f"{field} must be a non-empty list drawn from {allowed}")
+            continue
+        unknown = [value for value in values if value not in allowed]
+        if unknown:
+            errors.append(f"Unsupported {field} {unknown}; expected values from {allowed}")
+    
+    if event.get('usage') is not None:
+        rows = event['usage']
+        if not isinstance(event.get('pools'), list):
+            errors.append("pools must list one pool per usage column")
+        elif not isinstance(rows, list) or any(not isinstance(row, list) or len(row) != len(event['pools']) for row in rows):
+            errors.append("usage must be a list of hourly rows with one value per pool")
+    
+    if pools is not None:
+        for i, commitment in enumerate(event.get('existing_commitments') or []):
+            missing = [key for key in ('hourly_commitment', 'discount', 'expires_in_hours') if key not in commitment]
+            if missing:
+                errors.append(f"existing_commitments[{i}] is missing {missing}")
+            elif not 0 <= commitment['discount'] < 1:
+                errors.append(f"existing_commitments[{i}] discount must be in [0, 1)")
+            if commitment.get('pool') is not None and commitment['pool'] not in pools:
+                errors.append(f"existing_commitments[{i}] pool '{commitment['pool']}' is not one of the usage pools")
+    return errors
+
+def rank_commitment_scenarios(simulation: Dict[str, Any], top: int = 10) -> List[Dict[str, Any]]:
+    """Flatten a simulation into its highest net-savings scenarios"""
+    net_savings = simulation['net_savings']
+    order = np.argsort(net_savings, axis=None)[::-1][:top]
+    scenarios = []
+    for t, r, p, l in zip(*np.unravel_index(order, net_savings.shape)):
+        term = simulation['terms'][r]
+        break_even = simulation['break_even_months'][t, r, p, l]
+        scenarios.append({
+            'commitment_type': simulation['commitment_types'][t],
+            'term_years': term,
+            'payment_option': simulation['payment_options'][p],
+            'level_quantile': round(float(simulation['level_quantiles'][l]), 4),
+            'hourly_commitment': round(float(simulation['hourly_commitment'][t, r, p, l]), 4),
+            'upfront_cost': round(float(simulation['upfront_cost'][t, r, p, l]), 2),
+            'net_savings': round(float(net_savings[t, r, p, l]), 2),
+            'estimated_monthly_savings': round(float(net_savings[t, r, p, l]) / (term * 12), 2),
+            'utilization_percentage': round(float(simulation['utilization'][t, r, p, l]) * 100, 2),
+            'coverage_percentage': round(float(simulation['coverage'][t, r, p, l]) * 100, 2),
+            'break_even_months': None if np.isnan(break_even) else round(float(break_even), 1)
+        })
+    return scenarios
+
+class CommitmentPortfolio:
+    """Interval index over Reserved Instances and Savings Plans
+    
+    Commitments are dicts with 'start' and 'end' as epoch seconds and 'hourly_commitment' in $/hour.
+    Start and end points become a sorted step function of committed $/hour per kind, and
+    commitments are kept ordered by end, so both rate lookups and expiry windows are one bisect.
+    """
+    
+    KINDS = ('reserved_instance', 'savings_plan')
+    
+    def __init__(self, commitments: List[Dict[str, Any]]):
+        self.commitments = sorted(commitments, key=lambda c: c['end'])
+        self.ends = [c['end'] for c in self.commitments]
+        self.rate_index = {None: self._build_rate_index(self.commitments)}
+        for kind in self.KINDS:
+            self.rate_index[kind] = self._build_rate_index([c for c in self.commitments if c['kind'] == kind])
+    
+    @staticmethod
+    def _build_rate_index(commitments: List[Dict[str, Any]]) -> tuple:
+        deltas = defaultdict(float)
+        for commitment in commitments:
+            deltas[commitment['start']] += commitment['hourly_commitment']
+            deltas[commitment['end']] -= commitment['hourly_commitment']
+        times = sorted(deltas)
+        return times, list(accumulate(deltas[t] for t in times))
+    
+    def committed_at(self, timestamp: float, kind: str = None) -> float:
+        """Committed $/hour in force at an epoch timestamp"""
+        times, rates = self.rate_index[kind]
+        i = bisect_right(times, timestamp) - 1
+        return max(rates[i], 0.0) if i >= 0 else 0.0
+    
+    def expiring_between(self, start: float, end: float) -> List[Dict[str, Any]]:
+        """Commitments whose end falls in (start, end]"""
+        return self.commitments[bisect_right(self.ends, start):bisect_right(self.ends, end)]
+    
+    def expiring_within(self, days: float, now: float = None) -> List[Dict[str, Any]]:
+        now = time.time() if now is None else now
+        return self.expiring_between(now, now + days * 86400)
+    
+    def project_coverage(self, current_coverage: Dict[str, float], days: int = RENEWAL_ALERT_DAYS,
+                         step_days: int = 7, now: float = None) -> List[Dict[str, Any]]:
+        """Coverage over the coming days if nothing is renewed
+        
+        Current coverage percentages per kind are scaled by the share of today's committed $/hour
+        still in force, assuming eligible usage stays where it is.
+        """
+        now = time.time() if now is None else now
+        today = {kind: self.committed_at(now, kind) for kind in self.KINDS}
+        projection = []
+        for day in range(0, days + 1, step_days):
+            timestamp = now + day * 86400
+            point = {
+                'date': datetime.fromtimestamp(timestamp, timezone.utc).strftime('%Y-%m-%d'),
+                'committed_hourly': round(self.committed_at(timestamp), 4)
+            }
+            for kind in self.KINDS:
+                share = self.committed_at(timestamp, kind) / today[kind] if today[kind] > 0 else 0.0
+                point[f'{kind}_coverage'] = round(current_coverage.get(kind, 0.0) * share, 2)
+            projection.append(point)
+        return projection
+    
+    def renewal_alerts(self, days: int = RENEWAL_ALERT_DAYS, now: float = None) -> List[Dict[str, Any]]:
+        """One alert per commitment expiring inside the window"""
+        now = time.time() if now is None else now
+        alerts = []
+        for commitment in self.expiring_within(days, now):
+            days_remaining = (commitment['end'] - now) / 86400
+            alerts.append({
+                'type': 'commitment_expiring',
+                'commitment_id': commitment['id'],
+                'commitment_kind': commitment['kind'],
+                'commitment_type': commitment.get('commitment_type'),
+                'expires_at': datetime.fromtimestamp(commitment['end'], timezone.utc).isoformat(),
+                'days_remaining': round(days_remaining, 1),
+                'hourly_commitment': commitment['hourly_commitment'],
+                'recommendation': f"{commitment['kind'].replace('_', ' ').title()} {commitment['id']} expires in {days_remaining:.0f} days; "
+                                  f"${commitment['hourly_commitment']:.2f}/hour of commitment will revert to on-demand unless renewed.",
+                'priority': 'high' if days_remaining <= RENEWAL_HIGH_PRIORITY_DAYS else 'medium'
+            })
+        return alerts
+    
+    def existing_commitments(self, kinds: List[str] = None, now: float = None) -> List[Dict[str, Any]]:
+        """Active commitments in the form simulate_commitments() takes"""
+        now = time.time() if now is None else now
+        kinds = kinds or list(self.KINDS)
+        existing = []
+        for commitment in self.commitments[bisect_right(self.ends, now):]:
+            if commitment['kind'] not in kinds or commitment['start'] > now:
+                continue
+            term_years = 3 if commitment['term_years'] >= 2 else 1
+            discounts = COMMITMENT_DISCOUNTS.get(commitment['commitment_type'], {}).get(term_years, {})
+            existing.append({
+                'hourly_commitment': commitment['hourly_commitment'],
+                'discount': discounts.get(commitment['payment_option'], 0.0),
+                'expires_in_hours': (commitment['end'] - now) / 3600,
+                'pool': commitment.get('pool')
+            })
+        return existing
+    
+    def summary(self, now: float = None) -> Dict[str, Any]:
+        now = time.time() if now is None else now
+        return {
+            'commitment_count': len(self.commitments) - bisect_right(self.ends, now),
+            'committed_hourly': round(self.committed_at(now), 4),
+            'reserved_instance_hourly': round(self.committed_at(now, 'reserved_instance'), 4),
+            'savings_plan_hourly': round(self.committed_at(now, 'savings_plan'), 4),
+            'expiring_hourly_within_alert_window': round(
+                sum(c['hourly_commitment'] for c in self.expiring_within(RENEWAL_ALERT_DAYS, now)), 4)
+        }
+
 class RISavingsPlansAnalyzer:
+    # Collection stage: name -> method, all independent Cost Explorer reads
+    COLLECTORS = {
+        'ri_utilization': 'get_ri_utilization',
+        'ri_coverage': 'get_ri_coverage',
+        'ri_recommendations': 'get_ri_recommendations',
+        'sp_utilization': 'get_savings_plans_utilization',
+        'sp_coverage': 'get_savings_plans_coverage',
+        'sp_recommendations': 'get_savings_plans_recommendations'
+    }
+    
     def __init__(self):
-        self.ce_client = boto3.client('ce')
+        # Adaptive retries back off client-side when Cost Explorer throttles
+        self.ce_client = boto3.client('ce', config=Config(retries={'max_attempts': 8, 'mode': 'adaptive'}))
         self.ec2_client = boto3.client('ec2')
+        self.savingsplans_client = boto3.client('savingsplans')
+    
+    def collect(self, days: int = 30, names: List[str] = None) -> Dict[str, Any]:
+        """Run the selected collectors concurrently; latency is that of the slowest call"""
+        names = names or list(self.COLLECTORS)
+        
+        def run(name):
+            method = getattr(self, self.COLLECTORS[name])
+            return method(days) if name.endswith(('utilization', 'coverage')) else method()
+        
+        with ThreadPoolExecutor(max_workers=len(names)) as executor:
+            return dict(zip(names, executor.map(run, names)))
+    
+    def call_ce(self, operation: str, list_keys: List[str], **request) -> Dict[str, Any]:
+        """Call a Cost Explorer operation through the rate limiter, following pages up to a cap and caching the merged result"""
+        cache_key = json.dumps([operation, request], sort_keys=True)
+        with _ce_cache_lock:
+            cached = _ce_response_cache.get(cache_key)
+        if cached and cached['expires_at'] > time.time():
+            return cached['value']
+        
+        merged = None
+        seen_tokens = set()
+        for _ in range(CE_MAX_PAGES):
+            ce_rate_limiter.acquire()
+            response = getattr(self.ce_client, operation)(**request)
+            if merged is None:
+                merged = response
+            else:
+                for key in list_keys:
+                    merged.setdefault(key, []).extend(response.get(key, []))
+            
+            # Reservation APIs page with NextPageToken, Savings Plans coverage with NextToken
+            token_field = 'NextPageToken' if 'NextPageToken' in response else 'NextToken'
+            token = response.get(token_field)
+            if not token:
+                break
+            if token in seen_tokens:
+                logger.warning(f"Cost Explorer repeated a page token; stopping {operation}")
+                break
+            seen_tokens.add(token)
+            request[token_field] = token
+        else:
+            logger.warning(f"{operation} truncated at {CE_MAX_PAGES} pages")
+        
+        merged.pop('NextPageToken', None)
+        merged.pop('NextToken', None)
+        with _ce_cache_lock:
+            for key in [key for key, entry in _ce_response_cache.items() if entry['expires_at'] <= time.time()]:
+                del _ce_response_cache[key]
+            _ce_response_cache[cache_key] = {'expires_at': time.time() + CE_CACHE_TTL_SECONDS, 'value': merged}
+        return merged
         
     def get_ri_utilization(self, days: int = 30) -> Dict[str, Any]:
         """Get Reserved Instance utilization data"""
@@ -21,7 +457,8 @@ class RISavingsPlansAnalyzer:
             start_date = end_date - timedelta(days=days)
             
             # Get RI utilization
-            response = self.ce_client.get_reservation_utilization(
+            response = self.call_ce(
+                'get_reservation_utilization', ['UtilizationsByTime'],
                 TimePeriod={
                     'Start': start_date.strftime('%Y-%m-%d'),
                     'End': end_date.strftime('%Y-%m-%d')
@@ -82,7 +519,8 @@ class RISavingsPlansAnalyzer:
             start_date = end_date - timedelta(days=days)
             
             # Get Savings Plans utilization
-            response = self.ce_client.get_savings_plans_utilization(
+            response = self.call_ce(
+                'get_savings_plans_utilization', ['SavingsPlansUtilizationsByTime'],
                 TimePeriod={
                     'Start': start_date.strftime('%Y-%m-%d'),
                     'End': end_date.strftime('%Y-%m-%d')
@@ -139,7 +577,8 @@ class RISavingsPlansAnalyzer:
             start_date = end_date - timedelta(days=days)
             
             # Get RI coverage
-            response = self.ce_client.get_reservation_coverage(
+            response = self.call_ce(
+                'get_reservation_coverage', ['CoveragesByTime'],
                 TimePeriod={
                     'Start': start_date.strftime('%Y-%m-%d'),
                     'End': end_date.strftime('%Y-%m-%d')
@@ -198,7 +637,8 @@ class RISavingsPlansAnalyzer:
             start_date = end_date - timedelta(days=days)
             
             # Get Savings Plans coverage
-            response = self.ce_client.get_savings_plans_coverage(
+            response = self.call_ce(
+                'get_savings_plans_coverage', ['SavingsPlansCoverages'],
                 TimePeriod={
                     'Start': start_date.strftime('%Y-%m-%d'),
                     'End': end_date.strftime('%Y-%m-%d')
@@ -247,7 +687,8 @@ class RISavingsPlansAnalyzer:
     def get_ri_recommendations(self) -> Dict[str, Any]:
         """Get Reserved Instance purchase recommendations"""
         try:
-            response = self.ce_client.get_reservation_purchase_recommendation(
+            response = self.call_ce(
+                'get_reservation_purchase_recommendation', ['Recommendations'],
                 Service='EC2',
                 PaymentOption='ALL_UPFRONT',
                 Term='ONE_YEAR',
@@ -293,7 +734,8 @@ class RISavingsPlansAnalyzer:
     def get_savings_plans_recommendations(self) -> Dict[str, Any]:
         """Get Savings Plans purchase recommendations"""
         try:
-            response = self.ce_client.get_savings_plans_purchase_recommendation(
+            response = self.call_ce(
+                'get_savings_plans_purchase_recommendation', [],
                 SavingsPlansType='COMPUTE_SP',
                 TermInYears='ONE_YEAR',
                 PaymentOption='ALL_UPFRONT',
@@ -316,6 +758,138 @@ class RISavingsPlansAnalyzer:
             logger.error(f"Error getting Savings Plans recommendations: {str(e)}")
             return {}
     
+    def get_commitment_portfolio(self, regions: List[str] = None) -> CommitmentPortfolio:
+        """Build, or reuse, the timeline of active and queued RIs and Savings Plans"""
+        regions = regions or COMMITMENT_REGIONS or [self.ec2_client.meta.region_name]
+        cache_key = tuple(sorted(regions))
+        cached = _portfolio_cache.get(cache_key)
+        if cached and cached['expires_at'] > time.time():
+            return cached['portfolio']
+        
+        # Clients are created up front; boto3 client construction is not thread-safe
+        clients = {
+            region: self.ec2_client if region == self.ec2_client.meta.region_name
+            else boto3.client('ec2', region_name=region)
+            for region in regions
+        }
+        with ThreadPoolExecutor(max_workers=len(regions) + 1) as executor:
+            savings_plans = executor.submit(self.get_savings_plans)
+            reserved = executor.map(lambda region: self.get_reserved_instances(clients[region], region), regions)
+            commitments = [c for batch in reserved for c in batch] + savings_plans.result()
+        
+        portfolio = CommitmentPortfolio(commitments)
+        _portfolio_cache[cache_key] = {'expires_at': time.time() + PORTFOLIO_TTL_SECONDS, 'portfolio': portfolio}
+        return portfolio
+    
+    @staticmethod
+    def get_reserved_instances(ec2_client, region: str) -> List[Dict[str, Any]]:
+        """Active RIs in a region; DescribeReservedInstances returns them in a single page"""
+        try:
+            response = ec2_client.describe_reserved_instances(
+                Filters=[{'Name': 'state', 'Values': ['active', 'payment-pending']}]
+            )
+        except Exception as e:
+            logger.error(f"Error describing Reserved Instances in {region}: {str(e)}")
+            return []
+        
+        commitments = []
+        for ri in response.get('ReservedInstances', []):
+            duration_hours = ri['Duration'] / 3600
+            hourly_recurring = sum(
+                charge.get('Amount', 0) for charge in ri.get('RecurringCharges', [])
+                if charge.get('Frequency') == 'Hourly'
+            )
+            hourly_fixed = ri.get('FixedPrice', 0) / duration_hours if duration_hours else 0
+            commitments.append({
+                'id': ri['ReservedInstancesId'],
+                'kind': 'reserved_instance',
+                'commitment_type': 'reserved_instance',
+                'start': ri['Start'].timestamp(),
+                'end': ri['End'].timestamp(),
+                'hourly_commitment': (hourly_recurring + hourly_fixed) * ri.get('InstanceCount', 1),
+                'term_years': ri['Duration'] / (HOURS_PER_YEAR * 3600),
+                'payment_option': PAYMENT_OPTION_KEYS.get(ri.get('OfferingType'), 'no_upfront'),
+                'pool': f"{ri['InstanceType'].split('.')[0]}/{region}",
+                'instance_type': ri['InstanceType'],
+                'instance_count': ri.get('InstanceCount', 1)
+            })
+        return commitments
+    
+    def get_savings_plans(self) -> List[Dict[str, Any]]:
+        """Active and queued Savings Plans, following nextToken"""
+        commitments = []
+        request = {'states': ['active', 'queued', 'payment-pending'], 'maxResults': 1000}
+        try:
+            while True:
+                response = self.savingsplans_client.describe_savings_plans(**request)
+                for plan in response.get('savingsPlans', []):
+                    commitment_type = SAVINGS_PLAN_TYPES.get(plan.get('savingsPlanType'))
+                    commitments.append({
+                        'id': plan['savingsPlanId'],
+                        'kind': 'savings_plan',
+                        'commitment_type': commitment_type,
+                        'start': datetime.fromisoformat(plan['start'].replace('Z', '+00:00')).timestamp(),
+                        'end': datetime.fromisoformat(plan['end'].replace('Z', '+00:00')).timestamp(),
+                        'hourly_commitment': float(plan.get('commitment', '0')),
+                        'term_years': plan.get('termDurationInSeconds', 0) / (HOURS_PER_YEAR * 3600),
+                        'payment_option': PAYMENT_OPTION_KEYS.get(plan.get('paymentOption'), 'no_upfront'),
+                        'pool': f"{plan['ec2InstanceFamily']}/{plan['region']}"
+                        if commitment_type == 'ec2_instance_sp' else None,
+                        'savings_plan_type': plan.get('savingsPlanType')
+                    })
+                if not response.get('nextToken'):
+                    break
+                request['nextToken'] = response['nextToken']
+        except Exception as e:
+            logger.error(f"Error describing Savings Plans: {str(e)}")
+        return commitments
+    
+    def get_hourly_usage_matrix(self, days: int = USAGE_LOOKBACK_DAYS) -> Dict[str, Any]:
+        """Hourly eligible EC2 on-demand spend as an (hours, instance family/region) matrix
+        
+        Covers usage billed at on-demand rates, including usage covered by Savings Plans.
+        RI-covered hours are billed as DiscountedUsage and do not appear.
+        """
+        end = datetime.utcnow().replace(minute=0, second=0, microsecond=0)
+        start = end - timedelta(days=min(days, USAGE_LOOKBACK_DAYS))
+        response = self.call_ce(
+            'get_cost_and_usage', ['ResultsByTime'],
+            TimePeriod={
+                'Start': start.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                'End': end.strftime('%Y-%m-%dT%H:%M:%SZ')
+            },
+            Granularity='HOURLY',
+            Metrics=['UnblendedCost'],
+            Filter={'And': [
+                {'Dimensions': {'Key': 'SERVICE', 'Values': ['Amazon Elastic Compute Cloud - Compute']}},
+                {'Dimensions': {'Key': 'RECORD_TYPE', 'Values': ['Usage', 'SavingsPlanCoveredUsage']}},
+                {'Not': {'Dimensions': {'Key': 'PURCHASE_TYPE', 'Values': ['Spot Instances']}}}
+            ]},
+            GroupBy=[
+                {'Type': 'DIMENSION', 'Key': 'INSTANCE_TYPE'},
+                {'Type': 'DIMENSION', 'Key': 'REGION'}
+            ]
+        )
+        
+        # Grouped results page by group as well as by time, so merged pages repeat periods: rows are
+        # placed by each period's start hour rather than by position
+        pool_index: Dict[str, int] = {}
+        cells = []
+        for result in response.get('ResultsByTime', []):
+            period_start = datetime.strptime(result['TimePeriod']['Start'], '%Y-%m-%dT%H:%M:%SZ')
+            hour = int((period_start - start).total_seconds() // 3600)
+            for group in result.get('Groups', []):
+                instance_type, region = group['Keys']
+                pool = f"{instance_type.split('.')[0]}/{region}"
+                column = pool_index.setdefault(pool, len(pool_index))
+                cells.append((hour, column, float(group['Metrics']['UnblendedCost']['Amount'])))
+        
+        usage = np.zeros((int((end - start).total_seconds() // 3600), len(pool_index)))
+        if cells:
+            hours, columns, amounts = zip(*cells)
+            np.add.at(usage, (np.array(hours), np.array(columns)), amounts)
+        return {'usage': usage, 'pools': list(pool_index)}
+    
     def identify_optimization_opportunities(self, ri_data: Dict[str, Any], 
                                          sp_data: Dict[str, Any]) -> List[Dict[str, Any]]:
         """Identify RI and Savings Plans optimization opportunities"""
@@ -415,61 +989,131 @@ def lambda_handler(event, context):
         
         # Perform analysis based on action
         if action == 'analyze_utilization':
-            ri_utilization = analyzer.get_ri_utilization(days)
-            sp_utilization = analyzer.get_savings_plans_utilization(days)
+            collected = analyzer.collect(days, ['ri_utilization', 'sp_utilization'])
             
             return {
                 'statusCode': 200,
                 'body': json.dumps({
                     'action': action,
-                    'ri_utilization': ri_utilization,
-                    'savings_plans_utilization': sp_utilization,
+                    'ri_utilization': collected['ri_utilization'],
+                    'savings_plans_utilization': collected['sp_utilization'],
                     'analysis_period_days': days
                 })
             }
             
         elif action == 'analyze_coverage':
-            ri_coverage = analyzer.get_ri_coverage(days)
-            sp_coverage = analyzer.get_savings_plans_coverage(days)
+            collected = analyzer.collect(days, ['ri_coverage', 'sp_coverage'])
             
             return {
                 'statusCode': 200,
                 'body': json.dumps({
                     'action': action,
-                    'ri_coverage': ri_coverage,
-                    'savings_plans_coverage': sp_coverage,
+                    'ri_coverage': collected['ri_coverage'],
+                    'savings_plans_coverage': collected['sp_coverage'],
                     'analysis_period_days': days
                 })
             }
             
         elif action == 'get_recommendations':
-            ri_recommendations = analyzer.get_ri_recommendations()
-            sp_recommendations = analyzer.get_savings_plans_recommendations()
+            collected = analyzer.collect(days, ['ri_recommendations', 'sp_recommendations'])
+            
+            return {
+                'statusCode': 200,
+                'body': json.dumps({
+                    'action': action,
+                    'ri_recommendations': collected['ri_recommendations'],
+                    'savings_plans_recommendations': collected['sp_recommendations']
+                })
+            }
+            
+        elif action == 'simulate_commitments':
+            errors = validate_simulation_request(event)
+            if errors:
+                return {
+                    'statusCode': 400,
+                    'body': json.dumps({'error': 'Invalid simulation request', 'details': errors})
+                }
+            
+            existing = event.get('existing_commitments')
+            if event.get('usage') is not None:
+                usage, pools = np.array(event['usage'], dtype=np.float64), event['pools']
+            else:
+                matrix = analyzer.get_hourly_usage_matrix(event.get('usage_days', USAGE_LOOKBACK_DAYS))
+                usage, pools = matrix['usage'], matrix['pools']
+                if existing is None:
+                    # RI-covered hours are not in the loaded matrix, so only Savings Plans absorb it
+                    existing = [
+                        c for c in analyzer.get_commitment_portfolio(event.get('regions')).existing_commitments(['savings_plan'])
+                        if c['pool'] is None or c['pool'] in pools
+                    ]
+            
+            errors = validate_simulation_request({'existing_commitments': event.get('existing_commitments')}, pools)
+            if errors:
+                return {
+                    'statusCode': 400,
+                    'body': json.dumps({'error': 'Invalid simulation request', 'details': errors})
+                }
+            
+            if usage.size == 0:
+                scenarios = []
+            else:
+                simulation = simulate_commitments(
+                    usage, pools,
+                    existing=existing,
+                    commitment_types=event.get('commitment_types'),
+                    terms=event.get('terms'),
+                    payment_options=event.get('payment_options'),
+                    level_quantiles=event.get('level_quantiles')
+                )
+                scenarios = rank_commitment_scenarios(simulation, event.get('top', 10))
+            
+            return {
+                'statusCode': 200,
+                'body': json.dumps({
+                    'action': action,
+                    'scenarios': scenarios,
+                    'usage_hours': usage.shape[0],
+                    'pools': pools
+                })
+            }
+            
+        elif action == 'analyze_portfolio':
+            portfolio = analyzer.get_commitment_portfolio(event.get('regions'))
+            window_days = event.get('window_days', RENEWAL_ALERT_DAYS)
+            collected = analyzer.collect(days, ['ri_coverage', 'sp_coverage'])
+            current_coverage = {
+                'reserved_instance': collected['ri_coverage'].get('summary', {}).get('average_hours_coverage', 0),
+                'savings_plan': collected['sp_coverage'].get('summary', {}).get('average_coverage', 0)
+            }
             
             return {
                 'statusCode': 200,
                 'body': json.dumps({
                     'action': action,
-                    'ri_recommendations': ri_recommendations,
-                    'savings_plans_recommendations': sp_recommendations
+                    'summary': portfolio.summary(),
+                    'expiring': portfolio.renewal_alerts(window_days),
+                    'coverage_projection': portfolio.project_coverage(current_coverage, window_days)
                 })
             }
             
         elif action == 'analyze_all':
             # Comprehensive analysis
+            collected = analyzer.collect(days)
             ri_data = {
-                'utilization': analyzer.get_ri_utilization(days),
-                'coverage': analyzer.get_ri_coverage(days),
-                'recommendations': analyzer.get_ri_recommendations()
+                'utilization': collected['ri_utilization'],
+                'coverage': collected['ri_coverage'],
+                'recommendations': collected['ri_recommendations']
             }
             
             sp_data = {
-                'utilization': analyzer.get_savings_plans_utilization(days),
-                'coverage': analyzer.get_savings_plans_coverage(days),
-                'recommendations': analyzer.get_savings_plans_recommendations()
+                'utilization': collected['sp_utilization'],
+                'coverage': collected['sp_coverage'],
+                'recommendations': collected['sp_recommendations']
             }
             
             opportunities = analyzer.identify_optimization_opportunities(ri_data, sp_data)
+            portfolio = analyzer.get_commitment_portfolio(event.get('regions'))
+            opportunities.extend(portfolio.renewal_alerts())
             
             # Calculate summary
             total_potential_savings = 0
@@ -506,6 +1150,7 @@ def lambda_handler(event, context):
                     },
                     'ri_data': ri_data,
                     'savings_plans_data': sp_data,
+                    'portfolio': portfolio.summary(),
                     'recommendations': opportunities,
                     'analysis_period_days': days
                 })
@@ -516,7 +1161,7 @@ def lambda_handler(event, context):
                 'statusCode': 400,
                 'body': json.dumps({
                     'error': 'Invalid action',
-                    'supported_actions': ['analyze_utilization', 'analyze_coverage', 'get_recommendations', 'analyze_all']
+                    'supported_actions': ['analyze_utilization', 'analyze_coverage', 'get_recommendations', 'simulate_commitments', 'analyze_portfolio', 'analyze_all']
                 })
             }
             
@@ -1,19 +1,431 @@
+import os
+import io
+import csv
+import gzip
 import json
 import boto3
+import random
 import logging
-from datetime import datetime, timedelta
-from typing import Dict, List, Any
+import tempfile
+import threading
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Any, Iterator, Callable
 import re
 
 # Configure logging
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+# Inventory rows are aggregated in fixed-size batches so memory stays bounded
+INVENTORY_BATCH_ROWS = 50000
+
+# Histogram bin lower edges; the last bin is open-ended
+AGE_EDGES_DAYS = [0, 30, 90, 180, 365, 730]
+SIZE_EDGES_BYTES = [0, 128 * 1024, 1024**2, 16 * 1024**2, 128 * 1024**2, 1024**3]
+
+# Buckets, and the prefix listings of their samples, share one bounded worker pool
+BUCKET_WORKERS = 16
+
+# GetMetricData accepts at most 500 queries per request
+METRIC_QUERIES_PER_REQUEST = 500
+
+# Storage-class sampling: top-level prefixes become strata, listed concurrently within one key budget
+# per bucket (20 LIST pages) split evenly across the strata; listing is what makes stratum weights
+# exact, the reservoir only bounds memory. Prefix discovery reads at most SAMPLE_DISCOVERY_PAGES pages.
+# Buckets analyzed together also draw on one request-wide budget (500 LIST pages); buckets reached
+# once it is spent are not sampled.
+SAMPLE_WORKERS = 8  # pool size when a single bucket is sampled on its own
+SAMPLE_MAX_STRATA = 64
+SAMPLE_BUCKET_LIST_BUDGET = 20000
+SAMPLE_TOTAL_LIST_BUDGET = 500000
+SAMPLE_DISCOVERY_PAGES = 10
+SAMPLE_MIN_PER_STRATUM = 50
+
+# CloudWatch BucketSizeBytes storage types and the storage class each one bills as
+S3_STORAGE_TYPES = {
+    'StandardStorage': 'STANDARD',
+    'IntelligentTieringFAStorage': 'INTELLIGENT_TIERING',
+    'IntelligentTieringIAStorage': 'INTELLIGENT_TIERING',
+    'IntelligentTieringAAStorage': 'INTELLIGENT_TIERING',
+    'IntelligentTieringAIAStorage': 'INTELLIGENT_TIERING',
+    'IntelligentTieringDAAStorage': 'INTELLIGENT_TIERING',
+    'StandardIAStorage': 'STANDARD_IA',
+    'OneZoneIAStorage': 'ONEZONE_IA',
+    'ReducedRedundancyStorage': 'REDUCED_REDUNDANCY',
+    'GlacierInstantRetrievalStorage': 'GLACIER_IR',
+    'GlacierStorage': 'GLACIER',
+    'DeepArchiveStorage': 'DEEP_ARCHIVE'
+}
+
+def normalize_column(name: str) -> str:
+    """Map inventory schema names (LastModifiedDate) and columnar names (last_modified_date) to one form"""
+    return re.sub(r'(?<=[a-z0-9])(?=[A-Z])', '_', name.strip()).lower()
+
+class SharedListBudget:
+    """Keys that may still be listed across every bucket of one request, drawn by concurrent bucket workers"""
+    
+    def __init__(self, keys: int):
+        self.remaining = keys
+        self.lock = threading.Lock()
+    
+    def reserve(self, keys: int) -> int:
+        """Take up to keys from the budget, returning how many were granted"""
+        with self.lock:
+            granted = min(keys, self.remaining)
+            self.remaining -= granted
+            return granted
+    
+    def release(self, keys: int):
+        """Return the unused part of a reservation"""
+        with self.lock:
+            self.remaining += max(keys, 0)
+
+class InventoryAggregator:
+    """Exact per-bucket storage-class totals plus joint object age/size histograms"""
+    
+    def __init__(self, as_of: datetime = None):
+        self.as_of = np.datetime64((as_of or datetime.utcnow()).replace(microsecond=0), 's')
+        self.age_edges = np.array(AGE_EDGES_DAYS, dtype=np.int64) * 86400
+        self.size_edges = np.array(SIZE_EDGES_BYTES, dtype=np.int64)
+        self.buckets: Dict[str, Dict[str, Any]] = {}
+    
+    def _bucket_state(self, bucket_name: str) -> Dict[str, Any]:
+        if bucket_name not in self.buckets:
+            shape = (len(AGE_EDGES_DAYS), len(SIZE_EDGES_BYTES))
+            self.buckets[bucket_name] = {
+                'storage_classes': {},
+                'age_size_counts': np.zeros(shape, dtype=np.int64),
+                'age_size_bytes': np.zeros(shape, dtype=np.int64)
+            }
+        return self.buckets[bucket_name]
+    
+    def add_batch(self, buckets: np.ndarray, sizes: np.ndarray, last_modified: np.ndarray,
+                  storage_classes: np.ndarray):
+        """Fold one batch of object rows into the per-bucket totals"""
+        ages = (self.as_of - last_modified).astype('timedelta64[s]').astype(np.int64)
+        # Objects without a timestamp are treated as brand new
+        ages = np.where(np.isnat(last_modified), 0, np.maximum(ages, 0))
+        age_bins = np.searchsorted(self.age_edges, ages, side='right') - 1
+        size_bins = np.searchsorted(self.size_edges, sizes, side='right') - 1
+        
+        for bucket_name in np.unique(buckets):
+            mask = buckets == bucket_name
+            state = self._bucket_state(str(bucket_name))
+            bucket_sizes = sizes[mask]
+            
+            np.add.at(state['age_size_counts'], (age_bins[mask], size_bins[mask]), 1)
+            np.add.at(state['age_size_bytes'], (age_bins[mask], size_bins[mask]), bucket_sizes)
+            
+            class_names, class_codes = np.unique(storage_classes[mask], return_inverse=True)
+            class_bytes = np.zeros(len(class_names), dtype=np.int64)
+            np.add.at(class_bytes, class_codes, bucket_sizes)
+            class_counts = np.bincount(class_codes, minlength=len(class_names))
+            for name, count, total in zip(class_names, class_counts, class_bytes):
+                stats = state['storage_classes'].setdefault(str(name), {'count': 0, 'total_size': 0})
+                stats['count'] += int(count)
+                stats['total_size'] += int(total)
+    
+    def add_totals(self, bucket_name: str, storage_class: str, count: int = 0, total_size: int = 0):
+        """Record pre-aggregated totals, as exported by Storage Lens"""
+        state = self._bucket_state(bucket_name)
+        stats = state['storage_classes'].setdefault(storage_class, {'count': 0, 'total_size': 0})
+        stats['count'] += int(count)
+        stats['total_size'] += int(total_size)
+    
+    def summarize(self) -> Dict[str, Any]:
+        summary = {}
+        for bucket_name, state in self.buckets.items():
+            storage_classes = state['storage_classes']
+            total_size = sum(stats['total_size'] for stats in storage_classes.values())
+            for stats in storage_classes.values():
+                stats['size_percentage'] = (stats['total_size'] / total_size * 100) if total_size > 0 else 0
+                stats['size_gb'] = stats['total_size'] / (1024**3)
+            
+            summary[bucket_name] = {
+                'size_bytes': total_size,
+                'object_count': sum(stats['count'] for stats in storage_classes.values()),
+                'storage_classes': storage_classes
+            }
+            
+            counts = state['age_size_counts']
+            if not counts.any():
+                # Storage Lens totals carry no per-object ages or sizes
+                continue
+            sizes = state['age_size_bytes']
+            summary[bucket_name].update({
+                'age_histogram': {
+                    'edges_days': AGE_EDGES_DAYS,
+                    'counts': counts.sum(axis=1).tolist(),
+                    'bytes': sizes.sum(axis=1).tolist()
+                },
+                'size_histogram': {
+                    'edges_bytes': SIZE_EDGES_BYTES,
+                    'counts': counts.sum(axis=0).tolist(),
+                    'bytes': sizes.sum(axis=0).tolist()
+                },
+                'age_size_counts': counts.tolist(),
+                'age_size_bytes': sizes.tolist()
+            })
+        return summary
+
+# Lifecycle simulation prices (us-east-1): storage per GB-month, transitions per 1,000 requests,
+# retrieval per GB
+LIFECYCLE_STORAGE_CLASSES = ['STANDARD', 'STANDARD_IA', 'GLACIER_IR', 'GLACIER', 'DEEP_ARCHIVE']
+STORAGE_PRICE_PER_GB = np.array([0.023, 0.0125, 0.004, 0.0036, 0.00099])
+TRANSITION_PRICE_PER_1000 = np.array([0.0, 0.01, 0.02, 0.03, 0.05])
+RETRIEVAL_PRICE_PER_GB = np.array([0.0, 0.01, 0.03, 0.01, 0.02])
+# Minimum storage duration per class; objects leaving a class earlier are billed for the remainder
+MIN_STORAGE_DAYS = np.array([0, 30, 90, 90, 180])
+
+# Lifecycle rules skip objects under 128 KB by default, so the smallest size bin never transitions
+LIFECYCLE_MIN_TRANSITION_BYTES = 128 * 1024
+
+# Representative age (days) of each AGE_EDGES_DAYS bin; the open-ended last bin assumes three years
+AGE_BIN_DAYS = np.array([15, 60, 135, 272, 547, 1095])
+
+# Ranked by default: transitions only, which keep every object
+DEFAULT_LIFECYCLE_POLICIES = [
+    {'name': 'standard_only', 'transitions': [], 'expiration_days': None},
+    {'name': 'ia_30', 'transitions': [(30, 'STANDARD_IA')], 'expiration_days': None},
+    {'name': 'glacier_ir_90', 'transitions': [(90, 'GLACIER_IR')], 'expiration_days': None},
+    {'name': 'ia_30_glacier_ir_90', 'transitions': [(30, 'STANDARD_IA'), (90, 'GLACIER_IR')], 'expiration_days': None},
+    {'name': 'ia_30_deep_archive_180', 'transitions': [(30, 'STANDARD_IA'), (180, 'DEEP_ARCHIVE')], 'expiration_days': None}
+]
+# Expiration deletes data, which only the bucket owner can decide on; these are ranked on request only
+EXPIRATION_LIFECYCLE_POLICIES = [
+    {'name': 'ia_30_expire_365', 'transitions': [(30, 'STANDARD_IA')], 'expiration_days': 365},
+    {'name': 'expire_365', 'transitions': [], 'expiration_days': 365}
+]
+
+def simulate_lifecycle_policies(age_size_bytes: np.ndarray, age_size_counts: np.ndarray,
+                                policies: List[Dict[str, Any]] = None, months: int = 12,
+                                monthly_read_fraction: float = 0.02) -> Dict[str, np.ndarray]:
+    """Project storage, transition and retrieval costs for every (bucket, policy) pair at once
+    
+    age_size_bytes and age_size_counts are (buckets, age bins, size bins) histograms of the objects
+    a policy would act on. Objects age one month per step; each policy maps an age to a storage
+    class (or expiry), and costs are summed with one-hot class tensors, so thousands of buckets
+    cost a handful of array operations. Leaving a class (by transition or expiry) before its
+    minimum storage duration bills the remaining days, as S3's early-deletion fee does. New
+    uploads during the horizon are not modelled.
+    """
+    policies = policies or DEFAULT_LIFECYCLE_POLICIES
+    class_count = len(LIFECYCLE_STORAGE_CLASSES)
+    
+    # ages[a, m]: age in days of age bin a after m months
+    ages = AGE_BIN_DAYS[:, None] + 30 * np.arange(1, months + 1)[None, :]
+    classes = np.zeros((len(policies), len(AGE_BIN_DAYS), months), dtype=np.int64)
+    expired = np.zeros(classes.shape, dtype=bool)
+    for p, policy in enumerate(policies):
+        for days, storage_class in sorted(policy.get('transitions', [])):
+            classes[p][ages >= days] = LIFECYCLE_STORAGE_CLASSES.index(storage_class)
+        if policy.get('expiration_days'):
+            expired[p] = ages >= policy['expiration_days']
+    
+    # Objects below the transition size floor stay in STANDARD but still expire
+    eligible = np.array(SIZE_EDGES_BYTES) >= LIFECYCLE_MIN_TRANSITION_BYTES
+    classes = np.where(eligible[None, None, :, None], classes[:, :, None, :], 0)
+    expired = np.broadcast_to(expired[:, :, None, :], classes.shape)
+    
+    # live[p, a, s, m, c]: one-hot storage class of a histogram cell in a month, zero once expired
+    live = (classes[..., None] == np.arange(class_count)) & ~expired[..., None]
+    previous = np.concatenate([np.zeros_like(classes[..., :1]), classes[..., :-1]], axis=-1)
+    changed = classes != previous
+    transitioned = live & changed[..., None]
+    
+    # Early deletion: a cell departs its class in month m (m >= 1) when the class changes or it
+    # expires; it entered that class in the last month its class changed (STANDARD has no minimum)
+    month_index = np.arange(months)
+    entered = np.maximum.accumulate(np.where(changed, month_index, 0), axis=-1)
+    was_expired = np.concatenate([np.zeros_like(expired[..., :1]), expired[..., :-1]], axis=-1)
+    departed = (changed | expired) & ~was_expired & (month_index > 0)
+    departed_class = np.where(departed, previous, 0)
+    stored_days = 30 * (month_index - np.concatenate([entered[..., :1], entered[..., :-1]], axis=-1))
+    unserved_months = np.maximum(MIN_STORAGE_DAYS[departed_class] - stored_days, 0) / 30
+    early_fee_per_gb = np.where(departed, unserved_months * STORAGE_PRICE_PER_GB[departed_class], 0.0)
+    
+    gigabytes = np.asarray(age_size_bytes, dtype=np.float64) / (1024**3)
+    counts = np.asarray(age_size_counts, dtype=np.float64)
+    storage = np.einsum('bas,pasmc,c->bp', gigabytes, live, STORAGE_PRICE_PER_GB)
+    transitions = np.einsum('bas,pasmc,c->bp', counts, transitioned, TRANSITION_PRICE_PER_1000 / 1000)
+    retrieval = np.einsum('bas,pasmc,c->bp', gigabytes * monthly_read_fraction, live, RETRIEVAL_PRICE_PER_GB)
+    early_deletion = np.einsum('bas,pasm->bp', gigabytes, early_fee_per_gb)
+    
+    return {
+        'policies': [policy['name'] for policy in policies],
+        'deletes_data': [bool(policy.get('expiration_days')) for policy in policies],
+        'storage_cost': storage,
+        'transition_cost': transitions,
+        'retrieval_cost': retrieval,
+        'early_deletion_cost': early_deletion,
+        'total_cost': storage + transitions + retrieval + early_deletion
+    }
+
+S3_COST_SERVICE = 'Amazon Simple Storage Service'
+
 class S3CostAnalyzer:
-    def __init__(self):
+    def __init__(self, shared_data: Dict[str, Any] = None):
         self.s3_client = boto3.client('s3')
         self.cloudwatch_client = boto3.client('cloudwatch')
         self.cost_explorer_client = boto3.client('ce')
+        # Inputs the orchestrator prefetched once for every agent in its plan
+        self.shared_data = shared_data or {}
+        # Exact per-bucket statistics loaded from S3 Inventory or Storage Lens exports
+        self.inventory_stats: Dict[str, Any] = {}
+        # S3 and CloudWatch clients per bucket region, created on first use
+        self.regional_clients: Dict[tuple, Any] = {}
+        self.client_lock = threading.Lock()
+    
+    def get_regional_client(self, service: str, region: str):
+        """Return a client pinned to a bucket's region so requests avoid cross-region redirects"""
+        with self.client_lock:
+            if (service, region) not in self.regional_clients:
+                self.regional_clients[(service, region)] = boto3.client(service, region_name=region)
+            return self.regional_clients[(service, region)]
+    
+    def load_inventory(self, manifest_locations: List[str]) -> Dict[str, Any]:
+        """Load S3 Inventory or Storage Lens manifests from local paths or s3:// URIs"""
+        aggregator = InventoryAggregator()
+        
+        for location in manifest_locations:
+            try:
+                with self._open_location(location) as stream:
+                    manifest = json.load(stream)
+                
+                if 'reportFiles' in manifest:
+                    self._ingest_storage_lens(location, manifest, aggregator)
+                else:
+                    self._ingest_inventory(location, manifest, aggregator)
+                    
+            except Exception as e:
+                logger.warning(f"Error loading inventory manifest {location}: {str(e)}")
+        
+        self.inventory_stats.update(aggregator.summarize())
+        return self.inventory_stats
+    
+    def _ingest_inventory(self, location: str, manifest: Dict[str, Any], aggregator: InventoryAggregator):
+        file_format = manifest.get('fileFormat', 'CSV').upper()
+        schema = [normalize_column(name) for name in manifest.get('fileSchema', '').split(',')]
+        
+        for data_file in manifest.get('files', []):
+            data_location = self._resolve_data_file(location, manifest.get('destinationBucket', ''), data_file['key'])
+            for batch in self._iter_batches(data_location, file_format, schema):
+                rows = len(batch['key'])
+                if 'is_delete_marker' in batch:
+                    # Delete markers carry no bytes; non-current versions are still billed
+                    keep = np.array([str(v).lower() != 'true' for v in batch['is_delete_marker']])
+                else:
+                    keep = np.ones(rows, dtype=bool)
+                
+                sizes = np.array([int(v) if v not in (None, '') else 0 for v in batch['size']], dtype=np.int64)
+                classes = np.array([v or 'STANDARD' for v in batch.get('storage_class', ['STANDARD'] * rows)], dtype=object)
+                buckets = np.array(batch.get('bucket', [manifest.get('sourceBucket', '')] * rows), dtype=object)
+                modified = batch.get('last_modified_date', [None] * rows)
+                if not isinstance(modified, np.ndarray):
+                    modified = np.array([str(v)[:19] if v else 'NaT' for v in modified], dtype='datetime64[s]')
+                
+                aggregator.add_batch(buckets[keep], sizes[keep], modified[keep], classes[keep])
+    
+    def _ingest_storage_lens(self, location: str, manifest: Dict[str, Any], aggregator: InventoryAggregator):
+        file_format = manifest.get('reportFormat', 'CSV').upper()
+        schema = [normalize_column(name) for name in manifest.get('reportSchema', '').split(',')]
+        metric_fields = {'StorageBytes': 'total_size', 'ObjectCount': 'count'}
+        
+        for report_file in manifest['reportFiles']:
+            data_location = self._resolve_data_file(location, manifest.get('destinationBucket', ''), report_file['key'])
+            for batch in self._iter_batches(data_location, file_format, schema):
+                for record_type, bucket_name, storage_class, metric_name, metric_value in zip(
+                    batch['record_type'], batch['bucket_name'], batch['storage_class'],
+                    batch['metric_name'], batch['metric_value']
+                ):
+                    if record_type == 'BUCKET' and metric_name in metric_fields:
+                        aggregator.add_totals(bucket_name, storage_class,
+                                              **{metric_fields[metric_name]: int(float(metric_value))})
+    
+    def _open_location(self, location: str):
+        """Open a local file or an S3 object as a binary stream"""
+        if location.startswith('s3://'):
+            bucket, _, key = location[5:].partition('/')
+            return self.s3_client.get_object(Bucket=bucket, Key=key)['Body']
+        return open(location, 'rb')
+    
+    def _resolve_data_file(self, manifest_location: str, destination_bucket: str, key: str) -> str:
+        """Locate a data file listed in a manifest, next to a local copy or in the destination bucket"""
+        if manifest_location.startswith('s3://'):
+            bucket = destination_bucket.split(':::')[-1] or manifest_location[5:].partition('/')[0]
+            return f's3://{bucket}/{key}'
+        
+        manifest_dir = os.path.dirname(os.path.abspath(manifest_location))
+        candidates = [
+            os.path.join(manifest_dir, key),
+            os.path.join(manifest_dir, 'data', os.path.basename(key)),
+            os.path.join(manifest_dir, os.pardir, 'data', os.path.basename(key)),
+            os.path.join(manifest_dir, os.path.basename(key))
+        ]
+        for candidate in candidates:
+            if os.path.exists(candidate):
+                return candidate
+        raise FileNotFoundError(f"Data file {key} not found near {manifest_location}")
+    
+    def _iter_batches(self, location: str, file_format: str, schema: List[str]) -> Iterator[Dict[str, Any]]:
+        """Yield column batches of at most INVENTORY_BATCH_ROWS rows from a CSV, ORC or Parquet file"""
+        if file_format == 'CSV':
+            with self._open_location(location) as raw:
+                stream = gzip.GzipFile(fileobj=raw) if location.endswith('.gz') else raw
+                reader = csv.reader(io.TextIOWrapper(stream, encoding='utf-8', newline=''))
+                rows = []
+                first_row = next(reader, None)
+                # Only the first row of a file can be a header; later rows matching it are data
+                if first_row is not None and [normalize_column(value) for value in first_row] != schema:
+                    rows.append(first_row)
+                for row in reader:
+                    rows.append(row)
+                    if len(rows) >= INVENTORY_BATCH_ROWS:
+                        yield dict(zip(schema, map(list, zip(*rows))))
+                        rows = []
+                if rows:
+                    yield dict(zip(schema, map(list, zip(*rows))))
+            return
+        
+        # Columnar formats need a seekable file, so S3 objects are spooled to local disk first
+        local_path = location
+        if location.startswith('s3://'):
+            bucket, _, key = location[5:].partition('/')
+            handle, local_path = tempfile.mkstemp(suffix=os.path.basename(key))
+            os.close(handle)
+            self.s3_client.download_file(bucket, key, local_path)
+        
+        try:
+            import pyarrow as pa
+            if file_format == 'PARQUET':
+                import pyarrow.parquet as pq
+                batches = pq.ParquetFile(local_path).iter_batches(batch_size=INVENTORY_BATCH_ROWS)
+            elif file_format == 'ORC':
+                import pyarrow.orc as orc
+                orc_file = orc.ORCFile(local_path)
+                # Stripes can hold millions of rows, so each is converted in batch-sized slices
+                batches = (
+                    stripe.slice(offset, INVENTORY_BATCH_ROWS)
+                    for stripe in (orc_file.read_stripe(i) for i in range(orc_file.nstripes))
+                    for offset in range(0, stripe.num_rows, INVENTORY_BATCH_ROWS)
+                )
+            else:
+                raise ValueError(f"Unsupported inventory format: {file_format}")
+            
+            for record_batch in batches:
+                batch = {}
+                for name, column in zip(record_batch.schema.names, record_batch.columns):
+                    name = normalize_column(name)
+                    if name == 'last_modified_date' and pa.types.is_timestamp(column.type):
+                        batch[name] = column.to_numpy(zero_copy_only=False).astype('datetime64[s]')
+                    else:
+                        batch[name] = column.to_pylist()
+                yield batch
+        finally:
+            if local_path != location:
+                os.remove(local_path)
     
     def get_bucket_list(self) -> List[str]:
         """Get list of all S3 buckets"""
@@ -27,91 +439,27 @@ class S3CostAnalyzer:
     def analyze_bucket_storage(self, bucket_names: List[str] = None) -> Dict[str, Any]:
         """Analyze S3 bucket storage metrics and costs"""
         try:
+            response = self.s3_client.list_buckets()
+            listed_regions = {
+                bucket['Name']: bucket.get('BucketRegion') for bucket in response['Buckets']
+            }
             if not bucket_names:
                 # Get all buckets
-                response = self.s3_client.list_buckets()
-                bucket_names = [bucket['Name'] for bucket in response['Buckets']]
+                bucket_names = list(listed_regions)
             
-            bucket_analysis = {}
-            
-            for bucket_name in bucket_names:
-                try:
-                    # Get bucket size and object count from CloudWatch
-                    end_time = datetime.utcnow()
-                    start_time = end_time - timedelta(days=2)  # S3 metrics are daily
-                    
-                    # Get bucket size in bytes
-                    size_response = self.cloudwatch_client.get_metric_statistics(
-                        Namespace='AWS/S3',
-                        MetricName='BucketSizeBytes',
-                        Dimensions=[
-                            {'Name': 'BucketName', 'Value': bucket_name},
-                            {'Name': 'StorageType', 'Value': 'StandardStorage'}
-                        ],
-                        StartTime=start_time,
-                        EndTime=end_time,
-                        Period=86400,  # Daily
-                        Statistics=['Average']
-                    )
-                    
-                    # Get number of objects
-                    objects_response = self.cloudwatch_client.get_metric_statistics(
-                        Namespace='AWS/S3',
-                        MetricName='NumberOfObjects',
-                        Dimensions=[
-                            {'Name': 'BucketName', 'Value': bucket_name},
-                            {'Name': 'StorageType', 'Value': 'AllStorageTypes'}
-                        ],
-                        StartTime=start_time,
-                        EndTime=end_time,
-                        Period=86400,  # Daily
-                        Statistics=['Average']
-                    )
-                    
-                    # Extract latest values
-                    bucket_size = 0
-                    object_count = 0
-                    
-                    if size_response['Datapoints']:
-                        bucket_size = size_response['Datapoints'][-1]['Average']
-                    
-                    if objects_response['Datapoints']:
-                        object_count = int(objects_response['Datapoints'][-1]['Average'])
-                    
-                    # Get bucket location and storage class information
-                    try:
-                        location_response = self.s3_client.get_bucket_location(Bucket=bucket_name)
-                        region = location_response['LocationConstraint'] or 'us-east-1'
-                    except:
-                        region = 'unknown'
-                    
-                    # Get bucket tags
-                    try:
-                        tags_response = self.s3_client.get_bucket_tagging(Bucket=bucket_name)
-                        tags = {tag['Key']: tag['Value'] for tag in tags_response['TagSet']}
-                    except:
-                        tags = {}
-                    
-                    # Analyze storage classes (sample objects)
-                    storage_classes = self.analyze_storage_classes(bucket_name)
-                    
-                    bucket_analysis[bucket_name] = {
-                        'size_bytes': bucket_size,
-                        'size_gb': bucket_size / (1024**3),
-                        'object_count': object_count,
-                        'region': region,
-                        'tags': tags,
-                        'storage_classes': storage_classes,
-                        'last_modified': datetime.utcnow().isoformat()
-                    }
-                    
-                except Exception as e:
-                    logger.warning(f"Error analyzing bucket {bucket_name}: {str(e)}")
-                    bucket_analysis[bucket_name] = {
-                        'error': str(e),
-                        'size_bytes': 0,
-                        'object_count': 0
-                    }
+            list_budget = SharedListBudget(SAMPLE_TOTAL_LIST_BUDGET)
+            with ThreadPoolExecutor(max_workers=BUCKET_WORKERS) as executor:
+                regions = dict(zip(bucket_names, executor.map(
+                    lambda name: listed_regions.get(name) or self.get_bucket_region(name), bucket_names
+                )))
+                
+                # Size and object count for every bucket come from one batched pull per region
+                metrics = self.get_bucket_metrics(regions, executor)
+                
+                bucket_analysis = dict(zip(bucket_names, executor.map(
+                    lambda name: self.analyze_bucket(name, regions[name], metrics.get(name, {}), executor, list_budget),
+                    bucket_names
+                )))
             
             return bucket_analysis
             
@@ -119,74 +467,434 @@ class S3CostAnalyzer:
             logger.error(f"Error analyzing bucket storage: {str(e)}")
             return {}
     
-    def analyze_storage_classes(self, bucket_name: str, max_objects: int = 1000) -> Dict[str, Any]:
+    def get_bucket_region(self, bucket_name: str) -> str:
+        """Resolve a bucket's region, or 'unknown' if it cannot be read"""
+        try:
+            location_response = self.s3_client.get_bucket_location(Bucket=bucket_name)
+            location = location_response['LocationConstraint']
+            return {None: 'us-east-1', '': 'us-east-1', 'EU': 'eu-west-1'}.get(location, location)
+        except Exception:
+            return 'unknown'
+    
+    def get_bucket_metrics(self, regions: Dict[str, str], executor: ThreadPoolExecutor) -> Dict[str, Dict[str, float]]:
+        """Latest daily BucketSizeBytes per storage type and NumberOfObjects for all buckets, one region per task"""
+        buckets_by_region = {}
+        for bucket_name, region in regions.items():
+            buckets_by_region.setdefault(region, []).append(bucket_name)
+        
+        def collect_region(region_buckets):
+            region, bucket_names = region_buckets
+            try:
+                return self.fetch_region_metrics(region, bucket_names)
+            except Exception as e:
+                logger.warning(f"Error getting S3 metrics for region {region}: {str(e)}")
+                return {}
+        
+        metrics = {}
+        for region_metrics in executor.map(collect_region, buckets_by_region.items()):
+            metrics.update(region_metrics)
+        return metrics
+    
+    def fetch_region_metrics(self, region: str, bucket_names: List[str]) -> Dict[str, Dict[str, float]]:
+        # S3 storage metrics are published daily in the bucket's own region
+        end_time = datetime.utcnow()
+        start_time = end_time - timedelta(days=2)
+        cloudwatch_client = self.cloudwatch_client if region == 'unknown' else self.get_regional_client('cloudwatch', region)
+        
+        queries = []
+        query_targets = {}
+        for index, bucket_name in enumerate(bucket_names):
+            series = [('BucketSizeBytes', storage_type) for storage_type in S3_STORAGE_TYPES]
+            series.append(('NumberOfObjects', 'AllStorageTypes'))
+            for series_index, (metric_name, storage_type) in enumerate(series):
+                query_id = f'm{index}_{series_index}'
+                query_targets[query_id] = (bucket_name, storage_type)
+                queries.append({
+                    'Id': query_id,
+                    'MetricStat': {
+                        'Metric': {
+                            'Namespace': 'AWS/S3',
+                            'MetricName': metric_name,
+                            'Dimensions': [
+                                {'Name': 'BucketName', 'Value': bucket_name},
+                                {'Name': 'StorageType', 'Value': storage_type}
+                            ]
+                        },
+                        'Period': 86400,  # Daily
+                        'Stat': 'Average'
+                    },
+                    'ReturnData': True
+                })
+        
+        metrics = {bucket_name: {} for bucket_name in bucket_names}
+        paginator = cloudwatch_client.get_paginator('get_metric_data')
+        for i in range(0, len(queries), METRIC_QUERIES_PER_REQUEST):
+            for page in paginator.paginate(
+                MetricDataQueries=queries[i:i + METRIC_QUERIES_PER_REQUEST],
+                StartTime=start_time,
+                EndTime=end_time,
+                ScanBy='TimestampDescending'
+            ):
+                for result in page['MetricDataResults']:
+                    if result['Id'] in query_targets and result['Values']:
+                        bucket_name, storage_type = query_targets[result['Id']]
+                        # Values are newest first; keep the latest datapoint only
+                        metrics[bucket_name].setdefault(storage_type, result['Values'][0])
+        return metrics
+    
+    def analyze_bucket(self, bucket_name: str, region: str, metrics: Dict[str, float],
+                       executor: ThreadPoolExecutor = None, list_budget: SharedListBudget = None) -> Dict[str, Any]:
+        """Analyze one bucket; failures are contained to that bucket's entry"""
+        try:
+            s3_client = self.s3_client if region == 'unknown' else self.get_regional_client('s3', region)
+            
+            # Extract latest values
+            storage_type_bytes = {
+                storage_type: metrics[storage_type]
+                for storage_type in S3_STORAGE_TYPES if metrics.get(storage_type)
+            }
+            bucket_size = sum(storage_type_bytes.values())
+            object_count = int(metrics.get('AllStorageTypes', 0))
+            
+            # Get bucket tags
+            try:
+                tags_response = s3_client.get_bucket_tagging(Bucket=bucket_name)
+                tags = {tag['Key']: tag['Value'] for tag in tags_response['TagSet']}
+            except:
+                tags = {}
+            
+            inventory = self.inventory_stats.get(bucket_name)
+            if inventory:
+                # Inventory totals are exact, so they replace both the metrics and the sample
+                bucket_size = inventory['size_bytes']
+                object_count = inventory['object_count']
+                distribution = inventory
+            else:
+                # Estimate storage classes from a stratified sample of objects
+                distribution = self.sample_bucket(bucket_name, s3_client=s3_client, total_objects=object_count,
+                                                  executor=executor, list_budget=list_budget)
+            storage_classes = distribution.get('storage_classes', {})
+            
+            analysis = {
+                'size_bytes': bucket_size,
+                'size_gb': bucket_size / (1024**3),
+                'object_count': object_count,
+                'region': region,
+                'tags': tags,
+                'storage_type_bytes': storage_type_bytes,
+                'storage_classes': storage_classes,
+                'storage_class_source': 'inventory' if inventory else 'sample',
+                'last_modified': datetime.utcnow().isoformat()
+            }
+            for key in ('age_histogram', 'size_histogram', 'age_size_counts', 'age_size_bytes',
+                        'sampled_objects', 'complete_listing', 'list_budget_exhausted'):
+                if key in distribution:
+                    analysis[key] = distribution[key]
+            return analysis
+            
+        except Exception as e:
+            logger.warning(f"Error analyzing bucket {bucket_name}: {str(e)}")
+            return {
+                'error': str(e),
+                'size_bytes': 0,
+                'object_count': 0
+            }
+    
+    def analyze_storage_classes(self, bucket_name: str, max_objects: int = 1000, s3_client=None) -> Dict[str, Any]:
         """Analyze storage classes distribution in a bucket"""
+        return self.sample_bucket(bucket_name, max_objects, s3_client).get('storage_classes', {})
+    
+    def sample_bucket(self, bucket_name: str, max_objects: int = 1000, s3_client=None,
+                      total_objects: int = None, executor: ThreadPoolExecutor = None,
+                      list_budget: SharedListBudget = None) -> Dict[str, Any]:
+        """Estimate storage-class and age mix with stratified reservoir sampling over top-level prefixes
+        
+        The whole bucket is listed within SAMPLE_BUCKET_LIST_BUDGET keys, or what is left of the shared
+        list_budget when that is smaller (nothing is listed once it is spent): prefix discovery first, then
+        an even share of the rest per stratum, while a reservoir keeps a uniform sample of what was
+        listed. Strata listed to the end have exact weights; the remaining objects (from total_objects,
+        typically CloudWatch NumberOfObjects) are split across the truncated strata. Confidence
+        intervals are widened by the range that split could take; without total_objects the
+        truncated strata only count what was listed and the totals are flagged as lower bounds.
+        """
+        bucket_budget = SAMPLE_BUCKET_LIST_BUDGET
+        if list_budget is not None:
+            bucket_budget = list_budget.reserve(SAMPLE_BUCKET_LIST_BUDGET)
+            if not bucket_budget:
+                logger.warning(f"Request-wide LIST budget spent; not sampling {bucket_name}")
+                return {'complete_listing': False, 'list_budget_exhausted': True}
+        
         try:
-            storage_class_stats = {}
-            total_size = 0
+            s3_client = s3_client or self.s3_client
+            prefixes, root_objects, discovery_complete = self._discover_prefixes(bucket_name, s3_client)
             
-            # List objects with pagination
-            paginator = self.s3_client.get_paginator('list_objects_v2')
-            page_iterator = paginator.paginate(
-                Bucket=bucket_name,
-                PaginationConfig={'MaxItems': max_objects}
-            )
-            
-            for page in page_iterator:
-                if 'Contents' in page:
-                    for obj in page['Contents']:
-                        storage_class = obj.get('StorageClass', 'STANDARD')
-                        size = obj['Size']
-                        
-                        if storage_class not in storage_class_stats:
-                            storage_class_stats[storage_class] = {
-                                'count': 0,
-                                'total_size': 0
-                            }
-                        
-                        storage_class_stats[storage_class]['count'] += 1
-                        storage_class_stats[storage_class]['total_size'] += size
-                        total_size += size
-            
-            # Calculate percentages
-            for storage_class in storage_class_stats:
-                stats = storage_class_stats[storage_class]
-                stats['size_percentage'] = (stats['total_size'] / total_size * 100) if total_size > 0 else 0
-                stats['size_gb'] = stats['total_size'] / (1024**3)
+            unvisited = 0 if discovery_complete else 1
+            if len(prefixes) > SAMPLE_MAX_STRATA:
+                unvisited += len(prefixes) - SAMPLE_MAX_STRATA
+                prefixes = random.Random(bucket_name).sample(prefixes, SAMPLE_MAX_STRATA)
             
-            return storage_class_stats
+            reservoir_size = max(SAMPLE_MIN_PER_STRATUM, max_objects // max(len(prefixes) + 1, 1))
+            strata = [self._reservoir(f'{bucket_name}/', root_objects, reservoir_size, discovery_complete)]
+            
+            if prefixes:
+                stratum_budget = max((bucket_budget - len(root_objects)) // len(prefixes), SAMPLE_MIN_PER_STRATUM)
+                
+                def sample_prefix(prefix):
+                    return self._sample_prefix(bucket_name, prefix, reservoir_size, stratum_budget, s3_client)
+                
+                if executor is None:
+                    with ThreadPoolExecutor(max_workers=min(SAMPLE_WORKERS, len(prefixes))) as own_executor:
+                        strata.extend(own_executor.map(sample_prefix, prefixes))
+                else:
+                    strata.extend(self._map_on_shared_pool(executor, sample_prefix, prefixes))
+            
+            strata = [stratum for stratum in strata if stratum['listed']]
+            self._assign_stratum_weights(strata, total_objects, unvisited > 0)
+            
+            result = self._stratified_estimates(strata)
+            result['strata'] = len(strata)
+            result['listed_objects'] = sum(stratum['listed'] for stratum in strata)
+            result['truncated_strata'] = sum(1 for stratum in strata if not stratum['complete'])
+            result['complete_listing'] = not result['truncated_strata'] and not unvisited
+            # Unlisted objects with no total to scale to are simply missing from the estimates
+            result['totals_are_lower_bounds'] = not result['complete_listing'] and not total_objects
+            if list_budget is not None:
+                list_budget.release(bucket_budget - result['listed_objects'])
+            return result
             
         except Exception as e:
             logger.error(f"Error analyzing storage classes for {bucket_name}: {str(e)}")
             return {}
     
+    @staticmethod
+    def _map_on_shared_pool(executor: ThreadPoolExecutor, func: Callable, items: List[Any]) -> List[Any]:
+        """Map over a pool the calling thread belongs to without deadlocking it
+        
+        Work the pool has not started yet is taken back and run by the caller, so a bucket worker
+        never blocks on tasks queued behind other blocked bucket workers.
+        """
+        futures = [executor.submit(func, item) for item in items]
+        return [func(item) if future.cancel() else future.result() for item, future in zip(items, futures)]
+    
+    def _discover_prefixes(self, bucket_name: str, s3_client) -> tuple:
+        """Top-level prefixes via delimiter listing, plus the objects stored directly at the root
+        
+        Reads at most SAMPLE_DISCOVERY_PAGES pages; when more remain, both the root objects and the
+        prefix list are incomplete.
+        """
+        paginator = s3_client.get_paginator('list_objects_v2')
+        prefixes, root_objects = [], []
+        complete = True
+        for page_number, page in enumerate(paginator.paginate(Bucket=bucket_name, Delimiter='/')):
+            if page_number == SAMPLE_DISCOVERY_PAGES:
+                complete = False
+                break
+            prefixes.extend(common['Prefix'] for common in page.get('CommonPrefixes', []))
+            root_objects.extend(page.get('Contents', []))
+        return prefixes, root_objects, complete
+    
+    def _sample_prefix(self, bucket_name: str, prefix: str, reservoir_size: int, list_budget: int,
+                       s3_client) -> Dict[str, Any]:
+        paginator = s3_client.get_paginator('list_objects_v2')
+        listed = 0
+        
+        def objects():
+            nonlocal listed
+            for page in paginator.paginate(
+                Bucket=bucket_name,
+                Prefix=prefix,
+                PaginationConfig={'MaxItems': list_budget + 1}
+            ):
+                for obj in page.get('Contents', []):
+                    listed += 1
+                    yield obj
+        
+        stratum = self._reservoir(f'{bucket_name}/{prefix}', objects(), reservoir_size, True)
+        # Listing one key past the budget tells a truncated prefix apart from one that fits exactly
+        stratum['complete'] = listed <= list_budget
+        return stratum
+    
+    @staticmethod
+    def _reservoir(seed: str, objects, reservoir_size: int, complete: bool) -> Dict[str, Any]:
+        """Algorithm R over a listing stream, keeping (size, storage class, last modified) per sampled key"""
+        rng = random.Random(seed)
+        sample = []
+        listed = 0
+        for obj in objects:
+            item = (obj['Size'], obj.get('StorageClass', 'STANDARD'), obj.get('LastModified'))
+            if listed < reservoir_size:
+                sample.append(item)
+            else:
+                slot = rng.randint(0, listed)
+                if slot < reservoir_size:
+                    sample[slot] = item
+            listed += 1
+        return {'sample': sample, 'listed': listed, 'complete': complete}
+    
+    @staticmethod
+    def _assign_stratum_weights(strata: List[Dict[str, Any]], total_objects: int, has_unvisited: bool):
+        """Population size per stratum: exact where listed to the end, otherwise a share of the remainder"""
+        exact = sum(stratum['listed'] for stratum in strata if stratum['complete'])
+        open_strata = [stratum for stratum in strata if not stratum['complete']]
+        if not open_strata and has_unvisited:
+            open_strata = strata
+        
+        for stratum in strata:
+            stratum['population'] = stratum['listed']
+            stratum['estimated'] = False
+        
+        if total_objects and open_strata:
+            known = exact if open_strata is not strata else 0
+            remainder = max(total_objects - known, sum(stratum['listed'] for stratum in open_strata))
+            listed = sum(stratum['listed'] for stratum in open_strata)
+            for stratum in open_strata:
+                stratum['population'] = remainder * stratum['listed'] / listed
+                stratum['estimated'] = True
+    
+    @staticmethod
+    def _stratified_estimates(strata: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """Stratified totals per storage class with 95% confidence intervals, plus age/size histograms
+        
+        Intervals cover sampling error plus, when strata have estimated populations, every way the
+        unlisted objects could be split across those strata (each keeping at least what was listed).
+        """
+        now = datetime.now(timezone.utc)
+        age_edges = np.array(AGE_EDGES_DAYS)
+        size_edges = np.array(SIZE_EDGES_BYTES)
+        class_names = sorted({item[1] for stratum in strata for item in stratum['sample']})
+        class_index = {name: i for i, name in enumerate(class_names)}
+        
+        class_bytes = np.zeros(len(class_names))
+        class_counts = np.zeros(len(class_names))
+        bytes_variance = np.zeros(len(class_names))
+        counts_variance = np.zeros(len(class_names))
+        age_size_bytes = np.zeros((len(AGE_EDGES_DAYS), len(SIZE_EDGES_BYTES)))
+        age_size_counts = np.zeros_like(age_size_bytes)
+        sampled = 0
+        # Per-object class means of the strata whose population is an estimate, for the allocation range
+        estimated_listed, estimated_population, estimated_bytes, estimated_counts = [], [], [], []
+        
+        for stratum in strata:
+            sample = stratum['sample']
+            n, population = len(sample), stratum['population']
+            sampled += n
+            sizes = np.array([item[0] for item in sample], dtype=np.float64)
+            classes = np.array([class_index[item[1]] for item in sample])
+            ages = np.array([(now - item[2]).days if item[2] else 0 for item in sample])
+            
+            # Per-object contribution to each class, as an (objects, classes) matrix
+            in_class = np.zeros((n, len(class_names)))
+            in_class[np.arange(n), classes] = 1
+            weight = population / n
+            class_bytes += weight * (in_class * sizes[:, None]).sum(axis=0)
+            class_counts += weight * in_class.sum(axis=0)
+            
+            if stratum.get('estimated'):
+                estimated_listed.append(stratum['listed'])
+                estimated_population.append(population)
+                estimated_bytes.append((in_class * sizes[:, None]).mean(axis=0))
+                estimated_counts.append(in_class.mean(axis=0))
+            
+            if n > 1 and population > n:
+                fpc = 1 - n / population
+                bytes_variance += population**2 * fpc * (in_class * sizes[:, None]).var(axis=0, ddof=1) / n
+                counts_variance += population**2 * fpc * in_class.var(axis=0, ddof=1) / n
+            
+            age_bins = np.searchsorted(age_edges, ages, side='right') - 1
+            size_bins = np.searchsorted(size_edges, sizes, side='right') - 1
+            np.add.at(age_size_bytes, (age_bins, size_bins), sizes * weight)
+            np.add.at(age_size_counts, (age_bins, size_bins), weight)
+        
+        # Range of each class total over all splits of the unlisted objects across the estimated strata
+        def allocation_range(means):
+            if not estimated_listed:
+                return np.zeros(len(class_names)), np.zeros(len(class_names))
+            means = np.array(means)
+            listed = np.array(estimated_listed, dtype=np.float64)
+            population = np.array(estimated_population)
+            extra = population.sum() - listed.sum()
+            estimate, floor = population @ means, listed @ means
+            return (np.maximum(estimate - floor - extra * means.min(axis=0), 0),
+                    np.maximum(floor + extra * means.max(axis=0) - estimate, 0))
+        
+        bytes_below, bytes_above = allocation_range(estimated_bytes)
+        counts_below, counts_above = allocation_range(estimated_counts)
+        
+        total_size = class_bytes.sum()
+        storage_classes = {}
+        for i, name in enumerate(class_names):
+            bytes_margin = 1.96 * np.sqrt(bytes_variance[i])
+            counts_margin = 1.96 * np.sqrt(counts_variance[i])
+            storage_classes[name] = {
+                'count': int(round(class_counts[i])),
+                'total_size': int(round(class_bytes[i])),
+                'size_percentage': float(class_bytes[i] / total_size * 100) if total_size > 0 else 0,
+                'size_gb': float(class_bytes[i]) / (1024**3),
+                'size_ci_95': [int(max(class_bytes[i] - bytes_margin - bytes_below[i], 0)),
+                               int(class_bytes[i] + bytes_margin + bytes_above[i])],
+                'count_ci_95': [int(max(class_counts[i] - counts_margin - counts_below[i], 0)),
+                                int(round(class_counts[i] + counts_margin + counts_above[i]))]
+            }
+        
+        return {
+            'storage_classes': storage_classes,
+            'sampled_objects': sampled,
+            'intervals_include_allocation': bool(estimated_listed),
+            'age_histogram': {
+                'edges_days': AGE_EDGES_DAYS,
+                'counts': np.round(age_size_counts.sum(axis=1)).astype(int).tolist(),
+                'bytes': np.round(age_size_bytes.sum(axis=1)).astype(int).tolist()
+            },
+            'size_histogram': {
+                'edges_bytes': SIZE_EDGES_BYTES,
+                'counts': np.round(age_size_counts.sum(axis=0)).astype(int).tolist(),
+                'bytes': np.round(age_size_bytes.sum(axis=0)).astype(int).tolist()
+            },
+            'age_size_counts': np.round(age_size_counts).astype(int).tolist(),
+            'age_size_bytes': np.round(age_size_bytes).astype(int).tolist()
+        }
+    
     def get_s3_costs(self, days: int = 30) -> Dict[str, Any]:
         """Get S3 cost information from Cost Explorer"""
         try:
-            end_date = datetime.utcnow().date()
-            start_date = end_date - timedelta(days=days)
-            
-            # Get S3 cost data
-            response = self.cost_explorer_client.get_cost_and_usage(
-                TimePeriod={
-                    'Start': start_date.strftime('%Y-%m-%d'),
-                    'End': end_date.strftime('%Y-%m-%d')
-                },
-                Granularity='DAILY',
-                Metrics=['BlendedCost'],
-                GroupBy=[
-                    {
-                        'Type': 'DIMENSION',
-                        'Key': 'USAGE_TYPE'
-                    }
-                ],
-                Filter={
-                    'Dimensions': {
-                        'Key': 'SERVICE',
-                        'Values': ['Amazon Simple Storage Service']
+            cube = self.shared_data.get('cost_cube')
+            if cube and cube['days'] == days:
+                # Same (date, usage type) groups the query below returns, filtered from the shared cube
+                groups_by_date = {}
+                for date, service, usage_type, amount in cube['rows']:
+                    if service == S3_COST_SERVICE:
+                        groups_by_date.setdefault(date, []).append(
+                            {'Keys': [usage_type], 'Metrics': {'BlendedCost': {'Amount': str(amount)}}}
+                        )
+                response = {'ResultsByTime': [
+                    {'TimePeriod': {'Start': date}, 'Groups': groups}
+                    for date, groups in sorted(groups_by_date.items())
+                ]}
+            else:
+                end_date = datetime.utcnow().date()
+                start_date = end_date - timedelta(days=days)
+                
+                # Get S3 cost data
+                response = self.cost_explorer_client.get_cost_and_usage(
+                    TimePeriod={
+                        'Start': start_date.strftime('%Y-%m-%d'),
+                        'End': end_date.strftime('%Y-%m-%d')
+                    },
+                    Granularity='DAILY',
+                    Metrics=['BlendedCost'],
+                    GroupBy=[
+                        {
+                            'Type': 'DIMENSION',
+                            'Key': 'USAGE_TYPE'
+                        }
+                    ],
+                    Filter={
+                        'Dimensions': {
+                            'Key': 'SERVICE',
+                            'Values': [S3_COST_SERVICE]
+                        }
                     }
-                }
-            )
+                )
             
             # Process cost data by usage type
             usage_type_costs = {}
@@ -220,10 +928,66 @@ class S3CostAnalyzer:
             logger.error(f"Error getting S3 costs: {str(e)}")
             return {}
     
+    def rank_lifecycle_policies(self, bucket_analysis: Dict[str, Any],
+                                policies: List[Dict[str, Any]] = None, months: int = 12) -> Dict[str, Any]:
+        """Simulate candidate lifecycle policies for every bucket with an age/size histogram and rank them"""
+        bucket_names = [
+            name for name, analysis in bucket_analysis.items()
+            if 'error' not in analysis and analysis.get('age_size_bytes')
+        ]
+        if not bucket_names:
+            return {}
+        
+        # Only STANDARD data is acted on; histograms cover all classes, so scale by its share of bytes.
+        # Without a storage-class breakdown everything is assumed STANDARD.
+        standard_share = np.array([
+            bucket_analysis[name]['storage_classes'].get('STANDARD', {}).get('size_percentage', 0) / 100
+            if bucket_analysis[name].get('storage_classes') else 1.0
+            for name in bucket_names
+        ])[:, None, None]
+        simulation = simulate_lifecycle_policies(
+            np.array([bucket_analysis[name]['age_size_bytes'] for name in bucket_names]) * standard_share,
+            np.array([bucket_analysis[name]['age_size_counts'] for name in bucket_names]) * standard_share,
+            policies, months
+        )
+        
+        # The first policy with no transitions or expiry is the baseline to beat
+        baseline = 0
+        policies = policies or DEFAULT_LIFECYCLE_POLICIES
+        for p, policy in enumerate(policies):
+            if not policy.get('transitions') and not policy.get('expiration_days'):
+                baseline = p
+                break
+        
+        total_cost = simulation['total_cost']
+        rankings = {}
+        for b, bucket_name in enumerate(bucket_names):
+            order = np.argsort(total_cost[b], kind='stable')
+            rankings[bucket_name] = {
+                'horizon_months': months,
+                'baseline_policy': simulation['policies'][baseline],
+                'baseline_cost': round(float(total_cost[b, baseline]), 2),
+                'policies': [
+                    {
+                        'policy': simulation['policies'][p],
+                        'total_cost': round(float(total_cost[b, p]), 2),
+                        'storage_cost': round(float(simulation['storage_cost'][b, p]), 2),
+                        'transition_cost': round(float(simulation['transition_cost'][b, p]), 2),
+                        'retrieval_cost': round(float(simulation['retrieval_cost'][b, p]), 2),
+                        'early_deletion_cost': round(float(simulation['early_deletion_cost'][b, p]), 2),
+                        'savings': round(float(total_cost[b, baseline] - total_cost[b, p]), 2),
+                        'deletes_data': simulation['deletes_data'][p]
+                    }
+                    for p in order
+                ]
+            }
+        return rankings
+    
     def identify_optimization_opportunities(self, bucket_analysis: Dict[str, Any], 
                                          cost_data: Dict[str, Any]) -> List[Dict[str, Any]]:
         """Identify S3 cost optimization opportunities"""
         opportunities = []
+        lifecycle_rankings = self.rank_lifecycle_policies(bucket_analysis)
         
         for bucket_name, analysis in bucket_analysis.items():
             if 'error' in analysis:
@@ -251,14 +1015,34 @@ class S3CostAnalyzer:
                 try:
                     self.s3_client.get_bucket_lifecycle_configuration(Bucket=bucket_name)
                 except self.s3_client.exceptions.NoSuchLifecycleConfiguration:
-                    opportunities.append({
+                    opportunity = {
                         'type': 'lifecycle_policy',
                         'bucket_name': bucket_name,
                         'recommendation': 'Implement lifecycle policies to automatically transition objects to cheaper storage classes',
                         'priority': 'high' if size_gb > 100 else 'medium',
                         'estimated_savings_percent': 30 if size_gb > 100 else 20,
                         'size_gb': size_gb
-                    })
+                    }
+                    
+                    ranking = lifecycle_rankings.get(bucket_name)
+                    if ranking:
+                        # Replace the flat estimate with the best simulated policy
+                        best = ranking['policies'][0]
+                        monthly_savings = best['savings'] / ranking['horizon_months']
+                        action = 'expire (permanently delete)' if best['deletes_data'] else 'transition'
+                        opportunity.update({
+                            'recommendation': f"Apply lifecycle policy '{best['policy']}' to {action} aged objects",
+                            'recommended_policy': best['policy'],
+                            'deletes_data': best['deletes_data'],
+                            'projected_savings': best['savings'],
+                            'projection_months': ranking['horizon_months'],
+                            'estimated_savings_percent': round(best['savings'] / ranking['baseline_cost'] * 100, 1) if ranking['baseline_cost'] else 0,
+                            'estimated_monthly_savings': round(monthly_savings, 2),
+                            'priority': 'high' if monthly_savings > 100 else 'medium' if monthly_savings > 10 else 'low'
+                        })
+                    
+                    if not ranking or ranking['policies'][0]['savings'] > 0:
+                        opportunities.append(opportunity)
                 except Exception:
                     pass
             
@@ -311,14 +1095,45 @@ def lambda_handler(event, context):
         logger.info(f"Received event: {json.dumps(event)}")
         
         # Initialize the analyzer
-        analyzer = S3CostAnalyzer()
+        analyzer = S3CostAnalyzer(event.get('shared_data'))
         
         # Extract parameters from the event
         action = event.get('action', 'analyze_all')
         bucket_names = event.get('bucket_names', [])
         days = event.get('days', 30)
+        inventory_manifests = event.get('inventory_manifests') or [
+            location for location in os.environ.get('S3_INVENTORY_MANIFESTS', '').split(',') if location
+        ]
+        
+        if inventory_manifests:
+            analyzer.load_inventory(inventory_manifests)
         
-        if action == 'analyze_storage':
+        if action == 'simulate_lifecycle':
+            bucket_analysis = analyzer.analyze_bucket_storage(bucket_names)
+            policies = event.get('policies')
+            if policies is None and event.get('include_expiration'):
+                policies = DEFAULT_LIFECYCLE_POLICIES + EXPIRATION_LIFECYCLE_POLICIES
+            
+            return {
+                'statusCode': 200,
+                'body': json.dumps({
+                    'action': action,
+                    'lifecycle_rankings': analyzer.rank_lifecycle_policies(bucket_analysis, policies),
+                    'bucket_count': len(bucket_analysis)
+                })
+            }
+            
+        elif action == 'analyze_inventory':
+            return {
+                'statusCode': 200,
+                'body': json.dumps({
+                    'action': action,
+                    'inventory': analyzer.inventory_stats,
+                    'bucket_count': len(analyzer.inventory_stats)
+                })
+            }
+            
+        elif action == 'analyze_storage':
             bucket_analysis = analyzer.analyze_bucket_storage(bucket_names)
             
             return {
@@ -361,7 +1176,10 @@ def lambda_handler(event, context):
             high_priority_count = 0
             
             for opp in opportunities:
-                if opp.get('estimated_savings_percent') and opp.get('size_gb'):
+                if 'estimated_monthly_savings' in opp:
+                    # Simulated lifecycle savings are already priced
+                    total_potential_savings += opp['estimated_monthly_savings']
+                elif opp.get('estimated_savings_percent') and opp.get('size_gb'):
                     # Estimate savings based on storage size and average S3 pricing
                     storage_cost_per_gb = 0.023  # Approximate S3 Standard pricing
                     monthly_storage_cost = opp['size_gb'] * storage_cost_per_gb
@@ -397,7 +1215,7 @@ def lambda_handler(event, context):
                 'statusCode': 400,
                 'body': json.dumps({
                     'error': 'Invalid action',
-                    'supported_actions': ['analyze_storage', 'get_recommendations', 'analyze_all']
+                    'supported_actions': ['analyze_storage', 'analyze_inventory', 'simulate_lifecycle', 'get_recommendations', 'analyze_all']
                 })
             }
             
@@ -0,0 +1,145 @@
+import json
+import os
+import time
+import zlib
+import boto3
+from typing import Dict, Any, Optional
+
+# lambda_functions/state_store.py at the repository root is the action-group functions' copy, which
+# also holds their paging and job runner. Each tree is packaged on its own (deploy_finops_system.py
+# zips that directory; Terraform and CloudFormation package this one), so the module cannot be
+# shared; keep the encoding and key layout in step.
+
+# Stores use the same encoding as the FinOps action-group functions: DynamoDB items hold
+# zlib-compressed JSON and are capped at 400 KB, so larger values are spilled to S3
+MAX_ITEM_VALUE_BYTES = 350000
+SPILL_PREFIX = 'finops-state/'
+
+# A queued worker that has not started within this window is treated as lost
+JOB_START_TIMEOUT_SECONDS = int(os.environ.get('JOB_START_TIMEOUT_SECONDS', '300'))
+JOB_LEASE_GRACE_SECONDS = 30
+# Lambda's maximum timeout, used when a job runs without an invocation context
+JOB_INLINE_LEASE_SECONDS = 900
+
+def running_in_lambda() -> bool:
+    """Whether this process is a Lambda execution environment"""
+    return 'AWS_LAMBDA_FUNCTION_NAME' in os.environ
+
+def encode_value(value: Dict[str, Any]) -> bytes:
+    return zlib.compress(json.dumps(value).encode('utf-8'))
+
+def decode_value(blob: bytes) -> Dict[str, Any]:
+    return json.loads(zlib.decompress(blob))
+
+class FileStore:
+    """Local store keeping one JSON file per key (used for tests and local runs)"""
+
+    # Each Lambda container has its own /tmp, so a file store is only shared outside Lambda
+    shared = False
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def _file(self, key: str) -> str:
+        return os.path.join(self.path, f'{key}.json')
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self._file(key)) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if entry['expires_at'] < time.time():
+            return None
+        return entry['value']
+
+    def put(self, key: str, value: Dict[str, Any], ttl: int):
+        tmp_file = self._file(key) + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump({'expires_at': time.time() + ttl, 'value': value}, f)
+        os.replace(tmp_file, self._file(key))
+
+class DynamoDBStore:
+    """Store backed by a DynamoDB table with `cache_key` hash key and TTL on `expires_at`
+
+    Values that still exceed the item limit after compression are written to
+    `spill_bucket`, and the item keeps only their S3 key.
+    """
+
+    shared = True
+
+    def __init__(self, table_name: str, spill_bucket: str = None):
+        self.table_name = table_name
+        self.spill_bucket = spill_bucket
+        self.dynamodb_client = boto3.client('dynamodb')
+        self.s3_client = boto3.client('s3') if spill_bucket else None
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        response = self.dynamodb_client.get_item(
+            TableName=self.table_name,
+            Key={'cache_key': {'S': key}}
+        )
+        item = response.get('Item')
+        # DynamoDB TTL deletion is lazy, so expiry is enforced on read as well
+        if not item or float(item['expires_at']['N']) < time.time():
+            return None
+        if 'spill_key' in item:
+            obj = self.s3_client.get_object(Bucket=self.spill_bucket, Key=item['spill_key']['S'])
+            return decode_value(obj['Body'].read())
+        return decode_value(item['value']['B'])
+
+    def put(self, key: str, value: Dict[str, Any], ttl: int):
+        blob = encode_value(value)
+        item = {
+            'cache_key': {'S': key},
+            'expires_at': {'N': str(int(time.time() + ttl))}
+        }
+        if len(blob) <= MAX_ITEM_VALUE_BYTES:
+            item['value'] = {'B': blob}
+        elif self.spill_bucket:
+            spill_key = f'{SPILL_PREFIX}{key}'
+            self.s3_client.put_object(Bucket=self.spill_bucket, Key=spill_key, Body=blob)
+            item['spill_key'] = {'S': spill_key}
+        else:
+            raise ValueError(f'Value for {key} is {len(blob)} bytes compressed and no spill bucket is configured')
+        self.dynamodb_client.put_item(TableName=self.table_name, Item=item)
+
+def create_store(backend: str, table_name: Optional[str], path: str):
+    """Create a DynamoDB store or a local file store"""
+    if backend == 'dynamodb':
+        if not table_name:
+            raise RuntimeError('The dynamodb store backend needs a table name')
+        return DynamoDBStore(table_name, os.environ.get('STATE_SPILL_BUCKET'))
+    return FileStore(path)
+
+def create_job_store(default_path: str):
+    """Create the job store selected by JOB_STORE_BACKEND
+
+    Job workers run in other containers than the request that submitted the job,
+    so inside Lambda the store defaults to DynamoDB and a file store is refused.
+    """
+    backend = os.environ.get('JOB_STORE_BACKEND', 'dynamodb' if running_in_lambda() else 'file')
+    if backend == 'file' and running_in_lambda():
+        raise RuntimeError("JOB_STORE_BACKEND=file keeps jobs in one container's /tmp; set JOB_TABLE and use dynamodb")
+    return create_store(backend, os.environ.get('JOB_TABLE'), os.environ.get('JOB_STORE_PATH', default_path))
+
+def lease_job(job: Dict[str, Any], context=None):
+    """Mark a job running and lease it for the rest of this invocation"""
+    job['status'] = 'running'
+    if context is not None:
+        job['lease_expires_at'] = time.time() + context.get_remaining_time_in_millis() / 1000 + JOB_LEASE_GRACE_SECONDS
+    else:
+        job['lease_expires_at'] = time.time() + JOB_INLINE_LEASE_SECONDS
+
+def requeue_job(job: Dict[str, Any]):
+    """Lease a job to the queued invocation that starts or continues it"""
+    job['lease_expires_at'] = time.time() + JOB_START_TIMEOUT_SECONDS
+
+def expire_job(job: Dict[str, Any]) -> bool:
+    """Fail a pending or running job whose worker let its lease run out; returns whether it changed"""
+    if job['status'] not in ['pending', 'running'] or job['lease_expires_at'] >= time.time():
+        return False
+    job['status'] = 'failed'
+    job['error'] = 'Job worker stopped before finishing (crashed or timed out); resubmit the job'
+    return True
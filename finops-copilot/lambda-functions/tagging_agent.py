@@ -1,14 +1,460 @@
+import os
+import re
+import gzip
 import json
+import base64
+import time
+import hashlib
 import boto3
+import numpy as np
 import logging
+import threading
+from array import array
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from typing import Dict, List, Any, Set
+from typing import Dict, List, Any, Set, Iterator
 from collections import defaultdict
 
 # Configure logging
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+DEFAULT_RESOURCE_TYPES = [
+    'ec2:instance',
+    's3:bucket',
+    'rds:db',
+    'lambda:function',
+    'elasticloadbalancing:loadbalancer'
+]
+
+# Regions scanned concurrently; defaults to the Lambda's own region
+TAGGING_REGIONS = [region for region in os.environ.get('TAGGING_REGIONS', '').split(',') if region]
+
+# Compliance trend points kept in the snapshot
+SNAPSHOT_HISTORY_LIMIT = 90
+
+# CloudTrail events that change a resource's tags, across the tagging API, EC2, RDS, S3 and ELB
+TAG_CHANGE_EVENTS = [
+    'TagResource', 'UntagResource', 'CreateTags', 'DeleteTags', 'AddTagsToResource',
+    'RemoveTagsFromResource', 'PutBucketTagging', 'DeleteBucketTagging', 'AddTags', 'RemoveTags'
+]
+
+# CloudTrail delivers events up to about 15 minutes late; event lookups reach back this far before the snapshot
+CLOUDTRAIL_OVERLAP_MINUTES = 30
+# Resources created already tagged, or deleted, raise no tag-change event; cloudtrail mode rescans the
+# estate as in diff mode once the last scan is older than this
+CLOUDTRAIL_MAX_SCAN_AGE_HOURS = int(os.environ.get('TAG_CLOUDTRAIL_MAX_SCAN_AGE_HOURS', '24'))
+
+# GetResources accepts at most 100 ARNs per ResourceARNList call
+TAGGING_ARN_BATCH = 100
+
+# Untagged-cost results per (window, tags), reused by warm invocations
+COST_CACHE_TTL_SECONDS = int(os.environ.get('TAG_COST_CACHE_TTL_SECONDS', '21600'))
+COST_CACHE_MAX_ENTRIES = 32
+_untagged_cost_cache: Dict[str, Any] = {}
+# Upper bound on Cost Explorer pages read per query; a repeated page token also ends the read
+COST_QUERY_MAX_PAGES = 50
+
+def encode_array(values: np.ndarray) -> str:
+    return base64.b64encode(np.ascontiguousarray(values).tobytes()).decode('ascii')
+
+def decode_array(encoded: str, dtype) -> np.ndarray:
+    return np.frombuffer(base64.b64decode(encoded), dtype=dtype).copy()
+
+def mix64(values: np.ndarray) -> np.ndarray:
+    """SplitMix64 finalizer over a uint64 array (multiplications wrap modulo 2**64)"""
+    values = values ^ (values >> np.uint64(30))
+    values = values * np.uint64(0xBF58476D1CE4E5B9)
+    values = values ^ (values >> np.uint64(27))
+    values = values * np.uint64(0x94D049BB133111EB)
+    return values ^ (values >> np.uint64(31))
+
+class FileSnapshotStore:
+    """Compliance snapshot kept as one gzip JSON file (local runs and a warm Lambda's /tmp)"""
+    
+    def __init__(self, path: str):
+        self.path = path
+    
+    def load(self) -> Dict[str, Any]:
+        try:
+            with gzip.open(self.path, 'rt') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+    
+    def save(self, snapshot: Dict[str, Any]):
+        tmp_file = self.path + '.tmp'
+        with gzip.open(tmp_file, 'wt') as f:
+            json.dump(snapshot, f)
+        os.replace(tmp_file, self.path)
+
+class S3SnapshotStore:
+    """Compliance snapshot kept as one gzip JSON object; too large for a DynamoDB item"""
+    
+    def __init__(self, bucket: str, key: str):
+        self.bucket = bucket
+        self.key = key
+        self.s3_client = boto3.client('s3')
+    
+    def load(self) -> Dict[str, Any]:
+        try:
+            response = self.s3_client.get_object(Bucket=self.bucket, Key=self.key)
+            return json.loads(gzip.decompress(response['Body'].read()))
+        except self.s3_client.exceptions.NoSuchKey:
+            return None
+    
+    def save(self, snapshot: Dict[str, Any]):
+        self.s3_client.put_object(
+            Bucket=self.bucket,
+            Key=self.key,
+            Body=gzip.compress(json.dumps(snapshot).encode('utf-8')),
+            ContentType='application/json',
+            ContentEncoding='gzip'
+        )
+
+def create_snapshot_store():
+    """Create the snapshot store selected by COMPLIANCE_SNAPSHOT_BACKEND"""
+    if os.environ.get('COMPLIANCE_SNAPSHOT_BACKEND', 'file') == 's3':
+        return S3SnapshotStore(
+            os.environ['COMPLIANCE_SNAPSHOT_BUCKET'],
+            os.environ.get('COMPLIANCE_SNAPSHOT_KEY', 'finops-copilot/tag-compliance-snapshot.json.gz')
+        )
+    return FileSnapshotStore(os.environ.get('COMPLIANCE_SNAPSHOT_PATH', '/tmp/tag-compliance-snapshot.json.gz'))
+
+def resource_type_from_arn(arn: str) -> str:
+    """Derive the service:type filter name (ec2:instance, s3:bucket) from a resource ARN"""
+    parts = arn.split(':', 5)
+    service, resource = parts[2], parts[5] if len(parts) > 5 else ''
+    if service == 's3' and '/' not in resource:
+        return 's3:bucket'
+    return f"{service}:{resource.replace('/', ':').split(':', 1)[0]}"
+
+class ResourceInventory:
+    """Tagged resources held column-wise: tag keys, values, types and regions are interned to integer
+    ids and each resource's tags are a slice of flat key/value arrays (CSR layout)"""
+    
+    def __init__(self):
+        self.strings: List[str] = []
+        self.string_ids: Dict[str, int] = {}
+        self.arns: List[str] = []
+        self.arn_index: Dict[str, int] = {}
+        self.type_ids = array('I')
+        self.region_ids = array('I')
+        self.tag_offsets = array('I', [0])
+        self.tag_keys = array('I')
+        self.tag_values = array('I')
+        self.lock = threading.Lock()
+    
+    def intern(self, value: str) -> int:
+        string_id = self.string_ids.get(value)
+        if string_id is None:
+            string_id = len(self.strings)
+            self.strings.append(value)
+            self.string_ids[value] = string_id
+        return string_id
+    
+    def add_page(self, mappings: List[Dict[str, Any]], region: str, resource_types: List[str]):
+        """Append one GetResources page; resources already seen in another region are skipped"""
+        with self.lock:
+            region_id = self.intern(region)
+            for mapping in mappings:
+                arn = mapping['ResourceARN']
+                if arn in self.arn_index:
+                    continue
+                self.arn_index[arn] = len(self.arns)
+                self.arns.append(arn)
+                self.type_ids.append(self.intern(self.match_type(arn, resource_types)))
+                self.region_ids.append(region_id)
+                for tag in mapping.get('Tags', []):
+                    self.tag_keys.append(self.intern(tag['Key']))
+                    self.tag_values.append(self.intern(tag['Value']))
+                self.tag_offsets.append(len(self.tag_keys))
+    
+    @staticmethod
+    def match_type(arn: str, resource_types: List[str]) -> str:
+        """Report a resource under the filter that selected it, so service-wide filters (ec2) still group"""
+        resource_type = resource_type_from_arn(arn)
+        if resource_type in resource_types:
+            return resource_type
+        service = resource_type.split(':', 1)[0]
+        return service if service in resource_types else resource_type
+    
+    def __len__(self) -> int:
+        return len(self.arns)
+    
+    def resource_type(self, index: int) -> str:
+        return self.strings[self.type_ids[index]]
+    
+    def tags(self, index: int) -> Dict[str, str]:
+        start, end = self.tag_offsets[index], self.tag_offsets[index + 1]
+        return {
+            self.strings[key]: self.strings[value]
+            for key, value in zip(self.tag_keys[start:end], self.tag_values[start:end])
+        }
+    
+    def resource(self, index: int) -> Dict[str, Any]:
+        return {
+            'resource_arn': self.arns[index],
+            'resource_type': self.resource_type(index),
+            'region': self.strings[self.region_ids[index]],
+            'tags': self.tags(index)
+        }
+    
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        # Resource dicts are materialized one at a time for callers that want the classic shape
+        for index in range(len(self.arns)):
+            yield self.resource(index)
+    
+    def tag_hashes(self) -> np.ndarray:
+        """64-bit hash of each resource's tag set, independent of tag order and intern ids
+
+        Each distinct string is hashed once; a tag mixes its key and value hashes, and a resource sums
+        its tags' hashes (wrapping, so order does not matter) before a final mix.
+        """
+        string_hashes = np.array([
+            int.from_bytes(hashlib.blake2b(value.encode('utf-8'), digest_size=8).digest(), 'little')
+            for value in self.strings
+        ], dtype=np.uint64)
+        tag_keys = np.frombuffer(self.tag_keys, dtype=np.uint32) if len(self.tag_keys) else np.zeros(0, np.uint32)
+        tag_values = np.frombuffer(self.tag_values, dtype=np.uint32) if len(self.tag_values) else np.zeros(0, np.uint32)
+        owners = np.repeat(np.arange(len(self.arns)), np.diff(np.frombuffer(self.tag_offsets, dtype=np.uint32)))
+
+        tag_hashes = mix64(string_hashes[tag_keys] * np.uint64(0x9E3779B97F4A7C15) + string_hashes[tag_values])
+        hashes = np.zeros(len(self.arns), dtype=np.uint64)
+        np.add.at(hashes, owners, tag_hashes)
+        return mix64(hashes)
+    
+    def with_updates(self, updates: Dict[str, Dict[str, Any]]) -> 'ResourceInventory':
+        """Copy of the inventory with the given ARNs replaced by fresh resource dicts (or dropped if None)"""
+        keep = np.array([arn not in updates for arn in self.arns], dtype=bool)
+        offsets = np.frombuffer(self.tag_offsets, dtype=np.uint32).astype(np.int64)
+        counts = np.diff(offsets)
+        tag_keep = np.repeat(keep, counts)
+        
+        inventory = ResourceInventory()
+        inventory.strings = list(self.strings)
+        inventory.string_ids = dict(self.string_ids)
+        inventory.arns = [arn for arn, kept in zip(self.arns, keep) if kept]
+        inventory.arn_index = {arn: index for index, arn in enumerate(inventory.arns)}
+        inventory.type_ids = array('I', np.frombuffer(self.type_ids, dtype=np.uint32)[keep].tobytes())
+        inventory.region_ids = array('I', np.frombuffer(self.region_ids, dtype=np.uint32)[keep].tobytes())
+        inventory.tag_keys = array('I', np.frombuffer(self.tag_keys, dtype=np.uint32)[tag_keep].tobytes())
+        inventory.tag_values = array('I', np.frombuffer(self.tag_values, dtype=np.uint32)[tag_keep].tobytes())
+        inventory.tag_offsets = array('I', np.concatenate([[0], np.cumsum(counts[keep])]).astype(np.uint32).tobytes())
+        inventory.add_resources(resource for resource in updates.values() if resource)
+        return inventory
+    
+    def subset(self, indices: np.ndarray) -> 'ResourceInventory':
+        return ResourceInventory.from_resources(self.resource(index) for index in indices)
+    
+    def add_resources(self, resources):
+        for resource in resources:
+            self.arn_index[resource['resource_arn']] = len(self.arns)
+            self.arns.append(resource['resource_arn'])
+            self.type_ids.append(self.intern(resource['resource_type']))
+            self.region_ids.append(self.intern(resource.get('region', '')))
+            for key, value in resource.get('tags', {}).items():
+                self.tag_keys.append(self.intern(key))
+                self.tag_values.append(self.intern(value))
+            self.tag_offsets.append(len(self.tag_keys))
+    
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'strings': self.strings,
+            'arns': self.arns,
+            'type_ids': encode_array(np.frombuffer(self.type_ids, dtype=np.uint32)),
+            'region_ids': encode_array(np.frombuffer(self.region_ids, dtype=np.uint32)),
+            'tag_offsets': encode_array(np.frombuffer(self.tag_offsets, dtype=np.uint32)),
+            'tag_keys': encode_array(np.frombuffer(self.tag_keys, dtype=np.uint32)),
+            'tag_values': encode_array(np.frombuffer(self.tag_values, dtype=np.uint32))
+        }
+    
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> 'ResourceInventory':
+        inventory = cls()
+        inventory.strings = data['strings']
+        inventory.string_ids = {value: index for index, value in enumerate(inventory.strings)}
+        inventory.arns = data['arns']
+        inventory.arn_index = {arn: index for index, arn in enumerate(inventory.arns)}
+        for name in ('type_ids', 'region_ids', 'tag_offsets', 'tag_keys', 'tag_values'):
+            setattr(inventory, name, array('I', decode_array(data[name], np.uint32).tobytes()))
+        return inventory
+    
+    @classmethod
+    def from_resources(cls, resources: List[Dict[str, Any]]) -> 'ResourceInventory':
+        """Build an inventory from classic resource dicts"""
+        inventory = cls()
+        inventory.add_resources(resources)
+        return inventory
+
+class CompiledTagPolicy:
+    """A tagging policy compiled into per-string matchers over an inventory's intern table
+    
+    Each rule has a key, optional allowed values, an optional full-match regex and case rules.
+    Resource-type overrides can exempt types from rules or add rules for a single type.
+    """
+    
+    def __init__(self, required_tags: Dict[str, Any], overrides: Dict[str, Any] = None):
+        self.rules = []
+        self.overrides = overrides or {}
+        for key, rule in required_tags.items():
+            self.rules.append(self.compile_rule(key, rule, None))
+        for resource_type, override in self.overrides.items():
+            for key, rule in override.get('required_tags', {}).items():
+                self.rules.append(self.compile_rule(key, rule, resource_type))
+        self.keys = [rule['key'] for rule in self.rules]
+        # Snapshot results are only reusable under an identical policy
+        self.fingerprint = hashlib.sha256(
+            json.dumps([required_tags, self.overrides], sort_keys=True).encode('utf-8')
+        ).hexdigest()
+    
+    @staticmethod
+    def compile_rule(key: str, rule: Any, resource_type: str) -> Dict[str, Any]:
+        # A bare list (or None) is the classic allowed-values shorthand
+        if not isinstance(rule, dict):
+            rule = {'allowed_values': rule}
+        ignore_case = rule.get('case_insensitive', False)
+        allowed = rule.get('allowed_values')
+        if allowed and ignore_case:
+            allowed = {value.lower() for value in allowed}
+        return {
+            'key': key,
+            'only_type': resource_type,
+            'allowed_values': set(allowed) if allowed else None,
+            'listed_values': rule.get('allowed_values'),
+            'pattern': re.compile(rule['pattern'], re.IGNORECASE if ignore_case else 0) if rule.get('pattern') else None,
+            'case_insensitive': ignore_case,
+            'key_case_insensitive': rule.get('key_case_insensitive', False)
+        }
+    
+    def value_is_valid(self, rule: Dict[str, Any], value: str) -> bool:
+        candidate = value.lower() if rule['case_insensitive'] else value
+        if rule['allowed_values'] is not None and candidate not in rule['allowed_values']:
+            return False
+        return not rule['pattern'] or bool(rule['pattern'].fullmatch(value))
+    
+    def evaluate(self, inventory: ResourceInventory) -> 'ComplianceEvaluation':
+        """Evaluate every resource against every rule as (rules, resources) boolean matrices"""
+        resource_count = len(inventory)
+        tag_keys = np.frombuffer(inventory.tag_keys, dtype=np.uint32) if len(inventory.tag_keys) else np.zeros(0, np.uint32)
+        tag_values = np.frombuffer(inventory.tag_values, dtype=np.uint32) if len(inventory.tag_values) else np.zeros(0, np.uint32)
+        offsets = np.frombuffer(inventory.tag_offsets, dtype=np.uint32)
+        owners = np.repeat(np.arange(resource_count), np.diff(offsets))
+        type_ids = np.frombuffer(inventory.type_ids, dtype=np.uint32) if resource_count else np.zeros(0, np.uint32)
+        
+        present = np.zeros((len(self.rules), resource_count), dtype=bool)
+        valid = np.zeros_like(present)
+        applies = np.ones_like(present)
+        
+        for r, rule in enumerate(self.rules):
+            if rule['key_case_insensitive']:
+                key_ids = [i for i, name in enumerate(inventory.strings) if name.lower() == rule['key'].lower()]
+            else:
+                key_ids = [inventory.string_ids[rule['key']]] if rule['key'] in inventory.string_ids else []
+            
+            entries = np.isin(tag_keys, key_ids)
+            present[r, owners[entries]] = True
+            
+            # Each distinct value seen under this key is checked once, then broadcast to its tags
+            values = tag_values[entries]
+            distinct, inverse = np.unique(values, return_inverse=True)
+            distinct_valid = np.array([self.value_is_valid(rule, inventory.strings[v]) for v in distinct], dtype=bool)
+            valid[r, owners[entries][distinct_valid[inverse]]] = True
+            
+            if rule['only_type'] is not None:
+                type_id = inventory.string_ids.get(rule['only_type'], -1)
+                applies[r] = type_ids == type_id
+            else:
+                for resource_type, override in self.overrides.items():
+                    if rule['key'] in override.get('exempt', []) and resource_type in inventory.string_ids:
+                        applies[r, type_ids == inventory.string_ids[resource_type]] = False
+        
+        return ComplianceEvaluation(self, inventory, applies & ~present, applies & present & ~valid, applies, type_ids)
+
+class ComplianceEvaluation:
+    """Compliance matrices for one inventory; per-resource detail is only built when asked for"""
+    
+    def __init__(self, policy: CompiledTagPolicy, inventory: ResourceInventory, missing: np.ndarray,
+                 invalid: np.ndarray, applies: np.ndarray, type_ids: np.ndarray):
+        self.policy = policy
+        self.inventory = inventory
+        self.missing = missing
+        self.invalid = invalid
+        self.applies = applies
+        self.type_ids = type_ids
+        self.non_compliant_index = np.flatnonzero((missing | invalid).any(axis=0))
+    
+    def summary(self, detail_limit: int = 100) -> Dict[str, Any]:
+        total = len(self.inventory)
+        missing_count = self.missing.sum(axis=0)
+        compliant = ~(self.missing | self.invalid).any(axis=0)
+        # Non-compliant means every applicable tag is missing; anything in between is partial
+        fully_missing = (missing_count == self.applies.sum(axis=0)) & (missing_count > 0)
+        
+        compliance_by_tag = {}
+        for r, key in enumerate(self.policy.keys):
+            stats = compliance_by_tag.setdefault(key, {'present': 0, 'missing': 0})
+            stats['missing'] += int(self.missing[r].sum())
+            stats['present'] += int((self.applies[r] & ~self.missing[r]).sum())
+        
+        type_totals = np.bincount(self.type_ids, minlength=len(self.inventory.strings)) if total else []
+        type_compliant = np.bincount(self.type_ids[compliant], minlength=len(self.inventory.strings)) if total else []
+        compliance_by_resource_type = {
+            self.inventory.strings[type_id]: {'total': int(type_totals[type_id]), 'compliant': int(type_compliant[type_id])}
+            for type_id in np.flatnonzero(type_totals)
+        }
+        
+        compliant_count = int(compliant.sum())
+        return {
+            'total_resources': total,
+            'compliant_resources': compliant_count,
+            'non_compliant_resources': int(fully_missing.sum()),
+            'partially_compliant_resources': int((~compliant & ~fully_missing).sum()),
+            'compliance_by_tag': compliance_by_tag,
+            'compliance_by_resource_type': compliance_by_resource_type,
+            'missing_tags_detail': self.details(0, detail_limit),
+            'missing_tags_detail_total': int(len(self.non_compliant_index)),
+            'compliance_percentage': compliant_count / total * 100 if total > 0 else 0
+        }
+    
+    def matrices(self) -> Dict[str, str]:
+        """Bit-packed rule matrices for the compliance snapshot"""
+        return {
+            name: encode_array(np.packbits(getattr(self, name), axis=1))
+            for name in ('missing', 'invalid', 'applies')
+        }
+    
+    @staticmethod
+    def unpack_matrices(encoded: Dict[str, str], rules: int, resources: int) -> Dict[str, np.ndarray]:
+        return {
+            name: np.unpackbits(
+                decode_array(value, np.uint8).reshape(rules, -1), axis=1, count=resources
+            ).astype(bool)
+            for name, value in encoded.items()
+        }
+    
+    def details(self, offset: int = 0, limit: int = 100) -> List[Dict[str, Any]]:
+        """Materialize missing/invalid tag detail for a window of non-compliant resources"""
+        details = []
+        for index in self.non_compliant_index[offset:offset + limit]:
+            tags = self.inventory.tags(index)
+            invalid_tags = []
+            for r in np.flatnonzero(self.invalid[:, index]):
+                rule = self.policy.rules[r]
+                invalid_tags.append({
+                    'tag': rule['key'],
+                    'value': tags.get(rule['key']),
+                    'allowed_values': rule['listed_values']
+                })
+            details.append({
+                'resource_arn': self.inventory.arns[index],
+                'resource_type': self.inventory.resource_type(index),
+                'missing_tags': [self.policy.keys[r] for r in np.flatnonzero(self.missing[:, index])],
+                'invalid_tags': invalid_tags,
+                'existing_tags': tags
+            })
+        return details
+
 class TaggingComplianceAnalyzer:
     def __init__(self):
         self.resource_groups_tagging = boto3.client('resourcegroupstaggingapi')
@@ -26,178 +472,351 @@ class TaggingComplianceAnalyzer:
             'Application': None  # Any value accepted
         }
         
-    def get_all_resources(self, resource_types: List[str] = None) -> List[Dict[str, Any]]:
+        # Optional policy from TAG_POLICY (JSON): {"required_tags": {key: allowed values or rule},
+        # "resource_type_overrides": {type: {"exempt": [keys], "required_tags": {...}}}}
+        tag_policy = json.loads(os.environ.get('TAG_POLICY', '{}'))
+        self.required_tags = tag_policy.get('required_tags', self.required_tags)
+        self.tag_policy_overrides = tag_policy.get('resource_type_overrides', {})
+        self.last_evaluation = None
+        self.snapshot_store = create_snapshot_store()
+        
+    def get_all_resources(self, resource_types: List[str] = None, regions: List[str] = None) -> ResourceInventory:
         """Get all resources with their tags"""
+        resource_types = resource_types or DEFAULT_RESOURCE_TYPES
+        regions = regions or TAGGING_REGIONS or [self.resource_groups_tagging.meta.region_name]
+        inventory = ResourceInventory()
+        
+        # Clients are created up front; boto3 client construction is not thread-safe
+        clients = {
+            region: self.resource_groups_tagging
+            if region == self.resource_groups_tagging.meta.region_name
+            else boto3.client('resourcegroupstaggingapi', region_name=region)
+            for region in regions
+        }
+        
+        def scan_region(region):
+            try:
+                # All resource types share one paginated scan per region
+                paginator = clients[region].get_paginator('get_resources')
+                for page in paginator.paginate(ResourceTypeFilters=resource_types, ResourcesPerPage=100):
+                    inventory.add_page(page['ResourceTagMappingList'], region, resource_types)
+            except Exception as e:
+                logger.warning(f"Error getting resources in region {region}: {str(e)}")
+        
+        with ThreadPoolExecutor(max_workers=len(regions)) as executor:
+            list(executor.map(scan_region, regions))
+        
+        return inventory
+    
+    def analyze_tag_compliance(self, resources, detail_limit: int = 100) -> Dict[str, Any]:
+        """Analyze tag compliance for resources"""
         try:
-            if not resource_types:
-                resource_types = [
-                    'ec2:instance',
-                    's3:bucket',
-                    'rds:db',
-                    'lambda:function',
-                    'elasticloadbalancing:loadbalancer'
-                ]
-            
-            all_resources = []
-            paginator = self.resource_groups_tagging.get_paginator('get_resources')
-            
-            for resource_type in resource_types:
-                try:
-                    page_iterator = paginator.paginate(
-                        ResourceTypeFilters=[resource_type]
-                    )
-                    
-                    for page in page_iterator:
-                        for resource in page['ResourceTagMappingList']:
-                            tags = {tag['Key']: tag['Value'] for tag in resource.get('Tags', [])}
-                            
-                            all_resources.append({
-                                'resource_arn': resource['ResourceARN'],
-                                'resource_type': resource_type,
-                                'tags': tags
-                            })
-                except Exception as e:
-                    logger.warning(f"Error getting resources for type {resource_type}: {str(e)}")
-                    
-            return all_resources
+            if not isinstance(resources, ResourceInventory):
+                resources = ResourceInventory.from_resources(resources)
+            
+            policy = CompiledTagPolicy(self.required_tags, self.tag_policy_overrides)
+            self.last_evaluation = policy.evaluate(resources)
+            return self.last_evaluation.summary(detail_limit)
             
         except Exception as e:
-            logger.error(f"Error getting resources: {str(e)}")
-            return []
+            logger.error(f"Error analyzing tag compliance: {str(e)}")
+            return {}
     
-    def analyze_tag_compliance(self, resources: List[Dict[str, Any]]) -> Dict[str, Any]:
-        """Analyze tag compliance for resources"""
+    def incremental_compliance(self, mode: str = 'diff', resource_types: List[str] = None,
+                               regions: List[str] = None, detail_limit: int = 100) -> Dict[str, Any]:
+        """Evaluate compliance against the stored snapshot, re-evaluating only resources whose tags changed
+        
+        'diff' rescans the estate and compares tag-set hashes; 'cloudtrail' skips the scan and refreshes
+        only resources named in tag-change events since the snapshot, falling back to 'diff' once the last
+        scan is older than CLOUDTRAIL_MAX_SCAN_AGE_HOURS; 'full' re-evaluates everything.
+        """
         try:
-            compliance_summary = {
-                'total_resources': len(resources),
-                'compliant_resources': 0,
-                'non_compliant_resources': 0,
-                'partially_compliant_resources': 0,
-                'compliance_by_tag': defaultdict(lambda: {'present': 0, 'missing': 0}),
-                'compliance_by_resource_type': defaultdict(lambda: {'total': 0, 'compliant': 0}),
-                'missing_tags_detail': []
-            }
+            resource_types = resource_types or DEFAULT_RESOURCE_TYPES
+            policy = CompiledTagPolicy(self.required_tags, self.tag_policy_overrides)
+            snapshot = self.snapshot_store.load()
+            reusable = bool(snapshot) and snapshot.get('policy') == policy.fingerprint and mode != 'full'
+            started_at = datetime.utcnow()
             
-            for resource in resources:
-                resource_type = resource['resource_type']
-                resource_tags = resource.get('tags', {})
-                missing_tags = []
-                invalid_tags = []
-                
-                # Check each required tag
-                for required_tag, allowed_values in self.required_tags.items():
-                    if required_tag not in resource_tags:
-                        missing_tags.append(required_tag)
-                        compliance_summary['compliance_by_tag'][required_tag]['missing'] += 1
-                    else:
-                        compliance_summary['compliance_by_tag'][required_tag]['present'] += 1
-                        
-                        # Check if tag value is valid (if allowed values are specified)
-                        if allowed_values and resource_tags[required_tag] not in allowed_values:
-                            invalid_tags.append({
-                                'tag': required_tag,
-                                'value': resource_tags[required_tag],
-                                'allowed_values': allowed_values
-                            })
-                
-                # Update compliance counts
-                compliance_summary['compliance_by_resource_type'][resource_type]['total'] += 1
-                
-                if not missing_tags and not invalid_tags:
-                    compliance_summary['compliant_resources'] += 1
-                    compliance_summary['compliance_by_resource_type'][resource_type]['compliant'] += 1
-                elif len(missing_tags) == len(self.required_tags):
-                    compliance_summary['non_compliant_resources'] += 1
-                else:
-                    compliance_summary['partially_compliant_resources'] += 1
-                
-                # Add to missing tags detail
-                if missing_tags or invalid_tags:
-                    compliance_summary['missing_tags_detail'].append({
-                        'resource_arn': resource['resource_arn'],
-                        'resource_type': resource_type,
-                        'missing_tags': missing_tags,
-                        'invalid_tags': invalid_tags,
-                        'existing_tags': resource_tags
-                    })
+            if reusable and mode == 'cloudtrail':
+                scanned_at = datetime.fromisoformat(snapshot.get('scanned_at', snapshot['taken_at']))
+                if started_at - scanned_at > timedelta(hours=CLOUDTRAIL_MAX_SCAN_AGE_HOURS):
+                    logger.info(f"Last estate scan at {scanned_at.isoformat()}; rescanning instead of reading CloudTrail")
+                    mode = 'diff'
+            
+            if reusable and mode == 'cloudtrail':
+                previous_inventory = ResourceInventory.from_dict(snapshot['inventory'])
+                changed_arns = self.get_tag_change_arns(
+                    datetime.fromisoformat(snapshot['taken_at']) - timedelta(minutes=CLOUDTRAIL_OVERLAP_MINUTES),
+                    regions
+                )
+                updates = self.get_resources_by_arn(changed_arns, resource_types, previous_inventory)
+                inventory = previous_inventory.with_updates(updates)
+                # Untouched resources keep their stored hashes; only refreshed ones are hashed again
+                retained = np.array([arn not in updates for arn in previous_inventory.arns], dtype=bool)
+                refreshed = np.arange(int(retained.sum()), len(inventory))
+                hashes = np.concatenate([
+                    decode_array(snapshot['hashes'], np.uint64)[retained],
+                    inventory.subset(refreshed).tag_hashes()
+                ])
+                scanned_at = snapshot.get('scanned_at', snapshot['taken_at'])
+            else:
+                inventory = self.get_all_resources(resource_types, regions)
+                hashes = inventory.tag_hashes()
+                scanned_at = started_at.isoformat()
             
-            # Calculate compliance percentage
-            compliance_summary['compliance_percentage'] = (
-                compliance_summary['compliant_resources'] / compliance_summary['total_resources'] * 100
-                if compliance_summary['total_resources'] > 0 else 0
+            changed = np.arange(len(inventory))
+            previous = {}
+            if reusable:
+                previous_hashes = decode_array(snapshot['hashes'], np.uint64)
+                previous = {arn: index for index, arn in enumerate(snapshot['inventory']['arns'])}
+                previous_index = np.array([previous.get(arn, -1) for arn in inventory.arns], dtype=np.int64)
+                unchanged = previous_index >= 0
+                unchanged[unchanged] = previous_hashes[previous_index[unchanged]] == hashes[unchanged]
+                changed = np.flatnonzero(~unchanged)
+            
+            # Re-evaluate only changed resources and splice their columns into the snapshot's matrices
+            partial = policy.evaluate(inventory.subset(changed))
+            shape = (len(policy.rules), len(inventory))
+            combined = {name: np.zeros(shape, dtype=bool) for name in ('missing', 'invalid', 'applies')}
+            if reusable:
+                stored = ComplianceEvaluation.unpack_matrices(
+                    snapshot['matrices'], len(policy.rules), len(previous)
+                )
+                kept = np.flatnonzero(unchanged)
+                for name in combined:
+                    combined[name][:, kept] = stored[name][:, previous_index[kept]]
+            for name in combined:
+                combined[name][:, changed] = getattr(partial, name)
+            
+            type_ids = np.frombuffer(inventory.type_ids, dtype=np.uint32) if len(inventory) else np.zeros(0, np.uint32)
+            self.last_evaluation = ComplianceEvaluation(
+                policy, inventory, combined['missing'], combined['invalid'], combined['applies'], type_ids
             )
+            summary = self.last_evaluation.summary(detail_limit)
             
-            return compliance_summary
+            history = (snapshot or {}).get('history', []) if snapshot and snapshot.get('policy') == policy.fingerprint else []
+            history = (history + [{
+                'taken_at': started_at.isoformat(),
+                'total_resources': summary['total_resources'],
+                'compliant_resources': summary['compliant_resources'],
+                'compliance_percentage': summary['compliance_percentage']
+            }])[-SNAPSHOT_HISTORY_LIMIT:]
+            
+            self.snapshot_store.save({
+                'taken_at': started_at.isoformat(),
+                'scanned_at': scanned_at,
+                'policy': policy.fingerprint,
+                'inventory': inventory.to_dict(),
+                'hashes': encode_array(hashes),
+                'matrices': self.last_evaluation.matrices(),
+                'history': history
+            })
+            
+            current = set(inventory.arns)
+            summary['changes'] = {
+                'mode': mode if reusable else 'full',
+                'reevaluated_resources': int(len(changed)),
+                'added_resources': sum(1 for arn in inventory.arns if arn not in previous) if reusable else len(inventory),
+                'removed_resources': sum(1 for arn in previous if arn not in current)
+            }
+            summary['compliance_trend'] = history
+            return summary
             
         except Exception as e:
-            logger.error(f"Error analyzing tag compliance: {str(e)}")
+            logger.error(f"Error in incremental tag compliance: {str(e)}")
             return {}
     
+    def get_tag_change_arns(self, since: datetime, regions: List[str] = None) -> Set[str]:
+        """ARNs named in CloudTrail tag-change events since the given time"""
+        regions = regions or TAGGING_REGIONS or [self.resource_groups_tagging.meta.region_name]
+        arns = set()
+        
+        for region in regions:
+            cloudtrail_client = boto3.client('cloudtrail', region_name=region)
+            paginator = cloudtrail_client.get_paginator('lookup_events')
+            # LookupEvents takes one attribute per call and is throttled per account, so names go in sequence
+            for event_name in TAG_CHANGE_EVENTS:
+                for page in paginator.paginate(
+                    LookupAttributes=[{'AttributeKey': 'EventName', 'AttributeValue': event_name}],
+                    StartTime=since,
+                    EndTime=datetime.utcnow()
+                ):
+                    for event in page['Events']:
+                        arns.update(self.event_resource_arns(event, region))
+        return arns
+    
+    @staticmethod
+    def event_resource_arns(event: Dict[str, Any], region: str) -> List[str]:
+        """Resolve the resources of a CloudTrail event to ARNs; EC2 and S3 report bare ids and names"""
+        detail = json.loads(event.get('CloudTrailEvent', '{}'))
+        account = detail.get('recipientAccountId', '')
+        region = detail.get('awsRegion', region)
+        arns = []
+        for resource in event.get('Resources', []):
+            name = resource.get('ResourceName', '')
+            resource_type = resource.get('ResourceType', '')
+            if name.startswith('arn:'):
+                arns.append(name)
+            elif resource_type == 'AWS::S3::Bucket':
+                arns.append(f'arn:aws:s3:::{name}')
+            elif resource_type == 'AWS::EC2::Instance' or name.startswith('i-'):
+                arns.append(f'arn:aws:ec2:{region}:{account}:instance/{name}')
+        return arns
+    
+    def get_resources_by_arn(self, arns: Set[str], resource_types: List[str],
+                             known: ResourceInventory) -> Dict[str, Dict[str, Any]]:
+        """Fresh tags for specific ARNs; ARNs the API no longer returns are dropped if known, else ignored"""
+        by_region = defaultdict(list)
+        for arn in arns:
+            if ResourceInventory.match_type(arn, resource_types) in resource_types:
+                by_region[arn.split(':')[3] or self.resource_groups_tagging.meta.region_name].append(arn)
+        
+        updates = {arn: None for region_arns in by_region.values() for arn in region_arns if arn in known.arn_index}
+        for region, region_arns in by_region.items():
+            client = boto3.client('resourcegroupstaggingapi', region_name=region)
+            for i in range(0, len(region_arns), TAGGING_ARN_BATCH):
+                paginator = client.get_paginator('get_resources')
+                for page in paginator.paginate(ResourceARNList=region_arns[i:i + TAGGING_ARN_BATCH]):
+                    for mapping in page['ResourceTagMappingList']:
+                        updates[mapping['ResourceARN']] = {
+                            'resource_arn': mapping['ResourceARN'],
+                            'resource_type': ResourceInventory.match_type(mapping['ResourceARN'], resource_types),
+                            'region': region,
+                            'tags': {tag['Key']: tag['Value'] for tag in mapping.get('Tags', [])}
+                        }
+        return updates
+    
     def get_untagged_resource_costs(self, days: int = 30) -> Dict[str, Any]:
-        """Get costs for resources without required tags"""
+        """Get costs for resources without required tags
+        
+        Required tags are grouped two at a time (Cost Explorer's GroupBy limit), so each query yields
+        untagged spend for two tags. One more query filtered to spend carrying every required tag gives
+        the exact union: spend missing any tag is counted once, however many tags it lacks.
+        """
         try:
             end_date = datetime.utcnow().date()
             start_date = end_date - timedelta(days=days)
+            time_period = {
+                'Start': start_date.strftime('%Y-%m-%d'),
+                'End': end_date.strftime('%Y-%m-%d')
+            }
+            tags = list(self.required_tags)
+            
+            cache_key = json.dumps([time_period, tags])
+            cached = _untagged_cost_cache.get(cache_key)
+            if cached and cached['expires_at'] > time.time():
+                return cached['value']
             
             costs_by_missing_tag = {}
+            total_cost = None
+            queries = 0
+            failed_queries = 0
             
-            # Get cost data grouped by tags
-            for required_tag in self.required_tags:
+            for i in range(0, len(tags), 2):
+                pair = tags[i:i + 2]
                 try:
-                    response = self.ce_client.get_cost_and_usage(
-                        TimePeriod={
-                            'Start': start_date.strftime('%Y-%m-%d'),
-                            'End': end_date.strftime('%Y-%m-%d')
-                        },
-                        Granularity='MONTHLY',
-                        Metrics=['UnblendedCost'],
-                        GroupBy=[
-                            {
-                                'Type': 'TAG',
-                                'Key': required_tag
-                            }
-                        ]
-                    )
-                    
-                    untagged_cost = 0
-                    tagged_cost = 0
-                    
-                    for result in response['ResultsByTime']:
-                        for group in result['Groups']:
-                            # Cost Explorer returns empty key for untagged resources
-                            if not group['Keys'][0] or group['Keys'][0] == f'{required_tag}$':
-                                untagged_cost += float(group['Metrics']['UnblendedCost']['Amount'])
-                            else:
-                                tagged_cost += float(group['Metrics']['UnblendedCost']['Amount'])
-                    
-                    costs_by_missing_tag[required_tag] = {
-                        'untagged_cost': untagged_cost,
-                        'tagged_cost': tagged_cost,
-                        'total_cost': untagged_cost + tagged_cost,
-                        'untagged_percentage': (untagged_cost / (untagged_cost + tagged_cost) * 100) if (untagged_cost + tagged_cost) > 0 else 0
-                    }
+                    groups = self.get_cost_groups(time_period, [{'Type': 'TAG', 'Key': tag} for tag in pair])
+                    queries += 1
                     
+                    pair_total = sum(groups.values())
+                    total_cost = pair_total if total_cost is None else total_cost
+                    for position, tag in enumerate(pair):
+                        # Cost Explorer reports untagged spend under an empty key or a bare 'Tag$'
+                        untagged_cost = sum(
+                            cost for keys, cost in groups.items()
+                            if not keys[position] or keys[position] == f'{tag}$'
+                        )
+                        costs_by_missing_tag[tag] = {
+                            'untagged_cost': untagged_cost,
+                            'tagged_cost': pair_total - untagged_cost,
+                            'total_cost': pair_total,
+                            'untagged_percentage': (untagged_cost / pair_total * 100) if pair_total > 0 else 0
+                        }
                 except Exception as e:
-                    logger.warning(f"Error getting cost data for tag {required_tag}: {str(e)}")
-                    costs_by_missing_tag[required_tag] = {'error': str(e)}
-            
-            # Calculate total untagged costs
-            total_untagged_cost = sum(
-                data.get('untagged_cost', 0) 
-                for data in costs_by_missing_tag.values() 
-                if 'error' not in data
-            )
+                    logger.warning(f"Error getting cost data for tags {pair}: {str(e)}")
+                    failed_queries += 1
+                    for tag in pair:
+                        costs_by_missing_tag[tag] = {'error': str(e)}
             
-            return {
+            # Spend carrying every required tag; the rest of the total is the untagged union
+            present = [{'Not': {'Tags': {'Key': tag, 'MatchOptions': ['ABSENT']}}} for tag in tags]
+            fully_tagged_cost = None
+            if total_cost is not None and tags:
+                try:
+                    fully_tagged_cost = sum(self.get_cost_groups(
+                        time_period, [], present[0] if len(present) == 1 else {'And': present}
+                    ).values())
+                    queries += 1
+                except Exception as e:
+                    logger.warning(f"Error getting fully tagged cost: {str(e)}")
+                    failed_queries += 1
+            
+            if fully_tagged_cost is not None:
+                total_untagged_cost = max(total_cost - fully_tagged_cost, 0)
+            else:
+                # Without the union query, the largest single-tag gap is a lower bound
+                total_untagged_cost = max(
+                    (data.get('untagged_cost', 0) for data in costs_by_missing_tag.values()), default=0
+                )
+            
+            result = {
                 'costs_by_missing_tag': costs_by_missing_tag,
                 'total_untagged_cost': total_untagged_cost,
+                'fully_tagged_cost': fully_tagged_cost,
+                'total_cost': total_cost or 0,
+                'untagged_union_exact': fully_tagged_cost is not None,
+                'cost_explorer_queries': queries,
+                'failed_queries': failed_queries,
                 'analysis_period_days': days
             }
             
+            # A degraded result is served once; only a complete one is reused by later invocations
+            if failed_queries:
+                return result
+            if len(_untagged_cost_cache) >= COST_CACHE_MAX_ENTRIES:
+                _untagged_cost_cache.pop(min(_untagged_cost_cache, key=lambda key: _untagged_cost_cache[key]['expires_at']))
+            _untagged_cost_cache[cache_key] = {'expires_at': time.time() + COST_CACHE_TTL_SECONDS, 'value': result}
+            return result
+            
         except Exception as e:
             logger.error(f"Error getting untagged resource costs: {str(e)}")
             return {}
     
+    def get_cost_groups(self, time_period: Dict[str, str], group_by: List[Dict[str, str]],
+                        cost_filter: Dict[str, Any] = None) -> Dict[tuple, float]:
+        """Unblended cost summed over the window per group key tuple, following NextPageToken up to a page cap"""
+        request = {
+            'TimePeriod': time_period,
+            'Granularity': 'MONTHLY',
+            'Metrics': ['UnblendedCost']
+        }
+        if group_by:
+            request['GroupBy'] = group_by
+        if cost_filter:
+            request['Filter'] = cost_filter
+        
+        groups = defaultdict(float)
+        seen_tokens = set()
+        for _ in range(COST_QUERY_MAX_PAGES):
+            response = self.ce_client.get_cost_and_usage(**request)
+            for result in response['ResultsByTime']:
+                if group_by:
+                    for group in result['Groups']:
+                        groups[tuple(group['Keys'])] += float(group['Metrics']['UnblendedCost']['Amount'])
+                else:
+                    groups[()] += float(result['Total']['UnblendedCost']['Amount'])
+            token = response.get('NextPageToken')
+            if not token:
+                break
+            if token in seen_tokens:
+                logger.warning("Cost Explorer repeated a page token; stopping the cost query")
+                break
+            seen_tokens.add(token)
+            request['NextPageToken'] = token
+        else:
+            logger.warning(f"Cost query truncated at {COST_QUERY_MAX_PAGES} pages")
+        return groups
+    
     def get_tag_value_distribution(self, resources: List[Dict[str, Any]]) -> Dict[str, Any]:
         """Analyze distribution of tag values"""
         try:
@@ -338,10 +957,25 @@ def lambda_handler(event, context):
         # Extract parameters from the event
         action = event.get('action', 'analyze_all')
         resource_types = event.get('resource_types', None)
+        regions = event.get('regions', None)
         days = event.get('days', 30)
         
+        if action == 'incremental_compliance':
+            compliance_summary = analyzer.incremental_compliance(
+                event.get('mode', 'diff'), resource_types, regions
+            )
+            
+            return {
+                'statusCode': 200,
+                'body': json.dumps({
+                    'action': action,
+                    'compliance_summary': compliance_summary,
+                    'resource_count': compliance_summary.get('total_resources', 0)
+                })
+            }
+        
         # Get all resources
-        resources = analyzer.get_all_resources(resource_types)
+        resources = analyzer.get_all_resources(resource_types, regions)
         
         if action == 'check_compliance':
             compliance_summary = analyzer.analyze_tag_compliance(resources)
@@ -355,6 +989,21 @@ def lambda_handler(event, context):
                 })
             }
             
+        elif action == 'list_noncompliant':
+            analyzer.analyze_tag_compliance(resources, detail_limit=0)
+            offset = event.get('offset', 0)
+            limit = event.get('limit', 100)
+            
+            return {
+                'statusCode': 200,
+                'body': json.dumps({
+                    'action': action,
+                    'resources': analyzer.last_evaluation.details(offset, limit),
+                    'offset': offset,
+                    'total': int(len(analyzer.last_evaluation.non_compliant_index))
+                })
+            }
+            
         elif action == 'analyze_costs':
             cost_data = analyzer.get_untagged_resource_costs(days)
             
@@ -420,7 +1069,7 @@ def lambda_handler(event, context):
                 'statusCode': 400,
                 'body': json.dumps({
                     'error': 'Invalid action',
-                    'supported_actions': ['check_compliance', 'analyze_costs', 'get_distribution', 'analyze_all']
+                    'supported_actions': ['check_compliance', 'incremental_compliance', 'list_noncompliant', 'analyze_costs', 'get_distribution', 'analyze_all']
                 })
             }
             
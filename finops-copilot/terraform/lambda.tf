@@ -28,9 +28,12 @@ resource "aws_lambda_function" "finops_functions" {
   
   environment {
     variables = {
-      PROJECT_NAME = var.project_name
-      AWS_REGION   = var.aws_region
-      LOG_LEVEL    = "INFO"
+      PROJECT_NAME       = var.project_name
+      AWS_REGION         = var.aws_region
+      LOG_LEVEL          = "INFO"
+      JOB_STORE_BACKEND  = "dynamodb"
+      JOB_TABLE          = aws_dynamodb_table.jobs.name
+      STATE_SPILL_BUCKET = aws_s3_bucket.deployment_artifacts.id
     }
   }
   
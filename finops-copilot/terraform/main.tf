@@ -61,6 +61,23 @@ resource "aws_s3_bucket_server_side_encryption_configuration" "deployment_artifa
   }
 }
 
+# Orchestrator job checkpoints, shared by every Lambda container
+resource "aws_dynamodb_table" "jobs" {
+  name         = "${var.project_name}-jobs"
+  billing_mode = "PAY_PER_REQUEST"
+  hash_key     = "cache_key"
+  
+  attribute {
+    name = "cache_key"
+    type = "S"
+  }
+  
+  ttl {
+    attribute_name = "expires_at"
+    enabled        = true
+  }
+}
+
 # S3 bucket for API schemas
 resource "aws_s3_bucket" "api_schemas" {
   bucket = "${var.project_name}-schemas-${data.aws_caller_identity.current.account_id}"
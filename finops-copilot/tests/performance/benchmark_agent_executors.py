@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""Benchmark the orchestrator's agent executors: Lambda invokes against in-process handlers.
+
+Runs the same agent payloads through LambdaAgentExecutor (the deployed agent functions) and
+InProcessAgentExecutor (the agent modules imported into this process) and reports latency per
+agent and mode, checking that both modes return the same result contract.
+
+Usage:
+    python benchmark_agent_executors.py --agents ec2_agent rds_agent --iterations 10
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+from datetime import datetime
+
+# Make the agent modules importable for in-process execution
+lambda_functions_path = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+    'lambda-functions'
+)
+sys.path.insert(0, lambda_functions_path)
+
+from orchestrator_agent import FinOpsOrchestrator, LambdaAgentExecutor, InProcessAgentExecutor
+
+
+class AgentExecutorBenchmark:
+    """Latency comparison of the Lambda and in-process agent executors."""
+
+    def __init__(self, agents, iterations, days):
+        """Initialize the benchmark."""
+        orchestrator = FinOpsOrchestrator()
+        self.executors = {
+            'lambda': LambdaAgentExecutor(orchestrator.agent_functions),
+            'inprocess': InProcessAgentExecutor()
+        }
+        self.agents = agents
+        self.iterations = iterations
+        self.days = days
+        self.results = {}
+
+    def payload(self, agent_name):
+        """A standard analysis request for the agent."""
+        if agent_name == 'apptio_integration':
+            return {'action': 'get_apptio_data', 'days': self.days}
+        return {'action': 'analyze_all', 'days': self.days}
+
+    @staticmethod
+    def contract(result):
+        """The parts of a result the orchestrator relies on, for comparing the modes."""
+        data = result.get('data', {})
+        body = data.get('body')
+        body = json.loads(body) if isinstance(body, str) else body or {}
+        return {
+            'success': result.get('success'),
+            'status_code': data.get('statusCode'),
+            'body_keys': sorted(body),
+            'summary_keys': sorted(body.get('summary', {}))
+        }
+
+    def run_agent(self, agent_name):
+        """Time every mode for one agent; the first call of each mode is reported as the cold call."""
+        agent_results = {}
+        contracts = {}
+        for mode, executor in self.executors.items():
+            timings = []
+            for _ in range(self.iterations):
+                start_time = time.perf_counter()
+                try:
+                    result = executor.invoke(agent_name, self.payload(agent_name))
+                except Exception as e:
+                    result = {'agent': agent_name, 'success': False, 'error': str(e)}
+                timings.append((time.perf_counter() - start_time) * 1000)
+            contracts[mode] = self.contract(result)
+            warm = timings[1:] or timings
+            agent_results[mode] = {
+                'cold_ms': round(timings[0], 1),
+                'median_ms': round(statistics.median(warm), 1),
+                'p95_ms': round(sorted(warm)[int(0.95 * (len(warm) - 1))], 1),
+                'success': result.get('success', False)
+            }
+        agent_results['contracts_match'] = contracts['lambda'] == contracts['inprocess']
+        return agent_results
+
+    def run(self):
+        """Run the benchmark for every agent."""
+        for agent_name in self.agents:
+            print(f"Benchmarking {agent_name}...")
+            self.results[agent_name] = self.run_agent(agent_name)
+        return self.results
+
+    def report(self):
+        """Print a latency table and write the raw results to a JSON report."""
+        print(f"\n{'Agent':<20}{'Mode':<12}{'Cold (ms)':>12}{'Median (ms)':>14}{'p95 (ms)':>12}  Contract")
+        for agent_name, agent_results in self.results.items():
+            for mode in self.executors:
+                stats = agent_results[mode]
+                contract = 'match' if agent_results['contracts_match'] else 'MISMATCH'
+                print(f"{agent_name:<20}{mode:<12}{stats['cold_ms']:>12}{stats['median_ms']:>14}{stats['p95_ms']:>12}  {contract}")
+
+        report_path = f"agent_executor_benchmark_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+        with open(report_path, 'w') as f:
+            json.dump({'iterations': self.iterations, 'days': self.days, 'results': self.results}, f, indent=2)
+        print(f"\nReport written to {report_path}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare Lambda and in-process agent execution')
+    parser.add_argument('--agents', nargs='+', default=['ec2_agent', 's3_agent', 'rds_agent', 'ri_sp_agent', 'tagging_agent'],
+                        help='Agents to benchmark')
+    parser.add_argument('--iterations', type=int, default=5, help='Invocations per agent and mode')
+    parser.add_argument('--days', type=int, default=30, help='Analysis period in days')
+    args = parser.parse_args()
+
+    benchmark = AgentExecutorBenchmark(args.agents, args.iterations, args.days)
+    benchmark.run()
+    benchmark.report()
+
+
+if __name__ == '__main__':
+    main()
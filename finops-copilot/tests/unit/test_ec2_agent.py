@@ -3,6 +3,9 @@ from unittest.mock import patch, MagicMock
 import json
 import sys
 import os
+import importlib
+import time
+from datetime import datetime, timedelta, timezone
 
 # Add the parent directory to the Python path
 sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
@@ -30,28 +33,28 @@ class TestEC2Agent(unittest.TestCase):
             "days": 30
         }
         
-        # Sample CloudWatch metrics data
+        # Sample CloudWatch metrics data (GetMetricData results keyed by query id)
+        hours = [datetime.utcnow().replace(minute=0, second=0, microsecond=0) - timedelta(hours=h) for h in (3, 2, 1)]
         self.cloudwatch_metrics = {
             "MetricDataResults": [
                 {
-                    "Id": "cpu",
+                    "Id": "cpu_avg_0",
                     "Label": "CPUUtilization",
-                    "Timestamps": [
-                        "2023-09-01T00:00:00Z",
-                        "2023-09-02T00:00:00Z",
-                        "2023-09-03T00:00:00Z"
-                    ],
+                    "Timestamps": hours,
                     "Values": [10.5, 15.2, 8.7],
                     "StatusCode": "Complete"
                 },
                 {
-                    "Id": "memory",
-                    "Label": "MemoryUtilization",
-                    "Timestamps": [
-                        "2023-09-01T00:00:00Z",
-                        "2023-09-02T00:00:00Z",
-                        "2023-09-03T00:00:00Z"
-                    ],
+                    "Id": "cpu_max_0",
+                    "Label": "CPUUtilization",
+                    "Timestamps": hours,
+                    "Values": [12.0, 15.2, 9.9],
+                    "StatusCode": "Complete"
+                },
+                {
+                    "Id": "memory_search",
+                    "Label": "i-1234567890abcdef0",
+                    "Timestamps": hours,
                     "Values": [30.1, 35.8, 28.4],
                     "StatusCode": "Complete"
                 }
@@ -104,14 +107,7 @@ class TestEC2Agent(unittest.TestCase):
         mock_ce = MagicMock()
         
         # Set up the return values for the mock objects
-        mock_cloudwatch.get_metric_statistics.return_value = self.cloudwatch_metrics
-        mock_ec2.describe_instances.return_value = {
-            "Reservations": [
-                {
-                    "Instances": [self.ec2_instance]
-                }
-            ]
-        }
+        mock_cloudwatch.get_paginator.return_value.paginate.return_value = [self.cloudwatch_metrics]
         mock_ce.get_cost_and_usage.return_value = self.cost_data
         
         # Configure the boto3.client mock to return our mock objects
@@ -135,12 +131,114 @@ class TestEC2Agent(unittest.TestCase):
         self.assertIn("max_cpu", result["i-1234567890abcdef0"])
         self.assertEqual(result["i-1234567890abcdef0"]["avg_cpu"], 11.47)
         self.assertEqual(result["i-1234567890abcdef0"]["max_cpu"], 15.2)
+        self.assertEqual(result["i-1234567890abcdef0"]["p50_cpu"], 10.5)
+        self.assertEqual(result["i-1234567890abcdef0"]["data_points"], 3)
+        self.assertEqual(result["i-1234567890abcdef0"]["p95_memory"], 35.23)
+        
+        # All metrics for the fleet go out in a single batched GetMetricData request
+        mock_cloudwatch.get_paginator.assert_called_with('get_metric_data')
+        mock_cloudwatch.get_metric_statistics.assert_not_called()
+        queries = mock_cloudwatch.get_paginator.return_value.paginate.call_args.kwargs['MetricDataQueries']
+        self.assertEqual(len(queries), 7)
+
+    @patch('ec2_agent.boto3.client')
+    def test_get_instance_details_skips_stale_ids(self, mock_boto3_client):
+        """Stale instance IDs are dropped and described instances are reused."""
+        mock_ec2 = MagicMock()
+        instance = dict(self.ec2_instance, LaunchTime=datetime(2023, 9, 1),
+                        Placement={"AvailabilityZone": "us-east-1a"})
+        mock_ec2.get_paginator.return_value.paginate.return_value = [
+            {"Reservations": [{"Instances": [instance]}]}
+        ]
         
-        # Verify that the mock objects were called with the expected arguments
-        mock_cloudwatch.get_metric_statistics.assert_called()
-        mock_ec2.describe_instances.assert_called_with(
-            InstanceIds=["i-1234567890abcdef0"]
-        )
+        analyzer = EC2CostAnalyzer()
+        analyzer.ec2_client = mock_ec2
+        result = analyzer.get_instance_details(["i-1234567890abcdef0", "i-0stale0000000000"])
+        
+        self.assertEqual(list(result), ["i-1234567890abcdef0"])
+        self.assertEqual(result["i-1234567890abcdef0"]["tags"]["Environment"], "Development")
+        mock_ec2.get_paginator.assert_called_with('describe_instances')
+        mock_ec2.describe_instances.assert_not_called()
+        
+        # A second lookup is served from the per-invocation instance map
+        analyzer.get_instance_details(["i-1234567890abcdef0"])
+        self.assertEqual(mock_ec2.get_paginator.return_value.paginate.call_count, 1)
+
+    @patch('ec2_agent.boto3.client')
+    def test_shared_data_replaces_aws_calls(self, mock_boto3_client):
+        """Inventory, metrics and cost prefetched by the orchestrator are used without calling AWS."""
+        start = (datetime.utcnow().replace(minute=0, second=0, microsecond=0) - timedelta(days=1)).isoformat()
+        shared_data = {
+            'ec2_instances': {'i-1': {'instance_type': 'm5.large', 'state': 'running', 'tags': {}}},
+            'metrics': {
+                'days': 1,
+                'start': start,
+                'period': 3600,
+                'series': {'i-1': {'CPUUtilization/Average': [10.0, None, 30.0] + [None] * 21}}
+            },
+            'cost_cube': {'days': 1, 'rows': [['2024-01-01', 'Amazon Elastic Compute Cloud - Compute', 'BoxUsage', 24.0]]}
+        }
+        
+        analyzer = EC2CostAnalyzer(shared_data)
+        instance_ids = analyzer.get_running_instance_ids()
+        utilization = analyzer.analyze_instance_utilization(instance_ids, days=1)
+        costs = analyzer.get_instance_costs(instance_ids, days=1)
+        
+        self.assertEqual(instance_ids, ['i-1'])
+        self.assertEqual(utilization['i-1']['avg_cpu'], 20.0)
+        self.assertEqual(utilization['i-1']['data_points'], 2)
+        self.assertEqual(costs['total_cost'], 24.0)
+        self.assertEqual(analyzer.get_instance_details(instance_ids)['i-1']['instance_type'], 'm5.large')
+        mock_boto3_client.return_value.get_paginator.assert_not_called()
+        mock_boto3_client.return_value.get_cost_and_usage.assert_not_called()
+
+    def test_utilization_matrix_reads_naive_start_as_utc(self):
+        """Hour slots line up with UTC datapoints whatever the local timezone is."""
+        original_tz = os.environ.get('TZ')
+        os.environ['TZ'] = 'Asia/Tokyo'
+        time.tzset()
+        try:
+            start = datetime(2024, 1, 1)
+            matrix = ec2_agent.UtilizationMatrix(['cpu_avg'], ['i-1'], start, 24)
+            timestamps = [datetime(2024, 1, 1, hour, tzinfo=timezone.utc) for hour in (0, 5, 23)]
+            matrix.add_series('cpu_avg', 'i-1', timestamps, [1.0, 2.0, 3.0])
+        finally:
+            if original_tz is None:
+                os.environ.pop('TZ')
+            else:
+                os.environ['TZ'] = original_tz
+            time.tzset()
+
+        row = matrix.values[0, 0]
+        self.assertEqual([row[0], row[5], row[23]], [1.0, 2.0, 3.0])
+        self.assertEqual(int((row == row).sum()), 3)
+
+    @patch('ec2_agent.boto3.client')
+    def test_rightsizing_statistic_is_configurable(self, mock_boto3_client):
+        """p95 CPU with the memory guard is the default rule; the average rule applies when configured."""
+        utilization = {
+            'i-steady': {'avg_cpu': 15.0, 'max_cpu': 60.0, 'p95_cpu': 35.0},
+            'i-spiky': {'avg_cpu': 25.0, 'max_cpu': 90.0, 'p95_cpu': 30.0},
+            'i-memory': {'avg_cpu': 8.0, 'max_cpu': 50.0, 'p95_cpu': 12.0, 'p95_memory': 85.0}
+        }
+        instances = {instance_id: {'tags': {'Environment': 'dev', 'Owner': 'a', 'Project': 'b'}} for instance_id in utilization}
+        analyzer = EC2CostAnalyzer()
+
+        def rightsized():
+            return {o['instance_id']: o['priority'] for o in analyzer.identify_optimization_opportunities(utilization, instances)
+                    if o['type'] == 'right_sizing'}
+
+        self.assertEqual(rightsized(), {'i-steady': 'medium', 'i-spiky': 'medium'})
+        with patch.object(ec2_agent, 'RIGHTSIZING_CPU_STATISTIC', 'avg'):
+            self.assertEqual(rightsized(), {'i-steady': 'medium', 'i-memory': 'high'})
+
+    def test_unsupported_rightsizing_statistic_falls_back_at_import(self):
+        """An unknown statistic in the environment is replaced by p95 when the module loads."""
+        self.addCleanup(importlib.reload, ec2_agent)
+        for value, expected in [('P95 ', 'p95'), ('avg', 'avg')]:
+            with patch.dict(os.environ, {'RIGHTSIZING_CPU_STATISTIC': value}):
+                importlib.reload(ec2_agent)
+            self.assertEqual(ec2_agent.RIGHTSIZING_CPU_STATISTIC, expected)
 
     @patch('ec2_agent.boto3.client')
     def test_identify_optimization_opportunities(self, mock_boto3_client):
@@ -0,0 +1,525 @@
+import unittest
+from unittest.mock import patch, MagicMock
+import json
+import sys
+import os
+import shutil
+import tempfile
+import time
+
+# Add the parent directory to the Python path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+# Add the lambda-functions directory to the path
+lambda_functions_path = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+    'lambda-functions'
+)
+sys.path.insert(0, lambda_functions_path)
+
+# Import the orchestrator module directly
+import orchestrator_agent
+from orchestrator_agent import lambda_handler, FinOpsOrchestrator
+from state_store import FileStore
+
+class TestOrchestratorAsyncJobs(unittest.TestCase):
+    """Test cases for the orchestrator's async job mode."""
+
+    def setUp(self):
+        """Set up a file-backed job store and canned agent results."""
+        self.store_dir = tempfile.mkdtemp()
+        self.store_patcher = patch.object(orchestrator_agent, 'job_store', FileStore(self.store_dir))
+        self.store_patcher.start()
+
+        self.agent_body = {
+            'summary': {
+                'total_monthly_cost': 1000.0,
+                'potential_monthly_savings': 200.0
+            },
+            'recommendations': [
+                {
+                    'type': 'right_sizing',
+                    'instance_id': 'i-1234567890abcdef0',
+                    'recommendation': 'Consider downsizing to a smaller instance type',
+                    'priority': 'high',
+                    'estimated_monthly_savings': 200.0
+                }
+            ]
+        }
+
+    def tearDown(self):
+        self.store_patcher.stop()
+        shutil.rmtree(self.store_dir)
+
+    def fake_invoke_agent(self, agent_name, payload):
+        return {
+            'agent': agent_name,
+            'success': True,
+            'data': {'statusCode': 200, 'body': json.dumps(self.agent_body)}
+        }
+
+    @patch('orchestrator_agent.boto3.client')
+    def test_submit_and_poll_job(self, mock_boto3_client):
+        """A submitted job runs inline without a context and reports its result."""
+        with patch.object(FinOpsOrchestrator, 'invoke_agent', side_effect=self.fake_invoke_agent):
+            submitted = lambda_handler({'query': 'Check my EC2 instances', 'mode': 'async'}, None)
+
+        self.assertEqual(submitted['statusCode'], 202)
+        job_id = json.loads(submitted['body'])['job_id']
+
+        result = lambda_handler({'job_id': job_id}, None)
+        body = json.loads(result['body'])
+
+        self.assertEqual(body['status'], 'completed')
+        self.assertEqual(body['progress']['completed_stages'], 2)
+        self.assertEqual(body['progress']['total_stages'], 2)
+        self.assertIn('ec2_agent', body['results'])
+        self.assertEqual(body['result']['detailed_analysis']['cost_impact']['potential_monthly_savings'], 200.0)
+
+        # Polling with the returned cursor only yields stages completed since then
+        later = json.loads(lambda_handler({'job_id': job_id, 'cursor': body['cursor']}, None)['body'])
+        self.assertEqual(later['results'], {})
+
+    @patch('orchestrator_agent.boto3.client')
+    def test_job_hands_over_when_time_runs_out(self, mock_boto3_client):
+        """A worker low on time checkpoints and re-invokes itself asynchronously."""
+        context = MagicMock()
+        context.invoked_function_arn = 'arn:aws:lambda:us-east-1:123456789012:function:orchestrator'
+        context.get_remaining_time_in_millis.return_value = 1000
+
+        with patch.object(FinOpsOrchestrator, 'invoke_agent', side_effect=self.fake_invoke_agent):
+            submitted = lambda_handler({'query': 'Check my EC2 instances', 'mode': 'async'}, context)
+            job_id = json.loads(submitted['body'])['job_id']
+            lambda_handler({'job_worker': job_id}, context)
+
+        mock_boto3_client.return_value.invoke.assert_called_with(
+            FunctionName=context.invoked_function_arn,
+            InvocationType='Event',
+            Payload=json.dumps({'job_worker': job_id})
+        )
+        body = json.loads(lambda_handler({'job_id': job_id}, None)['body'])
+        self.assertEqual(body['status'], 'running')
+        self.assertEqual(body['progress']['completed_stages'], 0)
+
+    @patch('orchestrator_agent.boto3.client')
+    def test_job_with_lapsed_worker_lease_reports_failed(self, mock_boto3_client):
+        """A worker that dies without checkpointing leaves a job that polls as failed once its lease lapses."""
+        context = MagicMock()
+        context.invoked_function_arn = 'arn:aws:lambda:us-east-1:123456789012:function:orchestrator'
+        submitted = lambda_handler({'query': 'Check my EC2 instances', 'mode': 'async'}, context)
+        job_id = json.loads(submitted['body'])['job_id']
+
+        body = json.loads(lambda_handler({'job_id': job_id}, None)['body'])
+        self.assertEqual(body['status'], 'pending')
+
+        with patch('state_store.time.time', return_value=time.time() + orchestrator_agent.JOB_TTL_SECONDS / 2):
+            body = json.loads(lambda_handler({'job_id': job_id}, None)['body'])
+        self.assertEqual(body['status'], 'failed')
+        self.assertIn('crashed or timed out', body['error'])
+
+    def test_unknown_job(self):
+        """Polling an unknown job id returns 404."""
+        result = lambda_handler({'job_id': 'does-not-exist'}, None)
+        self.assertEqual(result['statusCode'], 404)
+
+class TestOrchestratorFanOut(unittest.TestCase):
+    """Test cases for deadline-aware agent fan-out."""
+
+    def agent_result(self, agent_name):
+        return {
+            'agent': agent_name,
+            'success': True,
+            'data': {'statusCode': 200, 'body': json.dumps({'summary': {'potential_monthly_savings': 10.0}})}
+        }
+
+    @patch('orchestrator_agent.boto3.client')
+    def test_slow_agent_times_out_with_partial_results(self, mock_boto3_client):
+        """An agent past its timeout is marked timed_out while the others are synthesized."""
+        def invoke(agent_name, payload):
+            if agent_name == 'rds_agent':
+                time.sleep(1)
+            return self.agent_result(agent_name)
+
+        orchestrator = FinOpsOrchestrator()
+        payloads = [{'agent': name, 'payload': {}} for name in ['rds_agent', 'ec2_agent']]
+        with patch.object(orchestrator, 'invoke_agent', side_effect=invoke), \
+                patch.dict(orchestrator_agent.AGENT_TIMEOUT_SECONDS, {'rds_agent': 0.2}):
+            results = orchestrator.invoke_agents_parallel(payloads, timeout=5)
+
+        statuses = {result['agent']: result['status'] for result in results}
+        self.assertEqual(statuses, {'ec2_agent': 'completed', 'rds_agent': 'timed_out'})
+        self.assertEqual(results[0]['agent'], 'ec2_agent')
+
+        synthesis = orchestrator.synthesize_results(results, 'Check EC2 and RDS')
+        self.assertTrue(synthesis['partial'])
+        self.assertEqual(synthesis['cost_impact']['potential_monthly_savings'], 10.0)
+
+    @patch('orchestrator_agent.boto3.client')
+    def test_hedged_invocation_wins(self, mock_boto3_client):
+        """A slow agent with a hedge delay gets a second invocation whose result is used."""
+        calls = []
+
+        def invoke(agent_name, payload):
+            calls.append(agent_name)
+            if len(calls) == 1:
+                time.sleep(1)
+            return self.agent_result(agent_name)
+
+        orchestrator = FinOpsOrchestrator()
+        with patch.object(orchestrator, 'invoke_agent', side_effect=invoke), \
+                patch.dict(orchestrator_agent.AGENT_HEDGE_AFTER_SECONDS, {'s3_agent': 0.1}):
+            started = time.monotonic()
+            results = orchestrator.invoke_agents_parallel([{'agent': 's3_agent', 'payload': {}}], timeout=5)
+
+        self.assertEqual(results[0]['status'], 'completed')
+        self.assertEqual(len(calls), 2)
+        self.assertLess(time.monotonic() - started, 0.9)
+
+    @patch('orchestrator_agent.boto3.client')
+    def test_prefetch_plan_shares_common_inputs(self, mock_boto3_client):
+        """Inputs consumed by two or more planned agents are prefetched once, dependencies first."""
+        orchestrator = FinOpsOrchestrator()
+
+        self.assertEqual(
+            orchestrator.compile_prefetch_plan(['ec2_agent', 'rds_agent', 's3_agent']),
+            [['cost_cube', 'ec2_instances', 'rds_instances'], ['metrics']]
+        )
+        self.assertEqual(orchestrator.compile_prefetch_plan(['ec2_agent', 's3_agent']), [['cost_cube']])
+        self.assertEqual(orchestrator.compile_prefetch_plan(['ec2_agent']), [])
+
+        payloads = [{'agent': name, 'payload': {}} for name in ['ec2_agent', 'rds_agent', 'tagging_agent']]
+        shared = {
+            'cost_cube': {'days': 30, 'rows': []},
+            'metrics': {'days': 30, 'series': {'ec2_agent': {'i-1': {}}, 'rds_agent': {'db-1': {}}}}
+        }
+        orchestrator.attach_shared_data(payloads, shared)
+
+        self.assertEqual(payloads[0]['payload']['shared_data']['metrics']['series'], {'i-1': {}})
+        self.assertEqual(payloads[1]['payload']['shared_data']['metrics']['series'], {'db-1': {}})
+        self.assertNotIn('shared_data', payloads[2]['payload'])
+
+    @patch('orchestrator_agent.boto3.client')
+    def test_slow_prefetch_is_abandoned_at_its_deadline(self, mock_boto3_client):
+        """Inputs still loading at the prefetch deadline are dropped, with the levels that depend on them."""
+        def slow_cost_cube(agents, days, shared):
+            time.sleep(1)
+            return {'days': days, 'rows': []}, 1
+
+        orchestrator = FinOpsOrchestrator()
+        agents = ['ec2_agent', 'rds_agent', 's3_agent']
+        with patch.object(orchestrator, 'prefetch_cost_cube', side_effect=slow_cost_cube), \
+                patch.object(orchestrator, 'prefetch_ec2_instances', return_value=({'i-1': {}}, 1)), \
+                patch.object(orchestrator, 'prefetch_rds_instances', return_value=({'db-1': {}}, 1)), \
+                patch.object(orchestrator, 'prefetch_metrics', return_value=({'days': 30, 'series': {}}, 1)) as metrics:
+            started = time.monotonic()
+            prefetch = orchestrator.prefetch_shared_inputs(agents, 30, timeout=0.2)
+
+        self.assertLess(time.monotonic() - started, 0.9)
+        self.assertEqual(sorted(prefetch['data']), ['ec2_instances', 'rds_instances'])
+        self.assertEqual(prefetch['abandoned'], ['cost_cube', 'metrics'])
+        metrics.assert_not_called()
+
+    @patch('orchestrator_agent.boto3.client')
+    def test_shared_metrics_limit_counts_memory_series(self, mock_boto3_client):
+        """The payload limit includes the memory series the search adds for each EC2 instance."""
+        shared = {'ec2_instances': {f'i-{n}': {} for n in range(10)}}
+        # One day of CPU series alone fits, CPU plus memory does not
+        cpu_points = 10 * len(orchestrator_agent.SHARED_METRICS['ec2_agent']['metrics']) * 24
+        orchestrator = FinOpsOrchestrator()
+        with patch.object(orchestrator_agent, 'SHARED_METRIC_POINTS_LIMIT', cpu_points):
+            self.assertEqual(orchestrator.prefetch_metrics(['ec2_agent'], 1, shared), (None, 0))
+        mock_boto3_client.return_value.get_paginator.assert_not_called()
+
+    @patch('orchestrator_agent.boto3.client')
+    def test_cost_cube_reads_every_page_and_stops_on_repeated_token(self, mock_boto3_client):
+        """Pages are merged until the token runs out, repeats, or the page cap is reached."""
+        def page(day, token=None):
+            response = {'ResultsByTime': [{'TimePeriod': {'Start': day}, 'Groups': [
+                {'Keys': ['Amazon Simple Storage Service', 'TimedStorage'], 'Metrics': {'BlendedCost': {'Amount': '1.5'}}}
+            ]}]}
+            if token:
+                response['NextPageToken'] = token
+            return response
+
+        ce_client = mock_boto3_client.return_value
+        ce_client.get_cost_and_usage.side_effect = [page('2024-01-01', 't1'), page('2024-01-02', 't2'), page('2024-01-03')]
+        cube, calls = FinOpsOrchestrator().prefetch_cost_cube(['s3_agent'], 3, {})
+        self.assertEqual(calls, 3)
+        self.assertEqual([row[0] for row in cube['rows']], ['2024-01-01', '2024-01-02', '2024-01-03'])
+        self.assertEqual(ce_client.get_cost_and_usage.call_args_list[2][1]['NextPageToken'], 't2')
+
+        ce_client.get_cost_and_usage.side_effect = [page('2024-01-01', 't1'), page('2024-01-02', 't1')]
+        self.assertEqual(FinOpsOrchestrator().prefetch_cost_cube(['s3_agent'], 3, {})[1], 2)
+
+        tokens = iter(range(100))
+        ce_client.get_cost_and_usage.side_effect = lambda **request: page('2024-01-01', f't{next(tokens)}')
+        with patch.object(orchestrator_agent, 'COST_CUBE_MAX_PAGES', 4):
+            self.assertEqual(FinOpsOrchestrator().prefetch_cost_cube(['s3_agent'], 3, {})[1], 4)
+
+class TestIncrementalSynthesis(unittest.TestCase):
+    """Test cases for incremental synthesis and streamed events."""
+
+    def agent_result(self, agent_name, savings):
+        recommendations = [
+            {'recommendation': f'{agent_name} {i}', 'priority': 'medium', 'estimated_monthly_savings': savings + i}
+            for i in range(8)
+        ]
+        return {
+            'agent': agent_name,
+            'success': True,
+            'status': 'completed',
+            'data': {'statusCode': 200, 'body': json.dumps({'recommendations': recommendations})}
+        }
+
+    def test_running_top_k_matches_full_sort(self):
+        """The heap-backed top-K equals sorting every recommendation at once."""
+        synthesizer = orchestrator_agent.IncrementalSynthesizer('query', top_k=5)
+        synthesizer.add(self.agent_result('ec2_agent', 10))
+        self.assertEqual([r['estimated_monthly_savings'] for r in synthesizer.snapshot()['recommendations']],
+                         [17, 16, 15, 14, 13])
+
+        synthesizer.add(self.agent_result('s3_agent', 14))
+        top = synthesizer.snapshot()['recommendations']
+        self.assertEqual([r['estimated_monthly_savings'] for r in top], [21, 20, 19, 18, 17])
+        self.assertEqual(top[-1]['source_agent'], 'ec2_agent')
+
+    def result_with(self, agent_name, recommendations, potential_savings):
+        return {
+            'agent': agent_name,
+            'success': True,
+            'status': 'completed',
+            'data': {'statusCode': 200, 'body': json.dumps({
+                'summary': {'total_monthly_cost': 1000.0, 'potential_monthly_savings': potential_savings},
+                'recommendations': recommendations
+            })}
+        }
+
+    def test_stopping_subsumes_rightsizing_in_either_order(self):
+        """An idle instance's rightsizing is dropped and its savings taken out of the total."""
+        rightsize = {'type': 'right_sizing', 'instance_id': 'i-1', 'priority': 'medium', 'estimated_monthly_savings': 30}
+        idle = {'type': 'idle_instance', 'instance_id': 'i-1', 'priority': 'high', 'estimated_monthly_savings': 100}
+        for order in ([rightsize, idle], [idle, rightsize]):
+            synthesizer = orchestrator_agent.IncrementalSynthesizer('query')
+            synthesizer.add(self.result_with('ec2_agent', [dict(rec) for rec in order], 130))
+            synthesis = synthesizer.snapshot()
+
+            self.assertEqual([r['type'] for r in synthesis['recommendations']], ['idle_instance'])
+            self.assertEqual(synthesis['recommendations'][0]['merged_types'], ['right_sizing'])
+            self.assertEqual(synthesis['cost_impact']['potential_monthly_savings'], 100)
+            self.assertEqual(synthesis['merged_recommendations'], 1)
+
+    def test_duplicates_merge_by_arn_and_id(self):
+        """An ARN and a bare ID naming the same resource merge; tagging aggregates stand alone."""
+        synthesizer = orchestrator_agent.IncrementalSynthesizer('query')
+        synthesizer.add(self.result_with('ec2_agent', [
+            {'type': 'tagging_compliance', 'instance_id': 'i-1', 'priority': 'low', 'estimated_monthly_savings': 0},
+            {'type': 'tagging_compliance', 'resource_arn': 'arn:aws:ec2:us-east-1:123456789012:instance/i-1',
+             'priority': 'high', 'estimated_monthly_savings': 5},
+            {'type': 'tagging_compliance', 'resource_arn': 'arn:aws:s3:::i-1', 'priority': 'high'}
+        ], 5))
+        synthesizer.add(self.result_with('tagging_agent', [
+            {'type': 'missing_required_tag', 'tag': 'Owner', 'resources_missing': 12, 'priority': 'high'}
+        ], 0))
+        synthesis = synthesizer.snapshot()
+
+        self.assertEqual(len(synthesis['recommendations']), 3)
+        merged = synthesis['recommendations'][0]
+        self.assertEqual(merged['estimated_monthly_savings'], 5)
+        self.assertEqual(merged['source_agents'], ['ec2_agent'])
+        self.assertEqual(synthesis['merged_recommendations'], 1)
+        self.assertEqual(synthesis['next_steps'][0], 'Address 3 high-priority recommendations immediately')
+
+    def test_top_k_refills_after_a_subsumed_entry_is_dropped(self):
+        """Dropping a top-K recommendation promotes the next best one rather than leaving a gap."""
+        synthesizer = orchestrator_agent.IncrementalSynthesizer('query', top_k=2)
+        synthesizer.add(self.result_with('rds_agent', [
+            {'type': 'right_sizing', 'instance_id': 'db-1', 'priority': 'high', 'estimated_monthly_savings': 90},
+            {'type': 'backup_optimization', 'instance_id': 'db-2', 'priority': 'high', 'estimated_monthly_savings': 80},
+            {'type': 'multi_az_optimization', 'instance_id': 'db-3', 'priority': 'high', 'estimated_monthly_savings': 70},
+            {'type': 'idle_instance', 'instance_id': 'db-1', 'priority': 'low', 'estimated_monthly_savings': 200}
+        ], 440))
+        synthesis = synthesizer.snapshot()
+
+        self.assertEqual([r['instance_id'] for r in synthesis['recommendations']], ['db-2', 'db-3'])
+        self.assertEqual(synthesis['cost_impact']['potential_monthly_savings'], 350)
+
+    def test_merge_index_matches_brute_force_at_scale(self):
+        """Tens of thousands of overlapping recommendations reduce to the brute-force top-K."""
+        types = ['right_sizing', 'idle_instance', 'tagging_compliance', 'multi_az_optimization']
+        recommendations = [
+            {'type': types[i % 4], 'instance_id': f'i-{i % 5000}', 'priority': ['low', 'medium', 'high'][i % 3],
+             'estimated_monthly_savings': (i * 7919) % 1000}
+            for i in range(20000)
+        ]
+        synthesizer = orchestrator_agent.IncrementalSynthesizer('query', top_k=10)
+        synthesizer.add(self.result_with('ec2_agent', [dict(rec) for rec in recommendations], 0))
+        top = synthesizer.snapshot()['recommendations']
+
+        # Brute force: per (instance, action) keep the largest saving, then drop what stopping subsumes
+        order = {'high': 3, 'medium': 2, 'low': 1}
+        best = {}
+        for sequence, rec in enumerate(recommendations):
+            action = orchestrator_agent.RECOMMENDATION_ACTIONS[rec['type']]
+            key = (rec['instance_id'], action)
+            if key not in best or rec['estimated_monthly_savings'] > best[key][1]['estimated_monthly_savings']:
+                best[key] = (sequence, rec)
+        stopped = {instance for instance, action in best if action == 'stop'}
+        survivors = [
+            (order[rec['priority']], rec['estimated_monthly_savings'], -sequence)
+            for (instance, action), (sequence, rec) in best.items()
+            if not (instance in stopped and action in orchestrator_agent.ACTION_SUBSUMES['stop'])
+        ]
+        expected = sorted(survivors, reverse=True)[:10]
+        self.assertEqual([(order[r['priority']], r['estimated_monthly_savings']) for r in top],
+                         [key[:2] for key in expected])
+
+    @patch('orchestrator_agent.boto3.client')
+    def test_stream_mode_records_progress_events(self, mock_boto3_client):
+        """Stream mode records the plan, one event per agent and the final result in the job store."""
+        mock_boto3_client.return_value.get_cost_and_usage.return_value = {'ResultsByTime': []}
+        store_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, store_dir)
+        with patch.object(orchestrator_agent, 'result_cache', FileStore(os.path.join(store_dir, 'cache'))), \
+                patch.object(orchestrator_agent, 'job_store', FileStore(os.path.join(store_dir, 'jobs'))), \
+                patch.dict(os.environ, {'AWS_ACCOUNT_ID': '123456789012'}), \
+                patch.object(FinOpsOrchestrator, 'invoke_agent',
+                             side_effect=lambda agent, payload: self.agent_result(agent, 10)):
+            response = lambda_handler({'query': 'Check my EC2 instances and S3 buckets', 'mode': 'stream'}, None)
+            self.assertEqual(response['statusCode'], 202)
+            job_id = json.loads(response['body'])['job_id']
+
+            first = json.loads(lambda_handler({'job_id': job_id, 'event_cursor': 0}, None)['body'])
+            rest = json.loads(lambda_handler({'job_id': job_id, 'event_cursor': 2}, None)['body'])
+
+        self.assertEqual(first['status'], 'completed')
+        events = first['events']
+        self.assertEqual([e['event'] for e in events],
+                         ['plan', 'agent_result', 'agent_result', 'synthesis', 'complete'])
+        self.assertEqual(len(events[1]['synthesis']['recommendations']), 8)
+        self.assertEqual(len(events[-1]['result']['detailed_analysis']['recommendations']), 10)
+        self.assertEqual(rest['events'], events[2:])
+        self.assertEqual(rest['event_cursor'], 5)
+        self.assertEqual(first['progress']['percentage'], 100.0)
+
+class TestAgentExecutors(unittest.TestCase):
+    """Test cases for running agents through Lambda or in-process."""
+
+    def setUp(self):
+        """Write a stand-in agent module that creates boto3 clients like the real agents do."""
+        self.module_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.module_dir)
+        with open(os.path.join(self.module_dir, 'fake_inprocess_agent.py'), 'w') as f:
+            f.write(
+                "import json\n"
+                "import boto3\n"
+                "def lambda_handler(event, context):\n"
+                "    clients = [boto3.client('ce'), boto3.client('ce'), boto3.client('ec2', region_name='eu-west-1')]\n"
+                "    return {'statusCode': 200, 'body': json.dumps({'days': event['days'],\n"
+                "            'shared_ce': clients[0] is clients[1], 'clients': len({id(c) for c in clients})})}\n"
+            )
+        sys.path.insert(0, self.module_dir)
+        self.addCleanup(sys.path.remove, self.module_dir)
+        self.addCleanup(sys.modules.pop, 'fake_inprocess_agent', None)
+
+    @patch('orchestrator_agent.boto3.client')
+    def test_in_process_results_match_lambda_contract(self, mock_boto3_client):
+        """Both executors return the same result for the same handler response, with pooled clients."""
+        mock_boto3_client.side_effect = lambda *args, **kwargs: MagicMock()
+        executor = orchestrator_agent.InProcessAgentExecutor({'ec2_agent': 'fake_inprocess_agent'})
+        in_process = executor.invoke('ec2_agent', {'days': 7})
+        executor.invoke('ec2_agent', {'days': 7})
+
+        self.assertEqual(mock_boto3_client.call_count, 2)
+        self.assertEqual(json.loads(in_process['data']['body']), {'days': 7, 'shared_ce': True, 'clients': 2})
+
+        lambda_client = MagicMock()
+        lambda_client.invoke.return_value = {
+            'StatusCode': 200,
+            'Payload': MagicMock(read=MagicMock(return_value=json.dumps(in_process['data'])))
+        }
+        via_lambda = orchestrator_agent.LambdaAgentExecutor({'ec2_agent': 'fn'}, lambda_client).invoke('ec2_agent', {'days': 7})
+        self.assertEqual(via_lambda, in_process)
+
+    @patch('orchestrator_agent.boto3.client')
+    def test_executor_selected_by_environment(self, mock_boto3_client):
+        """AGENT_EXECUTOR=inprocess routes invoke_agent to the shared in-process executor."""
+        with patch.dict(os.environ, {'AGENT_EXECUTOR': 'inprocess'}):
+            self.assertIs(FinOpsOrchestrator().executor, orchestrator_agent.in_process_executor)
+        self.assertIsInstance(FinOpsOrchestrator().executor, orchestrator_agent.LambdaAgentExecutor)
+        self.assertEqual(FinOpsOrchestrator().invoke_agent('unknown_agent', {}), {'error': 'Unknown agent: unknown_agent'})
+
+class TestOrchestratorResultCache(unittest.TestCase):
+    """Test cases for the plan-keyed result cache."""
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.cache_patcher = patch.object(orchestrator_agent, 'result_cache', FileStore(self.cache_dir))
+        self.cache_patcher.start()
+        self.env_patcher = patch.dict(os.environ, {'AWS_ACCOUNT_ID': '123456789012'})
+        self.env_patcher.start()
+        self.invocations = []
+
+    def tearDown(self):
+        self.env_patcher.stop()
+        self.cache_patcher.stop()
+        shutil.rmtree(self.cache_dir)
+
+    def fake_invoke_agent(self, agent_name, payload):
+        self.invocations.append(agent_name)
+        return {
+            'agent': agent_name,
+            'success': True,
+            'data': {'statusCode': 200, 'body': json.dumps({'summary': {'potential_monthly_savings': 50.0}})}
+        }
+
+    @patch('orchestrator_agent.boto3.client')
+    def test_paraphrased_query_served_from_cache(self, mock_boto3_client):
+        """Different phrasings of the same plan reuse the cached result without invoking agents."""
+        with patch.object(FinOpsOrchestrator, 'invoke_agent', side_effect=self.fake_invoke_agent):
+            first = json.loads(lambda_handler({'query': 'Check my EC2 instances'}, None)['body'])
+            second = json.loads(lambda_handler({'query': 'How are my servers doing?'}, None)['body'])
+
+        self.assertEqual(self.invocations, ['ec2_agent'])
+        self.assertFalse(first['cache']['plan_hit'])
+        self.assertTrue(second['cache']['plan_hit'])
+        self.assertEqual(second['query'], 'How are my servers doing?')
+        self.assertEqual(second['detailed_analysis']['cost_impact']['potential_monthly_savings'], 50.0)
+
+    @patch('orchestrator_agent.boto3.client')
+    def test_agent_results_reused_across_plans(self, mock_boto3_client):
+        """A wider plan only invokes the agents without a fresh cached result."""
+        with patch.object(FinOpsOrchestrator, 'invoke_agent', side_effect=self.fake_invoke_agent):
+            lambda_handler({'query': 'Check my EC2 instances'}, None)
+            body = json.loads(lambda_handler({'query': 'Check my EC2 instances and S3 buckets'}, None)['body'])
+
+        self.assertEqual(self.invocations, ['ec2_agent', 's3_agent'])
+        self.assertEqual(body['cache']['cached_agents'], ['ec2_agent'])
+        self.assertEqual(body['detailed_analysis']['cost_impact']['potential_monthly_savings'], 100.0)
+
+    @patch('orchestrator_agent.boto3.client')
+    def test_agent_error_responses_are_failures_and_not_cached(self, mock_boto3_client):
+        """An agent answering with a 500 body is reported failed, and neither it nor the plan is cached."""
+        def invoke(agent_name, payload):
+            self.invocations.append(agent_name)
+            return {
+                'agent': agent_name,
+                'success': True,
+                'data': {'statusCode': 500, 'body': json.dumps({'error': 'Throttling'})}
+            }
+
+        with patch.object(orchestrator_agent.LambdaAgentExecutor, 'invoke', side_effect=invoke):
+            first = json.loads(lambda_handler({'query': 'Check my EC2 instances'}, None)['body'])
+            second = json.loads(lambda_handler({'query': 'Check my EC2 instances'}, None)['body'])
+
+        self.assertEqual(self.invocations, ['ec2_agent', 'ec2_agent'])
+        self.assertFalse(second['cache']['plan_hit'])
+        self.assertEqual(second['cache']['cached_agents'], [])
+        result = first['agent_results'][0]
+        self.assertEqual(result['status'], 'failed')
+        self.assertFalse(result['success'])
+        self.assertIn('status 500: Throttling', result['error'])
+        self.assertTrue(first['detailed_analysis']['partial'])
+        self.assertEqual(first['detailed_analysis']['agent_status'], {'ec2_agent': 'failed'})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+import unittest
+from unittest.mock import patch, MagicMock
+import json
+import sys
+import os
+from datetime import datetime, timedelta
+
+# Add the parent directory to the Python path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+# Add the lambda-functions directory to the path
+lambda_functions_path = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+    'lambda-functions'
+)
+sys.path.insert(0, lambda_functions_path)
+
+# Import the RDS agent module directly
+import rds_agent
+from rds_agent import RDSCostAnalyzer
+
+class TestRDSAgent(unittest.TestCase):
+    """Test cases for the RDS Agent metric batching and recommendations."""
+
+    @patch('rds_agent.boto3.client')
+    def test_metric_queries_are_chunked_per_get_metric_data_call(self, mock_boto3_client):
+        """Every instance's metrics go out in calls of at most 500 queries and come back to the right series."""
+        instance_ids = [f'db-{n}' for n in range(80)]
+        paginate = mock_boto3_client.return_value.get_paginator.return_value.paginate
+
+        def pages(MetricDataQueries, StartTime, EndTime):
+            # Each query reports its own position in the batch as its single value
+            return [{'MetricDataResults': [
+                {'Id': query['Id'], 'Values': [float(position)]} for position, query in enumerate(MetricDataQueries)
+            ]}]
+
+        paginate.side_effect = pages
+        end_time = datetime(2024, 3, 10)
+        series = RDSCostAnalyzer().collect_metric_series(instance_ids, end_time - timedelta(days=1), end_time)
+
+        query_count = len(instance_ids) * len(rds_agent.RDS_UTILIZATION_METRICS)
+        batches = [call.kwargs['MetricDataQueries'] for call in paginate.call_args_list]
+        self.assertEqual([len(batch) for batch in batches], [500, query_count - 500])
+        ids = [query['Id'] for batch in batches for query in batch]
+        self.assertEqual(len(set(ids)), query_count)
+
+        metrics_per_instance = len(rds_agent.RDS_UTILIZATION_METRICS)
+        self.assertEqual(series['db-0']['cpu_avg'], [0.0])
+        self.assertEqual(series['db-0']['free_storage_min'], [float(metrics_per_instance - 1)])
+        # db-71's metrics straddle the batch boundary at query 500
+        self.assertEqual(series['db-71']['cpu_avg'], [497.0])
+        self.assertEqual(series['db-71']['free_storage_min'], [3.0])
+        self.assertEqual(series['db-79']['free_storage_min'], [float(query_count - 500 - 1)])
+
+    @patch('rds_agent.boto3.client')
+    def test_storage_right_sizing_uses_minimum_free_storage(self, mock_boto3_client):
+        """Storage that stayed at least half free all period is flagged with its peak use."""
+        busy = {'avg_cpu': 60, 'max_cpu': 90, 'avg_connections': 50, 'max_connections': 80,
+                'avg_read_iops': 500, 'avg_write_iops': 500, 'data_points': 720}
+        info = {'instance_class': 'db.r5.large', 'allocated_storage': 1000, 'storage_type': 'gp3',
+                'multi_az': False, 'tags': {'Environment': 'Production', 'Owner': 'dba', 'Project': 'orders'}}
+        utilization = {
+            'db-roomy': dict(busy, min_free_storage_bytes=700 * rds_agent.GIB),
+            'db-full': dict(busy, min_free_storage_bytes=100 * rds_agent.GIB),
+            'db-nodata': dict(busy, min_free_storage_bytes=None)
+        }
+
+        opportunities = RDSCostAnalyzer().identify_optimization_opportunities(
+            utilization, {instance_id: info for instance_id in utilization}
+        )
+
+        self.assertEqual(opportunities, [{
+            'type': 'storage_right_sizing',
+            'instance_id': 'db-roomy',
+            'storage_type': 'gp3',
+            'allocated_storage_gb': 1000,
+            'peak_used_storage_gb': 300.0,
+            'unused_storage_gb': 700.0,
+            'recommendation': 'Allocated storage cannot be reduced in place; move to a smaller allocation '
+                              '(snapshot restore or blue/green deployment) and enable storage autoscaling',
+            'priority': 'medium'
+        }])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,333 @@
+import unittest
+from unittest.mock import patch, MagicMock
+import json
+import sys
+import os
+from datetime import datetime, timedelta
+
+import numpy as np
+
+# Add the parent directory to the Python path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+# Add the lambda-functions directory to the path
+lambda_functions_path = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+    'lambda-functions'
+)
+sys.path.insert(0, lambda_functions_path)
+
+# Import the RI/SP agent module directly
+import ri_sp_agent
+from ri_sp_agent import lambda_handler, RISavingsPlansAnalyzer, simulate_commitments, rank_commitment_scenarios
+
+class FixedDatetime(datetime):
+    """datetime whose utcnow() is pinned, so hourly windows are deterministic."""
+
+    @classmethod
+    def utcnow(cls):
+        return cls(2024, 3, 10, 12, 30)
+
+class TestCommitmentSimulator(unittest.TestCase):
+    """Test cases for the vectorized commitment purchase simulator."""
+
+    def test_capped_sums_matches_brute_force(self):
+        """Sorted prefix sums equal sum(min(usage, capacity)) for every level and column."""
+        rng = np.random.default_rng(7)
+        usage = np.round(rng.gamma(2.0, 3.0, size=(200, 5)), 1)
+        capacity = np.vstack([np.zeros(5), usage[17], np.quantile(usage, [0.25, 0.5, 0.9], axis=0), usage.max(axis=0) + 1])
+
+        expected = np.minimum(usage[None, :, :], capacity[:, None, :]).sum(axis=1)
+        np.testing.assert_allclose(ri_sp_agent._capped_sums(usage, capacity), expected)
+
+    def test_residual_usage_applies_pool_commitments_before_floating_ones(self):
+        """A pool-bound commitment caps its column; a floating one then scales every column down."""
+        usage = np.array([[4.0, 2.0], [1.0, 3.0]])
+        commitments = [
+            {'hourly_commitment': 1.0, 'discount': 0.5},
+            {'hourly_commitment': 0.7, 'discount': 0.3, 'pool': 'm5/us-east-1'}
+        ]
+        residual = ri_sp_agent._residual_usage(usage, ['m5/us-east-1', 'c5/us-east-1'], commitments)
+
+        # Pool commitment covers $1/hour of m5: [[3, 2], [0, 3]]; floating $2/hour then takes 2/5 and 2/3
+        np.testing.assert_allclose(residual, [[1.8, 1.2], [0.0, 1.0]])
+
+    def test_hand_computed_scenario(self):
+        """A flat $1/hour pool fully committed for a year, with and without an upfront fee."""
+        simulation = simulate_commitments(
+            np.ones((24, 1)), ['m5/us-east-1'], commitment_types=['reserved_instance'], terms=[1],
+            payment_options=['no_upfront', 'all_upfront'], level_quantiles=[1.0]
+        )
+
+        np.testing.assert_allclose(simulation['hourly_commitment'][0, 0, :, 0], [0.70, 0.65])
+        np.testing.assert_allclose(simulation['net_savings'][0, 0, :, 0], [8760 * 0.30, 8760 * 0.35])
+        np.testing.assert_allclose(simulation['upfront_cost'][0, 0, :, 0], [0.0, 8760 * 0.65])
+        np.testing.assert_allclose(simulation['utilization'][0, 0, :, 0], [1.0, 1.0])
+        np.testing.assert_allclose(simulation['coverage'][0, 0, :, 0], [1.0, 1.0])
+        np.testing.assert_allclose(simulation['break_even_months'][0, 0, :, 0], [0.0, 8760 * 0.65 / 730])
+
+    def test_break_even_waits_for_an_existing_commitment_to_expire(self):
+        """A new commitment earns nothing while an existing one covers the pool."""
+        existing = [{'hourly_commitment': 0.7, 'discount': 0.3, 'expires_in_hours': 1000, 'pool': 'm5/us-east-1'}]
+        simulation = simulate_commitments(
+            np.ones((24, 1)), ['m5/us-east-1'], existing=existing, commitment_types=['reserved_instance'],
+            terms=[1], payment_options=['all_upfront'], level_quantiles=[1.0]
+        )
+
+        upfront = 8760 * 0.65
+        self.assertAlmostEqual(simulation['net_savings'][0, 0, 0, 0], (8760 - 1000) - upfront)
+        self.assertAlmostEqual(simulation['break_even_months'][0, 0, 0, 0], (1000 + upfront) / 730)
+        self.assertAlmostEqual(simulation['utilization'][0, 0, 0, 0], (8760 - 1000) / 8760)
+
+    def test_rank_commitment_scenarios_orders_by_net_savings(self):
+        """Scenarios come back best first, with break-even None when it is never reached."""
+        usage = np.array([[1.0], [0.0]] * 12)
+        simulation = simulate_commitments(usage, ['m5/us-east-1'], commitment_types=['compute_sp', 'reserved_instance'],
+                                          terms=[1, 3], level_quantiles=[0.5, 1.0])
+        scenarios = rank_commitment_scenarios(simulation, top=100)
+
+        self.assertEqual(len(scenarios), simulation['net_savings'].size)
+        savings = [scenario['net_savings'] for scenario in scenarios]
+        self.assertEqual(savings, sorted(savings, reverse=True))
+        self.assertEqual(scenarios[0]['commitment_type'], 'reserved_instance')
+        self.assertEqual(scenarios[0]['term_years'], 3)
+        losing = [s for s in scenarios if s['net_savings'] < 0 and s['payment_option'] == 'all_upfront']
+        self.assertTrue(losing)
+        self.assertTrue(all(s['break_even_months'] is None for s in losing))
+
+    @patch('ri_sp_agent.datetime', FixedDatetime)
+    @patch('ri_sp_agent.boto3.client')
+    def test_hourly_usage_matrix_places_paged_groups_by_period_start(self, mock_boto3_client):
+        """Grouped pages that repeat the same hours fill separate columns of the same rows."""
+        ri_sp_agent._ce_response_cache.clear()
+        self.addCleanup(ri_sp_agent._ce_response_cache.clear)
+        start = FixedDatetime(2024, 3, 9, 12)
+
+        def page(groups, token=None):
+            response = {'ResultsByTime': [
+                {'TimePeriod': {'Start': (start + timedelta(hours=hour)).strftime('%Y-%m-%dT%H:%M:%SZ')},
+                 'Groups': [{'Keys': keys, 'Metrics': {'UnblendedCost': {'Amount': str(amount * (hour + 1))}}}
+                            for keys, amount in groups]}
+                for hour in (0, 5)
+            ]}
+            if token:
+                response['NextPageToken'] = token
+            return response
+
+        mock_boto3_client.return_value.get_cost_and_usage.side_effect = [
+            page([(['m5.large', 'us-east-1'], 1.0)], 'next'),
+            page([(['c5.xlarge', 'us-east-1'], 10.0), (['m5.2xlarge', 'us-east-1'], 2.0)])
+        ]
+        matrix = RISavingsPlansAnalyzer().get_hourly_usage_matrix(1)
+
+        self.assertEqual(matrix['pools'], ['m5/us-east-1', 'c5/us-east-1'])
+        self.assertEqual(matrix['usage'].shape, (24, 2))
+        np.testing.assert_allclose(matrix['usage'][0], [3.0, 10.0])
+        np.testing.assert_allclose(matrix['usage'][5], [18.0, 60.0])
+        self.assertEqual(matrix['usage'][1:5].sum(), 0)
+
+    @patch('ri_sp_agent.boto3.client')
+    def test_simulate_rejects_invalid_requests(self, mock_boto3_client):
+        """Unsupported terms and existing commitments on unknown pools are caller errors."""
+        request = {'action': 'simulate_commitments', 'usage': [[1.0], [2.0]], 'pools': ['m5/us-east-1']}
+
+        response = lambda_handler(dict(request, terms=[2]), None)
+        self.assertEqual(response['statusCode'], 400)
+        self.assertIn('terms', json.loads(response['body'])['details'][0])
+
+        existing = [{'hourly_commitment': 1.0, 'discount': 0.3, 'expires_in_hours': 100, 'pool': 'r5/eu-west-1'}]
+        response = lambda_handler(dict(request, existing_commitments=existing), None)
+        self.assertEqual(response['statusCode'], 400)
+        self.assertIn("'r5/eu-west-1'", json.loads(response['body'])['details'][0])
+
+        response = lambda_handler(dict(request, terms=[1]), None)
+        self.assertEqual(response['statusCode'], 200)
+        self.assertTrue(json.loads(response['body'])['scenarios'])
+
+NOW = 1700000000.0
+DAY = 86400
+
+def commitment(commitment_id, kind, commitment_type, start_days, end_days, hourly, term_years=1.0,
+               payment_option='no_upfront', pool=None):
+    """A portfolio entry whose start and end are given in days from NOW."""
+    return {
+        'id': commitment_id, 'kind': kind, 'commitment_type': commitment_type,
+        'start': NOW + start_days * DAY, 'end': NOW + end_days * DAY, 'hourly_commitment': hourly,
+        'term_years': term_years, 'payment_option': payment_option, 'pool': pool
+    }
+
+class TestCommitmentPortfolio(unittest.TestCase):
+    """Test cases for the commitment timeline index."""
+
+    def setUp(self):
+        """An expired RI, two active RIs, an active and a queued Savings Plan."""
+        self.portfolio = ri_sp_agent.CommitmentPortfolio([
+            commitment('sp-queued', 'savings_plan', 'ec2_instance_sp', 30, 3 * 365, 5.0, 3.0, pool='m5/us-east-1'),
+            commitment('ri-expired', 'reserved_instance', 'reserved_instance', -400, -10, 1.0),
+            commitment('ri-edge', 'reserved_instance', 'reserved_instance', -275, 90, 0.5,
+                       payment_option='partial_upfront', pool='c5/us-east-1'),
+            commitment('sp-compute', 'savings_plan', 'compute_sp', -100, 60, 3.0, 3.0),
+            commitment('ri-m5', 'reserved_instance', 'reserved_instance', -300, 20, 2.0,
+                       payment_option='all_upfront', pool='m5/us-east-1')
+        ])
+
+    def test_committed_at_treats_end_as_exclusive(self):
+        """Rates step up at a start and down at an end; queued plans count only once they start."""
+        portfolio = self.portfolio
+
+        self.assertEqual(portfolio.committed_at(NOW - 500 * DAY), 0.0)
+        self.assertEqual(portfolio.committed_at(NOW), 5.5)
+        self.assertEqual(portfolio.committed_at(NOW, 'reserved_instance'), 2.5)
+        self.assertEqual(portfolio.committed_at(NOW, 'savings_plan'), 3.0)
+        self.assertEqual(portfolio.committed_at(NOW + 20 * DAY - 1, 'reserved_instance'), 2.5)
+        self.assertEqual(portfolio.committed_at(NOW + 20 * DAY, 'reserved_instance'), 0.5)
+        self.assertEqual(portfolio.committed_at(NOW + 30 * DAY), 8.5)
+        self.assertEqual(portfolio.committed_at(NOW + 3 * 365 * DAY), 0.0)
+
+    def test_expiring_between_is_half_open(self):
+        """A window (start, end] includes an expiry on its end and excludes one on its start."""
+        self.assertEqual([c['id'] for c in self.portfolio.expiring_between(NOW, NOW + 90 * DAY)],
+                         ['ri-m5', 'sp-compute', 'ri-edge'])
+        self.assertEqual(self.portfolio.expiring_between(NOW + 20 * DAY, NOW + 20 * DAY), [])
+        self.assertEqual([c['id'] for c in self.portfolio.expiring_between(NOW + 20 * DAY - 1, NOW + 20 * DAY)],
+                         ['ri-m5'])
+        self.assertEqual(self.portfolio.expiring_between(NOW + 90 * DAY, NOW + 200 * DAY), [])
+
+    def test_zero_length_commitment_is_never_in_force(self):
+        """A commitment starting and ending at the same moment adds no rate and is never active."""
+        portfolio = ri_sp_agent.CommitmentPortfolio([
+            commitment('ri-empty', 'reserved_instance', 'reserved_instance', 10, 10, 7.0),
+            commitment('ri-m5', 'reserved_instance', 'reserved_instance', -300, 20, 2.0)
+        ])
+
+        self.assertEqual(portfolio.committed_at(NOW + 10 * DAY), 2.0)
+        self.assertEqual(len(portfolio.existing_commitments(now=NOW + 10 * DAY)), 1)
+
+    def test_existing_commitments_skip_expired_and_queued(self):
+        """Only commitments in force are passed to the simulator, with their term's discount."""
+        existing = self.portfolio.existing_commitments(now=NOW)
+
+        self.assertEqual(existing, [
+            {'hourly_commitment': 2.0, 'discount': 0.35, 'expires_in_hours': 480.0, 'pool': 'm5/us-east-1'},
+            {'hourly_commitment': 3.0, 'discount': 0.36, 'expires_in_hours': 1440.0, 'pool': None},
+            {'hourly_commitment': 0.5, 'discount': 0.33, 'expires_in_hours': 2160.0, 'pool': 'c5/us-east-1'}
+        ])
+        self.assertEqual([c['pool'] for c in self.portfolio.existing_commitments(['savings_plan'], now=NOW)], [None])
+
+        # Once the queued plan starts it is in force, with its instance family pool
+        later = self.portfolio.existing_commitments(['savings_plan'], now=NOW + 30 * DAY)
+        self.assertEqual([(c['hourly_commitment'], c['discount'], c['pool']) for c in later],
+                         [(3.0, 0.36, None), (5.0, 0.47, 'm5/us-east-1')])
+
+    def test_renewal_alerts_and_summary(self):
+        """Alerts cover expiries inside the window, high priority within RENEWAL_HIGH_PRIORITY_DAYS."""
+        alerts = self.portfolio.renewal_alerts(now=NOW)
+
+        self.assertEqual([(a['commitment_id'], a['days_remaining'], a['priority']) for a in alerts],
+                         [('ri-m5', 20.0, 'high'), ('sp-compute', 60.0, 'medium'), ('ri-edge', 90.0, 'medium')])
+        self.assertEqual(alerts[0]['expires_at'], '2023-12-04T22:13:20+00:00')
+        self.assertEqual([a['commitment_id'] for a in self.portfolio.renewal_alerts(days=30, now=NOW)], ['ri-m5'])
+        self.assertEqual(self.portfolio.renewal_alerts(now=NOW + 3 * 365 * DAY), [])
+
+        self.assertEqual(self.portfolio.summary(now=NOW), {
+            'commitment_count': 4,
+            'committed_hourly': 5.5,
+            'reserved_instance_hourly': 2.5,
+            'savings_plan_hourly': 3.0,
+            'expiring_hourly_within_alert_window': 5.5
+        })
+
+class FakeClock:
+    """Stands in for the time module: sleep() advances monotonic() instead of blocking."""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+class TestCostExplorerAccess(unittest.TestCase):
+    """Test cases for the rate limiter and paged Cost Explorer calls."""
+
+    def setUp(self):
+        """An analyzer with a mocked Cost Explorer client and an empty response cache."""
+        ri_sp_agent._ce_response_cache.clear()
+        self.addCleanup(ri_sp_agent._ce_response_cache.clear)
+        for target in ('ri_sp_agent.boto3.client', 'ri_sp_agent.ce_rate_limiter'):
+            patcher = patch(target)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.analyzer = RISavingsPlansAnalyzer()
+
+    def test_rate_limiter_spends_the_burst_then_waits_for_refill(self):
+        """A full bucket serves its burst at once; later calls wait exactly for the next token."""
+        clock = FakeClock()
+        with patch('ri_sp_agent.time', clock):
+            limiter = ri_sp_agent.RateLimiter(2.0, burst=3)
+            for _ in range(3):
+                limiter.acquire()
+            self.assertEqual(clock.sleeps, [])
+
+            limiter.acquire()
+            self.assertEqual(clock.sleeps, [0.5])
+
+            # A long idle spell refills the bucket to its capacity and no further
+            clock.now += 100
+            for _ in range(3):
+                limiter.acquire()
+            self.assertEqual(clock.sleeps, [0.5])
+            limiter.acquire()
+            self.assertEqual(clock.sleeps, [0.5, 0.5])
+
+    def test_call_ce_merges_pages_for_either_token_field(self):
+        """List keys are concatenated across NextPageToken and NextToken pages and the tokens are dropped."""
+        get_reservation_utilization = self.analyzer.ce_client.get_reservation_utilization
+        get_reservation_utilization.side_effect = [
+            {'UtilizationsByTime': [1, 2], 'Total': {'UtilizationPercentage': '80'}, 'NextPageToken': 'a'},
+            {'UtilizationsByTime': [3], 'NextPageToken': 'b'},
+            {'UtilizationsByTime': [4]}
+        ]
+        merged = self.analyzer.call_ce('get_reservation_utilization', ['UtilizationsByTime'], Granularity='DAILY')
+
+        self.assertEqual(merged, {'UtilizationsByTime': [1, 2, 3, 4], 'Total': {'UtilizationPercentage': '80'}})
+        self.assertEqual([call.kwargs.get('NextPageToken') for call in get_reservation_utilization.call_args_list],
+                         [None, 'a', 'b'])
+
+        get_coverage = self.analyzer.ce_client.get_savings_plans_coverage
+        get_coverage.side_effect = [{'SavingsPlansCoverages': [1], 'NextToken': 'x'}, {'SavingsPlansCoverages': [2]}]
+        merged = self.analyzer.call_ce('get_savings_plans_coverage', ['SavingsPlansCoverages'], Granularity='DAILY')
+
+        self.assertEqual(merged, {'SavingsPlansCoverages': [1, 2]})
+        self.assertEqual(get_coverage.call_args_list[1].kwargs['NextToken'], 'x')
+
+        # The merged response is cached under the original request
+        self.analyzer.call_ce('get_savings_plans_coverage', ['SavingsPlansCoverages'], Granularity='DAILY')
+        self.assertEqual(get_coverage.call_count, 2)
+        self.assertEqual(ri_sp_agent.ce_rate_limiter.acquire.call_count, 5)
+
+    def test_call_ce_stops_on_repeated_token_and_page_cap(self):
+        """A repeated token or CE_MAX_PAGES pages ends the merge with what was read so far."""
+        get_utilization = self.analyzer.ce_client.get_reservation_utilization
+        get_utilization.return_value = {'UtilizationsByTime': [0], 'NextPageToken': 'same'}
+        merged = self.analyzer.call_ce('get_reservation_utilization', ['UtilizationsByTime'], Granularity='DAILY')
+
+        self.assertEqual(get_utilization.call_count, 2)
+        self.assertEqual(merged['UtilizationsByTime'], [0, 0])
+
+        get_utilization.reset_mock(return_value=True)
+        get_utilization.side_effect = (
+            {'UtilizationsByTime': [n], 'NextPageToken': str(n)} for n in range(ri_sp_agent.CE_MAX_PAGES + 1)
+        )
+        merged = self.analyzer.call_ce('get_reservation_utilization', ['UtilizationsByTime'], Granularity='MONTHLY')
+
+        self.assertEqual(get_utilization.call_count, ri_sp_agent.CE_MAX_PAGES)
+        self.assertEqual(merged['UtilizationsByTime'], list(range(ri_sp_agent.CE_MAX_PAGES)))
+        self.assertNotIn('NextPageToken', merged)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,6 +3,10 @@ from unittest.mock import patch, MagicMock
 import json
 import sys
 import os
+import gzip
+import shutil
+import tempfile
+from datetime import datetime, timedelta
 
 # Add the parent directory to the Python path
 sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
@@ -107,7 +111,18 @@ class TestS3Agent(unittest.TestCase):
         mock_s3.get_bucket_location.return_value = {'LocationConstraint': 'us-east-1'}
         mock_s3.get_bucket_tagging.side_effect = Exception("NoSuchTagSet")
         
-        mock_cloudwatch.get_metric_statistics.return_value = self.cloudwatch_metrics
+        # One batched GetMetricData page: StandardStorage size and object count per bucket
+        object_count_series = len(s3_agent.S3_STORAGE_TYPES)
+        mock_cloudwatch.get_paginator.return_value.paginate.return_value = [{
+            'MetricDataResults': [
+                result
+                for index in range(len(self.bucket_list))
+                for result in (
+                    {'Id': f'm{index}_0', 'Values': [self.cloudwatch_metrics['Datapoints'][0]['Average']]},
+                    {'Id': f'm{index}_{object_count_series}', 'Values': [3.0]}
+                )
+            ]
+        }]
         
         # Configure paginator mock
         mock_paginator = MagicMock()
@@ -136,10 +151,15 @@ class TestS3Agent(unittest.TestCase):
             self.assertIn(bucket, result)
             self.assertIn('size_gb', result[bucket])
             self.assertIn('object_count', result[bucket])
+            self.assertEqual(result[bucket]['size_gb'], 1.0)
+            self.assertEqual(result[bucket]['object_count'], 3)
         
         # Verify that the mock objects were called
         mock_s3.list_buckets.assert_called()
-        mock_cloudwatch.get_metric_statistics.assert_called()
+        mock_cloudwatch.get_paginator.assert_called_with('get_metric_data')
+        mock_cloudwatch.get_metric_statistics.assert_not_called()
+        # All buckets share a region, so their metrics go out in a single request
+        self.assertEqual(mock_cloudwatch.get_paginator.return_value.paginate.call_count, 1)
 
     @patch('s3_agent.boto3.client')
     def test_analyze_storage_classes(self, mock_boto3_client):
@@ -179,6 +199,292 @@ class TestS3Agent(unittest.TestCase):
         total_result_size = sum([sc['total_size'] for sc in result.values()])
         self.assertEqual(total_result_size, total_size)
 
+    @patch('s3_agent.boto3.client')
+    def test_load_inventory_csv(self, mock_boto3_client):
+        """Test exact storage-class totals and histograms from a local S3 Inventory export."""
+        inventory_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, inventory_dir)
+        
+        old = (datetime.utcnow() - timedelta(days=400)).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+        new = (datetime.utcnow() - timedelta(days=2)).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+        rows = [
+            f'"test-bucket-1","logs/a.log","1024","{new}","STANDARD","false"',
+            f'"test-bucket-1","logs/b.log","2048","{old}","STANDARD","false"',
+            f'"test-bucket-1","archive/c.zip","1048576","{old}","GLACIER","false"',
+            f'"test-bucket-1","archive/c.zip","","{new}","STANDARD","true"'
+        ]
+        os.makedirs(os.path.join(inventory_dir, 'data'))
+        with gzip.open(os.path.join(inventory_dir, 'data', 'part-0.csv.gz'), 'wt') as data_file:
+            data_file.write('\n'.join(rows) + '\n')
+        
+        manifest_path = os.path.join(inventory_dir, 'manifest.json')
+        with open(manifest_path, 'w') as manifest_file:
+            json.dump({
+                'sourceBucket': 'test-bucket-1',
+                'destinationBucket': 'arn:aws:s3:::inventory-bucket',
+                'fileFormat': 'CSV',
+                'fileSchema': 'Bucket, Key, Size, LastModifiedDate, StorageClass, IsDeleteMarker',
+                'files': [{'key': 'test-bucket-1/config/data/part-0.csv.gz'}]
+            }, manifest_file)
+        
+        analyzer = S3CostAnalyzer()
+        result = analyzer.load_inventory([manifest_path])
+        
+        bucket = result['test-bucket-1']
+        self.assertEqual(bucket['object_count'], 3)
+        self.assertEqual(bucket['size_bytes'], 1024 + 2048 + 1048576)
+        self.assertEqual(bucket['storage_classes']['STANDARD']['count'], 2)
+        self.assertEqual(bucket['storage_classes']['GLACIER']['total_size'], 1048576)
+        # Two objects are over a year old, one is under 30 days
+        self.assertEqual(bucket['age_histogram']['counts'], [1, 0, 0, 0, 2, 0])
+        self.assertEqual(bucket['size_histogram']['counts'], [2, 0, 1, 0, 0, 0])
+
+    @patch('s3_agent.boto3.client')
+    def test_iter_batches_csv_only_skips_a_leading_header(self, mock_boto3_client):
+        """A header is dropped from the first row only; a matching row later in the file is data."""
+        schema = ['bucket', 'key', 'size']
+        data_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, data_dir)
+        with_header = os.path.join(data_dir, 'with-header.csv')
+        without_header = os.path.join(data_dir, 'without-header.csv')
+        with open(with_header, 'w') as f:
+            f.write('Bucket,Key,Size\nb,a.txt,1\nbucket,key,size\n')
+        with open(without_header, 'w') as f:
+            f.write('b,a.txt,1\nb,c.txt,2\n')
+        
+        analyzer = S3CostAnalyzer()
+        batches = list(analyzer._iter_batches(with_header, 'CSV', schema))
+        self.assertEqual(batches, [{'bucket': ['b', 'bucket'], 'key': ['a.txt', 'key'], 'size': ['1', 'size']}])
+        batches = list(analyzer._iter_batches(without_header, 'CSV', schema))
+        self.assertEqual(batches[0]['key'], ['a.txt', 'c.txt'])
+
+    @patch('s3_agent.boto3.client')
+    def test_iter_batches_slices_orc_stripes(self, mock_boto3_client):
+        """ORC stripes larger than a batch are yielded in INVENTORY_BATCH_ROWS slices."""
+        try:
+            import pyarrow as pa
+            import pyarrow.orc as orc
+        except ImportError:
+            self.skipTest('pyarrow is not installed')
+        data_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, data_dir)
+        path = os.path.join(data_dir, 'part-0.orc')
+        orc.write_table(pa.table({'key': [f'k{i}' for i in range(5)], 'size': list(range(5))}), path)
+        
+        analyzer = S3CostAnalyzer()
+        with patch.object(s3_agent, 'INVENTORY_BATCH_ROWS', 2):
+            batches = list(analyzer._iter_batches(path, 'ORC', ['key', 'size']))
+        
+        self.assertEqual([len(batch['key']) for batch in batches], [2, 2, 1])
+        self.assertEqual(sum((batch['size'] for batch in batches), []), [0, 1, 2, 3, 4])
+
+    @patch('s3_agent.boto3.client')
+    def test_sample_bucket_stratifies_by_prefix(self, mock_boto3_client):
+        """Test that each top-level prefix is sampled as its own stratum with exact weights."""
+        objects = {
+            'logs/': [{'Key': f'logs/{i}', 'Size': 100, 'StorageClass': 'STANDARD'} for i in range(3000)],
+            'archive/': [{'Key': f'archive/{i}', 'Size': 5000, 'StorageClass': 'GLACIER'} for i in range(200)]
+        }
+        
+        def paginate(Bucket, Prefix='', Delimiter=None, PaginationConfig=None):
+            if Delimiter:
+                return [{'CommonPrefixes': [{'Prefix': prefix} for prefix in objects]}]
+            return [{'Contents': objects[Prefix]}]
+        
+        mock_s3 = MagicMock()
+        mock_s3.get_paginator.return_value.paginate.side_effect = paginate
+        mock_boto3_client.return_value = mock_s3
+        
+        analyzer = S3CostAnalyzer()
+        result = analyzer.sample_bucket('test-bucket-1', max_objects=300)
+        
+        self.assertEqual(result['strata'], 2)
+        self.assertTrue(result['complete_listing'])
+        self.assertLessEqual(result['sampled_objects'], 300)
+        # Single-class strata are estimated exactly despite sampling
+        self.assertEqual(result['storage_classes']['STANDARD']['count'], 3000)
+        self.assertEqual(result['storage_classes']['STANDARD']['total_size'], 300000)
+        self.assertEqual(result['storage_classes']['GLACIER']['size_ci_95'], [1000000, 1000000])
+
+    @patch('s3_agent.boto3.client')
+    def test_sample_bucket_bounds_listing_and_widens_truncated_strata(self, mock_boto3_client):
+        """Listing stays within the bucket budget, and truncated strata widen and flag the intervals."""
+        import s3_agent
+        objects = {
+            'hot/': [{'Key': f'hot/{i}', 'Size': 100, 'StorageClass': 'STANDARD'} for i in range(5000)],
+            'cold/': [{'Key': f'cold/{i}', 'Size': 100, 'StorageClass': 'GLACIER'} for i in range(5000)],
+            'small/': [{'Key': f'small/{i}', 'Size': 100, 'StorageClass': 'STANDARD'} for i in range(10)]
+        }
+        listed = []
+        discovery_pages = []
+        
+        def paginate(Bucket, Prefix='', Delimiter=None, PaginationConfig=None):
+            if Delimiter:
+                def pages():
+                    for page in range(50):
+                        discovery_pages.append(page)
+                        yield {'CommonPrefixes': [{'Prefix': prefix} for prefix in objects] if page == 0 else []}
+                return pages()
+            contents = objects[Prefix][:PaginationConfig['MaxItems']]
+            listed.append(len(contents))
+            return [{'Contents': contents}]
+        
+        mock_s3 = MagicMock()
+        mock_s3.get_paginator.return_value.paginate.side_effect = paginate
+        mock_boto3_client.return_value = mock_s3
+        
+        analyzer = S3CostAnalyzer()
+        with patch.object(s3_agent, 'SAMPLE_BUCKET_LIST_BUDGET', 3000):
+            result = analyzer.sample_bucket('test-bucket-1', max_objects=300, total_objects=10010)
+            unscaled = analyzer.sample_bucket('test-bucket-1', max_objects=300)
+        
+        # Discovery stops at its page cap; the strata share the key budget (plus one probe key each)
+        self.assertEqual(len(discovery_pages), 2 * (s3_agent.SAMPLE_DISCOVERY_PAGES + 1))
+        self.assertLessEqual(sum(listed[:3]), 3000 + 3)
+        self.assertEqual(result['truncated_strata'], 2)
+        self.assertFalse(result['complete_listing'])
+        self.assertTrue(result['intervals_include_allocation'])
+        self.assertFalse(result['totals_are_lower_bounds'])
+        
+        # hot/ and cold/ are single-class, so the interval is exactly the range of possible splits:
+        # cold/ holds between its 1001 listed keys and everything but hot/'s 1001 listed keys
+        glacier = result['storage_classes']['GLACIER']
+        self.assertEqual(glacier['count'], 5000)
+        self.assertEqual(glacier['count_ci_95'], [1001, 8999])
+        self.assertTrue(unscaled['totals_are_lower_bounds'])
+
+    @patch('s3_agent.boto3.client')
+    def test_buckets_share_one_list_budget(self, mock_boto3_client):
+        """Buckets draw their listing from one request-wide budget; unused keys go back, then sampling stops."""
+        import s3_agent
+        listed = []
+        
+        def paginate(Bucket, Prefix='', Delimiter=None, PaginationConfig=None):
+            if Delimiter:
+                return [{'CommonPrefixes': [{'Prefix': 'data/'}]}]
+            # Bucket "small-*" holds 100 keys, "large-*" 5000
+            keys = 100 if Bucket.startswith('small') else 5000
+            contents = [{'Key': f'data/{i}', 'Size': 10, 'StorageClass': 'STANDARD'}
+                        for i in range(min(keys, PaginationConfig['MaxItems']))]
+            listed.append((Bucket, len(contents)))
+            return [{'Contents': contents}]
+        
+        mock_boto3_client.return_value.get_paginator.return_value.paginate.side_effect = paginate
+        analyzer = S3CostAnalyzer()
+        budget = s3_agent.SharedListBudget(5000)
+        with patch.object(s3_agent, 'SAMPLE_BUCKET_LIST_BUDGET', 3000):
+            small = analyzer.sample_bucket('small-1', list_budget=budget)
+            first = analyzer.sample_bucket('large-1', list_budget=budget)
+            second = analyzer.sample_bucket('large-2', list_budget=budget)
+            skipped = analyzer.sample_bucket('large-3', list_budget=budget)
+        
+        self.assertTrue(small['complete_listing'])
+        # large-1 gets the full per-bucket budget, large-2 only what is left of the shared one
+        self.assertEqual(listed, [('small-1', 100), ('large-1', 3001), ('large-2', 1901)])
+        self.assertEqual((first['truncated_strata'], second['truncated_strata']), (1, 1))
+        self.assertEqual(skipped, {'complete_listing': False, 'list_budget_exhausted': True})
+        self.assertEqual(budget.remaining, 0)
+
+    @patch('s3_agent.boto3.client')
+    def test_sample_bucket_on_shared_pool_stays_within_pool_threads(self, mock_boto3_client):
+        """A bucket worker sampling on its own saturated pool runs the queued listings itself."""
+        import threading
+        from concurrent.futures import ThreadPoolExecutor
+        objects = {f'p{i}/': [{'Key': f'p{i}/0', 'Size': 10, 'StorageClass': 'STANDARD'}] for i in range(6)}
+        threads = set()
+        
+        def paginate(Bucket, Prefix='', Delimiter=None, PaginationConfig=None):
+            threads.add(threading.current_thread().name)
+            if Delimiter:
+                return [{'CommonPrefixes': [{'Prefix': prefix} for prefix in objects]}]
+            return [{'Contents': objects[Prefix]}]
+        
+        mock_s3 = MagicMock()
+        mock_s3.get_paginator.return_value.paginate.side_effect = paginate
+        mock_boto3_client.return_value = mock_s3
+        
+        analyzer = S3CostAnalyzer()
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            future = executor.submit(lambda: analyzer.sample_bucket('test-bucket-1', executor=executor))
+            result = future.result(timeout=10)
+        
+        self.assertEqual(result['strata'], 6)
+        self.assertEqual(result['storage_classes']['STANDARD']['count'], 6)
+        self.assertEqual(len(threads), 1)
+
+    def test_simulate_lifecycle_policies(self):
+        """Test that cold data favours archival policies and small objects never transition."""
+        import numpy as np
+        
+        # Bucket 0: 1 TB of 1-2 year old large objects; bucket 1: only objects under 128 KB
+        age_size_bytes = np.zeros((2, 6, 6))
+        age_size_counts = np.zeros((2, 6, 6))
+        age_size_bytes[0, 4, 4] = 1024**4
+        age_size_counts[0, 4, 4] = 4096
+        age_size_bytes[1, 4, 0] = 1024**3
+        age_size_counts[1, 4, 0] = 100000
+        
+        policies = [
+            {'name': 'standard_only', 'transitions': []},
+            {'name': 'ia_30', 'transitions': [(30, 'STANDARD_IA')]},
+            {'name': 'ia_30_deep_archive_180', 'transitions': [(30, 'STANDARD_IA'), (180, 'DEEP_ARCHIVE')]}
+        ]
+        result = s3_agent.simulate_lifecycle_policies(age_size_bytes, age_size_counts, policies, months=12)
+        
+        total = result['total_cost']
+        self.assertEqual(total.shape, (2, 3))
+        self.assertAlmostEqual(total[0, 0], 1024 * 0.023 * 12, places=6)
+        self.assertEqual(int(np.argmin(total[0])), 2)
+        # Objects under 128 KB stay in STANDARD, so every policy costs the same
+        self.assertTrue(np.allclose(total[1], total[1, 0]))
+        self.assertEqual(result['transition_cost'][1].sum(), 0)
+
+    def test_simulate_lifecycle_charges_early_deletion(self):
+        """Leaving a class before its minimum duration bills the remainder; expiry is flagged as deleting data."""
+        import numpy as np
+
+        # 1 GB of 15-day-old objects, aged 45, 75, 105... days over the horizon's months
+        age_size_bytes = np.zeros((1, 6, 6))
+        age_size_counts = np.zeros((1, 6, 6))
+        age_size_bytes[0, 0, 4] = 1024**3
+        age_size_counts[0, 0, 4] = 1
+        policies = [
+            {'name': 'ia_30_glacier_ir_60', 'transitions': [(30, 'STANDARD_IA'), (60, 'GLACIER_IR')]},
+            {'name': 'glacier_ir_30_deep_archive_60', 'transitions': [(30, 'GLACIER_IR'), (60, 'DEEP_ARCHIVE')]},
+            {'name': 'deep_archive_30_expire_90', 'transitions': [(30, 'DEEP_ARCHIVE')], 'expiration_days': 90}
+        ]
+        result = s3_agent.simulate_lifecycle_policies(age_size_bytes, age_size_counts, policies, months=6)
+
+        # 30 days in IA meets its minimum; Glacier IR is left after 30 of 90 days, Deep Archive
+        # expires after 60 of 180 days
+        self.assertAlmostEqual(result['early_deletion_cost'][0, 0], 0.0)
+        self.assertAlmostEqual(result['early_deletion_cost'][0, 1], 0.004 * 60 / 30)
+        self.assertAlmostEqual(result['early_deletion_cost'][0, 2], 0.00099 * 120 / 30)
+        self.assertEqual(result['deletes_data'], [False, False, True])
+        self.assertTrue(np.allclose(result['total_cost'], result['storage_cost'] + result['transition_cost']
+                                    + result['retrieval_cost'] + result['early_deletion_cost']))
+
+    @patch('s3_agent.boto3.client')
+    def test_rank_lifecycle_policies_only_acts_on_standard_data(self, mock_boto3_client):
+        """A bucket with no STANDARD bytes has nothing to save, and expiry is not ranked by default."""
+        age_size_bytes = [[0] * 6 for _ in range(6)]
+        age_size_bytes[4][4] = 1024**4
+        age_size_counts = [[0] * 6 for _ in range(6)]
+        age_size_counts[4][4] = 4096
+        analysis = {
+            'archive-bucket': {'age_size_bytes': age_size_bytes, 'age_size_counts': age_size_counts,
+                               'storage_classes': {'DEEP_ARCHIVE': {'size_percentage': 100}}},
+            'hot-bucket': {'age_size_bytes': age_size_bytes, 'age_size_counts': age_size_counts,
+                           'storage_classes': {}}
+        }
+        rankings = S3CostAnalyzer().rank_lifecycle_policies(analysis)
+
+        self.assertEqual(rankings['archive-bucket']['baseline_cost'], 0)
+        self.assertTrue(all(p['savings'] == 0 for p in rankings['archive-bucket']['policies']))
+        self.assertGreater(rankings['hot-bucket']['baseline_cost'], 0)
+        self.assertEqual(rankings['hot-bucket']['policies'][0]['policy'], 'ia_30_deep_archive_180')
+        self.assertFalse(any(p['deletes_data'] for p in rankings['hot-bucket']['policies']))
+
     @patch('s3_agent.boto3.client')
     def test_get_s3_costs(self, mock_boto3_client):
         """Test the get_s3_costs method."""
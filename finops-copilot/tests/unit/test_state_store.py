@@ -0,0 +1,91 @@
+import unittest
+from unittest.mock import patch, MagicMock
+import io
+import os
+import sys
+import tempfile
+
+# Add the parent directory to the Python path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+# Add the lambda-functions directory to the path
+lambda_functions_path = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+    'lambda-functions'
+)
+sys.path.insert(0, lambda_functions_path)
+
+# Import the state store module directly
+import state_store
+from state_store import DynamoDBStore, FileStore, create_job_store
+
+class TestDynamoDBStore(unittest.TestCase):
+    """Test cases for the compressed DynamoDB store encoding."""
+
+    def setUp(self):
+        self.dynamodb = MagicMock()
+        self.s3 = MagicMock()
+        patcher = patch('state_store.boto3.client', side_effect=lambda name: self.dynamodb if name == 'dynamodb' else self.s3)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def stored_item(self):
+        item = self.dynamodb.put_item.call_args.kwargs['Item']
+        self.dynamodb.get_item.return_value = {'Item': item}
+        return item
+
+    def test_small_value_is_stored_compressed_in_the_item(self):
+        """Values under the item limit round-trip through a binary attribute."""
+        store = DynamoDBStore('jobs', 'spill-bucket')
+        value = {'results': ['same text'] * 1000}
+        store.put('job-1', value, 60)
+
+        item = self.stored_item()
+        self.assertIn('B', item['value'])
+        self.assertLess(len(item['value']['B']), 1000)
+        self.assertEqual(store.get('job-1'), value)
+        self.s3.put_object.assert_not_called()
+
+    def test_oversized_value_spills_to_s3(self):
+        """Values above the item limit are written to S3 and read back through the item's spill key."""
+        store = DynamoDBStore('jobs', 'spill-bucket')
+        value = {'events': [os.urandom(16).hex() for _ in range(30000)]}
+        store.put('job-2', value, 60)
+
+        item = self.stored_item()
+        self.assertNotIn('value', item)
+        self.assertEqual(item['spill_key']['S'], 'finops-state/job-2')
+        self.s3.get_object.return_value = {'Body': io.BytesIO(self.s3.put_object.call_args.kwargs['Body'])}
+        self.assertEqual(store.get('job-2'), value)
+
+    def test_oversized_value_without_spill_bucket_is_rejected(self):
+        """Without a spill bucket an oversized value raises instead of failing inside DynamoDB."""
+        store = DynamoDBStore('jobs')
+        with self.assertRaises(ValueError):
+            store.put('job-3', {'events': [os.urandom(16).hex() for _ in range(30000)]}, 60)
+        self.dynamodb.put_item.assert_not_called()
+
+class TestCreateJobStore(unittest.TestCase):
+    """Test cases for job store selection inside and outside Lambda."""
+
+    def test_file_store_outside_lambda(self):
+        with patch.dict(os.environ, {}, clear=True):
+            self.assertIsInstance(create_job_store(tempfile.mkdtemp()), FileStore)
+
+    @patch('state_store.boto3.client')
+    def test_lambda_defaults_to_dynamodb(self, mock_boto3_client):
+        with patch.dict(os.environ, {'AWS_LAMBDA_FUNCTION_NAME': 'orchestrator', 'JOB_TABLE': 'jobs'}, clear=True):
+            store = create_job_store(tempfile.mkdtemp())
+        self.assertIsInstance(store, DynamoDBStore)
+        self.assertEqual(store.table_name, 'jobs')
+
+    def test_lambda_refuses_file_store_and_missing_table(self):
+        with patch.dict(os.environ, {'AWS_LAMBDA_FUNCTION_NAME': 'orchestrator', 'JOB_STORE_BACKEND': 'file'}, clear=True):
+            with self.assertRaises(RuntimeError):
+                create_job_store(tempfile.mkdtemp())
+        with patch.dict(os.environ, {'AWS_LAMBDA_FUNCTION_NAME': 'orchestrator'}, clear=True):
+            with self.assertRaises(RuntimeError):
+                create_job_store(tempfile.mkdtemp())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,460 @@
+import unittest
+from unittest.mock import patch, MagicMock
+import json
+import sys
+import os
+import shutil
+import tempfile
+from datetime import datetime, timedelta
+
+import numpy as np
+
+# Add the parent directory to the Python path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+# Add the lambda-functions directory to the path
+lambda_functions_path = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+    'lambda-functions'
+)
+sys.path.insert(0, lambda_functions_path)
+
+# Import the tagging agent module directly
+import tagging_agent
+from tagging_agent import (
+    ResourceInventory, CompiledTagPolicy, ComplianceEvaluation, FileSnapshotStore, TaggingComplianceAnalyzer
+)
+
+def mapping(arn, **tags):
+    return {'ResourceARN': arn, 'Tags': [{'Key': key, 'Value': value} for key, value in tags.items()]}
+
+class TestResourceInventory(unittest.TestCase):
+    """Test cases for the interned, CSR-layout resource inventory."""
+
+    def setUp(self):
+        """Two regions' pages over a shared set of tag strings."""
+        self.resource_types = ['ec2:instance', 's3:bucket', 'rds']
+        self.inventory = ResourceInventory()
+        self.inventory.add_page([
+            mapping('arn:aws:ec2:us-east-1:123456789012:instance/i-1', Environment='Production', Owner='alice'),
+            mapping('arn:aws:s3:::logs'),
+            mapping('arn:aws:rds:us-east-1:123456789012:db:orders', Owner='alice')
+        ], 'us-east-1', self.resource_types)
+        # Global resources such as S3 buckets come back from every region
+        self.inventory.add_page([
+            mapping('arn:aws:s3:::logs', Owner='bob'),
+            mapping('arn:aws:ec2:eu-west-1:123456789012:instance/i-2', Environment='Production')
+        ], 'eu-west-1', self.resource_types)
+
+    def test_tags_are_csr_slices_over_interned_strings(self):
+        """Offsets delimit each resource's tags and every repeated string is stored once."""
+        inventory = self.inventory
+
+        self.assertEqual(len(inventory), 4)
+        self.assertEqual(list(inventory.tag_offsets), [0, 2, 2, 3, 4])
+        self.assertEqual(len(inventory.strings), len(set(inventory.strings)))
+        self.assertEqual(inventory.tag_keys[0], inventory.tag_keys[3])
+        self.assertEqual(inventory.tag_values[1], inventory.tag_values[2])
+        self.assertEqual(inventory.tags(0), {'Environment': 'Production', 'Owner': 'alice'})
+        self.assertEqual(inventory.tags(1), {})
+        self.assertEqual(inventory.resource(3), {
+            'resource_arn': 'arn:aws:ec2:eu-west-1:123456789012:instance/i-2',
+            'resource_type': 'ec2:instance',
+            'region': 'eu-west-1',
+            'tags': {'Environment': 'Production'}
+        })
+
+    def test_duplicate_arns_keep_the_first_region(self):
+        """A resource listed by a second region is skipped, tags and all."""
+        index = self.inventory.arn_index['arn:aws:s3:::logs']
+
+        self.assertEqual(index, 1)
+        self.assertEqual(self.inventory.resource(index)['region'], 'us-east-1')
+        self.assertEqual(self.inventory.tags(index), {})
+        self.assertNotIn('bob', self.inventory.strings)
+
+    def test_resources_group_under_the_filter_that_selected_them(self):
+        """Typed filters match exactly; a service-wide filter groups every type of that service."""
+        self.assertEqual(ResourceInventory.match_type('arn:aws:s3:::logs', self.resource_types), 's3:bucket')
+        self.assertEqual(ResourceInventory.match_type('arn:aws:rds:us-east-1:1:db:orders', self.resource_types), 'rds')
+        self.assertEqual(ResourceInventory.match_type('arn:aws:rds:us-east-1:1:snapshot:s1', self.resource_types), 'rds')
+        self.assertEqual(
+            ResourceInventory.match_type('arn:aws:lambda:us-east-1:1:function:f', self.resource_types), 'lambda:function'
+        )
+
+    def test_with_updates_and_round_trip(self):
+        """Updated resources move to the end, dropped ones vanish, and the arrays survive to_dict/from_dict."""
+        updated = self.inventory.with_updates({
+            'arn:aws:ec2:us-east-1:123456789012:instance/i-1': {
+                'resource_arn': 'arn:aws:ec2:us-east-1:123456789012:instance/i-1',
+                'resource_type': 'ec2:instance',
+                'region': 'us-east-1',
+                'tags': {'Owner': 'carol'}
+            },
+            'arn:aws:s3:::logs': None
+        })
+
+        self.assertEqual(updated.arns, [
+            'arn:aws:rds:us-east-1:123456789012:db:orders',
+            'arn:aws:ec2:eu-west-1:123456789012:instance/i-2',
+            'arn:aws:ec2:us-east-1:123456789012:instance/i-1'
+        ])
+        self.assertEqual([updated.tags(i) for i in range(3)],
+                         [{'Owner': 'alice'}, {'Environment': 'Production'}, {'Owner': 'carol'}])
+        self.assertEqual(updated.arn_index['arn:aws:ec2:us-east-1:123456789012:instance/i-1'], 2)
+
+        restored = ResourceInventory.from_dict(json.loads(json.dumps(updated.to_dict())))
+        self.assertEqual(list(restored), list(updated))
+        self.assertEqual(restored.intern('carol'), updated.string_ids['carol'])
+
+class TestCompiledTagPolicy(unittest.TestCase):
+    """Test cases for the compiled policy and its boolean rule matrices."""
+
+    def setUp(self):
+        """A policy with an allowed-values rule, a pattern rule, an exemption and a type-only rule."""
+        self.policy = CompiledTagPolicy(
+            {
+                'Environment': {'allowed_values': ['Production', 'Test'], 'case_insensitive': True},
+                'Owner': {'pattern': r'[a-z]+'},
+            },
+            {
+                's3:bucket': {'exempt': ['Owner']},
+                'rds:db': {'required_tags': {'Backup': ['daily']}}
+            }
+        )
+        self.inventory = ResourceInventory.from_resources([
+            {'resource_arn': 'arn:aws:ec2:us-east-1:1:instance/i-1', 'resource_type': 'ec2:instance',
+             'tags': {'Environment': 'production', 'Owner': 'alice'}},
+            {'resource_arn': 'arn:aws:ec2:us-east-1:1:instance/i-2', 'resource_type': 'ec2:instance',
+             'tags': {'Environment': 'Dev', 'Owner': 'Bob'}},
+            {'resource_arn': 'arn:aws:s3:::logs', 'resource_type': 's3:bucket', 'tags': {}},
+            {'resource_arn': 'arn:aws:rds:us-east-1:1:db:orders', 'resource_type': 'rds:db',
+             'tags': {'Environment': 'Test', 'Owner': 'carol', 'Backup': 'weekly'}}
+        ])
+
+    def test_evaluate_builds_rule_by_resource_matrices(self):
+        """Missing, invalid and applicable bits follow values, patterns, exemptions and type-only rules."""
+        evaluation = self.policy.evaluate(self.inventory)
+
+        self.assertEqual(self.policy.keys, ['Environment', 'Owner', 'Backup'])
+        np.testing.assert_array_equal(evaluation.applies, [
+            [True, True, True, True],
+            [True, True, False, True],
+            [False, False, False, True]
+        ])
+        np.testing.assert_array_equal(evaluation.missing, [
+            [False, False, True, False],
+            [False, False, False, False],
+            [False, False, False, False]
+        ])
+        np.testing.assert_array_equal(evaluation.invalid, [
+            [False, True, False, False],
+            [False, True, False, False],
+            [False, False, False, True]
+        ])
+
+        summary = evaluation.summary()
+        self.assertEqual(summary['compliant_resources'], 1)
+        self.assertEqual(summary['non_compliant_resources'], 1)
+        self.assertEqual(summary['partially_compliant_resources'], 2)
+        self.assertEqual(summary['compliance_by_resource_type']['s3:bucket'], {'total': 1, 'compliant': 0})
+        self.assertEqual([detail['resource_arn'] for detail in summary['missing_tags_detail']], self.inventory.arns[1:])
+        self.assertEqual(summary['missing_tags_detail'][2]['invalid_tags'],
+                         [{'tag': 'Backup', 'value': 'weekly', 'allowed_values': ['daily']}])
+
+    def test_packed_matrices_round_trip(self):
+        """Bit-packed snapshot matrices unpack to the same booleans, including a partial last byte."""
+        rng = np.random.default_rng(3)
+        evaluation = self.policy.evaluate(self.inventory)
+        evaluation.missing = rng.random((3, 13)) < 0.5
+        evaluation.invalid = rng.random((3, 13)) < 0.5
+        evaluation.applies = rng.random((3, 13)) < 0.5
+
+        unpacked = ComplianceEvaluation.unpack_matrices(json.loads(json.dumps(evaluation.matrices())), 3, 13)
+        for name in ('missing', 'invalid', 'applies'):
+            np.testing.assert_array_equal(unpacked[name], getattr(evaluation, name))
+
+    def test_empty_inventory(self):
+        """An empty inventory evaluates to empty matrices and a zero summary."""
+        summary = self.policy.evaluate(ResourceInventory()).summary()
+
+        self.assertEqual(summary['total_resources'], 0)
+        self.assertEqual(summary['compliance_percentage'], 0)
+        self.assertEqual(summary['missing_tags_detail'], [])
+
+class TestIncrementalCompliance(unittest.TestCase):
+    """Test cases for snapshot-based incremental compliance."""
+
+    def setUp(self):
+        """An analyzer with mocked clients and a snapshot file in a temporary directory."""
+        patcher = patch('tagging_agent.boto3.client')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        snapshot_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, snapshot_dir)
+
+        self.analyzer = TaggingComplianceAnalyzer()
+        self.analyzer.snapshot_store = FileSnapshotStore(os.path.join(snapshot_dir, 'snapshot.json.gz'))
+        self.resources = [
+            self.resource(f'i-{n}', Environment='Production' if n % 3 else 'Prod', Owner='team',
+                          Project='p', CostCenter='cc', Application='app')
+            for n in range(8)
+        ]
+        self.resources[5]['tags'] = {}
+
+    @staticmethod
+    def resource(instance_id, **tags):
+        return {
+            'resource_arn': f'arn:aws:ec2:us-east-1:123456789012:instance/{instance_id}',
+            'resource_type': 'ec2:instance',
+            'region': 'us-east-1',
+            'tags': tags
+        }
+
+    def run_mode(self, mode, resources):
+        """Run incremental compliance with the estate scan returning the given resources."""
+        with patch.object(self.analyzer, 'get_all_resources', return_value=ResourceInventory.from_resources(resources)):
+            return self.analyzer.incremental_compliance(mode)
+
+    def assert_matches_full_evaluation(self, summary, resources):
+        """The spliced result equals evaluating the current inventory from scratch."""
+        inventory = self.analyzer.last_evaluation.inventory
+        self.assertEqual(sorted(inventory.arns), sorted(resource['resource_arn'] for resource in resources))
+        full = CompiledTagPolicy(self.analyzer.required_tags).evaluate(inventory)
+        for name in ('missing', 'invalid', 'applies'):
+            np.testing.assert_array_equal(getattr(self.analyzer.last_evaluation, name), getattr(full, name))
+
+        expected = full.summary()
+        self.assertEqual({key: summary[key] for key in expected}, expected)
+        snapshot = self.analyzer.snapshot_store.load()
+        np.testing.assert_array_equal(tagging_agent.decode_array(snapshot['hashes'], np.uint64), inventory.tag_hashes())
+
+    def test_tag_hashes_ignore_tag_order_and_intern_ids(self):
+        """Equal tag sets hash equally across inventories; swapping a key's value changes the hash."""
+        first = ResourceInventory.from_resources([self.resource('i-1', A='1', B='2'), self.resource('i-2')])
+        second = ResourceInventory.from_resources([self.resource('i-3', Z='9', B='2', A='1')])
+        second.add_resources([self.resource('i-4', B='2', A='1'), self.resource('i-5', A='2', B='1')])
+
+        hashes = second.tag_hashes()
+        self.assertEqual(hashes[1], first.tag_hashes()[0])
+        self.assertNotEqual(hashes[2], hashes[1])
+        self.assertNotEqual(hashes[0], hashes[1])
+
+    def test_diff_mode_reevaluates_only_changed_resources(self):
+        """Changed, added and removed resources are spliced into the stored matrices."""
+        first = self.run_mode('diff', self.resources)
+        self.assertEqual(first['changes'], {'mode': 'full', 'reevaluated_resources': 8, 'added_resources': 8,
+                                            'removed_resources': 0})
+
+        resources = [dict(resource) for resource in self.resources if resource['resource_arn'][-2:] != '-2']
+        resources[0]['tags'] = {'Environment': 'Test'}
+        resources[4]['tags'] = dict(self.resources[0]['tags'])
+        resources.insert(2, self.resource('i-9', Environment='Staging'))
+        second = self.run_mode('diff', resources)
+
+        self.assertEqual(second['changes'], {'mode': 'diff', 'reevaluated_resources': 3, 'added_resources': 1,
+                                             'removed_resources': 1})
+        self.assert_matches_full_evaluation(second, resources)
+        self.assertEqual([point['total_resources'] for point in second['compliance_trend']], [8, 8])
+
+    @patch('tagging_agent.TaggingComplianceAnalyzer.get_tag_change_arns')
+    def test_cloudtrail_mode_refreshes_named_resources(self, mock_change_arns):
+        """Resources named in tag-change events are refreshed or dropped; the rest keep their snapshot state."""
+        self.run_mode('diff', self.resources)
+
+        arn = lambda n: f'arn:aws:ec2:us-east-1:123456789012:instance/i-{n}'
+        changed = self.resource('i-1', Environment='Development', Owner='team', Project='p', CostCenter='cc',
+                                Application='app')
+        added = self.resource('i-9', Owner='team')
+        mock_change_arns.return_value = {arn(1), arn(4), arn(9)}
+        with patch.object(self.analyzer, 'get_resources_by_arn',
+                          return_value={arn(1): changed, arn(4): None, arn(9): added}):
+            summary = self.analyzer.incremental_compliance('cloudtrail')
+
+        self.assertEqual(summary['changes'], {'mode': 'cloudtrail', 'reevaluated_resources': 2, 'added_resources': 1,
+                                              'removed_resources': 1})
+        inventory = self.analyzer.last_evaluation.inventory
+        self.assertEqual(inventory.arns[-2:], [arn(1), arn(9)])
+        expected = [resource for resource in self.resources if resource['resource_arn'] not in (arn(1), arn(4))]
+        self.assert_matches_full_evaluation(summary, expected + [changed, added])
+
+    @patch('tagging_agent.TaggingComplianceAnalyzer.get_tag_change_arns', return_value=set())
+    def test_cloudtrail_mode_overlaps_delivery_and_rescans_when_stale(self, mock_change_arns):
+        """Events are read from before the snapshot, and an old estate scan is redone as in diff mode."""
+        self.run_mode('diff', self.resources)
+        snapshot = self.analyzer.snapshot_store.load()
+        scanned_at = snapshot['scanned_at']
+
+        summary = self.run_mode('cloudtrail', self.resources[1:])
+        self.assertEqual(summary['changes']['mode'], 'cloudtrail')
+        self.assertEqual(summary['total_resources'], 8)
+        since = mock_change_arns.call_args[0][0]
+        self.assertEqual(datetime.fromisoformat(snapshot['taken_at']) - since,
+                         timedelta(minutes=tagging_agent.CLOUDTRAIL_OVERLAP_MINUTES))
+        self.assertEqual(self.analyzer.snapshot_store.load()['scanned_at'], scanned_at)
+
+        # The deleted instance raised no tag event; once the scan is stale it is found by a rescan
+        snapshot = self.analyzer.snapshot_store.load()
+        snapshot['scanned_at'] = (datetime.utcnow() - timedelta(
+            hours=tagging_agent.CLOUDTRAIL_MAX_SCAN_AGE_HOURS, minutes=1)).isoformat()
+        self.analyzer.snapshot_store.save(snapshot)
+        summary = self.run_mode('cloudtrail', self.resources[1:])
+
+        self.assertEqual(mock_change_arns.call_count, 1)
+        self.assertEqual(summary['changes'], {'mode': 'diff', 'reevaluated_resources': 0, 'added_resources': 0,
+                                              'removed_resources': 1})
+        self.assertGreater(self.analyzer.snapshot_store.load()['scanned_at'], scanned_at)
+
+    def test_policy_change_forces_a_full_evaluation(self):
+        """A snapshot taken under another policy is not reused."""
+        self.run_mode('diff', self.resources)
+        self.analyzer.required_tags = {'Owner': None}
+
+        summary = self.run_mode('diff', self.resources)
+
+        self.assertEqual(summary['changes']['mode'], 'full')
+        self.assertEqual(summary['changes']['reevaluated_resources'], 8)
+        self.assertEqual(len(summary['compliance_trend']), 1)
+
+    def test_event_resource_arns(self):
+        """ARNs pass through; S3 bucket names and EC2 instance ids resolve with the event's account and region."""
+        event = {
+            'CloudTrailEvent': json.dumps({'recipientAccountId': '123456789012', 'awsRegion': 'eu-west-1'}),
+            'Resources': [
+                {'ResourceType': 'AWS::RDS::DBInstance', 'ResourceName': 'arn:aws:rds:eu-west-1:123456789012:db:orders'},
+                {'ResourceType': 'AWS::S3::Bucket', 'ResourceName': 'logs'},
+                {'ResourceType': 'AWS::EC2::Instance', 'ResourceName': 'i-0abc'},
+                {'ResourceName': 'i-0def'},
+                {'ResourceType': 'AWS::EC2::SecurityGroup', 'ResourceName': 'sg-1'}
+            ]
+        }
+
+        self.assertEqual(TaggingComplianceAnalyzer.event_resource_arns(event, 'us-east-1'), [
+            'arn:aws:rds:eu-west-1:123456789012:db:orders',
+            'arn:aws:s3:::logs',
+            'arn:aws:ec2:eu-west-1:123456789012:instance/i-0abc',
+            'arn:aws:ec2:eu-west-1:123456789012:instance/i-0def'
+        ])
+        self.assertEqual(
+            TaggingComplianceAnalyzer.event_resource_arns({'Resources': [{'ResourceName': 'i-1'}]}, 'us-east-1'),
+            ['arn:aws:ec2:us-east-1::instance/i-1']
+        )
+
+class TestUntaggedCosts(unittest.TestCase):
+    """Test cases for untagged cost attribution from grouped Cost Explorer queries."""
+
+    # Spend per resource and the required tags it carries
+    SPEND = [
+        (100.0, {'Environment': 'Production', 'Owner': 'alice', 'Project': 'web'}),
+        (10.0, {'Owner': 'bob', 'Project': 'web'}),
+        (20.0, {'Environment': 'Test'}),
+        (5.0, {})
+    ]
+
+    def setUp(self):
+        """An analyzer requiring three tags, with a Cost Explorer mock answering from SPEND."""
+        patcher = patch('tagging_agent.boto3.client')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        tagging_agent._untagged_cost_cache.clear()
+        self.addCleanup(tagging_agent._untagged_cost_cache.clear)
+
+        self.analyzer = TaggingComplianceAnalyzer()
+        self.analyzer.required_tags = {'Environment': ['Production', 'Test'], 'Owner': None, 'Project': None}
+        self.analyzer.ce_client = MagicMock()
+        self.analyzer.ce_client.get_cost_and_usage.side_effect = self.get_cost_and_usage
+
+    def get_cost_and_usage(self, **request):
+        if 'Filter' in request:
+            # Only the union query filters, to spend carrying every required tag
+            required = [condition['Not']['Tags']['Key'] for condition in request['Filter']['And']]
+            cost = sum(amount for amount, tags in self.SPEND if all(key in tags for key in required))
+            return {'ResultsByTime': [{'Total': {'UnblendedCost': {'Amount': str(cost)}}, 'Groups': []}]}
+
+        keys = [group['Key'] for group in request['GroupBy']]
+        groups = [
+            {'Keys': [f"{key}${tags.get(key, '')}" for key in keys], 'Metrics': {'UnblendedCost': {'Amount': str(amount)}}}
+            for amount, tags in self.SPEND
+        ]
+        # The first pair's groups come back over two pages
+        if keys == ['Environment', 'Owner'] and 'NextPageToken' not in request:
+            return {'ResultsByTime': [{'Groups': groups[:2]}], 'NextPageToken': 'page-2'}
+        if 'NextPageToken' in request:
+            groups = groups[2:]
+        return {'ResultsByTime': [{'Groups': groups}]}
+
+    def test_two_tags_per_query_and_exact_union(self):
+        """Tags are grouped in pairs, and the union counts spend missing several tags once."""
+        costs = self.analyzer.get_untagged_resource_costs(30)
+
+        group_bys = [call.kwargs.get('GroupBy') for call in self.analyzer.ce_client.get_cost_and_usage.call_args_list]
+        self.assertEqual(group_bys, [
+            [{'Type': 'TAG', 'Key': 'Environment'}, {'Type': 'TAG', 'Key': 'Owner'}],
+            [{'Type': 'TAG', 'Key': 'Environment'}, {'Type': 'TAG', 'Key': 'Owner'}],
+            [{'Type': 'TAG', 'Key': 'Project'}],
+            None
+        ])
+        self.assertEqual(costs['cost_explorer_queries'], 3)
+        self.assertEqual({tag: data['untagged_cost'] for tag, data in costs['costs_by_missing_tag'].items()},
+                         {'Environment': 15.0, 'Owner': 25.0, 'Project': 25.0})
+        self.assertEqual(costs['total_cost'], 135.0)
+        self.assertEqual(costs['fully_tagged_cost'], 100.0)
+        self.assertEqual(costs['total_untagged_cost'], 35.0)
+        self.assertTrue(costs['untagged_union_exact'])
+
+        # A warm invocation answers from the cache
+        self.assertEqual(self.analyzer.get_untagged_resource_costs(30), costs)
+        self.assertEqual(self.analyzer.ce_client.get_cost_and_usage.call_count, 4)
+
+    def test_failed_union_query_falls_back_to_a_lower_bound(self):
+        """Without the union query the largest single-tag gap is reported, flagged as inexact."""
+        answer = self.get_cost_and_usage
+
+        def get_cost_and_usage(**request):
+            if 'Filter' in request:
+                raise Exception('Throttled')
+            return answer(**request)
+
+        self.analyzer.ce_client.get_cost_and_usage.side_effect = get_cost_and_usage
+        costs = self.analyzer.get_untagged_resource_costs(30)
+
+        self.assertEqual(costs['total_untagged_cost'], 25.0)
+        self.assertFalse(costs['untagged_union_exact'])
+        self.assertEqual(costs['failed_queries'], 1)
+
+        # The degraded result is not cached, so the next invocation queries again
+        self.assertEqual(tagging_agent._untagged_cost_cache, {})
+        self.analyzer.get_untagged_resource_costs(30)
+        self.assertEqual(self.analyzer.ce_client.get_cost_and_usage.call_count, 8)
+
+    def test_failed_pair_queries_are_not_cached(self):
+        """When every query fails the zero totals are returned once and never reused."""
+        self.analyzer.ce_client.get_cost_and_usage.side_effect = Exception('Throttled')
+        costs = self.analyzer.get_untagged_resource_costs(30)
+
+        self.assertEqual(costs['total_untagged_cost'], 0)
+        self.assertEqual(costs['failed_queries'], 2)
+        self.assertEqual(costs['costs_by_missing_tag']['Owner'], {'error': 'Throttled'})
+        self.assertEqual(tagging_agent._untagged_cost_cache, {})
+
+    def test_cost_groups_stop_on_repeated_token_and_page_cap(self):
+        """A repeated page token or COST_QUERY_MAX_PAGES ends the read with what was summed so far."""
+        time_period = {'Start': '2024-01-01', 'End': '2024-02-01'}
+        page = {'ResultsByTime': [{'Total': {'UnblendedCost': {'Amount': '1.5'}}}], 'NextPageToken': 'same'}
+        self.analyzer.ce_client.get_cost_and_usage.side_effect = None
+        self.analyzer.ce_client.get_cost_and_usage.return_value = page
+
+        self.assertEqual(self.analyzer.get_cost_groups(time_period, []), {(): 3.0})
+        self.assertEqual(self.analyzer.ce_client.get_cost_and_usage.call_count, 2)
+
+        self.analyzer.ce_client.get_cost_and_usage.reset_mock()
+        self.analyzer.ce_client.get_cost_and_usage.side_effect = (
+            dict(page, NextPageToken=str(n)) for n in range(tagging_agent.COST_QUERY_MAX_PAGES + 1)
+        )
+        groups = self.analyzer.get_cost_groups(time_period, [])
+
+        self.assertEqual(self.analyzer.ce_client.get_cost_and_usage.call_count, tagging_agent.COST_QUERY_MAX_PAGES)
+        self.assertEqual(groups, {(): 1.5 * tagging_agent.COST_QUERY_MAX_PAGES})
+
+if __name__ == '__main__':
+    unittest.main()
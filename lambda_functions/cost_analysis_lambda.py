@@ -1,13 +1,50 @@
 import json
+import os
+import time
+import hashlib
 import boto3
 from datetime import datetime, timedelta
+from state_store import (
+    create_store, create_job_store, page_result, next_result_page, parse_page_size, InvalidRequest, JobRunner
+)
 
 ce_client = boto3.client('ce')
 cloudwatch = boto3.client('cloudwatch')
+lambda_client = boto3.client('lambda')
+
+# Cost Explorer responses are memoized per container so that the three
+# endpoints a Bedrock conversation usually hits back-to-back share one query.
+CACHE_TTL_SECONDS = int(os.environ.get('CE_CACHE_TTL_SECONDS', '900'))
+CACHE_WINDOW_DAYS = int(os.environ.get('CE_CACHE_WINDOW_DAYS', '30'))
+CACHE_MAX_ENTRIES = 64
+
+_ce_memo = {}
+
+
+def create_cache_store():
+    backend = os.environ.get('CE_CACHE_BACKEND', 'memory')
+    if backend == 'memory':
+        return None
+    return create_store(
+        backend,
+        os.environ.get('CE_CACHE_TABLE'),
+        os.environ.get('CE_CACHE_PATH', '/tmp/finops-ce-cache')
+    )
+
+cache_store = create_cache_store()
+
+# Workers hand a job to a fresh invocation once less time than this remains
+JOB_MIN_REMAINING_MS = 15000
+
+job_store = create_job_store()
 
 def lambda_handler(event, context):
     print(f"Received event: {json.dumps(event)}")
     
+    # Self-invocation that advances a background job
+    if 'job_worker' in event:
+        return job_runner.run(event['job_worker'], context)
+    
     # Parse parameters
     action_group = event.get('actionGroup', '')
     api_path = event.get('apiPath', '')
@@ -20,87 +57,170 @@ def lambda_handler(event, context):
         params[param.get('name', '')] = param.get('value', '')
     
     try:
-        if 'get_cost_breakdown' in api_path:
+        # Reject malformed paging parameters before any work is done
+        parse_page_size(params)
+        if params.get('next_token'):
+            result = next_result_page(job_store, params)
+        elif 'get_cost_breakdown' in api_path:
             result = get_cost_breakdown(params)
         elif 'analyze_cost_trends' in api_path:
             result = analyze_cost_trends(params)
         elif 'identify_cost_anomalies' in api_path:
             result = identify_cost_anomalies(params)
+        elif 'submit_analysis_job' in api_path:
+            result = job_runner.submit(params, context)
+        elif 'get_job_status' in api_path:
+            result = job_runner.status(params)
         else:
             result = {'error': f'Unknown path: {api_path}'}
         
-        return {
-            'messageVersion': '1.0',
-            'response': {
-                'actionGroup': action_group,
-                'apiPath': api_path,
-                'httpMethod': http_method,
-                'httpStatusCode': 200,
-                'responseBody': {
-                    'application/json': {
-                        'body': json.dumps(result)
-                    }
-                }
-            }
-        }
+        status_code = 200
+    except InvalidRequest as e:
+        result = {'error': str(e)}
+        status_code = 400
     except Exception as e:
         print(f"Error: {str(e)}")
-        return {
-            'messageVersion': '1.0',
-            'response': {
-                'actionGroup': action_group,
-                'apiPath': api_path,
-                'httpMethod': http_method,
-                'httpStatusCode': 500,
-                'responseBody': {
-                    'application/json': {
-                        'body': json.dumps({'error': str(e)})
-                    }
+        result = {'error': str(e)}
+        status_code = 500
+    
+    return {
+        'messageVersion': '1.0',
+        'response': {
+            'actionGroup': action_group,
+            'apiPath': api_path,
+            'httpMethod': http_method,
+            'httpStatusCode': status_code,
+            'responseBody': {
+                'application/json': {
+                    'body': json.dumps(result)
                 }
             }
         }
+    }
+
+def make_cache_key(start_date, end_date, granularity, metrics, query_filter=None, group_by=None):
+    raw = json.dumps(
+        [start_date, end_date, granularity, metrics, query_filter, group_by],
+        sort_keys=True
+    )
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+def remember(key, results):
+    now = time.time()
+    if len(_ce_memo) >= CACHE_MAX_ENTRIES:
+        for stale_key in [k for k, (expires_at, _) in _ce_memo.items() if expires_at < now]:
+            del _ce_memo[stale_key]
+    if len(_ce_memo) >= CACHE_MAX_ENTRIES:
+        oldest_key = min(_ce_memo, key=lambda k: _ce_memo[k][0])
+        del _ce_memo[oldest_key]
+    _ce_memo[key] = (now + CACHE_TTL_SECONDS, results)
+
+def fetch_cost_and_usage(query_params):
+    # Grouped queries are paged by group, each page repeating the time periods
+    results_by_start = {}
+    next_token = None
+    while True:
+        if next_token:
+            query_params['NextPageToken'] = next_token
+        response = ce_client.get_cost_and_usage(**query_params)
+        for result in response['ResultsByTime']:
+            start = result['TimePeriod']['Start']
+            if start in results_by_start:
+                results_by_start[start]['Groups'].extend(result.get('Groups', []))
+            else:
+                results_by_start[start] = {
+                    'TimePeriod': result['TimePeriod'],
+                    'Total': result.get('Total', {}),
+                    'Groups': list(result.get('Groups', []))
+                }
+        next_token = response.get('NextPageToken')
+        if not next_token:
+            break
+    return [results_by_start[start] for start in sorted(results_by_start)]
+
+def cached_cost_and_usage(start_date, end_date, granularity, metrics, query_filter=None, group_by=None):
+    key = make_cache_key(start_date, end_date, granularity, metrics, query_filter, group_by)
+    
+    entry = _ce_memo.get(key)
+    if entry and entry[0] >= time.time():
+        return entry[1]
+    
+    if cache_store:
+        try:
+            results = cache_store.get(key)
+            if results is not None:
+                remember(key, results)
+                return results
+        except Exception as e:
+            print(f"Cache read failed: {str(e)}")
+    
+    query_params = {
+        'TimePeriod': {'Start': start_date, 'End': end_date},
+        'Granularity': granularity,
+        'Metrics': metrics
+    }
+    if query_filter:
+        query_params['Filter'] = query_filter
+    if group_by:
+        query_params['GroupBy'] = group_by
+    
+    results = fetch_cost_and_usage(query_params)
+    remember(key, results)
+    
+    if cache_store:
+        try:
+            cache_store.put(key, results, CACHE_TTL_SECONDS)
+        except Exception as e:
+            print(f"Cache write failed: {str(e)}")
+    
+    return results
+
+def get_daily_service_costs(days):
+    # Every endpoint reads the same per-service daily cube; short windows are
+    # sliced from a CACHE_WINDOW_DAYS fetch so they hit the same cache key.
+    end_date = datetime.now().date()
+    start_date = end_date - timedelta(days=max(days, CACHE_WINDOW_DAYS))
+    
+    results = cached_cost_and_usage(
+        start_date.strftime('%Y-%m-%d'),
+        end_date.strftime('%Y-%m-%d'),
+        'DAILY',
+        ['UnblendedCost'],
+        group_by=[{'Type': 'DIMENSION', 'Key': 'SERVICE'}]
+    )
+    
+    daily_costs = []
+    for result in results:
+        costs = {}
+        for group in result['Groups']:
+            service = group['Keys'][0]
+            costs[service] = costs.get(service, 0) + float(group['Metrics']['UnblendedCost']['Amount'])
+        daily_costs.append((result['TimePeriod']['Start'], costs))
+    
+    return daily_costs[-days:] if days > 0 else []
 
 def get_cost_breakdown(params):
     days = int(params.get('days', '7'))
-    end_date = datetime.now().date()
-    start_date = end_date - timedelta(days=days)
     
     try:
-        response = ce_client.get_cost_and_usage(
-            TimePeriod={
-                'Start': start_date.strftime('%Y-%m-%d'),
-                'End': end_date.strftime('%Y-%m-%d')
-            },
-            Granularity='DAILY',
-            Metrics=['UnblendedCost'],
-            GroupBy=[
-                {
-                    'Type': 'DIMENSION',
-                    'Key': 'SERVICE'
-                }
-            ]
-        )
-        
         cost_by_service = {}
-        for result in response['ResultsByTime']:
-            for group in result['Groups']:
-                service = group['Keys'][0]
-                cost = float(group['Metrics']['UnblendedCost']['Amount'])
+        for date, costs in get_daily_service_costs(days):
+            for service, cost in costs.items():
                 if service not in cost_by_service:
                     cost_by_service[service] = 0
                 cost_by_service[service] += cost
         
         sorted_costs = sorted(
             cost_by_service.items(), 
-            key=lambda x: x[1], 
-            reverse=True
+            key=lambda x: (-x[1], x[0])
         )
         
-        return {
+        return page_result(job_store, {
             'period': f'{days} days',
             'total_cost': round(sum(cost_by_service.values()), 2),
-            'cost_by_service': {k: round(v, 2) for k, v in sorted_costs[:10]}
-        }
+            'service_count': len(sorted_costs),
+            'cost_by_service': {k: round(v, 2) for k, v in sorted_costs}
+        }, 'cost_by_service', params)
     except Exception as e:
         return {'error': f'Failed to get cost breakdown: {str(e)}'}
 
@@ -108,33 +228,10 @@ def analyze_cost_trends(params):
     days = int(params.get('days', '30'))
     service = params.get('service', '')
     
-    end_date = datetime.now().date()
-    start_date = end_date - timedelta(days=days)
-    
     try:
-        query_params = {
-            'TimePeriod': {
-                'Start': start_date.strftime('%Y-%m-%d'),
-                'End': end_date.strftime('%Y-%m-%d')
-            },
-            'Granularity': 'DAILY',
-            'Metrics': ['UnblendedCost']
-        }
-        
-        if service:
-            query_params['Filter'] = {
-                'Dimensions': {
-                    'Key': 'SERVICE',
-                    'Values': [service]
-                }
-            }
-        
-        response = ce_client.get_cost_and_usage(**query_params)
-        
         daily_costs = []
-        for result in response['ResultsByTime']:
-            date = result['TimePeriod']['Start']
-            cost = float(result['Total']['UnblendedCost']['Amount'])
+        for date, costs in get_daily_service_costs(days):
+            cost = costs.get(service, 0) if service else sum(costs.values())
             daily_costs.append({
                 'date': date,
                 'cost': round(cost, 2)
@@ -167,46 +264,39 @@ def analyze_cost_trends(params):
 def identify_cost_anomalies(params):
     threshold = float(params.get('threshold', '20'))
     
-    end_date = datetime.now().date()
-    start_date = end_date - timedelta(days=30)
-    
     try:
-        response = ce_client.get_cost_and_usage(
-            TimePeriod={
-                'Start': start_date.strftime('%Y-%m-%d'),
-                'End': end_date.strftime('%Y-%m-%d')
-            },
-            Granularity='DAILY',
-            Metrics=['UnblendedCost']
-        )
-        
-        daily_costs = []
-        for result in response['ResultsByTime']:
-            cost = float(result['Total']['UnblendedCost']['Amount'])
-            daily_costs.append(cost)
+        daily_costs = [(date, sum(costs.values())) for date, costs in get_daily_service_costs(30)]
         
         if not daily_costs:
             return {'anomalies_found': 0, 'anomalies': []}
         
-        avg_cost = sum(daily_costs) / len(daily_costs)
+        avg_cost = sum(cost for _, cost in daily_costs) / len(daily_costs)
         
         anomalies = []
-        for i, cost in enumerate(daily_costs):
+        for date, cost in daily_costs:
             if avg_cost > 0:
                 deviation = ((cost - avg_cost) / avg_cost) * 100
                 if abs(deviation) > threshold:
                     anomalies.append({
-                        'date': (start_date + timedelta(days=i)).strftime('%Y-%m-%d'),
+                        'date': date,
                         'cost': round(cost, 2),
                         'deviation_percentage': round(deviation, 2),
                         'type': 'spike' if deviation > 0 else 'drop'
                     })
         
-        return {
+        return page_result(job_store, {
             'anomalies_found': len(anomalies),
             'threshold_used': threshold,
             'average_daily_cost': round(avg_cost, 2),
-            'anomalies': anomalies[:10]
-        }
+            'anomalies': anomalies
+        }, 'anomalies', params)
     except Exception as e:
         return {'error': f'Failed to identify anomalies: {str(e)}'}
+
+JOB_STAGES = [
+    ('cost_breakdown', get_cost_breakdown),
+    ('cost_trends', analyze_cost_trends),
+    ('cost_anomalies', identify_cost_anomalies)
+]
+
+job_runner = JobRunner(job_store, JOB_STAGES, JOB_MIN_REMAINING_MS, lambda_client)
@@ -1,10 +1,27 @@
 import json
 import boto3
+import hashlib
+import numpy as np
 from datetime import datetime, timedelta
-import statistics
+from state_store import InvalidRequest
 
 ce_client = boto3.client('ce')
 
+SEASON_LENGTH = 7
+Z_95 = 1.96
+# Every series is fitted with every grid combination in one lockstep pass over the stacked batch
+SMOOTHING_GRID = np.array([
+    (alpha, beta, gamma)
+    for alpha in (0.2, 0.5, 0.8)
+    for beta in (0.05, 0.2)
+    for gamma in (0.1, 0.3)
+])
+FIT_CACHE_MAX_ENTRIES = 2000
+
+# (service, end date, history days, series digest) -> fitted model, reused across warm invocations;
+# the digest refits a service whose recent costs were restated
+_fit_cache = {}
+
 def lambda_handler(event, context):
     print(f"Received event: {json.dumps(event)}")
     
@@ -25,94 +42,232 @@ def lambda_handler(event, context):
         else:
             result = {'error': f'Unknown path: {api_path}'}
         
-        return {
-            'messageVersion': '1.0',
-            'response': {
-                'actionGroup': action_group,
-                'apiPath': api_path,
-                'httpMethod': http_method,
-                'httpStatusCode': 200,
-                'responseBody': {
-                    'application/json': {
-                        'body': json.dumps(result)
-                    }
-                }
-            }
-        }
+        status_code = 200
+    except InvalidRequest as e:
+        result = {'error': str(e)}
+        status_code = 400
     except Exception as e:
         print(f"Error: {str(e)}")
-        return {
-            'messageVersion': '1.0',
-            'response': {
-                'actionGroup': action_group,
-                'apiPath': api_path,
-                'httpMethod': http_method,
-                'httpStatusCode': 500,
-                'responseBody': {
-                    'application/json': {
-                        'body': json.dumps({'error': str(e)})
-                    }
+        result = {'error': str(e)}
+        status_code = 500
+    
+    return {
+        'messageVersion': '1.0',
+        'response': {
+            'actionGroup': action_group,
+            'apiPath': api_path,
+            'httpMethod': http_method,
+            'httpStatusCode': status_code,
+            'responseBody': {
+                'application/json': {
+                    'body': json.dumps(result)
                 }
             }
         }
+    }
 
-def forecast_costs(params):
-    months_to_forecast = int(params.get('months', '3'))
-    
+def get_daily_service_matrix(history_days):
     end_date = datetime.now().date()
-    start_date = end_date - timedelta(days=180)
+    start_date = end_date - timedelta(days=history_days)
+    
+    query_params = {
+        'TimePeriod': {
+            'Start': start_date.strftime('%Y-%m-%d'),
+            'End': end_date.strftime('%Y-%m-%d')
+        },
+        'Granularity': 'DAILY',
+        'Metrics': ['UnblendedCost'],
+        'GroupBy': [{'Type': 'DIMENSION', 'Key': 'SERVICE'}]
+    }
+    
+    dates = []
+    day_index = {}
+    service_costs = {}
+    while True:
+        response = ce_client.get_cost_and_usage(**query_params)
+        for result in response['ResultsByTime']:
+            date = result['TimePeriod']['Start']
+            if date not in day_index:
+                day_index[date] = len(dates)
+                dates.append(date)
+            for group in result['Groups']:
+                svc = group['Keys'][0]
+                cost = float(group['Metrics']['UnblendedCost']['Amount'])
+                service_costs.setdefault(svc, {})
+                service_costs[svc][date] = service_costs[svc].get(date, 0) + cost
+        if not response.get('NextPageToken'):
+            break
+        query_params['NextPageToken'] = response['NextPageToken']
+    
+    dates.sort()
+    services = sorted(service_costs)
+    series = [[service_costs[svc].get(date, 0.0) for date in dates] for svc in services]
+    return end_date, dates, services, series
+
+def smooth_batch(series, alphas, betas, gammas):
+    # Additive Holt-Winters over every row of a (series, days) array at once; each row has its own parameters
+    m = SEASON_LENGTH
+    levels = series[:, :m].mean(axis=1)
+    trends = (series[:, m:2 * m].sum(axis=1) - series[:, :m].sum(axis=1)) / (m * m)
+    seasons = series[:, :m] - levels[:, None]
+    sse = np.zeros(len(series))
+    
+    for t in range(m, series.shape[1]):
+        idx = t % m
+        y = series[:, t]
+        season = seasons[:, idx]
+        error = y - (levels + trends + season)
+        sse += error * error
+        new_levels = alphas * (y - season) + (1 - alphas) * (levels + trends)
+        trends = betas * (new_levels - levels) + (1 - betas) * trends
+        seasons[:, idx] = gammas * (y - new_levels) + (1 - gammas) * season
+        levels = new_levels
+    
+    return levels, trends, seasons, sse
+
+def fit_series_batch(services, series, end_date):
+    """Fit Holt-Winters to every series, grid-searching and smoothing only those without a cached model"""
+    series = np.asarray(series, dtype=np.float64)
+    count, history_days = series.shape
+    keys = [
+        (svc, end_date.isoformat(), history_days, hashlib.sha1(series[k].tobytes()).hexdigest())
+        for k, svc in enumerate(services)
+    ]
+    fits = [_fit_cache.get(key) for key in keys]
+    
+    uncached = [k for k in range(count) if fits[k] is None]
+    if uncached:
+        subset = series[uncached]
+        width = len(uncached)
+        
+        # Rows are grid-major: row g * width + i is series i under grid combination g
+        grid = np.repeat(SMOOTHING_GRID, width, axis=0)
+        _, _, _, sse = smooth_batch(np.tile(subset, (len(SMOOTHING_GRID), 1)), grid[:, 0], grid[:, 1], grid[:, 2])
+        best = SMOOTHING_GRID[np.argmin(sse.reshape(len(SMOOTHING_GRID), width), axis=0)]
+        levels, trends, seasons, sse = smooth_batch(subset, best[:, 0], best[:, 1], best[:, 2])
+        
+        if len(_fit_cache) + width > FIT_CACHE_MAX_ENTRIES:
+            _fit_cache.clear()
+        residual_points = max(history_days - SEASON_LENGTH, 1)
+        for pos, k in enumerate(uncached):
+            fits[k] = {
+                'level': float(levels[pos]),
+                'trend': float(trends[pos]),
+                'seasons': seasons[pos].tolist(),
+                'params': tuple(float(p) for p in best[pos]),
+                'sigma': float(np.sqrt(sse[pos] / residual_points))
+            }
+            _fit_cache[keys[k]] = fits[k]
     
+    return fits
+
+def forecast_fit(fit, history_days, horizon):
+    """Daily point forecasts for h = 1..horizon and the innovation weights psi_0..psi_{horizon-1}"""
+    alpha, beta, gamma = fit['params']
+    h = np.arange(1, horizon + 1)
+    points = fit['level'] + h * fit['trend'] + np.asarray(fit['seasons'])[(history_days + h - 1) % SEASON_LENGTH]
+    # ETS(A,A,A): the h-step error is sum_{j<h} psi_j * e_{n+h-j}, with psi_0 = 1 and
+    # psi_j = alpha * (1 + j * beta) + gamma when j is a whole number of seasons
+    j = np.arange(horizon)
+    psi = alpha * (1 + j * beta) + np.where(j % SEASON_LENGTH == 0, gamma, 0.0)
+    psi[0] = 1.0
+    return points, psi
+
+def aggregate_variance(psi, sigma, first, last):
+    """Variance of the summed forecast errors for days first..last (1-based, inclusive)
+    
+    Daily errors share innovations, so the sum is not the sum of the daily variances: innovation
+    e_{n+k} enters the total with weight sum_{h=max(first,k)}^{last} psi_{h-k}.
+    """
+    cumulative = np.cumsum(psi[:last])
+    k = np.arange(1, last + 1)
+    before = first - k - 1
+    weights = cumulative[last - k] - np.where(before >= 0, cumulative[np.maximum(before, 0)], 0.0)
+    return float(sigma ** 2 * np.sum(weights * weights))
+
+def monthly_forecasts(fit, history_days, months):
+    """(predicted cost, variance) for each following 30-day month"""
+    points, psi = forecast_fit(fit, history_days, months * 30)
+    predicted = np.maximum(points.reshape(months, 30).sum(axis=1), 0.0)
+    return [
+        (float(predicted[month]), aggregate_variance(psi, fit['sigma'], month * 30 + 1, (month + 1) * 30))
+        for month in range(months)
+    ]
+
+def forecast_costs(params):
     try:
-        response = ce_client.get_cost_and_usage(
-            TimePeriod={
-                'Start': start_date.strftime('%Y-%m-%d'),
-                'End': end_date.strftime('%Y-%m-%d')
-            },
-            Granularity='MONTHLY',
-            Metrics=['UnblendedCost']
-        )
+        months_to_forecast = int(params.get('months', '3'))
+    except (TypeError, ValueError):
+        raise InvalidRequest(f"months must be an integer, got {params.get('months')!r}")
+    if months_to_forecast < 1:
+        raise InvalidRequest(f'months must be at least 1, got {months_to_forecast}')
+    history_days = max(int(params.get('history_days', '90')), 4 * SEASON_LENGTH)
+    service_filter = params.get('service', '')
+    
+    try:
+        end_date, dates, services, series = get_daily_service_matrix(history_days)
+        if service_filter:
+            keep = [k for k, svc in enumerate(services) if svc == service_filter]
+            services = [services[k] for k in keep]
+            series = [series[k] for k in keep]
         
-        monthly_costs = []
-        for result in response['ResultsByTime']:
-            cost = float(result['Total']['UnblendedCost']['Amount'])
-            monthly_costs.append(cost)
+        if not series or len(dates) < 2 * SEASON_LENGTH:
+            return {
+                'forecast_period': f'{months_to_forecast} months',
+                'current_monthly_cost': 0,
+                'forecasts': [],
+                'historical_data_points': len(dates)
+            }
         
-        if len(monthly_costs) >= 2:
-            growth_rates = []
-            for i in range(1, len(monthly_costs)):
-                if monthly_costs[i-1] > 0:
-                    rate = (monthly_costs[i] - monthly_costs[i-1]) / monthly_costs[i-1]
-                    growth_rates.append(rate)
+        fits = fit_series_batch(services, series, end_date)
+        
+        # Services are treated as independent, so their monthly variances add
+        total_by_month = [[0.0, 0.0] for _ in range(months_to_forecast)]
+        service_forecasts = []
+        for svc, values, fit in zip(services, series, fits):
+            monthly = monthly_forecasts(fit, len(dates), months_to_forecast)
+            for month, (predicted, variance) in enumerate(monthly):
+                total_by_month[month][0] += predicted
+                total_by_month[month][1] += variance
             
-            avg_growth_rate = statistics.mean(growth_rates) if growth_rates else 0
-        else:
-            avg_growth_rate = 0
+            predicted, variance = monthly[0]
+            margin = Z_95 * np.sqrt(variance)
+            service_forecasts.append({
+                'service': svc,
+                'current_monthly_cost': round(float(sum(values[-30:])), 2),
+                'next_month_cost': round(predicted, 2),
+                'lower_bound': round(max(predicted - margin, 0), 2),
+                'upper_bound': round(predicted + margin, 2),
+                'smoothing_parameters': dict(zip(('alpha', 'beta', 'gamma'), fit['params']))
+            })
         
-        current_cost = monthly_costs[-1] if monthly_costs else 0
+        current_cost = sum(sum(values[-30:]) for values in series)
         forecasts = []
-        
-        for month in range(1, months_to_forecast + 1):
-            forecasted_cost = current_cost * ((1 + avg_growth_rate) ** month)
-            
-            if len(monthly_costs) > 2:
-                cost_variance = statistics.stdev(monthly_costs) / statistics.mean(monthly_costs)
-                confidence = max(0.5, 1 - (cost_variance * month * 0.1))
-            else:
-                confidence = 0.7
-            
+        for month, (predicted, variance) in enumerate(total_by_month, start=1):
+            margin = Z_95 * np.sqrt(variance)
+            confidence = max(0.5, 1 - margin / predicted) if predicted > 0 else 0.5
             forecasts.append({
                 'month': month,
-                'predicted_cost': round(forecasted_cost, 2),
+                'predicted_cost': round(predicted, 2),
+                'lower_bound': round(max(predicted - margin, 0), 2),
+                'upper_bound': round(predicted + margin, 2),
                 'confidence': round(confidence, 2),
                 'date': (end_date + timedelta(days=30*month)).strftime('%Y-%m')
             })
         
+        next_month = total_by_month[0][0]
+        growth_rate = (next_month - current_cost) / current_cost if current_cost > 0 else 0
+        service_forecasts.sort(key=lambda x: x['next_month_cost'], reverse=True)
+        
         return {
             'forecast_period': f'{months_to_forecast} months',
+            'model': 'holt_winters_additive_weekly',
             'current_monthly_cost': round(current_cost, 2),
-            'average_growth_rate': f'{avg_growth_rate*100:.1f}%',
+            'average_growth_rate': f'{growth_rate*100:.1f}%',
             'forecasts': forecasts,
-            'historical_data_points': len(monthly_costs)
+            'services_forecasted': len(service_forecasts),
+            'service_forecasts': service_forecasts[:10],
+            'historical_data_points': len(dates)
         }
     except Exception as e:
         return {'error': f'Failed to forecast costs: {str(e)}'}
@@ -120,41 +275,30 @@ def forecast_costs(params):
 def analyze_growth_trends(params):
     service = params.get('service', '')
     
-    end_date = datetime.now().date()
-    start_date = end_date - timedelta(days=90)
-    
     try:
-        query_params = {
-            'TimePeriod': {
-                'Start': start_date.strftime('%Y-%m-%d'),
-                'End': end_date.strftime('%Y-%m-%d')
-            },
-            'Granularity': 'MONTHLY',
-            'Metrics': ['UnblendedCost'],
-            'GroupBy': [{'Type': 'DIMENSION', 'Key': 'SERVICE'}]
-        }
+        end_date, dates, services, series = get_daily_service_matrix(90)
+        if service:
+            keep = [k for k, svc in enumerate(services) if svc == service]
+            services = [services[k] for k in keep]
+            series = [series[k] for k in keep]
         
-        response = ce_client.get_cost_and_usage(**query_params)
-        
-        service_trends = {}
+        if not series or len(dates) < 2 * SEASON_LENGTH:
+            return {'analysis_period': '3 months', 'top_growing_services': [], 'declining_services': []}
         
-        for result in response['ResultsByTime']:
-            for group in result['Groups']:
-                svc = group['Keys'][0]
-                cost = float(group['Metrics']['UnblendedCost']['Amount'])
-                
-                if svc not in service_trends:
-                    service_trends[svc] = []
-                service_trends[svc].append(cost)
+        fits = fit_series_batch(services, series, end_date)
         
         growth_analysis = []
-        for svc, costs in service_trends.items():
-            if len(costs) >= 2 and costs[0] > 0:
-                growth_rate = ((costs[-1] - costs[0]) / costs[0]) * 100
+        for svc, values, fit in zip(services, series, fits):
+            initial_cost = sum(values[:30])
+            current_cost = sum(values[-30:])
+            if initial_cost > 0:
+                growth_rate = ((current_cost - initial_cost) / initial_cost) * 100
+                projected_cost = monthly_forecasts(fit, len(dates), 1)[0][0]
                 growth_analysis.append({
                     'service': svc,
-                    'initial_cost': round(costs[0], 2),
-                    'current_cost': round(costs[-1], 2),
+                    'initial_cost': round(initial_cost, 2),
+                    'current_cost': round(current_cost, 2),
+                    'projected_next_month_cost': round(projected_cost, 2),
                     'growth_percentage': round(growth_rate, 1),
                     'trend': 'increasing' if growth_rate > 0 else 'decreasing'
                 })
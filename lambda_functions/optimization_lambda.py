@@ -1,14 +1,37 @@
 import json
 import boto3
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from state_store import (
+    create_job_store, page_result, next_result_page, parse_page_size, InvalidRequest, JobRunner
+)
 
 ec2_client = boto3.client('ec2')
 cloudwatch = boto3.client('cloudwatch')
 rds_client = boto3.client('rds')
+lambda_client = boto3.client('lambda')
+
+METRIC_QUERIES_PER_REQUEST = 500
+METRIC_WORKERS = 4
+
+# Resource/metric snapshot shared by the endpoints and job stages of one invocation
+_invocation_snapshot = {}
+
+# Workers hand a job to a fresh invocation once less time than this remains
+JOB_MIN_REMAINING_MS = 30000
+
+job_store = create_job_store()
 
 def lambda_handler(event, context):
     print(f"Received event: {json.dumps(event)}")
     
+    # Every invocation collects afresh; a warm container never serves an earlier invocation's data
+    _invocation_snapshot.clear()
+    
+    # Self-invocation that advances a background job
+    if 'job_worker' in event:
+        return job_runner.run(event['job_worker'], context)
+    
     action_group = event.get('actionGroup', '')
     api_path = event.get('apiPath', '')
     http_method = event.get('httpMethod', '')
@@ -19,129 +42,226 @@ def lambda_handler(event, context):
         params[param.get('name', '')] = param.get('value', '')
     
     try:
-        if 'get_optimization_recommendations' in api_path:
+        # Reject malformed paging parameters before any work is done
+        parse_page_size(params)
+        if params.get('next_token'):
+            result = next_result_page(job_store, params)
+        elif 'get_optimization_recommendations' in api_path:
             result = get_optimization_recommendations(params)
         elif 'identify_idle_resources' in api_path:
             result = identify_idle_resources(params)
+        elif 'submit_analysis_job' in api_path:
+            result = job_runner.submit(params, context)
+        elif 'get_job_status' in api_path:
+            result = job_runner.status(params)
         else:
             result = {'error': f'Unknown path: {api_path}'}
         
-        return {
-            'messageVersion': '1.0',
-            'response': {
-                'actionGroup': action_group,
-                'apiPath': api_path,
-                'httpMethod': http_method,
-                'httpStatusCode': 200,
-                'responseBody': {
-                    'application/json': {
-                        'body': json.dumps(result)
-                    }
-                }
-            }
-        }
+        status_code = 200
+    except InvalidRequest as e:
+        result = {'error': str(e)}
+        status_code = 400
     except Exception as e:
         print(f"Error: {str(e)}")
-        return {
-            'messageVersion': '1.0',
-            'response': {
-                'actionGroup': action_group,
-                'apiPath': api_path,
-                'httpMethod': http_method,
-                'httpStatusCode': 500,
-                'responseBody': {
-                    'application/json': {
-                        'body': json.dumps({'error': str(e)})
-                    }
+        result = {'error': str(e)}
+        status_code = 500
+    
+    return {
+        'messageVersion': '1.0',
+        'response': {
+            'actionGroup': action_group,
+            'apiPath': api_path,
+            'httpMethod': http_method,
+            'httpStatusCode': status_code,
+            'responseBody': {
+                'application/json': {
+                    'body': json.dumps(result)
                 }
             }
         }
+    }
 
 def get_optimization_recommendations(params):
     resource_type = params.get('resource_type', 'all')
+    snapshot = get_resource_snapshot(
+        include_ec2=resource_type in ['all', 'ec2'],
+        include_rds=resource_type in ['all', 'rds']
+    )
     recommendations = []
     
     if resource_type in ['all', 'ec2']:
-        ec2_recs = get_ec2_recommendations()
+        ec2_recs = get_ec2_recommendations(snapshot)
         recommendations.extend(ec2_recs)
     
     if resource_type in ['all', 'rds']:
-        rds_recs = get_rds_recommendations()
+        rds_recs = get_rds_recommendations(snapshot)
         recommendations.extend(rds_recs)
     
     total_savings = sum(rec.get('estimated_monthly_savings', 0) for rec in recommendations)
+    # Stable order so continuation pages line up with the first page
+    recommendations.sort(
+        key=lambda rec: (-rec.get('estimated_monthly_savings', 0), rec['resource_type'], rec['resource_id'])
+    )
     
-    return {
+    result = {
         'total_recommendations': len(recommendations),
         'total_estimated_monthly_savings': round(total_savings, 2),
-        'recommendations': recommendations[:10]
+        'recommendations': recommendations
     }
+    # Instances without CPU datapoints are reported as having no data, not as idle
+    if resource_type in ['all', 'ec2']:
+        result['instances_without_cpu_data'] = count_instances_without_cpu_data(snapshot)
+    return page_result(job_store, result, 'recommendations', params)
 
-def get_ec2_recommendations():
-    recommendations = []
+def get_resource_snapshot(include_ec2=True, include_rds=True):
+    snapshot = dict(_invocation_snapshot)
     
-    try:
-        response = ec2_client.describe_instances(
-            Filters=[{'Name': 'instance-state-name', 'Values': ['running']}]
-        )
-        
-        for reservation in response['Reservations']:
-            for instance in reservation['Instances']:
-                instance_id = instance['InstanceId']
-                instance_type = instance['InstanceType']
-                
-                cpu_stats = get_instance_cpu_utilization(instance_id)
-                
-                if cpu_stats['average'] < 10:
-                    recommendations.append({
-                        'resource_type': 'EC2',
-                        'resource_id': instance_id,
-                        'current_type': instance_type,
-                        'recommendation': 'Terminate or stop instance',
-                        'reason': f'Low CPU utilization: {cpu_stats["average"]:.1f}%',
-                        'estimated_monthly_savings': estimate_instance_cost(instance_type),
-                        'priority': 'high'
-                    })
-                elif cpu_stats['average'] < 40:
-                    recommendations.append({
-                        'resource_type': 'EC2',
-                        'resource_id': instance_id,
-                        'current_type': instance_type,
-                        'recommendation': 'Consider downsizing',
-                        'reason': f'Moderate CPU utilization: {cpu_stats["average"]:.1f}%',
-                        'estimated_monthly_savings': estimate_instance_cost(instance_type) * 0.3,
-                        'priority': 'medium'
-                    })
-    except Exception as e:
-        print(f"Error getting EC2 recommendations: {e}")
+    # Collect whatever this request needs and the snapshot lacks, EC2 and RDS side by side.
+    # A failed describe raises, so an empty inventory is never mistaken for an empty account.
+    tasks = {}
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        if include_ec2 and 'ec2_instances' not in snapshot:
+            tasks['ec2'] = executor.submit(collect_ec2_snapshot)
+        if include_rds and 'rds_instances' not in snapshot:
+            tasks['rds'] = executor.submit(collect_rds_snapshot)
     
-    return recommendations
+    if 'ec2' in tasks:
+        instances, cpu_stats, failed_chunks = tasks['ec2'].result()
+        ec2 = {'ec2_instances': instances, 'ec2_cpu': cpu_stats}
+        snapshot.update(ec2)
+        # Metrics missing from a failed chunk serve this request only; the next stage pulls them again
+        if failed_chunks:
+            print(f"{failed_chunks} GetMetricData chunks failed; not keeping the EC2 snapshot")
+        else:
+            _invocation_snapshot.update(ec2)
+    if 'rds' in tasks:
+        snapshot['rds_instances'] = tasks['rds'].result()
+        _invocation_snapshot['rds_instances'] = snapshot['rds_instances']
+    
+    return snapshot
+
+def collect_ec2_snapshot():
+    instances = []
+    paginator = ec2_client.get_paginator('describe_instances')
+    for page in paginator.paginate(
+        Filters=[{'Name': 'instance-state-name', 'Values': ['running']}]
+    ):
+        for reservation in page['Reservations']:
+            instances.extend(reservation['Instances'])
+    
+    cpu_stats, failed_chunks = get_cpu_utilization_batch([i['InstanceId'] for i in instances])
+    return instances, cpu_stats, failed_chunks
+
+def collect_rds_snapshot():
+    db_instances = []
+    paginator = rds_client.get_paginator('describe_db_instances')
+    for page in paginator.paginate():
+        db_instances.extend(page['DBInstances'])
+    return db_instances
 
-def get_instance_cpu_utilization(instance_id, days=7):
+def get_cpu_utilization_batch(instance_ids, days=7):
     end_time = datetime.now()
     start_time = end_time - timedelta(days=days)
     
+    queries = []
+    for index, instance_id in enumerate(instance_ids):
+        for stat in ['Average', 'Maximum']:
+            queries.append({
+                'Id': f'{stat.lower()}_{index}',
+                'MetricStat': {
+                    'Metric': {
+                        'Namespace': 'AWS/EC2',
+                        'MetricName': 'CPUUtilization',
+                        'Dimensions': [{'Name': 'InstanceId', 'Value': instance_id}]
+                    },
+                    'Period': 3600,
+                    'Stat': stat
+                },
+                'ReturnData': True
+            })
+    
+    chunks = [
+        queries[i:i + METRIC_QUERIES_PER_REQUEST]
+        for i in range(0, len(queries), METRIC_QUERIES_PER_REQUEST)
+    ]
+    values = {}
+    failed_chunks = 0
+    with ThreadPoolExecutor(max_workers=METRIC_WORKERS) as executor:
+        for chunk_values in executor.map(
+            lambda chunk: fetch_metric_data(chunk, start_time, end_time), chunks
+        ):
+            if chunk_values is None:
+                failed_chunks += 1
+            else:
+                values.update(chunk_values)
+    
+    # Instances without datapoints (new, or in a failed chunk) get None, never a CPU of 0
+    cpu_stats = {}
+    for index, instance_id in enumerate(instance_ids):
+        averages = values.get(f'average_{index}', [])
+        maximums = values.get(f'maximum_{index}', [])
+        cpu_stats[instance_id] = {
+            'average': sum(averages) / len(averages),
+            'maximum': max(maximums) if maximums else None
+        } if averages else None
+    return cpu_stats, failed_chunks
+
+def fetch_metric_data(queries, start_time, end_time):
+    """Values per query id for one chunk, or None if the chunk could not be read"""
+    values = {}
     try:
-        response = cloudwatch.get_metric_statistics(
-            Namespace='AWS/EC2',
-            MetricName='CPUUtilization',
-            Dimensions=[{'Name': 'InstanceId', 'Value': instance_id}],
+        paginator = cloudwatch.get_paginator('get_metric_data')
+        for page in paginator.paginate(
+            MetricDataQueries=queries,
             StartTime=start_time,
-            EndTime=end_time,
-            Period=3600,
-            Statistics=['Average', 'Maximum']
-        )
-        
-        datapoints = response.get('Datapoints', [])
-        if datapoints:
-            avg_cpu = sum(d['Average'] for d in datapoints) / len(datapoints)
-            max_cpu = max(d['Maximum'] for d in datapoints)
-            return {'average': avg_cpu, 'maximum': max_cpu}
-        else:
-            return {'average': 0, 'maximum': 0}
+            EndTime=end_time
+        ):
+            for result in page['MetricDataResults']:
+                values.setdefault(result['Id'], []).extend(result['Values'])
     except Exception as e:
         print(f"Error getting CPU stats: {e}")
-        return {'average': 0, 'maximum': 0}
+        return None
+    return values
+
+def count_instances_without_cpu_data(snapshot):
+    return sum(
+        1 for instance in snapshot.get('ec2_instances', [])
+        if snapshot['ec2_cpu'].get(instance['InstanceId']) is None
+    )
+
+def get_ec2_recommendations(snapshot):
+    recommendations = []
+    
+    for instance in snapshot.get('ec2_instances', []):
+        instance_id = instance['InstanceId']
+        instance_type = instance['InstanceType']
+        
+        cpu_stats = snapshot['ec2_cpu'].get(instance_id)
+        if cpu_stats is None:
+            continue
+        
+        if cpu_stats['average'] < 10:
+            recommendations.append({
+                'resource_type': 'EC2',
+                'resource_id': instance_id,
+                'current_type': instance_type,
+                'recommendation': 'Terminate or stop instance',
+                'reason': f'Low CPU utilization: {cpu_stats["average"]:.1f}%',
+                'estimated_monthly_savings': estimate_instance_cost(instance_type),
+                'priority': 'high'
+            })
+        elif cpu_stats['average'] < 40:
+            recommendations.append({
+                'resource_type': 'EC2',
+                'resource_id': instance_id,
+                'current_type': instance_type,
+                'recommendation': 'Consider downsizing',
+                'reason': f'Moderate CPU utilization: {cpu_stats["average"]:.1f}%',
+                'estimated_monthly_savings': estimate_instance_cost(instance_type) * 0.3,
+                'priority': 'medium'
+            })
+    
+    return recommendations
 
 def estimate_instance_cost(instance_type):
     cost_map = {
@@ -153,26 +273,21 @@ def estimate_instance_cost(instance_type):
     }
     return round(cost_map.get(instance_type, 50), 2)
 
-def get_rds_recommendations():
+def get_rds_recommendations(snapshot):
     recommendations = []
     
-    try:
-        response = rds_client.describe_db_instances()
+    for db in snapshot.get('rds_instances', []):
+        db_id = db['DBInstanceIdentifier']
         
-        for db in response['DBInstances']:
-            db_id = db['DBInstanceIdentifier']
-            
-            if db['MultiAZ']:
-                recommendations.append({
-                    'resource_type': 'RDS',
-                    'resource_id': db_id,
-                    'recommendation': 'Review Multi-AZ necessity',
-                    'reason': 'Multi-AZ doubles cost - ensure it is needed',
-                    'estimated_monthly_savings': estimate_rds_cost(db) / 2,
-                    'priority': 'medium'
-                })
-    except Exception as e:
-        print(f"Error getting RDS recommendations: {e}")
+        if db['MultiAZ']:
+            recommendations.append({
+                'resource_type': 'RDS',
+                'resource_id': db_id,
+                'recommendation': 'Review Multi-AZ necessity',
+                'reason': 'Multi-AZ doubles cost - ensure it is needed',
+                'estimated_monthly_savings': estimate_rds_cost(db) / 2,
+                'priority': 'medium'
+            })
     
     return recommendations
 
@@ -185,30 +300,47 @@ def estimate_rds_cost(db_instance):
     return round(cost_map.get(instance_class, 100), 2)
 
 def identify_idle_resources(params):
+    snapshot = get_resource_snapshot(include_ec2=True, include_rds=False)
     idle_resources = []
     
-    try:
-        response = ec2_client.describe_instances(
-            Filters=[{'Name': 'instance-state-name', 'Values': ['running']}]
-        )
+    for instance in snapshot.get('ec2_instances', []):
+        instance_id = instance['InstanceId']
+        cpu_stats = snapshot['ec2_cpu'].get(instance_id)
+        if cpu_stats is None:
+            continue
         
-        for reservation in response['Reservations']:
-            for instance in reservation['Instances']:
-                instance_id = instance['InstanceId']
-                cpu_stats = get_instance_cpu_utilization(instance_id)
-                
-                if cpu_stats['average'] < 5:
-                    idle_resources.append({
-                        'resource_type': 'EC2',
-                        'resource_id': instance_id,
-                        'status': 'idle',
-                        'details': f'CPU usage: {cpu_stats["average"]:.1f}%',
-                        'recommended_action': 'Terminate or stop'
-                    })
-    except Exception as e:
-        print(f"Error checking idle EC2: {e}")
+        if cpu_stats['average'] < 5:
+            idle_resources.append({
+                'resource_type': 'EC2',
+                'resource_id': instance_id,
+                'status': 'idle',
+                'details': f'CPU usage: {cpu_stats["average"]:.1f}%',
+                'recommended_action': 'Terminate or stop'
+            })
     
-    return {
+    idle_resources.sort(key=lambda resource: resource['resource_id'])
+    
+    return page_result(job_store, {
         'total_idle_resources': len(idle_resources),
-        'resources': idle_resources[:10]
-    }
+        'instances_without_cpu_data': count_instances_without_cpu_data(snapshot),
+        'resources': idle_resources
+    }, 'resources', params)
+
+def collect_ec2_stage(params):
+    snapshot = get_resource_snapshot(include_ec2=True, include_rds=False)
+    return {'running_instances': len(snapshot['ec2_instances'])}
+
+def collect_rds_stage(params):
+    snapshot = get_resource_snapshot(include_ec2=False, include_rds=True)
+    return {'db_instances': len(snapshot['rds_instances'])}
+
+# Collection stages fill the invocation's snapshot so each analysis stage stays
+# short; a continuation runs in a new invocation and simply re-collects.
+JOB_STAGES = [
+    ('collect_ec2', collect_ec2_stage),
+    ('collect_rds', collect_rds_stage),
+    ('optimization_recommendations', get_optimization_recommendations),
+    ('idle_resources', identify_idle_resources)
+]
+
+job_runner = JobRunner(job_store, JOB_STAGES, JOB_MIN_REMAINING_MS, lambda_client)
@@ -0,0 +1,347 @@
+import json
+import os
+import time
+import uuid
+import zlib
+import boto3
+from datetime import datetime
+
+# The agent functions in finops-copilot/lambda-functions keep their own copy of the stores and
+# job leasing. deploy_finops_system.py zips only this directory and the agents are packaged from
+# theirs, so neither tree can import the other's module; keep the encoding and key layout in step.
+
+# DynamoDB items are capped at 400 KB; larger compressed values are spilled to S3
+MAX_ITEM_VALUE_BYTES = 350000
+SPILL_PREFIX = 'finops-state/'
+
+# Oversized result lists are returned a page at a time; the full, ordered
+# list is kept in the job store under a continuation token.
+RESULT_PAGE_SIZE = 10
+RESULT_SET_TTL_SECONDS = 3600
+
+# Long-running analyses run as background jobs checkpointed to the job store.
+# Every worker holds a lease on its job; a job whose lease runs out without a
+# checkpoint (the worker crashed or timed out) is reported as failed.
+JOB_TTL_SECONDS = 86400
+JOB_START_TIMEOUT_SECONDS = int(os.environ.get('JOB_START_TIMEOUT_SECONDS', '300'))
+JOB_LEASE_GRACE_SECONDS = 30
+# Lambda's maximum timeout, used when a job runs without an invocation context
+JOB_INLINE_LEASE_SECONDS = 900
+
+
+class InvalidRequest(ValueError):
+    """A caller error, reported back with HTTP status 400"""
+
+
+def running_in_lambda():
+    return 'AWS_LAMBDA_FUNCTION_NAME' in os.environ
+
+
+def encode_value(value):
+    return zlib.compress(json.dumps(value).encode('utf-8'))
+
+
+def decode_value(blob):
+    return json.loads(zlib.decompress(blob))
+
+
+class FileStore:
+    """Local stand-in for the shared store, one JSON file per key"""
+
+    # Each Lambda container has its own /tmp, so a file store is only shared outside Lambda
+    shared = False
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def _file(self, key):
+        return os.path.join(self.path, f'{key}.json')
+
+    def get(self, key):
+        try:
+            with open(self._file(key)) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if entry['expires_at'] < time.time():
+            return None
+        return entry['value']
+
+    def put(self, key, value, ttl):
+        tmp_file = self._file(key) + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump({'expires_at': time.time() + ttl, 'value': value}, f)
+        os.replace(tmp_file, self._file(key))
+
+
+class DynamoDBStore:
+    """Shared store in a DynamoDB table with `cache_key` as hash key and TTL on `expires_at`
+
+    Values are zlib-compressed JSON in the binary `value` attribute. Values that
+    still exceed the item limit are written to `spill_bucket` and the item keeps
+    only their S3 key.
+    """
+
+    shared = True
+
+    def __init__(self, table_name, spill_bucket=None):
+        self.table_name = table_name
+        self.spill_bucket = spill_bucket
+        self.client = boto3.client('dynamodb')
+        self.s3_client = boto3.client('s3') if spill_bucket else None
+
+    def get(self, key):
+        response = self.client.get_item(
+            TableName=self.table_name,
+            Key={'cache_key': {'S': key}}
+        )
+        item = response.get('Item')
+        # DynamoDB TTL deletion is lazy, so expiry is enforced on read as well
+        if not item or float(item['expires_at']['N']) < time.time():
+            return None
+        if 'spill_key' in item:
+            obj = self.s3_client.get_object(Bucket=self.spill_bucket, Key=item['spill_key']['S'])
+            return decode_value(obj['Body'].read())
+        return decode_value(item['value']['B'])
+
+    def put(self, key, value, ttl):
+        blob = encode_value(value)
+        item = {
+            'cache_key': {'S': key},
+            'expires_at': {'N': str(int(time.time() + ttl))}
+        }
+        if len(blob) <= MAX_ITEM_VALUE_BYTES:
+            item['value'] = {'B': blob}
+        elif self.spill_bucket:
+            spill_key = f'{SPILL_PREFIX}{key}'
+            self.s3_client.put_object(Bucket=self.spill_bucket, Key=spill_key, Body=blob)
+            item['spill_key'] = {'S': spill_key}
+        else:
+            raise ValueError(f'Value for {key} is {len(blob)} bytes compressed and no spill bucket is configured')
+        self.client.put_item(TableName=self.table_name, Item=item)
+
+
+def create_store(backend, table_name, path):
+    if backend == 'dynamodb':
+        if not table_name:
+            raise RuntimeError('The dynamodb store backend needs a table name')
+        return DynamoDBStore(table_name, os.environ.get('STATE_SPILL_BUCKET'))
+    return FileStore(path)
+
+
+def create_job_store():
+    # Job workers and continuation pages land on other containers, so Lambda needs the shared table
+    backend = os.environ.get('JOB_STORE_BACKEND', 'dynamodb' if running_in_lambda() else 'file')
+    if backend == 'file' and running_in_lambda():
+        raise RuntimeError('JOB_STORE_BACKEND=file keeps jobs in one container\'s /tmp; set JOB_TABLE and use dynamodb')
+    return create_store(backend, os.environ.get('JOB_TABLE'), os.environ.get('JOB_STORE_PATH', '/tmp/finops-jobs'))
+
+
+def lease_job(job, context=None):
+    """Mark a job running and lease it for the rest of this invocation"""
+    job['status'] = 'running'
+    if context is not None:
+        job['lease_expires_at'] = time.time() + context.get_remaining_time_in_millis() / 1000 + JOB_LEASE_GRACE_SECONDS
+    else:
+        job['lease_expires_at'] = time.time() + JOB_INLINE_LEASE_SECONDS
+
+
+def requeue_job(job):
+    """Lease a job to the queued invocation that starts or continues it"""
+    job['lease_expires_at'] = time.time() + JOB_START_TIMEOUT_SECONDS
+
+
+def expire_job(job):
+    """Fail a pending or running job whose worker let its lease run out; returns whether it changed"""
+    if job['status'] not in ['pending', 'running'] or job['lease_expires_at'] >= time.time():
+        return False
+    job['status'] = 'failed'
+    job['error'] = 'Job worker stopped before finishing (crashed or timed out); resubmit the job'
+    return True
+
+
+def parse_page_size(params):
+    try:
+        page_size = int(params.get('page_size', RESULT_PAGE_SIZE))
+    except (TypeError, ValueError):
+        raise InvalidRequest(f"page_size must be an integer, got {params.get('page_size')!r}")
+    if page_size < 1:
+        raise InvalidRequest(f'page_size must be at least 1, got {page_size}')
+    return page_size
+
+
+def page_result(store, result, items_key, params):
+    items = result[items_key]
+    is_mapping = isinstance(items, dict)
+    entries = list(items.items()) if is_mapping else list(items)
+    page_size = parse_page_size(params)
+
+    page = dict(result)
+    page[items_key] = dict(entries[:page_size]) if is_mapping else entries[:page_size]
+    if len(entries) <= page_size:
+        return page
+
+    # A token held in one container's /tmp cannot be redeemed by the next invocation
+    if running_in_lambda() and not store.shared:
+        print('Result paging needs a shared job store; returning the first page only')
+        page['truncated'] = True
+        page['total_items'] = len(entries)
+        return page
+
+    result_set_id = uuid.uuid4().hex
+    envelope = {k: v for k, v in result.items() if k != items_key}
+    try:
+        store.put(result_set_id, {
+            'envelope': envelope,
+            'items_key': items_key,
+            'is_mapping': is_mapping,
+            'entries': entries
+        }, RESULT_SET_TTL_SECONDS)
+    except Exception as e:
+        print(f"Could not store result set: {str(e)}")
+        page['truncated'] = True
+        page['total_items'] = len(entries)
+        return page
+
+    page['next_token'] = f'{result_set_id}:{page_size}'
+    return page
+
+
+def next_result_page(store, params):
+    try:
+        result_set_id, offset = params['next_token'].rsplit(':', 1)
+        offset = int(offset)
+    except ValueError:
+        raise InvalidRequest('Invalid continuation token')
+    if offset < 0:
+        raise InvalidRequest('Invalid continuation token')
+    page_size = parse_page_size(params)
+
+    result_set = store.get(result_set_id)
+    if not result_set:
+        return {'error': 'Continuation token expired; repeat the original request'}
+
+    entries = result_set['entries'][offset:offset + page_size]
+
+    page = dict(result_set['envelope'])
+    page[result_set['items_key']] = dict(entries) if result_set['is_mapping'] else entries
+    if offset + page_size < len(result_set['entries']):
+        page['next_token'] = f'{result_set_id}:{offset + page_size}'
+    return page
+
+
+class JobRunner:
+    """Runs a fixed list of (name, function) stages as a checkpointed background job
+
+    Each stage result is saved as it completes. A worker that is running short of
+    time hands the rest of the job to a fresh asynchronous self-invocation.
+    """
+
+    def __init__(self, store, stages, min_remaining_ms, lambda_client):
+        self.store = store
+        self.stages = stages
+        self.min_remaining_ms = min_remaining_ms
+        self.lambda_client = lambda_client
+
+    def save(self, job):
+        job['updated_at'] = datetime.utcnow().isoformat()
+        self.store.put(job['job_id'], job, JOB_TTL_SECONDS)
+
+    def submit(self, params, context):
+        now = datetime.utcnow().isoformat()
+        job = {
+            'job_id': uuid.uuid4().hex,
+            'status': 'pending',
+            'params': params,
+            'stages': [name for name, _ in self.stages],
+            'completed_stages': [],
+            'results': {},
+            'created_at': now,
+            'updated_at': now
+        }
+        requeue_job(job)
+        self.store.put(job['job_id'], job, JOB_TTL_SECONDS)
+        self.start_worker(job['job_id'], context)
+
+        return {
+            'job_id': job['job_id'],
+            'status': job['status'],
+            'total_stages': len(job['stages'])
+        }
+
+    def start_worker(self, job_id, context):
+        if context is None or os.environ.get('JOB_RUNNER', 'lambda') == 'inline':
+            self.run(job_id, context)
+            return
+        self.lambda_client.invoke(
+            FunctionName=context.invoked_function_arn,
+            InvocationType='Event',
+            Payload=json.dumps({'job_worker': job_id})
+        )
+
+    def run(self, job_id, context):
+        job = self.store.get(job_id)
+        if not job or job['status'] in ['completed', 'failed']:
+            return {'job_id': job_id, 'status': job['status'] if job else 'unknown'}
+
+        lease_job(job, context)
+        self.save(job)
+        try:
+            for name, stage in self.stages:
+                if name in job['completed_stages']:
+                    continue
+                # Hand the rest of the job to a fresh invocation before this one times out
+                if context is not None and context.get_remaining_time_in_millis() < self.min_remaining_ms:
+                    requeue_job(job)
+                    self.save(job)
+                    self.start_worker(job_id, context)
+                    return {'job_id': job_id, 'status': job['status']}
+
+                job['results'][name] = stage(job['params'])
+                job['completed_stages'].append(name)
+                self.save(job)
+
+            job['status'] = 'completed'
+        except Exception as e:
+            print(f"Job {job_id} failed: {str(e)}")
+            job['status'] = 'failed'
+            job['error'] = str(e)
+
+        self.save(job)
+        return {'job_id': job_id, 'status': job['status']}
+
+    def status(self, params):
+        job_id = params.get('job_id', '')
+        job = self.store.get(job_id) if job_id else None
+        if not job:
+            return {'error': f'Unknown job: {job_id}'}
+
+        # Callers stream results by passing back the cursor from the previous poll
+        try:
+            cursor = int(params.get('cursor', '0'))
+        except ValueError:
+            raise InvalidRequest(f"cursor must be an integer, got {params.get('cursor')!r}")
+        if cursor < 0:
+            raise InvalidRequest(f'cursor must not be negative, got {cursor}')
+
+        if expire_job(job):
+            self.save(job)
+
+        new_stages = job['completed_stages'][cursor:]
+
+        response = {
+            'job_id': job_id,
+            'status': job['status'],
+            'progress': {
+                'completed_stages': len(job['completed_stages']),
+                'total_stages': len(job['stages']),
+                'percentage': round(len(job['completed_stages']) / len(job['stages']) * 100, 1)
+            },
+            'results': {name: job['results'][name] for name in new_stages},
+            'cursor': len(job['completed_stages']),
+            'updated_at': job['updated_at']
+        }
+        if 'error' in job:
+            response['error'] = job['error']
+        return response
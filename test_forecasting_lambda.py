@@ -0,0 +1,111 @@
+import os
+import sys
+import json
+import unittest
+import numpy as np
+from datetime import date
+from unittest.mock import patch
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'lambda_functions'))
+
+import forecasting_lambda
+
+def bedrock_event(api_path, **params):
+    return {
+        'actionGroup': 'forecasting',
+        'apiPath': api_path,
+        'httpMethod': 'GET',
+        'parameters': [{'name': name, 'value': value} for name, value in params.items()]
+    }
+
+def reference_smooth(values, alpha, beta, gamma):
+    """One series through additive Holt-Winters, one day at a time"""
+    m = forecasting_lambda.SEASON_LENGTH
+    level = sum(values[:m]) / m
+    trend = (sum(values[m:2 * m]) - sum(values[:m])) / (m * m)
+    seasons = [value - level for value in values[:m]]
+    sse = 0.0
+    for t in range(m, len(values)):
+        season = seasons[t % m]
+        sse += (values[t] - (level + trend + season)) ** 2
+        new_level = alpha * (values[t] - season) + (1 - alpha) * (level + trend)
+        trend = beta * (new_level - level) + (1 - beta) * trend
+        seasons[t % m] = gamma * (values[t] - new_level) + (1 - gamma) * season
+        level = new_level
+    return level, trend, seasons, sse
+
+class ForecastingModelTests(unittest.TestCase):
+    """Holt-Winters fitting, forecast variance and the fit cache"""
+
+    def setUp(self):
+        forecasting_lambda._fit_cache.clear()
+        self.addCleanup(forecasting_lambda._fit_cache.clear)
+        rng = np.random.default_rng(7)
+        days = np.arange(60)
+        weekly = np.array([5.0, 3.0, 0.0, -1.0, -2.0, -2.0, -3.0])
+        self.series = [
+            (100 + 0.5 * days + weekly[days % 7] + rng.normal(0, 2, len(days))).tolist(),
+            (40 + 3 * weekly[days % 7] + rng.normal(0, 1, len(days))).tolist()
+        ]
+
+    def test_batch_recursion_matches_single_series(self):
+        """Every row of the batch follows the one-series recursion under its own parameters"""
+        batch = np.array(self.series * 2)
+        params = np.array([(0.2, 0.05, 0.1), (0.5, 0.2, 0.3), (0.8, 0.05, 0.3), (0.2, 0.2, 0.1)])
+        levels, trends, seasons, sse = forecasting_lambda.smooth_batch(batch.copy(), *params.T)
+
+        for row, (alpha, beta, gamma) in enumerate(params):
+            level, trend, season, row_sse = reference_smooth(batch[row].tolist(), alpha, beta, gamma)
+            self.assertAlmostEqual(levels[row], level)
+            self.assertAlmostEqual(trends[row], trend)
+            np.testing.assert_allclose(seasons[row], season)
+            self.assertAlmostEqual(sse[row], row_sse)
+
+    def test_monthly_variance_includes_error_covariance(self):
+        """A month's variance is the variance of the summed daily errors, not the sum of daily variances"""
+        fit = forecasting_lambda.fit_series_batch(['EC2'], self.series[:1], date(2024, 3, 1))[0]
+        _, psi = forecasting_lambda.forecast_fit(fit, 60, 60)
+
+        # Daily errors as weights on the innovations: row h - 1 holds psi_{h-k} for innovation k
+        weights = np.zeros((60, 60))
+        for h in range(1, 61):
+            for k in range(1, h + 1):
+                weights[h - 1, k - 1] = psi[h - k]
+        covariance = fit['sigma'] ** 2 * weights @ weights.T
+
+        monthly = forecasting_lambda.monthly_forecasts(fit, 60, 2)
+        self.assertAlmostEqual(monthly[0][1], covariance[:30, :30].sum())
+        self.assertAlmostEqual(monthly[1][1], covariance[30:, 30:].sum())
+        self.assertGreater(monthly[0][1], np.trace(covariance[:30, :30]))
+        self.assertAlmostEqual(forecasting_lambda.aggregate_variance(psi, fit['sigma'], 1, 1), fit['sigma'] ** 2)
+
+    def test_fit_cache_reuses_unchanged_series(self):
+        """Only series without a cached fit for the same end date and values are smoothed again"""
+        smooth = forecasting_lambda.smooth_batch
+        with patch.object(forecasting_lambda, 'smooth_batch', side_effect=smooth) as smoothed:
+            first = forecasting_lambda.fit_series_batch(['EC2', 'S3'], self.series, date(2024, 3, 1))
+            self.assertEqual(smoothed.call_count, 2)
+            self.assertEqual(forecasting_lambda.fit_series_batch(['EC2', 'S3'], self.series, date(2024, 3, 1)), first)
+            self.assertEqual(smoothed.call_count, 2)
+
+            # A restated day refits that service alone
+            restated = [self.series[0], self.series[1][:-1] + [0.0]]
+            forecasting_lambda.fit_series_batch(['EC2', 'S3'], restated, date(2024, 3, 1))
+            self.assertEqual(len(smoothed.call_args_list[-1].args[0]), 1)
+
+            forecasting_lambda.fit_series_batch(['EC2'], self.series[:1], date(2024, 3, 2))
+            self.assertEqual(smoothed.call_count, 6)
+
+    def test_months_must_be_positive(self):
+        """A non-positive or malformed horizon is a 400 and no costs are queried"""
+        with patch.object(forecasting_lambda, 'ce_client') as ce_client:
+            for months in ('0', '-2', 'three'):
+                response = forecasting_lambda.lambda_handler(bedrock_event('/forecast_costs', months=months), None)
+                self.assertEqual(response['response']['httpStatusCode'], 400)
+                body = json.loads(response['response']['responseBody']['application/json']['body'])
+                self.assertIn('months must be', body['error'])
+        ce_client.get_cost_and_usage.assert_not_called()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+import os
+import sys
+import json
+import unittest
+from unittest.mock import patch, MagicMock
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'lambda_functions'))
+
+import optimization_lambda
+
+def bedrock_event(api_path):
+    return {'actionGroup': 'optimization', 'apiPath': api_path, 'httpMethod': 'GET', 'parameters': []}
+
+def response_body(response):
+    return json.loads(response['response']['responseBody']['application/json']['body'])
+
+class OptimizationSnapshotTests(unittest.TestCase):
+    """Batched snapshot collection for the optimization endpoints, against mocked AWS clients"""
+
+    def setUp(self):
+        optimization_lambda._invocation_snapshot.clear()
+        self.addCleanup(optimization_lambda._invocation_snapshot.clear)
+        self.instance_ids = [f'i-{n:04d}' for n in range(300)]
+
+        self.ec2_client = MagicMock()
+        self.ec2_client.get_paginator.return_value.paginate.return_value = [
+            {'Reservations': [{'Instances': [
+                {'InstanceId': instance_id, 'InstanceType': 'm5.large'} for instance_id in self.instance_ids
+            ]}]}
+        ]
+        self.cloudwatch = MagicMock()
+        self.metric_calls = []
+        self.failing_chunks = set()
+        self.cloudwatch.get_paginator.return_value.paginate.side_effect = self.get_metric_data
+        for name in ('ec2_client', 'cloudwatch'):
+            patcher = patch.object(optimization_lambda, name, getattr(self, name))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def get_metric_data(self, MetricDataQueries, StartTime, EndTime):
+        chunk = len(self.metric_calls)
+        self.metric_calls.append([query['Id'] for query in MetricDataQueries])
+        if chunk in self.failing_chunks:
+            raise Exception('Throttling')
+        # Instance n averages n % 50 percent CPU
+        return [{'MetricDataResults': [
+            {'Id': query['Id'], 'Values': [float(int(query['Id'].split('_')[1]) % 50)]}
+            for query in MetricDataQueries
+        ]}]
+
+    def test_metric_queries_are_chunked_and_mapped_back(self):
+        """Average and maximum queries go out 500 at a time and land on the right instances"""
+        snapshot = optimization_lambda.get_resource_snapshot(include_ec2=True, include_rds=False)
+
+        self.assertEqual(sorted(len(ids) for ids in self.metric_calls), [100, 500])
+        self.assertEqual(len({query_id for ids in self.metric_calls for query_id in ids}), 600)
+        self.assertEqual(snapshot['ec2_cpu']['i-0000'], {'average': 0.0, 'maximum': 0.0})
+        self.assertEqual(snapshot['ec2_cpu']['i-0299'], {'average': 49.0, 'maximum': 49.0})
+
+        # The rest of the invocation reuses the snapshot
+        optimization_lambda.get_resource_snapshot(include_ec2=True, include_rds=False)
+        self.assertEqual(len(self.metric_calls), 2)
+        self.assertEqual(self.ec2_client.get_paginator.return_value.paginate.call_count, 1)
+
+    def test_failed_chunk_reports_no_data_and_is_not_kept(self):
+        """Instances in a failed chunk are neither idle nor recommended, and the next stage pulls again"""
+        self.failing_chunks = {1}
+        with patch.object(optimization_lambda, 'METRIC_WORKERS', 1):
+            result = optimization_lambda.identify_idle_resources({'page_size': '1000'})
+
+        # Chunk 1 holds the queries for instances 250-299
+        self.assertEqual(result['instances_without_cpu_data'], 50)
+        self.assertEqual(result['total_idle_resources'], 5 * 5)
+        self.assertTrue(all(resource['resource_id'] < 'i-0250' for resource in result['resources']))
+        self.assertNotIn('ec2_instances', optimization_lambda._invocation_snapshot)
+
+        self.failing_chunks = set()
+        with patch.object(optimization_lambda, 'METRIC_WORKERS', 1):
+            result = optimization_lambda.identify_idle_resources({'page_size': '1000'})
+        self.assertEqual(result['instances_without_cpu_data'], 0)
+        self.assertEqual(result['total_idle_resources'], 6 * 5)
+
+    def test_snapshot_is_scoped_to_one_invocation(self):
+        """Each invocation describes and pulls metrics again; a failed describe is an error, not an empty fleet"""
+        optimization_lambda.lambda_handler(bedrock_event('/identify_idle_resources'), None)
+        optimization_lambda.lambda_handler(bedrock_event('/identify_idle_resources'), None)
+        self.assertEqual(self.ec2_client.get_paginator.return_value.paginate.call_count, 2)
+
+        self.ec2_client.get_paginator.return_value.paginate.side_effect = Exception('RequestLimitExceeded')
+        response = optimization_lambda.lambda_handler(bedrock_event('/identify_idle_resources'), None)
+        self.assertEqual(response['response']['httpStatusCode'], 500)
+        self.assertEqual(response_body(response), {'error': 'RequestLimitExceeded'})
+
+if __name__ == '__main__':
+    unittest.main()